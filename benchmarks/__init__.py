@@ -0,0 +1,182 @@
+# artwork-indexer - update artwork index files at the Internet Archive
+#
+# Copyright (C) 2026  MetaBrainz Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# Shared helpers for the scripts in this directory. The benchmarks are
+# run from the repository root, e.g.:
+#
+#   poetry run python -m benchmarks.throughput --config=config.tests.ini
+#
+# They TRUNCATE `artwork_indexer.event_queue` (and `uploaded_file`, so
+# that every run uploads the same files), so only ever point them at a
+# test database.
+
+import argparse
+import asyncio
+import configparser
+import contextlib
+import logging
+import resource
+import time
+from textwrap import dedent
+
+
+STUB_CHUNK_SIZE = 64 * 1024
+
+
+class StubResponse:
+    """
+    A response with a body of `size` bytes, allocated anew as it's read,
+    as a real response's would be.
+    """
+
+    status_code = 200
+    text = ''
+
+    def __init__(self, size=0):
+        self.size = size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    @property
+    def content(self):
+        return b''.join(self.iter_content(STUB_CHUNK_SIZE))
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size):
+        for offset in range(0, self.size, chunk_size):
+            yield bytes(min(chunk_size, self.size - offset))
+
+    async def aiter_bytes(self, chunk_size):
+        for chunk in self.iter_content(chunk_size):
+            yield chunk
+
+
+class StubSession:
+    """
+    Stands in for `requests.Session`: every request succeeds after
+    `latency` seconds, without touching the network. GET responses have
+    a body of `response_size` bytes, and uploaded bodies are read (in
+    chunks, if they're streamed) and discarded.
+    """
+
+    def __init__(self, latency=0, response_size=0):
+        self.headers = {}
+        self.latency = latency
+        self.response_size = response_size
+
+    def _respond(self, size=0):
+        if self.latency:
+            time.sleep(self.latency)
+        return StubResponse(size)
+
+    def get(self, url, **kwargs):
+        return self._respond(self.response_size)
+
+    def put(self, url, **kwargs):
+        data = kwargs.get('data')
+        if hasattr(data, 'read'):
+            while data.read(STUB_CHUNK_SIZE):
+                pass
+        return self._respond()
+
+    def delete(self, url, **kwargs):
+        return self._respond()
+
+    def close(self):
+        pass
+
+
+class StubAsyncSession:
+    """
+    Stands in for `httpx.AsyncClient`, like `StubSession` does for the
+    sync engine.
+    """
+
+    def __init__(self, latency=0, response_size=0):
+        self.headers = {}
+        self.latency = latency
+        self.response_size = response_size
+
+    async def request(self, method, url, **kwargs):
+        content = kwargs.get('content')
+        if hasattr(content, '__aiter__'):
+            async for _chunk in content:
+                pass
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return StubResponse(self.response_size if method == 'GET' else 0)
+
+    @contextlib.asynccontextmanager
+    async def stream(self, method, url, **kwargs):
+        yield await self.request(method, url, **kwargs)
+
+    async def aclose(self):
+        pass
+
+
+def make_arg_parser(description):
+    arg_parser = argparse.ArgumentParser(description=description)
+    arg_parser.add_argument('--config',
+                            help='path to config file',
+                            dest='config',
+                            type=str,
+                            default='config.tests.ini')
+    return arg_parser
+
+
+def load_config(path):
+    # Per-event logging would dominate the timings.
+    logging.getLogger().setLevel(logging.WARNING)
+
+    config = configparser.ConfigParser()
+    config.read(path)
+    return config
+
+
+def reset_event_queue(pg_conn):
+    pg_conn.execute_and_commit(dedent('''
+        TRUNCATE artwork_indexer.event_queue CASCADE;
+        TRUNCATE artwork_indexer.uploaded_file;
+    '''))
+
+
+def queue_index_events(pg_conn, count, entity_type='release'):
+    # The gids needn't exist: `index` then uploads an empty image list,
+    # which exercises the full handler without any fixture data.
+    pg_conn.execute_and_commit(dedent('''
+        INSERT INTO artwork_indexer.event_queue
+                (entity_type, action, message)
+             SELECT %(entity_type)s, 'index',
+                    jsonb_build_object('gid', md5(i::text)::uuid)
+               FROM generate_series(1, %(count)s) AS i
+    '''), {'entity_type': entity_type, 'count': count})
+
+
+def report(label, event_count, seconds):
+    # The peak RSS is for the whole process so far, so only compare it
+    # between separate runs.
+    max_rss_mib = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print('%-32s %8d events in %8.3fs  %10.1f events/s  %7.1f MiB max RSS' % (
+        label, event_count, seconds, event_count / seconds, max_rss_mib,
+    ))
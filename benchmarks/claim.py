@@ -0,0 +1,171 @@
+# artwork-indexer - update artwork index files at the Internet Archive
+#
+# Copyright (C) 2026  MetaBrainz Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# Measures how long `claim_events` takes with a large queue, most of which
+# is made up of events waiting to be retried. They're older than the
+# events that are due, so they're the first ones a scan in creation
+# order would hit. Optionally, the oldest of the due events depend on
+# events that are waiting to be retried, like the long chains of
+# copy_image, delete_image and index events queued by release merges.
+# Completed events can be added as well, to check that the history kept
+# doesn't slow claims down.
+
+import time
+from textwrap import dedent
+
+import indexer
+from pg_conn_wrapper import PgConnWrapper
+from . import (
+    load_config,
+    make_arg_parser,
+    report,
+    reset_event_queue,
+)
+
+
+def queue_events(pg_conn, count, retrying_count, blocked_count=0):
+    pg_conn.execute_and_commit(dedent('''
+        INSERT INTO artwork_indexer.event_queue
+                (entity_type, action, message, attempts, created,
+                 next_attempt_at)
+             SELECT 'release', 'index',
+                    jsonb_build_object('gid', md5(i::text)::uuid),
+                    attempts,
+                    now() - interval '1 day' + (interval '1 ms' * i),
+                    now() + (interval '1 hour' * attempts)
+               FROM generate_series(1, %(count)s) AS i,
+                    LATERAL (
+                        SELECT CASE WHEN i <= %(retrying_count)s
+                                    THEN 1 + (i %% 4)
+                                    ELSE 0
+                                END AS attempts
+                    ) AS a
+    '''), {'count': count, 'retrying_count': retrying_count})
+    # The events were numbered in order, so the Nth due event depends on
+    # the Nth retrying one.
+    pg_conn.execute_and_commit(dedent('''
+        WITH first_due AS (
+            SELECT min(id) AS id
+              FROM artwork_indexer.event_queue
+             WHERE attempts = 0
+        )
+        INSERT INTO artwork_indexer.event_dependency (parent, child)
+             SELECT eq.id - %(retrying_count)s, eq.id
+               FROM artwork_indexer.event_queue eq, first_due
+              WHERE eq.id >= first_due.id
+                AND eq.id < first_due.id + %(blocked_count)s
+    '''), {'retrying_count': retrying_count, 'blocked_count': blocked_count})
+    pg_conn.execute_and_commit('ANALYZE artwork_indexer.event_queue')
+    pg_conn.execute_and_commit('ANALYZE artwork_indexer.event_dependency')
+
+
+def queue_completed_events(pg_conn, count):
+    # Spread over the 90 days they're kept for.
+    pg_conn.execute_and_commit(dedent('''
+        SELECT artwork_indexer.create_event_partitions(
+                   now() - (interval '1 day' * d))
+          FROM generate_series(0, 90) AS d
+    '''))
+    pg_conn.execute_and_commit(dedent('''
+        INSERT INTO artwork_indexer.event_queue
+                (state, entity_type, action, message, attempts, created,
+                 completed_at)
+             SELECT 'completed', 'release', 'index',
+                    jsonb_build_object('gid', md5(i::text)::uuid),
+                    1,
+                    completed_at - interval '1 minute',
+                    completed_at
+               FROM generate_series(1, %(count)s) AS i,
+                    LATERAL (
+                        SELECT now() - (interval '90 days' * i / %(count)s)
+                                   AS completed_at
+                    ) AS c
+    '''), {'count': count})
+
+
+def main():
+    arg_parser = make_arg_parser('measure claim latency with a large queue')
+    arg_parser.add_argument('--events',
+                            help='number of events to queue',
+                            dest='events',
+                            type=int,
+                            default=1_000_000)
+    arg_parser.add_argument('--retrying',
+                            help='fraction of the events waiting to be '
+                                 'retried',
+                            dest='retrying',
+                            type=float,
+                            default=0.9)
+    arg_parser.add_argument('--blocked',
+                            help='fraction of the events that are due, '
+                                 'but depend on an event waiting to be '
+                                 'retried',
+                            dest='blocked',
+                            type=float,
+                            default=0)
+    arg_parser.add_argument('--completed',
+                            help='number of completed events to add',
+                            dest='completed',
+                            type=int,
+                            default=0)
+    arg_parser.add_argument('--claims',
+                            help='number of claims to time',
+                            dest='claims',
+                            type=int,
+                            default=200)
+    arg_parser.add_argument('--claim-batch-size',
+                            help='number of events to claim at a time',
+                            dest='claim_batch_size',
+                            type=int,
+                            default=1)
+    args = arg_parser.parse_args()
+
+    config = load_config(args.config)
+    pg_conn = PgConnWrapper(config)
+
+    reset_event_queue(pg_conn)
+    queue_completed_events(pg_conn, args.completed)
+    retrying_count = int(args.events * args.retrying)
+    queue_events(pg_conn, args.events, retrying_count,
+                 int((args.events - retrying_count) * args.blocked))
+
+    claimed_count = 0
+    elapsed = 0
+    for _ in range(args.claims):
+        start = time.monotonic()
+        events = indexer.claim_events(pg_conn, args.claim_batch_size)
+        elapsed += time.monotonic() - start
+        claimed_count += len(events)
+
+        # Complete them (untimed), as the indexer would, so that running
+        # events don't pile up.
+        pg_conn.execute_and_commit(dedent('''
+            UPDATE artwork_indexer.event_queue
+               SET state = 'completed'
+             WHERE id = any(%(ids)s)
+        '''), {'ids': [event['id'] for event in events]})
+
+    report(f'claim (batch={args.claim_batch_size})', claimed_count, elapsed)
+    print('%.3f ms per claim' % (elapsed * 1000 / args.claims))
+
+    reset_event_queue(pg_conn)
+    pg_conn.close()
+
+
+if __name__ == '__main__':
+    main()
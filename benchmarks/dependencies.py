@@ -0,0 +1,170 @@
+# artwork-indexer - update artwork index files at the Internet Archive
+#
+# Copyright (C) 2026  MetaBrainz Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# Measures how long it takes to push an event's completion or failure to
+# the events depending on it, with a large queue made up of long chains
+# of dependent events, like those queued by repeated release merges
+# (copy_image, then delete_image, then index, and so on). Most of the
+# chains have completed, as they'd be kept around for 90 days.
+
+import time
+from textwrap import dedent
+
+import indexer
+from pg_conn_wrapper import PgConnWrapper
+from . import (
+    load_config,
+    make_arg_parser,
+    reset_event_queue,
+)
+
+
+def queue_chains(pg_conn, count, chain_length, completed_count):
+    # Event i is the (i %% chain_length)th link of its chain, and depends
+    # on event i - 1 unless it's the first. The first `completed_count`
+    # events have completed (so their dependencies are gone).
+    pg_conn.execute_and_commit(dedent('''
+        INSERT INTO artwork_indexer.event_queue
+                (id, state, entity_type, action, message, completed_at)
+             SELECT i,
+                    CASE WHEN completed
+                         THEN 'completed'
+                         ELSE 'queued'
+                     END::artwork_indexer.event_state,
+                    'release',
+                    (ARRAY['copy_image', 'delete_image', 'index'])[
+                        1 + (i %% %(chain_length)s) %% 3
+                    ]::artwork_indexer.event_queue_action,
+                    jsonb_build_object('gid', md5(i::text)::uuid,
+                                       'artwork_id', i),
+                    CASE WHEN completed
+                         THEN now()
+                         ELSE 'infinity'
+                     END
+               FROM generate_series(0, %(count)s - 1) AS i,
+                    LATERAL (
+                        SELECT i < %(completed_count)s AS completed
+                    ) AS c
+    '''), {
+        'count': count,
+        'chain_length': chain_length,
+        'completed_count': completed_count,
+    })
+    pg_conn.execute_and_commit(dedent('''
+        INSERT INTO artwork_indexer.event_dependency (parent, child)
+             SELECT i - 1, i
+               FROM generate_series(0, %(count)s - 1) AS i
+              WHERE i %% %(chain_length)s != 0
+                AND i >= %(completed_count)s
+    '''), {
+        'count': count,
+        'chain_length': chain_length,
+        'completed_count': completed_count,
+    })
+    pg_conn.execute_and_commit('ANALYZE artwork_indexer.event_queue')
+    pg_conn.execute_and_commit('ANALYZE artwork_indexer.event_dependency')
+
+
+def main():
+    arg_parser = make_arg_parser(
+        'measure dependency propagation with a large queue')
+    arg_parser.add_argument('--events',
+                            help='number of events to queue',
+                            dest='events',
+                            type=int,
+                            default=10_000_000)
+    arg_parser.add_argument('--chain-length',
+                            help='number of events in each chain',
+                            dest='chain_length',
+                            type=int,
+                            default=100)
+    arg_parser.add_argument('--completed',
+                            help='fraction of the chains that have '
+                                 'completed',
+                            dest='completed',
+                            type=float,
+                            default=0.8)
+    arg_parser.add_argument('--chains',
+                            help='number of chains to fail, and to '
+                                 'complete the first event of',
+                            dest='chains',
+                            type=int,
+                            default=20)
+    args = arg_parser.parse_args()
+
+    config = load_config(args.config)
+    pg_conn = PgConnWrapper(config)
+
+    chain_count = args.events // args.chain_length
+    completed_chain_count = int(chain_count * args.completed)
+    if chain_count - completed_chain_count < args.chains * 2:
+        arg_parser.error('not enough queued chains for --chains')
+
+    reset_event_queue(pg_conn)
+    start = time.monotonic()
+    queue_chains(pg_conn, chain_count * args.chain_length,
+                 args.chain_length,
+                 completed_chain_count * args.chain_length)
+    print('queued %d events in %.1fs' % (
+        chain_count * args.chain_length, time.monotonic() - start))
+
+    queued_heads = [
+        chain * args.chain_length
+        for chain in range(completed_chain_count, chain_count)
+    ]
+
+    # Fail the first event of some chains, as `handle_event_failure`
+    # does, which fails the rest of each chain.
+    elapsed = 0
+    for event_id in queued_heads[:args.chains]:
+        pg_conn.execute_and_commit(dedent('''
+            UPDATE artwork_indexer.event_queue
+               SET state = 'failed'
+             WHERE id = %(event_id)s
+        '''), {'event_id': event_id})
+        start = time.monotonic()
+        pg_conn.execute_and_commit(indexer.FAIL_DEPENDENT_EVENTS_QUERY, {
+            'event_id': event_id,
+            'failure_reason': 'benchmark',
+        })
+        elapsed += time.monotonic() - start
+    print('%.3f ms per chain failed (%d events each)' % (
+        elapsed * 1000 / args.chains, args.chain_length))
+
+    # Complete the first event of some others, which unblocks the next.
+    elapsed = 0
+    for event_id in queued_heads[args.chains:args.chains * 2]:
+        pg_conn.execute_and_commit(dedent('''
+            UPDATE artwork_indexer.event_queue
+               SET state = 'running'
+             WHERE id = %(event_id)s
+        '''), {'event_id': event_id})
+        start = time.monotonic()
+        pg_conn.execute_and_commit(indexer.COMPLETE_EVENT_QUERY, {
+            'event_id': event_id,
+            'worker_id': None,
+        })
+        elapsed += time.monotonic() - start
+    print('%.3f ms per event completed' % (elapsed * 1000 / args.chains))
+
+    reset_event_queue(pg_conn)
+    pg_conn.close()
+
+
+if __name__ == '__main__':
+    main()
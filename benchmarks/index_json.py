@@ -0,0 +1,167 @@
+# artwork-indexer - update artwork index files at the Internet Archive
+#
+# Copyright (C) 2026  MetaBrainz Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# Compares how long it takes to render a release's index.json, and the
+# peak memory (as traced by `tracemalloc`) that takes, for a release with
+# many images, in each of these ways:
+#
+#   python    `build_index_json` from the rows of
+#             `fetch_image_rows_batch` (as prefetched for a claimed
+#             batch), encoded for upload
+#   streamed  `write_index_json` from a server-side cursor into a
+#             `SpooledContent`, as `index_images` does
+#   database  `render_index_json` (`index_json_renderer = database`)
+#
+# The release is one from tests/caa_setup.sql, which is loaded first and
+# torn down afterwards.
+
+import hashlib
+import os.path
+import time
+import tracemalloc
+from textwrap import dedent
+
+from handlers import EVENT_HANDLER_CLASSES
+from handlers_base import SpooledContent
+from pg_conn_wrapper import PgConnWrapper
+from . import (
+    load_config,
+    make_arg_parser,
+    reset_event_queue,
+)
+
+
+RELEASE_MBID = '16ebbc86-670c-4ad3-980b-bfbd1eee4ff4'
+
+TESTS_DIR = os.path.join(os.path.dirname(__file__), '..', 'tests')
+
+
+def run_tests_sql_file(pg_conn, file_name):
+    with open(os.path.join(TESTS_DIR, file_name), 'r') as fp:
+        pg_conn.execute_and_commit(fp.read())
+
+
+def add_images(pg_conn, count):
+    # Alternating types, and a non-ASCII comment on every image, which
+    # has to be escaped.
+    pg_conn.execute_and_commit(dedent('''
+        INSERT INTO cover_art_archive.cover_art
+                (id, release, mime_type, edit, ordering, comment)
+             SELECT 1000 + i, 1, 'image/jpeg', 1, 1 + i, 'página ' || i
+               FROM generate_series(1, %(count)s) AS i
+    '''), {'count': count})
+    pg_conn.execute_and_commit(dedent('''
+        INSERT INTO cover_art_archive.cover_art_type (id, type_id)
+             SELECT 1000 + i, 3 + (i %% 2)
+               FROM generate_series(1, %(count)s) AS i
+    '''), {'count': count})
+
+
+def time_renderer(render, iterations):
+    start = time.monotonic()
+    for _ in range(iterations):
+        render()
+    return time.monotonic() - start
+
+
+def trace_peak_memory(render):
+    tracemalloc.start()
+    try:
+        render()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def main():
+    arg_parser = make_arg_parser(
+        'compare rendering index.json in Python and in the database')
+    arg_parser.add_argument('--images',
+                            help='number of images the release has',
+                            dest='images',
+                            type=int,
+                            default=500)
+    arg_parser.add_argument('--iterations',
+                            help='number of times to render it',
+                            dest='iterations',
+                            type=int,
+                            default=200)
+    args = arg_parser.parse_args()
+
+    config = load_config(args.config)
+    pg_conn = PgConnWrapper(config)
+    handler = EVENT_HANDLER_CLASSES['release'](config, None)
+
+    run_tests_sql_file(pg_conn, 'caa_setup.sql')
+    add_images(pg_conn, args.images)
+    # The images' triggers queued index events.
+    reset_event_queue(pg_conn)
+
+    # Each returns the SHA-256 of what would be uploaded, which doesn't
+    # count against the streamed renderer's memory use as reading it
+    # back would.
+    def render_in_python():
+        return hashlib.sha256(handler.build_index_json(
+            RELEASE_MBID,
+            handler.fetch_image_rows_batch(
+                pg_conn,
+                [RELEASE_MBID],
+            )[RELEASE_MBID],
+        ).encode('utf-8')).digest()
+
+    def render_streamed():
+        with SpooledContent() as content:
+            handler.write_index_json(
+                RELEASE_MBID,
+                handler.iter_image_rows(pg_conn, RELEASE_MBID),
+                content,
+            )
+            return content.sha256.digest()
+
+    def render_in_database():
+        return hashlib.sha256(handler.render_index_json(
+            pg_conn,
+            RELEASE_MBID,
+        ).encode('utf-8')).digest()
+
+    renderers = (
+        ('python', render_in_python),
+        ('streamed', render_streamed),
+        ('database', render_in_database),
+    )
+
+    index_json_sha256 = render_in_python()
+    for label, render in renderers[1:]:
+        if render() != index_json_sha256:
+            arg_parser.exit(1, f'the {label} renderer disagrees\n')
+    print('%d images' % (args.images + 1))
+
+    for label, render in renderers:
+        elapsed = time_renderer(render, args.iterations)
+        peak_memory = trace_peak_memory(render)
+        print('%-8s %8.3f ms per index.json, %8.1f KiB peak memory' % (
+            label, elapsed * 1000 / args.iterations, peak_memory / 1024))
+
+    pg_conn.rollback()
+    run_tests_sql_file(pg_conn, 'caa_teardown.sql')
+    reset_event_queue(pg_conn)
+    pg_conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+# artwork-indexer - update artwork index files at the Internet Archive
+#
+# Copyright (C) 2026  MetaBrainz Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# Measures how fast a single `indexer` loop drains a backlog of `index`
+# events, with the HTTP session replaced by a stub. Run it on two
+# checkouts to compare them.
+#
+# With `--latency`, every stubbed request takes that long, roughly like
+# talking to the IA. Passing several `--concurrency` values then shows
+# how throughput scales with the number of worker threads, e.g.:
+#
+#   python -m benchmarks.throughput --latency=0.05 --concurrency 1 2 4 8
+#
+# `--engine=async` measures the asyncio engine instead, which can be run
+# with much higher concurrency. Run each engine in a separate process to
+# compare their memory use.
+#
+# `--metadata-size` makes each stubbed MB web service response that many
+# bytes, to see how peak memory use grows with large metadata XML and
+# concurrency, e.g.:
+#
+#   python -m benchmarks.throughput --metadata-size=50000000 \
+#       --latency=0.05 --concurrency 16
+
+import asyncio
+import functools
+import time
+
+import indexer
+import indexer_async
+from pg_conn_wrapper import AsyncPgConnWrapper, PgConnWrapper
+from . import (
+    StubAsyncSession,
+    StubSession,
+    load_config,
+    make_arg_parser,
+    queue_index_events,
+    report,
+    reset_event_queue,
+)
+
+
+def main():
+    arg_parser = make_arg_parser('measure indexer throughput (events/s)')
+    arg_parser.add_argument('--events',
+                            help='number of index events to queue',
+                            dest='events',
+                            type=int,
+                            default=200)
+    arg_parser.add_argument('--claim-batch-size',
+                            help='number of events to claim at a time',
+                            dest='claim_batch_size',
+                            type=int,
+                            default=1)
+    arg_parser.add_argument('--concurrency',
+                            help='number(s) of concurrent events to measure',
+                            dest='concurrency',
+                            type=int,
+                            nargs='+',
+                            default=[1])
+    arg_parser.add_argument('--latency',
+                            help='seconds each stubbed HTTP request takes',
+                            dest='latency',
+                            type=float,
+                            default=0)
+    arg_parser.add_argument('--metadata-size',
+                            help='bytes of metadata XML each stubbed '
+                                 'GET returns',
+                            dest='metadata_size',
+                            type=int,
+                            default=0)
+    arg_parser.add_argument('--engine',
+                            help='which engine to measure',
+                            dest='engine',
+                            choices=('sync', 'async'),
+                            default='sync')
+    args = arg_parser.parse_args()
+
+    config = load_config(args.config)
+    # `indexer` closes the connection when it's done, but the wrapper
+    # reconnects on the next query.
+    pg_conn = PgConnWrapper(config)
+
+    for concurrency in args.concurrency:
+        reset_event_queue(pg_conn)
+        queue_index_events(pg_conn, args.events)
+
+        start = time.monotonic()
+        if args.engine == 'async':
+            asyncio.run(indexer_async.indexer(
+                config,
+                AsyncPgConnWrapper(config),
+                1,
+                max_idle_loops=1,
+                http_client_cls=functools.partial(
+                    StubAsyncSession,
+                    latency=args.latency,
+                    response_size=args.metadata_size,
+                ),
+                claim_batch_size=args.claim_batch_size,
+                concurrency=concurrency,
+            ))
+        else:
+            indexer.indexer(config, pg_conn, 1,
+                            max_idle_loops=1,
+                            http_client_cls=functools.partial(
+                                StubSession,
+                                latency=args.latency,
+                                response_size=args.metadata_size,
+                            ),
+                            claim_batch_size=args.claim_batch_size,
+                            concurrency=concurrency)
+        elapsed = time.monotonic() - start
+
+        report(f'{args.engine} (concurrency={concurrency})',
+               args.events, elapsed)
+
+    reset_event_queue(pg_conn)
+    pg_conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+# artwork-indexer - update artwork index files at the Internet Archive
+#
+# Copyright (C) 2026  MetaBrainz Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import asyncio
+import logging
+import os
+import time
+
+# Named points in the `indexer` event loop where tests can inject a
+# fault, e.g. a delay to widen a race window, or a crash. The hook at
+# `before_claim_commit`, which runs while the claim's transaction is still
+# open, is passed the list of claimed events rather than a single one.
+INJECTION_POINTS = (
+    'before_claim_commit',
+    'after_claim',
+    'before_handler',
+    'after_handler',
+)
+
+# Faults may be configured in the `[fault_injection]` section of the
+# config file, one `point = fault` per line, or through this environment
+# variable as a comma-separated list of `point=fault` pairs. The latter
+# takes precedence. Supported faults are:
+#
+#   sleep:SECONDS   pause the loop
+#   fail            raise an `InjectedFault`
+#   exit[:STATUS]   terminate the process immediately, without cleanup
+FAULT_INJECTION_ENV_VAR = 'ARTWORK_INDEXER_FAULTS'
+
+
+class InjectedFault(Exception):
+    pass
+
+
+def parse_fault(point, spec):
+    action, _, arg = spec.strip().partition(':')
+
+    if action == 'sleep':
+        seconds = float(arg)
+
+        def hook(event):
+            time.sleep(seconds)
+    elif action == 'fail':
+        def hook(event):
+            raise InjectedFault(f'Injected fault at {point}')
+    elif action == 'exit':
+        status = int(arg or 1)
+
+        def hook(event):
+            os._exit(status)
+    else:
+        raise ValueError(f'Unknown fault for {point}: {spec!r}')
+
+    return hook
+
+
+def load_fault_hooks(config):
+    specs = {}
+
+    if 'fault_injection' in config:
+        specs.update(config['fault_injection'])
+
+    env_specs = os.environ.get(FAULT_INJECTION_ENV_VAR)
+    if env_specs:
+        for item in env_specs.split(','):
+            point, _, spec = item.partition('=')
+            specs[point.strip()] = spec
+
+    hooks = {}
+    for point, spec in specs.items():
+        if point not in INJECTION_POINTS:
+            raise ValueError(f'Unknown fault injection point: {point}')
+        hooks[point] = parse_fault(point, spec)
+        logging.warning('Fault injection enabled: %s=%s', point, spec)
+    return hooks
+
+
+def inject_fault(hooks, point, event):
+    # Callers check `if hooks:` first, so nothing is done (not even
+    # this call) when fault injection is disabled.
+    hook = hooks.get(point)
+    if hook is not None:
+        hook(event)
+
+
+async def inject_fault_async(hooks, point, event):
+    # For the async engine. The hook runs in a thread, so that a `sleep`
+    # fault only delays this event rather than the whole event loop.
+    hook = hooks.get(point)
+    if hook is not None:
+        await asyncio.to_thread(hook, event)
@@ -31,6 +31,12 @@ TG_OP_FULLNAMES = {
     'del': 'DELETE',
 }
 
+# Channel on which the triggers notify idle indexers of new events.
+# Postgres folds identical notifications sent within a transaction into
+# one, so a single edit touching many entities wakes the indexer once.
+NOTIFY_CHANNEL = 'artwork_indexer'
+NOTIFY_STMT = f"PERFORM pg_notify('{NOTIFY_CHANNEL}', '');"
+
 indent_level = 1
 def indent():
     global indent_level
@@ -62,6 +68,12 @@ for project in PROJECTS:
     # event_art_archive schema.
     q_image_type_table = 'cover_art_archive.image_type'
 
+    # Changes to the artwork only affect index.json, unless the entity's
+    # web service XML summarizes its artwork too (see projects.py).
+    artwork_index_action = (
+        'index' if project['ws_artwork_summary'] else 'index_images'
+    )
+
     extra_functions_source = ''
     extra_triggers_source = ''
     indent_level = 1
@@ -95,7 +107,7 @@ for project in PROJECTS:
 
             indent_level += 1
             extra_functions_source += ' (\n'
-            extra_functions_source += f"{indent()}SELECT '{entity_type}', 'index', jsonb_build_object('gid', {q_entity_table}.gid)\n"
+            extra_functions_source += f"{indent()}SELECT '{entity_type}', 'index_metadata', jsonb_build_object('gid', {q_entity_table}.gid)\n"
             extra_functions_source += f'{indent()}FROM {q_entity_table}\n'
 
             for join in im.get('joins', ()):
@@ -121,10 +133,29 @@ for project in PROJECTS:
             if im_condition:
                 extra_functions_source += f'{indent()}AND {im_condition.format(tg_rowvar=tg_rowvar)}\n'
 
+            # A queued `index` event will reindex the metadata anyway.
+            extra_functions_source += f'{indent()}AND NOT EXISTS (\n'
+            indent_level += 1
+            extra_functions_source += f'{indent()}SELECT 1 FROM artwork_indexer.event_queue\n'
+            extra_functions_source += f"{indent()}WHERE state = 'queued'\n"
+            extra_functions_source += f"{indent()}AND entity_type = '{entity_type}'\n"
+            extra_functions_source += f"{indent()}AND action = 'index'\n"
+            extra_functions_source += f"{indent()}AND message = jsonb_build_object('gid', {q_entity_table}.gid)\n"
             indent_level -= 1
             extra_functions_source += f'{indent()})\n'
 
-            extra_functions_source += f'{indent()}ON CONFLICT DO NOTHING;\n'
+            indent_level -= 1
+            extra_functions_source += f'{indent()})\n'
+
+            extra_functions_source += f'{indent()}ON CONFLICT DO NOTHING;\n\n'
+            # These fire for every change to the indexed columns, most of
+            # which don't concern an entity with artwork; only wake the
+            # indexer if something was actually queued.
+            extra_functions_source += f'{indent()}IF FOUND THEN\n'
+            indent_level += 1
+            extra_functions_source += f'{indent()}{NOTIFY_STMT}\n'
+            indent_level -= 1
+            extra_functions_source += f'{indent()}END IF;\n'
             if col_comparisons:
                 indent_level -= 1
                 extra_functions_source += f'{indent()}END IF;\n'
@@ -144,26 +175,43 @@ for project in PROJECTS:
                     EXECUTE PROCEDURE artwork_indexer.{tg_fn_name}();
             ''')
 
-    def index_artwork_stmt(gids, parent, starting_indent_level):
+    def add_dependency_stmt(parent, child, starting_indent_level):
         global indent_level
         indent_level = starting_indent_level
-        stmt = 'INSERT INTO artwork_indexer.event_queue ('
-        stmt += 'entity_type, action, message'
+        stmt = 'INSERT INTO artwork_indexer.event_dependency (parent, child)\n'
+        stmt += f'{indent()}VALUES ({parent}, {child});'
+        return stmt
+
+    def index_artwork_stmt(gids, action, parent, starting_indent_level):
+        global indent_level
+        indent_level = starting_indent_level
+        stmt = ''
         if parent:
-            stmt += ', depends_on'
+            # The index events may already be queued. `DO UPDATE` (unlike
+            # `DO NOTHING`) has their ids returned too, so that they're
+            # made to depend on the parent all the same.
+            stmt += 'WITH child AS (\n'
+            indent_level += 1
+            stmt += indent()
+        stmt += 'INSERT INTO artwork_indexer.event_queue ('
+        stmt += 'entity_type, action, message'
         stmt += ')\n'
         stmt += f'{indent()}VALUES '
         stmt += ', '.join([
-            (
-                f"('{entity_type}', 'index', jsonb_build_object('gid', {gid})" +
-                (f", array[{parent}])" if parent else ')')
-            ) for gid in gids
+            f"('{entity_type}', '{action}', jsonb_build_object('gid', {gid}))"
+            for gid in gids
         ])
         stmt += '\n'
         stmt += f'{indent()}ON CONFLICT ';
         if parent:
-            stmt += "(entity_type, action, message) WHERE state = 'queued'\n"
-            stmt += f"{indent()}DO UPDATE SET depends_on = (coalesce(artwork_indexer.event_queue.depends_on, '{{}}') || {parent});"
+            stmt += ("(entity_type, action, message, completed_at) "
+                     "WHERE state = 'queued'\n")
+            stmt += f'{indent()}DO UPDATE SET last_updated = now()\n'
+            stmt += f'{indent()}RETURNING id\n'
+            indent_level -= 1
+            stmt += f'{indent()})\n'
+            stmt += f'{indent()}INSERT INTO artwork_indexer.event_dependency (parent, child)\n'
+            stmt += f'{indent()}SELECT {parent}, child.id FROM child;'
         else:
             stmt += 'DO NOTHING;'
         return stmt
@@ -173,29 +221,41 @@ for project in PROJECTS:
         indent_level = starting_indent_level
         stmt = 'INSERT INTO artwork_indexer.event_queue ('
         stmt += 'entity_type, action, message'
-        if parent:
-            stmt += ', depends_on'
         stmt += ')\n'
         stmt += f"{indent()}VALUES ('{entity_type}', 'delete_image', "
         stmt += f"jsonb_build_object('artwork_id', {artwork_id}, 'gid', {gid}, 'suffix', {suffix})"
-        if parent:
-            stmt += f", array[{parent}]"
         stmt += ')\n'
         stmt += f'{indent()}RETURNING id INTO STRICT {return_var};'
+        if parent:
+            stmt += f'\n\n{indent()}'
+            stmt += add_dependency_stmt(parent, return_var, starting_indent_level)
         return stmt
 
     def deindex_artwork_stmt(gid, parent, starting_indent_level):
         global indent_level
         indent_level = starting_indent_level
-        stmt = 'INSERT INTO artwork_indexer.event_queue (entity_type, action, message, depends_on)\n'
-        stmt += f"{indent()}VALUES ('{entity_type}', 'deindex', jsonb_build_object('gid', {gid}), {parent})\n"
-        stmt += f'{indent()}ON CONFLICT DO NOTHING;\n\n'
-        # Delete any previous 'index' events that were queued; it's unlikely
+        stmt = ''
+        if parent:
+            stmt += 'WITH child AS (\n'
+            indent_level += 1
+            stmt += indent()
+        stmt += 'INSERT INTO artwork_indexer.event_queue (entity_type, action, message)\n'
+        stmt += f"{indent()}VALUES ('{entity_type}', 'deindex', jsonb_build_object('gid', {gid}))\n"
+        stmt += f'{indent()}ON CONFLICT DO NOTHING'
+        if parent:
+            stmt += '\n'
+            stmt += f'{indent()}RETURNING id\n'
+            indent_level -= 1
+            stmt += f'{indent()})\n'
+            stmt += f'{indent()}INSERT INTO artwork_indexer.event_dependency (parent, child)\n'
+            stmt += f'{indent()}SELECT {parent}, child.id FROM child'
+        stmt += ';\n\n'
+        # Delete any previous index events that were queued; it's unlikely
         # these exist, but if they do we can avoid having them run and fail.
         stmt += f'{indent()}DELETE FROM artwork_indexer.event_queue\n'
         stmt += f"{indent()}WHERE state = 'queued'\n"
         stmt += f"{indent()}AND entity_type = '{entity_type}'\n"
-        stmt += f"{indent()}AND action = 'index'\n"
+        stmt += f"{indent()}AND action IN ('index', 'index_images', 'index_metadata')\n"
         stmt += f"{indent()}AND message = jsonb_build_object('gid', {gid});"
         return stmt
 
@@ -211,7 +271,9 @@ for project in PROJECTS:
             FROM {q_entity_table}
             WHERE {q_entity_table}.id = NEW.{entity_type};
 
-            {index_artwork_stmt((f'{entity_type}_gid',), None, 3)}
+            {index_artwork_stmt((f'{entity_type}_gid',), artwork_index_action, None, 3)}
+
+            {NOTIFY_STMT}
 
             RETURN NEW;
         END;
@@ -262,16 +324,20 @@ for project in PROJECTS:
                 IF FOUND THEN
                     -- If there's an existing, queued index event, reset its parent to our
                     -- deletion event (i.e. delay it until after the deletion executes).
-                    {index_artwork_stmt((f'old_{entity_type}_gid', f'new_{entity_type}_gid'), 'delete_event_id', 5)}
+                    {index_artwork_stmt((f'old_{entity_type}_gid', f'new_{entity_type}_gid'), artwork_index_action, 'delete_event_id', 5)}
                 ELSE
-                    {index_artwork_stmt((f'new_{entity_type}_gid',), 'delete_event_id', 5)}
+                    {index_artwork_stmt((f'new_{entity_type}_gid',), artwork_index_action, 'delete_event_id', 5)}
 
-                    {deindex_artwork_stmt(f'old_{entity_type}_gid', 'array[delete_event_id]', 5)}
+                    {deindex_artwork_stmt(f'old_{entity_type}_gid', 'delete_event_id', 5)}
                 END IF;
             ELSE
-                {index_artwork_stmt((f'old_{entity_type}_gid', f'new_{entity_type}_gid'), None, 4)}
+                -- Only the image's own details changed (such as its comment),
+                -- which don't appear in the web service XML.
+                {index_artwork_stmt((f'old_{entity_type}_gid', f'new_{entity_type}_gid'), 'index_images', None, 4)}
             END IF;
 
+            {NOTIFY_STMT}
+
             RETURN NEW;
         END;
         $$ LANGUAGE plpgsql;
@@ -294,7 +360,9 @@ for project in PROJECTS:
             IF FOUND THEN
                 {delete_artwork_stmt('OLD.id', f'{entity_type}_gid', 'suffix', None, 'delete_event_id', 4)}
 
-                {index_artwork_stmt((f'{entity_type}_gid',), 'delete_event_id', 4)}
+                {index_artwork_stmt((f'{entity_type}_gid',), artwork_index_action, 'delete_event_id', 4)}
+
+                {NOTIFY_STMT}
             END IF;
 
             RETURN OLD;
@@ -311,7 +379,9 @@ for project in PROJECTS:
             JOIN {q_art_table} ON {q_entity_table}.id = {q_art_table}.{entity_type}
             WHERE {q_art_table}.id = NEW.id;
 
-            {index_artwork_stmt((f'{entity_type}_gid',), None, 3)}
+            {index_artwork_stmt((f'{entity_type}_gid',), artwork_index_action, None, 3)}
+
+            {NOTIFY_STMT}
 
             RETURN NEW;
         END;
@@ -330,7 +400,9 @@ for project in PROJECTS:
             -- If no row is found, it's likely because the artwork itself has been
             -- deleted, which cascades to this table.
             IF FOUND THEN
-                {index_artwork_stmt((f'{entity_type}_gid',), None, 4)}
+                {index_artwork_stmt((f'{entity_type}_gid',), artwork_index_action, None, 4)}
+
+                {NOTIFY_STMT}
             END IF;
 
             RETURN OLD;
@@ -357,7 +429,9 @@ for project in PROJECTS:
                 )
                 ON CONFLICT DO NOTHING;
 
-                {deindex_artwork_stmt('OLD.gid', 'NULL', 4)}
+                {deindex_artwork_stmt('OLD.gid', None, 4)}
+
+                {NOTIFY_STMT}
             END IF;
 
             RETURN OLD;
@@ -365,6 +439,57 @@ for project in PROJECTS:
         $$ LANGUAGE plpgsql;
         ''')
 
+    # Renders the same document as `EventHandler.build_index_json` does
+    # (`json.dumps` with `sort_keys=True`), byte for byte, so the keys
+    # must be in sorted order, and strings go through json_ascii_text.
+    entity_key = entity_type.replace('_', '-')
+    index_json_members_source = ''.join(
+        f"\n                {', ' if i else ''}\"{key}\": {value} ||"
+        for i, (key, value) in enumerate(sorted((
+            ('images', "[' || coalesce(string_agg(image_json, ', ' ORDER BY ordering), '') || ']'"),
+            (entity_key, f"\"https://musicbrainz.org/{entity_key}/' || {entity_type}_gid || '\"'"),
+        )))
+    ).replace('\n                ', "\n                '")
+    back_json_source = (
+        "\n                    ', \"back\": ' || coalesce(il.is_back, FALSE)::text ||"
+        if project['back_images'] else ''
+    )
+    extra_functions_source += dedent(f'''
+        CREATE OR REPLACE FUNCTION artwork_indexer.build_{entity_type}_index_json({entity_type}_gid UUID) RETURNS TEXT AS $$
+            SELECT '{{' ||{index_json_members_source}
+                '}}'
+            FROM (
+                SELECT il.ordering,
+                    '{{"approved": ' || coalesce(il.approved, FALSE)::text ||{back_json_source}
+                    ', "comment": ' || coalesce(artwork_indexer.json_ascii_text(il.comment), 'null') ||
+                    ', "edit": ' || coalesce(il.edit::text, 'null') ||
+                    ', "front": ' || coalesce(il.is_front, FALSE)::text ||
+                    ', "id": ' || il.id ||
+                    ', "image": "' || image_url || '.' || {q_image_type_table}.suffix || '"' ||
+                    ', "thumbnails": {{' ||
+                        '"1200": "' || image_url || '-1200.jpg", ' ||
+                        '"250": "' || image_url || '-250.jpg", ' ||
+                        '"500": "' || image_url || '-500.jpg", ' ||
+                        '"large": "' || image_url || '-500.jpg", ' ||
+                        '"small": "' || image_url || '-250.jpg"' ||
+                    '}}' ||
+                    ', "types": [' || coalesce((
+                        SELECT string_agg(artwork_indexer.json_ascii_text(type), ', ' ORDER BY position)
+                        FROM unnest(il.types) WITH ORDINALITY AS types (type, position)
+                    ), '') || ']' ||
+                    '}}' AS image_json
+                FROM {art_schema}.index_listing il
+                JOIN {q_image_type_table} USING (mime_type)
+                CROSS JOIN LATERAL (
+                    SELECT 'https://{project['domain']}/{entity_type}/' || {entity_type}_gid || '/' || il.id AS image_url
+                ) url
+                WHERE il.{entity_type} = (
+                    SELECT id FROM {q_entity_table} WHERE gid = {entity_type}_gid
+                )
+            ) images
+        $$ LANGUAGE sql STABLE;
+        ''')
+
     functions_source += extra_functions_source + '\n'
 
     functions_fpath = os.path.join(curdir, f'sql/{abbr}_functions.sql')
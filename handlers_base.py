@@ -16,26 +16,256 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
+import asyncio
+import hashlib
 import logging
 import json
+import tempfile
+import threading
 import time
 
+import httpx
 from psycopg import sql
 from requests.exceptions import HTTPError
 from textwrap import dedent
 import urllib.parse
 
+import mb_metadata
+
 
 IMAGE_FILE_FORMAT = '{bucket}-{id}.{suffix}'
 
 # connect, read timeouts
 REQUEST_TIMEOUT = (10, 30)
 
+# The same timeouts, for the httpx client used by the async engine.
+ASYNC_REQUEST_TIMEOUT = httpx.Timeout(
+    REQUEST_TIMEOUT[1],
+    connect=REQUEST_TIMEOUT[0],
+)
+
+# The metadata XML is streamed from MusicBrainz in chunks of this size,
+# and spooled to a temporary file once it's larger than
+# `SPOOL_MAX_MEMORY_SIZE`, so that it needn't be held in memory in full
+# while it's uploaded to the IA.
+STREAM_CHUNK_SIZE = 64 * 1024
+SPOOL_MAX_MEMORY_SIZE = 1024 * 1024
+
+# If a `delete_image` event exists with no parent, there should be no
+# later `copy_image` event for the same image. (With a parent, it's the
+# `copy_image` event itself.)
+LATER_COPY_IMAGE_EVENT_QUERY = dedent('''
+    SELECT id FROM artwork_indexer.event_queue eq
+    WHERE NOT EXISTS (
+        SELECT 1 FROM artwork_indexer.event_dependency dep
+        WHERE dep.child = %(event_id)s
+    )
+    AND eq.state = 'queued'
+    AND eq.action = 'copy_image'
+    AND eq.created > %(created)s
+    AND eq.message->'artwork_id' = %(artwork_id)s
+    AND eq.message->'old_gid' = %(gid)s
+    AND eq.message->'suffix' = %(suffix)s
+    LIMIT 1
+''')
+
+
+FIND_UPLOADED_FILE_QUERY = dedent('''
+    SELECT content_sha256 FROM artwork_indexer.uploaded_file
+    WHERE entity_type = %(entity_type)s
+    AND gid = %(gid)s
+    AND file_name = %(file_name)s
+''')
+
+RECORD_UPLOADED_FILE_QUERY = dedent('''
+    INSERT INTO artwork_indexer.uploaded_file
+        (entity_type, gid, file_name, content_sha256)
+    VALUES (%(entity_type)s, %(gid)s, %(file_name)s, %(content_sha256)s)
+    ON CONFLICT (entity_type, gid, file_name) DO UPDATE
+    SET content_sha256 = excluded.content_sha256,
+        uploaded = now()
+''')
+
+DELETE_UPLOADED_FILE_QUERY = dedent('''
+    DELETE FROM artwork_indexer.uploaded_file
+    WHERE entity_type = %(entity_type)s
+    AND gid = %(gid)s
+    AND file_name = %(file_name)s
+''')
+
+# Maps MIME types to file suffixes, from cover_art_archive.image_type
+# (which the event_art_archive schema uses, too). The table only changes
+# along with the MusicBrainz schema, so it's loaded once per process, and
+# again only if an image turns up with a MIME type we haven't seen.
+IMAGE_TYPE_QUERY = dedent('''
+    SELECT mime_type, suffix FROM cover_art_archive.image_type
+''')
+
+image_type_suffixes = {}
+image_type_suffixes_lock = threading.Lock()
+
+# Image rows fetched in bulk for a batch of claimed events (see
+# `indexer.prefetch_image_rows`), keyed by entity type and gid, for
+# `index_images` to take instead of querying them itself. Only one event
+# per entity runs at a time, and any entry it doesn't take is discarded
+# once it's done or released (`discard_prefetched_image_rows`), so an
+# entry is never used by any other event.
+prefetched_image_rows = {}
+prefetched_image_rows_lock = threading.Lock()
+
+# The number of uploads this process has skipped because the file was
+# unchanged, reported in its `artwork_indexer.worker` row.
+skipped_upload_count = 0
+skipped_upload_count_lock = threading.Lock()
+
+
+def count_skipped_upload():
+    global skipped_upload_count
+    with skipped_upload_count_lock:
+        skipped_upload_count += 1
+
+
+def update_image_type_suffixes(image_type_rows):
+    with image_type_suffixes_lock:
+        image_type_suffixes.update(
+            (row['mime_type'], row['suffix']) for row in image_type_rows
+        )
+
+
+def has_image_type_suffixes(image_rows):
+    return all(row['mime_type'] in image_type_suffixes for row in image_rows)
+
+
+def add_image_suffixes(image_rows):
+    for row in image_rows:
+        row['suffix'] = image_type_suffixes[row['mime_type']]
+
+
+def store_prefetched_image_rows(entity_type, image_rows_by_gid):
+    with prefetched_image_rows_lock:
+        for gid, image_rows in image_rows_by_gid.items():
+            prefetched_image_rows[(entity_type, gid)] = image_rows
+
+
+def take_prefetched_image_rows(entity_type, gid):
+    with prefetched_image_rows_lock:
+        return prefetched_image_rows.pop((entity_type, gid), None)
+
+
+def discard_prefetched_image_rows(event):
+    # For events that are released, or that finish without having taken
+    # theirs, so that they don't outlive their batch.
+    take_prefetched_image_rows(
+        event['entity_type'],
+        event['message'].get('gid'),
+    )
+
+
+def select_gids_within_limit(gids, image_counts, max_rows):
+    # Picks the gids, in order, whose images fit in `max_rows` rows
+    # together; a gid that would go over is skipped, and any later ones
+    # that still fit are picked.
+    selected_gids = []
+    row_count = 0
+    for gid in gids:
+        image_count = image_counts.get(gid, 0)
+        if row_count + image_count <= max_rows:
+            selected_gids.append(gid)
+            row_count += image_count
+    return selected_gids
+
 
 def kebab(s):
     return s.replace('_', '-')
 
 
+class SpooledContent:
+    """
+    A response body received in chunks, hashed as they're written, to be
+    uploaded again. Supports `len` and `read`, so that `requests` streams
+    it with a Content-Length; `aiter_chunks` does the same for `httpx`.
+    """
+
+    def __init__(self):
+        self.file = tempfile.SpooledTemporaryFile(
+            max_size=SPOOL_MAX_MEMORY_SIZE,
+        )
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.file.close()
+
+    def __len__(self):
+        return self.size
+
+    def write(self, chunk):
+        self.file.write(chunk)
+        self.sha256.update(chunk)
+        self.size += len(chunk)
+
+    def rewind(self):
+        self.file.seek(0)
+
+    def read(self, size=-1):
+        return self.file.read(size)
+
+    async def aiter_chunks(self):
+        while chunk := self.file.read(STREAM_CHUNK_SIZE):
+            yield chunk
+
+
+class IndexJsonWriter:
+    """
+    Writes an entity's index.json to a `SpooledContent` one image at a
+    time. The bytes are the same as those `EventHandler.build_index_json`
+    returns all at once (`json.dumps` with `sort_keys=True`), but neither
+    the image rows nor the document need be held in memory in full.
+    """
+
+    def __init__(self, handler, gid, content):
+        self.handler = handler
+        self.gid = gid
+        self.content = content
+        self.image_count = 0
+
+        # The other members go before or after "images", depending on
+        # how their keys sort.
+        members = sorted({
+            'images': None,
+            kebab(handler.entity_type):
+                handler.build_canonical_entity_url(gid),
+        }.items())
+        images_index = [key for key, value in members].index('images')
+
+        self.write('{')
+        for key, value in members[:images_index]:
+            self.write(json.dumps(key) + ': ' + json.dumps(value) + ', ')
+        self.write('"images": [')
+        self.members_after_images = members[images_index + 1:]
+
+    def write(self, s):
+        self.content.write(s.encode('utf-8'))
+
+    def write_image(self, row):
+        if self.image_count:
+            self.write(', ')
+        self.write(json.dumps(
+            self.handler.build_image_json(self.gid, row),
+            sort_keys=True,
+        ))
+        self.image_count += 1
+
+    def finish(self):
+        self.write(']')
+        for key, value in self.members_after_images:
+            self.write(', ' + json.dumps(key) + ': ' + json.dumps(value))
+        self.write('}')
+
+
 class EventHandler:
 
     image_url_format = 'https://{domain}/{subpath}/{gid}/{id}{size}.{suffix}'
@@ -71,6 +301,38 @@ class EventHandler:
     def project_abbr(self):
         raise NotImplementedError
 
+    # Where the entity's metadata XML comes from: `ws` fetches it from
+    # the web service (see `build_metadata_url`), and `database` renders
+    # it locally (see `render_metadata_xml`).
+    @property
+    def metadata_source(self):
+        metadata_source = self.config['musicbrainz'].get(
+            self.project_abbr + '_metadata_source',
+            'ws',
+        )
+        if metadata_source not in ('ws', 'database'):
+            raise ValueError(
+                f'Unknown {self.project_abbr}_metadata_source: ' +
+                repr(metadata_source)
+            )
+        return metadata_source
+
+    # What renders index.json: `python` (see `build_index_json`), or
+    # `database`, which has the generated `build_*_index_json` function
+    # render the same document in a single query.
+    @property
+    def index_json_renderer(self):
+        index_json_renderer = self.config.get(
+            'indexer',
+            'index_json_renderer',
+            fallback='python',
+        )
+        if index_json_renderer not in ('python', 'database'):
+            raise ValueError(
+                'Unknown index_json_renderer: ' + repr(index_json_renderer)
+            )
+        return index_json_renderer
+
     def build_authorization_header(self):
         abbr = self.project_abbr
         s3_conf = self.config['s3']
@@ -117,90 +379,45 @@ class EventHandler:
         bucket = self.build_bucket_name(gid)
         return url.format(bucket=bucket, file=filename)
 
-    def fetch_image_rows(self, pg_conn, entity_gid):
-        raise NotImplementedError
-
-    def index(self, pg_conn, event):
-        message = event['message']
-        gid = message['gid']
-
-        index_json_content = json.dumps({
+    def build_index_json(self, gid, image_rows):
+        return json.dumps({
             'images': [
                 self.build_image_json(gid, row)
-                for row in self.fetch_image_rows(pg_conn, gid)
+                for row in image_rows
             ],
             kebab(self.entity_type): self.build_canonical_entity_url(gid),
         }, sort_keys=True)
 
-        logging.debug('Produced %s', index_json_content)
-
-        index_json_upload_url = self.build_s3_item_url(gid, 'index.json')
-        try:
-            index_json_upload_res = self.http_session.put(
-                index_json_upload_url,
-                data=index_json_content.encode('utf-8'),
-                headers={
-                    **self.build_authorization_header(),
-                    'content-type': 'application/json; charset=UTF-8',
-                    'x-archive-auto-make-bucket': '1',
-                    'x-archive-keep-old-version': '1',
-                    'x-archive-meta-collection': self.ia_collection,
-                    'x-archive-meta-mediatype': 'image',
-                    'x-archive-meta-noindex': 'true',
-                },
-                timeout=REQUEST_TIMEOUT
-            )
-            index_json_upload_res.raise_for_status()
-        except HTTPError as exc:
-            logging.info('Upload of %s failed', index_json_upload_url)
-            logging.error('Response text: %s', index_json_upload_res.text)
-            raise exc
-
-        logging.info('Upload of %s succeeded', index_json_upload_url)
-
-        entity_metadata_url = self.build_metadata_url(gid)
-        entity_metadata_headers = self.build_metadata_headers()
-        try:
-            entity_metadata_res = self.http_session.get(
-                entity_metadata_url,
-                headers=entity_metadata_headers,
-                stream=True,
-                timeout=REQUEST_TIMEOUT
-            )
-            entity_metadata_res.raise_for_status()
-        except HTTPError as exc:
-            logging.info('Fetch of %s failed', entity_metadata_url)
-            logging.error('Response text: %s', entity_metadata_res.text)
-            raise exc
-
-        entity_metadata_upload_url = self.build_s3_item_url(
-            gid,
-            self.build_metadata_ia_filename(gid),
+    def build_index_json_query(self):
+        return sql.SQL('SELECT {function}(%(gid)s) AS index_json').format(
+            function=sql.Identifier(
+                'artwork_indexer',
+                f'build_{self.entity_type}_index_json',
+            ),
         )
-        try:
-            entity_metadata_upload_res = self.http_session.put(
-                entity_metadata_upload_url,
-                data=entity_metadata_res.content,
-                headers={
-                    **self.build_authorization_header(),
-                    'content-type': 'application/xml; charset=UTF-8',
-                    'x-archive-auto-make-bucket': '1',
-                    'x-archive-meta-collection': self.ia_collection,
-                    'x-archive-meta-mediatype': 'image',
-                    'x-archive-meta-noindex': 'true',
-                },
-                timeout=REQUEST_TIMEOUT
-            )
-            entity_metadata_upload_res.raise_for_status()
-        except HTTPError as exc:
-            logging.info('Upload of %s failed', entity_metadata_upload_url)
-            logging.error('Response text: %s', entity_metadata_upload_res.text)
-            raise exc
 
-        logging.info('Upload of %s succeeded', entity_metadata_upload_url)
+    def build_index_json_upload_headers(self):
+        return {
+            **self.build_authorization_header(),
+            'content-type': 'application/json; charset=UTF-8',
+            'x-archive-auto-make-bucket': '1',
+            'x-archive-keep-old-version': '1',
+            'x-archive-meta-collection': self.ia_collection,
+            'x-archive-meta-mediatype': 'image',
+            'x-archive-meta-noindex': 'true',
+        }
 
-    def copy_image(self, pg_conn, event):
-        message = event['message']
+    def build_metadata_upload_headers(self):
+        return {
+            **self.build_authorization_header(),
+            'content-type': 'application/xml; charset=UTF-8',
+            'x-archive-auto-make-bucket': '1',
+            'x-archive-meta-collection': self.ia_collection,
+            'x-archive-meta-mediatype': 'image',
+            'x-archive-meta-noindex': 'true',
+        }
+
+    def build_copy_image_paths(self, message):
         artwork_id = message['artwork_id']
         old_gid = message['old_gid']
         new_gid = message['new_gid']
@@ -224,21 +441,295 @@ class EventHandler:
             file=old_file_name,
         )
         target_url = self.build_s3_item_url(new_gid, new_file_name)
+        return source_file_path, target_url
+
+    def build_copy_image_headers(self, source_file_path):
+        return {
+            **self.build_authorization_header(),
+            'x-amz-copy-source': source_file_path,
+            'x-archive-auto-make-bucket': '1',
+            'x-archive-keep-old-version': '1',
+            'x-archive-meta-collection': self.ia_collection,
+            'x-archive-meta-mediatype': 'image',
+            'x-archive-meta-noindex': 'true',
+        }
+
+    def build_image_s3_url(self, message):
+        gid = message['gid']
+        filename = IMAGE_FILE_FORMAT.format(
+            bucket=self.build_bucket_name(gid),
+            id=message['artwork_id'],
+            suffix=message['suffix']
+        )
+        return self.build_s3_item_url(gid, filename)
+
+    def build_delete_headers(self):
+        return {
+            **self.build_authorization_header(),
+            'x-archive-keep-old-version': '1',
+            'x-archive-cascade-delete': '1',
+        }
+
+    def build_later_copy_image_event_params(self, event):
+        message = event['message']
+        return {
+            'event_id': event['id'],
+            'created': event['created'],
+            'artwork_id': json.dumps(message['artwork_id']),
+            'gid': json.dumps(message['gid']),
+            'suffix': json.dumps(message['suffix']),
+        }
+
+    def build_uploaded_file_params(self, gid, file_name, content=None):
+        params = {
+            'entity_type': self.entity_type,
+            'gid': gid,
+            'file_name': file_name,
+        }
+        if isinstance(content, SpooledContent):
+            params['content_sha256'] = content.sha256.digest()
+        elif content is not None:
+            params['content_sha256'] = hashlib.sha256(content).digest()
+        return params
+
+    def check_upload_unchanged(self, event, uploaded_file, params):
+        # Returns whether `params['content_sha256']` matches the hash of
+        # the content last uploaded to the file (`uploaded_file`), in
+        # which case it needn't be uploaded again, unless the event
+        # forces it to be (e.g. if the file was lost at the IA).
+        if event['message'].get('force') or uploaded_file is None:
+            return False
+        if uploaded_file['content_sha256'] != params['content_sha256']:
+            return False
+        logging.info('Skipped upload of %s (unchanged)', params['file_name'])
+        count_skipped_upload()
+        return True
+
+    def check_later_copy_image_event(self, later_copy_image_event):
+        if later_copy_image_event:
+            latest_copy_image_event_id = later_copy_image_event['id']
+            raise Exception(
+                'This image cannot be deleted, because ' +
+                'a later event exists ' +
+                f'(id={latest_copy_image_event_id}) ' +
+                'that wants to copy it.'
+            )
+
+    def commit_before_request(self, pg_conn):
+        # Called before each request to the IA or MusicBrainz, so that no
+        # transaction is left idle for as long as the request takes,
+        # holding back vacuum on the event queue and tying up a server
+        # connection in pgbouncer. The handlers only read before their
+        # requests; anything they've written by then (the files recorded
+        # as uploaded) is already true of the IA, so it's committed
+        # rather than rolled back.
+        if not pg_conn.closed:
+            pg_conn.commit()
+
+    async def commit_before_request_async(self, pg_conn):
+        if not pg_conn.closed:
+            await pg_conn.commit()
+
+    def check_metadata_row(self, entity_gid, metadata_row):
+        if metadata_row is None:
+            raise Exception(
+                f'The {self.entity_type} {entity_gid} does not exist.'
+            )
+
+    def iter_image_rows(self, pg_conn, entity_gid):
+        raise NotImplementedError
+
+    def aiter_image_rows(self, pg_conn, entity_gid):
+        raise NotImplementedError
+
+    def fetch_image_rows_batch(self, pg_conn, entity_gids, max_rows=None):
+        raise NotImplementedError
+
+    async def fetch_image_rows_batch_async(self, pg_conn, entity_gids,
+                                           max_rows=None):
+        raise NotImplementedError
+
+    def add_image_suffixes(self, pg_conn, image_rows):
+        if not has_image_type_suffixes(image_rows):
+            update_image_type_suffixes(
+                pg_conn.execute(IMAGE_TYPE_QUERY).fetchall(),
+            )
+        add_image_suffixes(image_rows)
+
+    async def add_image_suffixes_async(self, pg_conn, image_rows):
+        if not has_image_type_suffixes(image_rows):
+            pg_cur = await pg_conn.execute(IMAGE_TYPE_QUERY)
+            update_image_type_suffixes(await pg_cur.fetchall())
+        add_image_suffixes(image_rows)
+
+    def write_index_json(self, gid, image_rows, content):
+        writer = IndexJsonWriter(self, gid, content)
+        for row in image_rows:
+            writer.write_image(row)
+        writer.finish()
+
+    async def write_index_json_async(self, gid, image_rows, content):
+        writer = IndexJsonWriter(self, gid, content)
+        async for row in image_rows:
+            writer.write_image(row)
+        writer.finish()
+
+    def render_index_json(self, pg_conn, entity_gid):
+        return pg_conn.execute(
+            self.build_index_json_query(),
+            {'gid': entity_gid},
+        ).fetchone()['index_json']
+
+    async def render_index_json_async(self, pg_conn, entity_gid):
+        pg_cur = await pg_conn.execute(
+            self.build_index_json_query(),
+            {'gid': entity_gid},
+        )
+        return (await pg_cur.fetchone())['index_json']
+
+    def render_metadata_xml(self, pg_conn, entity_gid):
+        raise NotImplementedError
+
+    async def render_metadata_xml_async(self, pg_conn, entity_gid):
+        raise NotImplementedError
+
+    def index(self, pg_conn, event):
+        self.index_images(pg_conn, event)
+        self.index_metadata(pg_conn, event)
+
+    def index_images(self, pg_conn, event):
+        gid = event['message']['gid']
+
+        if self.index_json_renderer == 'database':
+            index_json_content = self.render_index_json(pg_conn, gid)
+
+            logging.debug('Produced %s', index_json_content)
+
+            self.upload_unless_unchanged(
+                pg_conn,
+                event,
+                'index.json',
+                index_json_content.encode('utf-8'),
+                self.build_index_json_upload_headers(),
+            )
+            return
+
+        # Releases can have thousands of images, so unless they were
+        # prefetched, the rows are streamed from the database into the
+        # document, which is spooled to disk if it gets large.
+        with SpooledContent() as index_json_content:
+            image_rows = take_prefetched_image_rows(self.entity_type, gid)
+            if image_rows is None:
+                image_rows = self.iter_image_rows(pg_conn, gid)
+            self.write_index_json(gid, image_rows, index_json_content)
+
+            logging.debug('Produced index.json (%d bytes)',
+                          len(index_json_content))
+
+            index_json_content.rewind()
+            self.upload_unless_unchanged(
+                pg_conn,
+                event,
+                'index.json',
+                index_json_content,
+                self.build_index_json_upload_headers(),
+            )
+
+    def index_metadata(self, pg_conn, event):
+        gid = event['message']['gid']
+
+        if self.metadata_source == 'database':
+            self.upload_unless_unchanged(
+                pg_conn,
+                event,
+                self.build_metadata_ia_filename(gid),
+                self.render_metadata_xml(pg_conn, gid),
+                self.build_metadata_upload_headers(),
+            )
+            return
+
+        entity_metadata_url = self.build_metadata_url(gid)
+        entity_metadata_headers = self.build_metadata_headers()
+        self.commit_before_request(pg_conn)
+        with SpooledContent() as entity_metadata:
+            with self.http_session.get(
+                entity_metadata_url,
+                headers=entity_metadata_headers,
+                stream=True,
+                timeout=REQUEST_TIMEOUT
+            ) as entity_metadata_res:
+                try:
+                    entity_metadata_res.raise_for_status()
+                except HTTPError as exc:
+                    logging.info('Fetch of %s failed', entity_metadata_url)
+                    logging.error('Response text: %s',
+                                  entity_metadata_res.text)
+                    raise exc
+
+                for chunk in entity_metadata_res.iter_content(
+                    STREAM_CHUNK_SIZE,
+                ):
+                    entity_metadata.write(chunk)
+
+            entity_metadata.rewind()
+            self.upload_unless_unchanged(
+                pg_conn,
+                event,
+                self.build_metadata_ia_filename(gid),
+                entity_metadata,
+                self.build_metadata_upload_headers(),
+            )
+
+    def upload_unless_unchanged(self,
+                                pg_conn,
+                                event,
+                                file_name,
+                                content,
+                                headers):
+        # Uploads `content` (bytes, or a `SpooledContent`) to `file_name`
+        # in the event's bucket, unless it's what we last uploaded there.
+        # Many events don't change a file, such as release edits that
+        # leave its images alone, and each upload of one would otherwise
+        # add a version at the IA.
+        gid = event['message']['gid']
+        params = self.build_uploaded_file_params(gid, file_name, content)
+        if self.check_upload_unchanged(
+            event,
+            pg_conn.execute(FIND_UPLOADED_FILE_QUERY, params).fetchone(),
+            params,
+        ):
+            return
+
+        upload_url = self.build_s3_item_url(gid, file_name)
+        self.commit_before_request(pg_conn)
+        try:
+            upload_res = self.http_session.put(
+                upload_url,
+                data=content,
+                headers=headers,
+                timeout=REQUEST_TIMEOUT
+            )
+            upload_res.raise_for_status()
+        except HTTPError as exc:
+            logging.info('Upload of %s failed', upload_url)
+            logging.error('Response text: %s', upload_res.text)
+            raise exc
+
+        logging.info('Upload of %s succeeded', upload_url)
+
+        pg_conn.execute(RECORD_UPLOADED_FILE_QUERY, params)
+
+    def copy_image(self, pg_conn, event):
+        source_file_path, target_url = \
+            self.build_copy_image_paths(event['message'])
 
         # Copy the image to the new MBID. (The old image will be deleted by a
         # subsequent and dependant `delete_image` event.)
+        self.commit_before_request(pg_conn)
         try:
             copy_res = self.http_session.put(
                 target_url,
-                headers={
-                    **self.build_authorization_header(),
-                    'x-amz-copy-source': source_file_path,
-                    'x-archive-auto-make-bucket': '1',
-                    'x-archive-keep-old-version': '1',
-                    'x-archive-meta-collection': self.ia_collection,
-                    'x-archive-meta-mediatype': 'image',
-                    'x-archive-meta-noindex': 'true',
-                },
+                headers=self.build_copy_image_headers(source_file_path),
                 timeout=REQUEST_TIMEOUT
             )
             copy_res.raise_for_status()
@@ -252,55 +743,22 @@ class EventHandler:
                      source_file_path, target_url)
 
     def delete_image(self, pg_conn, event):
-        message = event['message']
-        gid = message['gid']
+        # Verify that no later `copy_image` event wants this image,
+        # to be safe.
+        self.check_later_copy_image_event(pg_conn.execute(
+            LATER_COPY_IMAGE_EVENT_QUERY,
+            self.build_later_copy_image_event_params(event),
+        ).fetchone())
 
-        if event['depends_on'] is None:
-            # If a `delete_image` event exists with no parent,
-            # there should be no later `copy_image` event for
-            # the same image. Verify this to be safe.
-            later_copy_image_event = pg_conn.execute(dedent('''
-                SELECT id FROM artwork_indexer.event_queue eq
-                WHERE eq.state = 'queued'
-                AND eq.action = 'copy_image'
-                AND eq.created > %(created)s
-                AND eq.message->'artwork_id' = %(artwork_id)s
-                AND eq.message->'old_gid' = %(gid)s
-                AND eq.message->'suffix' = %(suffix)s
-                LIMIT 1
-            '''), {
-                'created': event['created'],
-                'artwork_id': json.dumps(message['artwork_id']),
-                'gid': json.dumps(gid),
-                'suffix': json.dumps(message['suffix']),
-            }).fetchone()
-
-            if later_copy_image_event:
-                latest_copy_image_event_id = later_copy_image_event['id']
-                raise Exception(
-                    'This image cannot be deleted, because ' +
-                    'a later event exists ' +
-                    f'(id={latest_copy_image_event_id}) ' +
-                    'that wants to copy it.'
-                )
-
-        filename = IMAGE_FILE_FORMAT.format(
-            bucket=self.build_bucket_name(gid),
-            id=message['artwork_id'],
-            suffix=message['suffix']
-        )
-        target_url = self.build_s3_item_url(gid, filename)
+        target_url = self.build_image_s3_url(event['message'])
+        self.commit_before_request(pg_conn)
 
         # Note: This request should succeed (204) even if the file
         # no longer exists.
         try:
             delete_res = self.http_session.delete(
                 target_url,
-                headers={
-                    **self.build_authorization_header(),
-                    'x-archive-keep-old-version': '1',
-                    'x-archive-cascade-delete': '1',
-                },
+                headers=self.build_delete_headers(),
                 timeout=REQUEST_TIMEOUT
             )
             delete_res.raise_for_status()
@@ -316,17 +774,14 @@ class EventHandler:
         gid = message['gid']
 
         target_url = self.build_s3_item_url(gid, 'index.json')
+        self.commit_before_request(pg_conn)
 
         # Note: This request should succeed (204) even if the file
         # no longer exists.
         try:
             deindex_res = self.http_session.delete(
                 target_url,
-                headers={
-                    **self.build_authorization_header(),
-                    'x-archive-keep-old-version': '1',
-                    'x-archive-cascade-delete': '1',
-                },
+                headers=self.build_delete_headers(),
                 timeout=REQUEST_TIMEOUT
             )
             deindex_res.raise_for_status()
@@ -337,6 +792,11 @@ class EventHandler:
 
         logging.info('Deletion of %s succeeded', target_url)
 
+        pg_conn.execute(
+            DELETE_UPLOADED_FILE_QUERY,
+            self.build_uploaded_file_params(gid, 'index.json'),
+        )
+
     def noop(self, pg_conn, event):
         message = event['message']
         if message.get('fail'):
@@ -344,6 +804,213 @@ class EventHandler:
         if 'sleep' in message:
             time.sleep(message['sleep'])
 
+    # Async versions of the handler methods above, used by the async
+    # engine (see indexer_async.py). There, `pg_conn` is an
+    # `AsyncPgConnWrapper` and `http_session` an `httpx.AsyncClient`.
+
+    async def send_async(self, method, url, description, **kwargs):
+        res = await self.http_session.request(
+            method,
+            url,
+            timeout=ASYNC_REQUEST_TIMEOUT,
+            **kwargs
+        )
+        try:
+            res.raise_for_status()
+        except httpx.HTTPStatusError as exc:
+            logging.info('%s failed', description)
+            logging.error('Response text: %s', res.text)
+            raise exc
+        return res
+
+    async def index_async(self, pg_conn, event):
+        await self.index_images_async(pg_conn, event)
+        await self.index_metadata_async(pg_conn, event)
+
+    async def index_images_async(self, pg_conn, event):
+        gid = event['message']['gid']
+
+        if self.index_json_renderer == 'database':
+            index_json_content = await self.render_index_json_async(
+                pg_conn,
+                gid,
+            )
+
+            logging.debug('Produced %s', index_json_content)
+
+            await self.upload_unless_unchanged_async(
+                pg_conn,
+                event,
+                'index.json',
+                index_json_content.encode('utf-8'),
+                self.build_index_json_upload_headers(),
+            )
+            return
+
+        # See `index_images`.
+        with SpooledContent() as index_json_content:
+            image_rows = take_prefetched_image_rows(self.entity_type, gid)
+            if image_rows is None:
+                await self.write_index_json_async(
+                    gid,
+                    self.aiter_image_rows(pg_conn, gid),
+                    index_json_content,
+                )
+            else:
+                self.write_index_json(gid, image_rows, index_json_content)
+
+            logging.debug('Produced index.json (%d bytes)',
+                          len(index_json_content))
+
+            index_json_content.rewind()
+            await self.upload_unless_unchanged_async(
+                pg_conn,
+                event,
+                'index.json',
+                index_json_content,
+                self.build_index_json_upload_headers(),
+            )
+
+    async def index_metadata_async(self, pg_conn, event):
+        gid = event['message']['gid']
+
+        if self.metadata_source == 'database':
+            await self.upload_unless_unchanged_async(
+                pg_conn,
+                event,
+                self.build_metadata_ia_filename(gid),
+                await self.render_metadata_xml_async(pg_conn, gid),
+                self.build_metadata_upload_headers(),
+            )
+            return
+
+        entity_metadata_url = self.build_metadata_url(gid)
+        await self.commit_before_request_async(pg_conn)
+        with SpooledContent() as entity_metadata:
+            async with self.http_session.stream(
+                'GET',
+                entity_metadata_url,
+                headers=self.build_metadata_headers(),
+                timeout=ASYNC_REQUEST_TIMEOUT,
+            ) as entity_metadata_res:
+                try:
+                    entity_metadata_res.raise_for_status()
+                except httpx.HTTPStatusError as exc:
+                    logging.info('Fetch of %s failed', entity_metadata_url)
+                    await entity_metadata_res.aread()
+                    logging.error('Response text: %s',
+                                  entity_metadata_res.text)
+                    raise exc
+
+                async for chunk in entity_metadata_res.aiter_bytes(
+                    STREAM_CHUNK_SIZE,
+                ):
+                    entity_metadata.write(chunk)
+
+            entity_metadata.rewind()
+            await self.upload_unless_unchanged_async(
+                pg_conn,
+                event,
+                self.build_metadata_ia_filename(gid),
+                entity_metadata,
+                self.build_metadata_upload_headers(),
+            )
+
+    async def upload_unless_unchanged_async(self,
+                                            pg_conn,
+                                            event,
+                                            file_name,
+                                            content,
+                                            headers):
+        gid = event['message']['gid']
+        params = self.build_uploaded_file_params(gid, file_name, content)
+        pg_cur = await pg_conn.execute(FIND_UPLOADED_FILE_QUERY, params)
+        if self.check_upload_unchanged(
+            event,
+            await pg_cur.fetchone(),
+            params,
+        ):
+            return
+
+        if isinstance(content, SpooledContent):
+            # httpx would otherwise send it with chunked encoding.
+            headers = headers | {'content-length': str(len(content))}
+            content = content.aiter_chunks()
+
+        upload_url = self.build_s3_item_url(gid, file_name)
+        await self.commit_before_request_async(pg_conn)
+        await self.send_async(
+            'PUT',
+            upload_url,
+            f'Upload of {upload_url}',
+            content=content,
+            headers=headers,
+        )
+
+        logging.info('Upload of %s succeeded', upload_url)
+
+        await pg_conn.execute(RECORD_UPLOADED_FILE_QUERY, params)
+
+    async def copy_image_async(self, pg_conn, event):
+        source_file_path, target_url = \
+            self.build_copy_image_paths(event['message'])
+
+        await self.commit_before_request_async(pg_conn)
+        await self.send_async(
+            'PUT',
+            target_url,
+            f'Copy from {source_file_path} to {target_url}',
+            headers=self.build_copy_image_headers(source_file_path),
+        )
+
+        logging.info('Copy from %s to %s succeeded',
+                     source_file_path, target_url)
+
+    async def delete_image_async(self, pg_conn, event):
+        pg_cur = await pg_conn.execute(
+            LATER_COPY_IMAGE_EVENT_QUERY,
+            self.build_later_copy_image_event_params(event),
+        )
+        self.check_later_copy_image_event(await pg_cur.fetchone())
+
+        target_url = self.build_image_s3_url(event['message'])
+
+        await self.commit_before_request_async(pg_conn)
+        await self.send_async(
+            'DELETE',
+            target_url,
+            f'Deletion of {target_url}',
+            headers=self.build_delete_headers(),
+        )
+
+        logging.info('Deletion of %s succeeded', target_url)
+
+    async def deindex_async(self, pg_conn, event):
+        gid = event['message']['gid']
+        target_url = self.build_s3_item_url(gid, 'index.json')
+
+        await self.commit_before_request_async(pg_conn)
+        await self.send_async(
+            'DELETE',
+            target_url,
+            f'Deletion of {target_url}',
+            headers=self.build_delete_headers(),
+        )
+
+        logging.info('Deletion of %s succeeded', target_url)
+
+        await pg_conn.execute(
+            DELETE_UPLOADED_FILE_QUERY,
+            self.build_uploaded_file_params(gid, 'index.json'),
+        )
+
+    async def noop_async(self, pg_conn, event):
+        message = event['message']
+        if message.get('fail'):
+            raise Exception('Failure (no-op)')
+        if 'sleep' in message:
+            await asyncio.sleep(message['sleep'])
+
 
 class MusicBrainzEventHandler(EventHandler):
 
@@ -403,21 +1070,138 @@ class MusicBrainzEventHandler(EventHandler):
             headers['mb-set-database'] = database
         return headers
 
-    def fetch_image_rows(self, pg_conn, mbid):
+    def build_image_rows_query(self):
         schema = self.artwork_schema
         entity_type = self.entity_type
 
-        # Note: cover_art_archive.image_type is also used by the
-        # event_art_archive schema.
-        return pg_conn.execute(
-            sql.SQL(dedent('''
-                SELECT * FROM {schema}.index_listing
-                JOIN cover_art_archive.image_type USING (mime_type)
-                WHERE {entity} = (SELECT id FROM {entity} WHERE gid = %(gid)s)
-                ORDER BY ordering
-            ''')).format(
-                schema=sql.Identifier(schema),
-                entity=sql.Identifier(entity_type),
-            ),
-            {'gid': mbid},
+        # The suffixes are added from `image_type_suffixes`.
+        return sql.SQL(dedent('''
+            SELECT * FROM {schema}.index_listing
+            WHERE {entity} = (SELECT id FROM {entity} WHERE gid = %(gid)s)
+            ORDER BY ordering
+        ''')).format(
+            schema=sql.Identifier(schema),
+            entity=sql.Identifier(entity_type),
+        )
+
+    def build_image_rows_batch_query(self):
+        schema = self.artwork_schema
+        entity_type = self.entity_type
+
+        return sql.SQL(dedent('''
+            SELECT {entity}.gid::text AS entity_gid, index_listing.*
+            FROM {schema}.index_listing
+            JOIN {entity} ON {entity}.id = index_listing.{entity}
+            WHERE {entity}.gid = any(%(gids)s::uuid[])
+            ORDER BY index_listing.ordering
+        ''')).format(
+            schema=sql.Identifier(schema),
+            entity=sql.Identifier(entity_type),
+        )
+
+    def build_image_counts_query(self):
+        schema = self.artwork_schema
+        entity_type = self.entity_type
+
+        return sql.SQL(dedent('''
+            SELECT {entity}.gid::text AS entity_gid, count(*) AS image_count
+            FROM {schema}.index_listing
+            JOIN {entity} ON {entity}.id = index_listing.{entity}
+            WHERE {entity}.gid = any(%(gids)s::uuid[])
+            GROUP BY {entity}.gid
+        ''')).format(
+            schema=sql.Identifier(schema),
+            entity=sql.Identifier(entity_type),
+        )
+
+    def group_image_rows(self, mbids, image_rows):
+        # `mbids` must be in canonical (lowercase) form to match
+        # `entity_gid`. Entities without images, or that don't exist, get
+        # an empty list, as `iter_image_rows` would yield no rows.
+        image_rows_by_mbid = {mbid: [] for mbid in mbids}
+        for row in image_rows:
+            image_rows_by_mbid[row.pop('entity_gid')].append(row)
+        return image_rows_by_mbid
+
+    def iter_image_rows(self, pg_conn, mbid):
+        with pg_conn.server_cursor('image_rows') as pg_cur:
+            pg_cur.execute(self.build_image_rows_query(), {'gid': mbid})
+            for row in pg_cur:
+                self.add_image_suffixes(pg_conn, [row])
+                yield row
+
+    async def aiter_image_rows(self, pg_conn, mbid):
+        async with await pg_conn.server_cursor('image_rows') as pg_cur:
+            await pg_cur.execute(
+                self.build_image_rows_query(),
+                {'gid': mbid},
+            )
+            async for row in pg_cur:
+                await self.add_image_suffixes_async(pg_conn, [row])
+                yield row
+
+    def fetch_image_rows_batch(self, pg_conn, mbids, max_rows=None):
+        # Returns the image rows of each of `mbids`, or with `max_rows`,
+        # of those whose rows fit in that many (see
+        # `select_gids_within_limit`); the rest are left out.
+        if max_rows is not None:
+            image_counts = {
+                row['entity_gid']: row['image_count']
+                for row in pg_conn.execute(
+                    self.build_image_counts_query(),
+                    {'gids': list(mbids)},
+                ).fetchall()
+            }
+            mbids = select_gids_within_limit(mbids, image_counts, max_rows)
+            if not mbids:
+                return {}
+        image_rows = pg_conn.execute(
+            self.build_image_rows_batch_query(),
+            {'gids': list(mbids)},
         ).fetchall()
+        self.add_image_suffixes(pg_conn, image_rows)
+        return self.group_image_rows(mbids, image_rows)
+
+    async def fetch_image_rows_batch_async(self, pg_conn, mbids,
+                                           max_rows=None):
+        if max_rows is not None:
+            pg_cur = await pg_conn.execute(
+                self.build_image_counts_query(),
+                {'gids': list(mbids)},
+            )
+            image_counts = {
+                row['entity_gid']: row['image_count']
+                for row in await pg_cur.fetchall()
+            }
+            mbids = select_gids_within_limit(mbids, image_counts, max_rows)
+            if not mbids:
+                return {}
+        pg_cur = await pg_conn.execute(
+            self.build_image_rows_batch_query(),
+            {'gids': list(mbids)},
+        )
+        image_rows = await pg_cur.fetchall()
+        await self.add_image_suffixes_async(pg_conn, image_rows)
+        return self.group_image_rows(mbids, image_rows)
+
+    def render_metadata_xml(self, pg_conn, mbid):
+        metadata_row = pg_conn.execute(
+            mb_metadata.METADATA_QUERIES[self.entity_type],
+            {'gid': mbid},
+        ).fetchone()
+        self.check_metadata_row(mbid, metadata_row)
+        return self.build_metadata_xml(metadata_row)
+
+    async def render_metadata_xml_async(self, pg_conn, mbid):
+        pg_cur = await pg_conn.execute(
+            mb_metadata.METADATA_QUERIES[self.entity_type],
+            {'gid': mbid},
+        )
+        metadata_row = await pg_cur.fetchone()
+        self.check_metadata_row(mbid, metadata_row)
+        return self.build_metadata_xml(metadata_row)
+
+    def build_metadata_xml(self, metadata_row):
+        return mb_metadata.METADATA_XML_BUILDERS[self.entity_type](
+            metadata_row,
+        ).encode('utf-8')
@@ -17,22 +17,38 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 import argparse
+import collections
+import concurrent.futures
 import configparser
 import datetime
 import logging
 import os
 import signal
+import socket
 import sys
+import threading
 import time
 import traceback
+import uuid
 from math import inf
 from textwrap import dedent
 
+import psycopg
 import requests
 import sentry_sdk
+from psycopg.types.json import Jsonb
 
+import handlers_base
+from fault_injection import inject_fault, load_fault_hooks
 from handlers import EVENT_HANDLER_CLASSES
-from pg_conn_wrapper import PgConnWrapper
+from pg_conn_wrapper import (
+    POOL_STATS_KEYS,
+    PgConnWrapper,
+    PgNotifyListener,
+    close_pools,
+    get_pool_stats,
+)
+from supervisor import WorkerSupervisor
 
 # Maximum number of times we should try to handle an event
 # before we give up. This works together with the `attempts`
@@ -42,10 +58,348 @@ from pg_conn_wrapper import PgConnWrapper
 # inspecting the `event_failure_reason` table.
 MAX_ATTEMPTS = 5
 
+# How often (in seconds) old events are cleaned up, whether or not the
+# indexer is busy, and how many expired events are re-queued per
+# transaction while doing so.
+CLEANUP_INTERVAL = 150
+CLEANUP_BATCH_SIZE = 10_000
+
+# How long a claimed event's lease lasts, and how often (in seconds) the
+# indexer updates its `artwork_indexer.worker` row, extending the leases
+# of the events it's claimed as it does. An event whose lease expires is
+# re-queued, and a worker that hasn't sent a heartbeat for as long is
+# presumed dead, so the former must comfortably exceed the latter.
+EVENT_LEASE_DURATION = datetime.timedelta(minutes=1)
+HEARTBEAT_INTERVAL = 20
+
+# How many times a heartbeat tries to extend the leases, if events are
+# completed (and so moved to another partition) while it's locking them.
+EXTEND_EVENT_LEASES_ATTEMPTS = 3
+
+# At most how many image rows `prefetch_image_rows` loads into memory for
+# a batch of claimed events. The entities whose rows don't fit, like any
+# with more images than this, stream theirs from a server-side cursor in
+# `index_images`, as they would without prefetching.
+PREFETCH_MAX_IMAGE_ROWS = 1000
+
+# While events are running but none could be claimed, how often (in
+# seconds) the indexer checks whether the triggers have notified it of a
+# new event, between waiting on the running ones.
+IN_FLIGHT_POLL_INTERVAL = 0.5
+
 # When set to True, indicates to the `indexer` event loop that it should
 # stop once idle.
 SHUTDOWN_SIGNAL = False
 
+# Queries shared with the async engine (indexer_async.py).
+
+# `RETRY_OR_FAIL_EVENT_QUERY` and `COMPLETE_EVENT_QUERY` update an event
+# only while it's still running on `worker_id`: a worker whose lease
+# expired (see `requeue_expired_events`) mustn't complete or fail an
+# event that's since been re-queued, and perhaps claimed by another
+# worker.
+#
+# The queries below that look events up by id only ever want ones that
+# haven't completed, so they say `completed_at = 'infinity'`, as
+# `CLAIM_EVENTS_QUERY` does. That limits them to the
+# `event_queue_active` partition, instead of checking every monthly
+# partition of completed events too.
+
+# Failed events keep their `next_attempt_at`, so that they run right
+# away if they're re-queued by hand.
+RETRY_OR_FAIL_EVENT_QUERY = dedent('''
+    WITH new_state AS (
+        SELECT (
+            CASE WHEN eq.attempts >= %(max_attempts)s OR EXISTS (
+                SELECT 1
+                FROM artwork_indexer.event_queue dup
+                WHERE dup.state = 'queued'
+                AND dup.completed_at = 'infinity'
+                AND dup.action = eq.action
+                AND dup.message = eq.message
+                AND dup.id != %(event_id)s
+                FOR UPDATE
+            ) THEN 'failed' ELSE 'queued' END
+        )::artwork_indexer.event_state AS state
+        FROM artwork_indexer.event_queue eq
+        WHERE eq.id = %(event_id)s
+        AND eq.completed_at = 'infinity'
+    )
+    UPDATE artwork_indexer.event_queue eq
+    SET state = new_state.state,
+        next_attempt_at = (
+            CASE WHEN new_state.state = 'queued'
+                 THEN now() + (interval '1 hour' * eq.attempts)
+                 ELSE eq.next_attempt_at END
+        )
+    FROM new_state
+    WHERE eq.id = %(event_id)s
+    AND eq.completed_at = 'infinity'
+    AND eq.state = 'running'
+    AND eq.worker IS NOT DISTINCT FROM %(worker_id)s
+''')
+
+INSERT_FAILURE_REASON_QUERY = dedent('''
+    INSERT INTO artwork_indexer.event_failure_reason
+        (event, failure_reason)
+    VALUES (%(event_id)s, %(error)s)
+''')
+
+FAIL_DEPENDENT_EVENTS_QUERY = dedent('''
+    WITH RECURSIVE descendants AS (
+        SELECT dep.child AS id
+        FROM artwork_indexer.event_dependency dep
+        JOIN artwork_indexer.event_queue parent
+        ON (parent.id = dep.parent
+            AND parent.id = %(event_id)s
+            AND parent.completed_at = 'infinity'
+            AND parent.state = 'failed')
+        UNION
+        SELECT dep.child
+        FROM artwork_indexer.event_dependency dep
+        JOIN descendants parent
+        ON parent.id = dep.parent
+    ),
+    updates AS (
+        UPDATE artwork_indexer.event_queue
+        SET state = 'failed'
+        WHERE id IN (SELECT id FROM descendants)
+        AND completed_at = 'infinity'
+        RETURNING id
+    )
+    INSERT INTO artwork_indexer.event_failure_reason
+        (event, failure_reason)
+    SELECT id, %(failure_reason)s
+    FROM updates
+''')
+
+CREATE_EVENT_PARTITIONS_QUERY = dedent('''
+    SELECT artwork_indexer.create_event_partitions(now()),
+           artwork_indexer.create_event_partitions(now() + interval '1 month')
+''')
+
+DROP_OLD_EVENT_PARTITIONS_QUERY = dedent('''
+    SELECT artwork_indexer.drop_event_partitions(
+        now() - interval '90 days'
+    ) AS name
+''')
+
+# Partition maintenance needs an exclusive lock on the queue, which it
+# shouldn't wait for long while blocking everything else.
+PARTITION_LOCK_TIMEOUT_QUERY = dedent('''
+    SET LOCAL lock_timeout = '5s'
+''')
+
+REGISTER_WORKER_QUERY = dedent('''
+    INSERT INTO artwork_indexer.worker (host, pid, concurrency)
+    VALUES (%(host)s, %(pid)s, %(concurrency)s)
+    RETURNING id, started
+''')
+
+# Puts the row back if it was removed in the meantime (say, because the
+# worker couldn't reach the database for a while, and was presumed dead).
+WORKER_HEARTBEAT_QUERY = dedent('''
+    INSERT INTO artwork_indexer.worker
+        (id, host, pid, concurrency, started, events_handled,
+         events_in_flight, last_claim_duration, uploads_skipped,
+         pool_requests, pool_requests_queued, pool_wait_time,
+         pool_request_errors)
+    VALUES (%(worker_id)s, %(host)s, %(pid)s, %(concurrency)s, %(started)s,
+            %(events_handled)s, %(events_in_flight)s,
+            %(last_claim_duration)s, %(uploads_skipped)s,
+            %(pool_requests)s, %(pool_requests_queued)s,
+            %(pool_wait_time)s, %(pool_request_errors)s)
+    ON CONFLICT (id) DO UPDATE
+    SET last_heartbeat = now(),
+        events_handled = excluded.events_handled,
+        events_in_flight = excluded.events_in_flight,
+        last_claim_duration = excluded.last_claim_duration,
+        uploads_skipped = excluded.uploads_skipped,
+        pool_requests = excluded.pool_requests,
+        pool_requests_queued = excluded.pool_requests_queued,
+        pool_wait_time = excluded.pool_wait_time,
+        pool_request_errors = excluded.pool_request_errors
+''')
+
+DEREGISTER_WORKER_QUERY = dedent('''
+    DELETE FROM artwork_indexer.worker
+    WHERE id = %(worker_id)s
+''')
+
+DELETE_DEAD_WORKERS_QUERY = dedent('''
+    DELETE FROM artwork_indexer.worker
+    WHERE last_heartbeat < now() - %(lease_duration)s
+    RETURNING id, host, pid
+''')
+
+# Skips events that are locked, which are either being completed by
+# the indexer that claimed them or re-queued by another (see
+# `FIND_EXPIRED_EVENTS_QUERY`); neither needs its lease extended.
+EXTEND_EVENT_LEASES_QUERY = dedent('''
+    WITH leased AS (
+        SELECT id, completed_at
+        FROM artwork_indexer.event_queue
+        WHERE id = any(%(event_ids)s)
+        AND state = 'running'
+        AND completed_at = 'infinity'
+        AND worker = %(worker_id)s
+        FOR UPDATE SKIP LOCKED
+    )
+    UPDATE artwork_indexer.event_queue eq
+    SET lease_expires_at = now() + %(lease_duration)s
+    FROM leased
+    WHERE eq.id = leased.id
+    AND eq.completed_at = leased.completed_at
+''')
+
+# Running events without a lease were claimed before leases existed,
+# and are treated as having expired. Those of workers that are gone
+# (which normally release their events on the way out) don't have to
+# wait for their lease to expire.
+FIND_EXPIRED_EVENTS_QUERY = dedent('''
+    SELECT *
+    FROM artwork_indexer.event_queue eq
+    WHERE state = 'running'
+    AND completed_at = 'infinity'
+    AND (
+        lease_expires_at IS NULL
+        OR lease_expires_at < now()
+        OR (
+            worker IS NOT NULL
+            AND NOT EXISTS (
+                SELECT TRUE FROM artwork_indexer.worker w
+                WHERE w.id = eq.worker
+            )
+        )
+    )
+    ORDER BY id
+    LIMIT %(limit)s
+    FOR UPDATE SKIP LOCKED
+''')
+
+TRY_MAINTENANCE_LOCK_QUERY = dedent('''
+    SELECT pg_try_advisory_lock(hashtext('artwork_indexer.maintenance'))
+           AS locked
+''')
+
+# Taken before `CLAIM_EVENTS_QUERY`, in its own statement, so that
+# the claim's snapshot includes everything claimed before the lock was
+# granted.
+LOCK_EVENT_CLAIMS_QUERY = dedent('''
+    SELECT pg_advisory_xact_lock(hashtext('artwork_indexer.claim_events'))
+''')
+
+CLAIM_EVENTS_QUERY = dedent('''
+    WITH running_gids AS (
+        SELECT entity_type, gid
+        FROM artwork_indexer.event_queue,
+             unnest(ARRAY[
+                 message->>'gid',
+                 message->>'old_gid',
+                 message->>'new_gid'
+             ]) AS gid
+        WHERE state = 'running'
+        AND completed_at = 'infinity'
+        AND gid IS NOT NULL
+    ), candidates AS (
+        SELECT eq.id, eq.next_attempt_at, eq.entity_type,
+               array_remove(ARRAY[
+                   eq.message->>'gid',
+                   eq.message->>'old_gid',
+                   eq.message->>'new_gid'
+               ], NULL) AS gids
+        FROM artwork_indexer.event_queue eq
+        WHERE eq.state = 'queued'
+        AND eq.completed_at = 'infinity'
+        AND eq.pending_parents = 0
+        AND eq.next_attempt_at <= now()
+        AND eq.attempts < %(max_attempts)s
+        -- Written as three equality checks, rather than one comparing
+        -- arrays, so that each can be planned as a hash anti-join.
+        AND NOT EXISTS (
+            SELECT TRUE FROM running_gids r
+            WHERE r.entity_type = eq.entity_type
+            AND r.gid = eq.message->>'gid'
+        )
+        AND NOT EXISTS (
+            SELECT TRUE FROM running_gids r
+            WHERE r.entity_type = eq.entity_type
+            AND r.gid = eq.message->>'old_gid'
+        )
+        AND NOT EXISTS (
+            SELECT TRUE FROM running_gids r
+            WHERE r.entity_type = eq.entity_type
+            AND r.gid = eq.message->>'new_gid'
+        )
+        ORDER BY next_attempt_at, id
+        LIMIT %(limit)s
+        FOR UPDATE SKIP LOCKED
+    )
+    UPDATE artwork_indexer.event_queue
+    SET state = 'running',
+        attempts = attempts + 1,
+        lease_expires_at = now() + %(lease_duration)s,
+        worker = %(worker_id)s
+    WHERE completed_at = 'infinity'
+    AND id IN (
+        SELECT c.id FROM candidates c
+        WHERE NOT EXISTS (
+            SELECT TRUE
+            FROM candidates earlier_c
+            WHERE earlier_c.entity_type = c.entity_type
+            AND earlier_c.gids && c.gids
+            AND (earlier_c.next_attempt_at, earlier_c.id) <
+                (c.next_attempt_at, c.id)
+        )
+    )
+    RETURNING *
+''')
+
+FIND_QUEUED_DUPLICATE_QUERY = dedent('''
+    SELECT id FROM artwork_indexer.event_queue
+    WHERE state = 'queued'
+    AND completed_at = 'infinity'
+    AND entity_type = %(entity_type)s
+    AND action = %(action)s
+    AND message = %(message)s
+    FOR UPDATE
+''')
+
+REPLACE_DEPENDENCY_QUERY = dedent('''
+    WITH removed AS (
+        DELETE FROM artwork_indexer.event_dependency
+        WHERE parent = %(event_id)s
+        RETURNING child
+    )
+    INSERT INTO artwork_indexer.event_dependency (parent, child)
+    SELECT %(duplicate_id)s, child FROM removed
+    ON CONFLICT DO NOTHING
+''')
+
+DELETE_EVENT_QUERY = dedent('''
+    DELETE FROM artwork_indexer.event_queue
+    WHERE id = %(event_id)s
+    AND completed_at = 'infinity'
+''')
+
+REQUEUE_EVENT_QUERY = dedent('''
+    UPDATE artwork_indexer.event_queue
+    SET state = 'queued',
+        attempts = attempts - 1
+    WHERE id = %(event_id)s
+    AND completed_at = 'infinity'
+    AND state = 'running'
+''')
+
+COMPLETE_EVENT_QUERY = dedent('''
+    UPDATE artwork_indexer.event_queue
+    SET state = 'completed'
+    WHERE id = %(event_id)s
+    AND completed_at = 'infinity'
+    AND state = 'running'
+    AND worker IS NOT DISTINCT FROM %(worker_id)s
+''')
+
 
 def handle_event_failure(pg_conn, event, error):
     logging.error(error)
@@ -61,8 +415,8 @@ def handle_event_failure(pg_conn, event, error):
     #       while this one was running)
     #
     # Otherwise, the event stays queued and is retried later based on
-    # the number of attempts so far. (See the `get_next_event` function
-    # below for how this delay calculated.)
+    # the number of attempts so far: `next_attempt_at` is pushed back by
+    # an hour per attempt.
     #
     # Identical 'queued' events are blocked at the database level by a
     # UNIQUE INDEX, `event_queue_idx_queued_uniq`. This prevents
@@ -73,62 +427,29 @@ def handle_event_failure(pg_conn, event, error):
     # this would cause compounding failures at worst, and bypass any
     # delay in processing we have on the existing event.
 
-    pg_conn.execute_with_retry(dedent('''
-        UPDATE artwork_indexer.event_queue eq
-        SET state = (
-            CASE WHEN eq.attempts >= %(max_attempts)s OR EXISTS (
-                SELECT 1
-                FROM artwork_indexer.event_queue dup
-                WHERE dup.state = 'queued'
-                AND dup.action = eq.action
-                AND dup.message = eq.message
-                AND dup.id != %(event_id)s
-                FOR UPDATE
-            ) THEN 'failed' ELSE 'queued' END
-        )::artwork_indexer.event_state
-        WHERE eq.id = %(event_id)s
-    '''), {
+    updated = pg_conn.execute_with_retry(RETRY_OR_FAIL_EVENT_QUERY, {
         'max_attempts': MAX_ATTEMPTS,
         'event_id': event['id'],
-    })
+        'worker_id': event['worker'],
+    }).rowcount
 
-    pg_conn.execute_with_retry(dedent('''
-        INSERT INTO artwork_indexer.event_failure_reason
-            (event, failure_reason)
-        VALUES (%(event_id)s, %(error)s)
-    '''), {'event_id': event['id'], 'error': str(error)})
-
-    # If the event failed, mark any dependent events as failed, too.
-    pg_conn.execute_with_retry(dedent('''
-        WITH RECURSIVE descendants AS (
-            SELECT child.id, child.depends_on
-            FROM artwork_indexer.event_queue child
-            JOIN artwork_indexer.event_queue parent
-            ON (parent.id = any(child.depends_on)
-                AND parent.id = %(event_id)s
-                AND parent.state = 'failed')
-            UNION ALL
-            SELECT child.id, child.depends_on
-            FROM artwork_indexer.event_queue child
-            JOIN descendants parent
-            ON parent.id = any(child.depends_on)
-        ),
-        updates AS (
-            UPDATE artwork_indexer.event_queue
-            SET state = 'failed'
-            WHERE id IN (SELECT id FROM descendants)
-            RETURNING id
-        )
-        INSERT INTO artwork_indexer.event_failure_reason
-            (event, failure_reason)
-        SELECT id, %(failure_reason)s
-        FROM updates
-    '''), {
-        'event_id': event['id'],
-        'failure_reason': 'This event was marked as failed because '
-                          f'an event it depended on ({event['id']}) '
-                          'had failed.',
-    })
+    if updated:
+        pg_conn.execute_with_retry(INSERT_FAILURE_REASON_QUERY, {
+            'event_id': event['id'],
+            'error': str(error),
+        })
+
+        # If the event failed, mark any dependent events as failed, too.
+        # (Its `worker` has been cleared by now, so this is only safe
+        # because we've just failed it ourselves.)
+        pg_conn.execute_with_retry(FAIL_DEPENDENT_EVENTS_QUERY, {
+            'event_id': event['id'],
+            'failure_reason': 'This event was marked as failed because '
+                              f'an event it depended on ({event['id']}) '
+                              'had failed.',
+        })
+    else:
+        log_lost_lease(event, 'failed')
 
     try:
         sentry_sdk.capture_exception(error)
@@ -136,9 +457,41 @@ def handle_event_failure(pg_conn, event, error):
         logging.error(sentry_exc)
 
 
+def log_lost_lease(event, state):
+    logging.warning(
+        'Event id=%s is no longer running on this worker (its lease '
+        'expired); not marking it %s',
+        event['id'],
+        state,
+    )
+
+
+def maintain_event_partitions(pg_conn):
+    # Makes sure there are partitions for events completing this month
+    # and next, and drops those of events completed over 90 days ago.
+    # Returns the names of the partitions dropped, or None if they
+    # couldn't be locked in time (in which case we try again later).
+    try:
+        pg_conn.execute(PARTITION_LOCK_TIMEOUT_QUERY)
+        pg_conn.execute(CREATE_EVENT_PARTITIONS_QUERY)
+        dropped_partitions = [
+            row['name'] for row in
+            pg_conn.execute(DROP_OLD_EVENT_PARTITIONS_QUERY).fetchall()
+        ]
+        pg_conn.commit()
+    except psycopg.errors.LockNotAvailable as exc:
+        pg_conn.rollback()
+        logging.warning('Skipped partition maintenance: %s', exc)
+        return None
+    return dropped_partitions
+
+
 def cleanup_events(pg_conn):
     # Cleanup completed events older than 90 days. We only keep these
-    # around in case they help with debugging.
+    # around in case they help with debugging. They're partitioned by
+    # the month they completed in, and dropped a month at a time once
+    # all of the month's events are old enough; deleting them row by
+    # row would leave the table and its indexes bloated.
     #
     # Failed events are not cleaned up. These should always be inspected
     # and dealt with, not ignored and left for deletion. (It's less
@@ -147,64 +500,292 @@ def cleanup_events(pg_conn):
     #
     # We don't want to delete queued or running events that are older
     # than 90 days: if this occurs, we'd want to inspect them to find
-    # out why they're stuck (ideally before 90 days has passed).
-    pg_cur = pg_conn.execute(dedent('''
-        DELETE FROM artwork_indexer.event_queue
-        WHERE state = 'completed'
-        AND (now() - created) > interval '90 days'
-    '''))
+    # out why they're stuck (ideally before 90 days has passed). None
+    # of them are in the partitions dropped.
+    for partition_name in maintain_event_partitions(pg_conn) or ():
+        logging.info('Dropped %s (events completed over 90 days ago)',
+                     partition_name)
+
+    # Additionally, forget workers that have stopped sending heartbeats,
+    # and re-queue events whose lease has expired, which the indexer
+    # that claimed them would have kept extending had it not crashed or
+    # lost its connection.
+    delete_dead_workers(pg_conn)
+    requeue_expired_events(pg_conn)
+
+
+def delete_dead_workers(pg_conn):
+    dead_workers = pg_conn.execute(DELETE_DEAD_WORKERS_QUERY, {
+        'lease_duration': EVENT_LEASE_DURATION,
+    }).fetchall()
     pg_conn.commit()
-    if pg_cur.rowcount:
-        logging.info(
-            'Deleted ' + str(pg_cur.rowcount) + ' event' +
-            ('s' if pg_cur.rowcount > 1 else '') +
-            ' older than 90 days')
+    for worker in dead_workers:
+        logging.warning('Worker id=%s (pid %s on %s) stopped responding',
+                        worker['id'], worker['pid'], worker['host'])
 
-    # Additionally, mark events that have been running for more than
-    # 2.5 minutes as failed.
-    timed_out_events = pg_conn.execute(dedent('''
-        UPDATE artwork_indexer.event_queue
-        SET state = 'failed'
-        WHERE state = 'running'
-        AND (last_updated - created) > interval '2.5 minutes'
-        RETURNING id, (last_updated - created) AS duration
-    ''')).fetchall()
-    for event in timed_out_events:
-        seconds_elapsed = event['duration'].total_seconds()
-        pg_conn.execute(dedent('''
-            INSERT INTO artwork_indexer.event_failure_reason
-                (event, failure_reason)
-            VALUES (%(event_id)s, %(error)s)
-        '''), {
-            'event_id': event['id'],
-            'error': 'This event was marked as failed because ' +
-                     'it had been running for more than 2.5 minutes ' +
-                     f'({seconds_elapsed} seconds).'
-        })
+
+def requeue_expired_events(pg_conn, batch_size=CLEANUP_BATCH_SIZE):
+    # Re-queues the events in batches of `batch_size`, committing each
+    # one, so that a large number of them (after an outage, say) never
+    # holds row locks for long against the claimers. As when they're
+    # released, the attempt they were claimed for isn't counted: nothing
+    # is known to be wrong with the events themselves.
+    while True:
+        expired_events = pg_conn.execute(FIND_EXPIRED_EVENTS_QUERY, {
+            'limit': batch_size,
+        }).fetchall()
+        for event in expired_events:
+            logging.warning('Lease expired for event id=%s', event['id'])
+        release_events(pg_conn, expired_events)
+        if len(expired_events) < batch_size:
+            break
+
+
+class WorkerState:
+    """
+    What this indexer process reports in its `artwork_indexer.worker`
+    row, including the events it's claimed but not yet handled, whose
+    leases are extended along with each heartbeat. Updated by the loop
+    and by the handlers, whichever thread they run on.
+    """
+
+    def __init__(self, concurrency):
+        self.id = None
+        self.host = socket.gethostname()
+        self.pid = os.getpid()
+        self.concurrency = concurrency
+        self.started = None
+        self.event_ids = set()
+        self.events_handled = 0
+        self.last_claim_duration = None
+        self.lock = threading.Lock()
+
+    def add_events(self, events, claim_duration):
+        with self.lock:
+            self.event_ids.update(event['id'] for event in events)
+            self.last_claim_duration = \
+                datetime.timedelta(seconds=claim_duration)
+
+    def finish_event(self, event):
+        with self.lock:
+            self.event_ids.discard(event['id'])
+            self.events_handled += 1
+
+    def get_heartbeat_params(self):
+        pool_stats = get_pool_stats() or dict.fromkeys(POOL_STATS_KEYS)
+        with self.lock:
+            return {
+                'worker_id': self.id,
+                'host': self.host,
+                'pid': self.pid,
+                'concurrency': self.concurrency,
+                'started': self.started,
+                'events_handled': self.events_handled,
+                'events_in_flight': len(self.event_ids),
+                'last_claim_duration': self.last_claim_duration,
+                'uploads_skipped': handlers_base.skipped_upload_count,
+                **{f'pool_{key}': pool_stats[key] for key in POOL_STATS_KEYS},
+                'event_ids': list(self.event_ids),
+                'lease_duration': EVENT_LEASE_DURATION,
+            }
+
+
+def register_worker(pg_conn, worker):
+    row = pg_conn.execute(REGISTER_WORKER_QUERY, {
+        'host': worker.host,
+        'pid': worker.pid,
+        'concurrency': worker.concurrency,
+    }).fetchone()
     pg_conn.commit()
+    worker.id = row['id']
+    worker.started = row['started']
+    logging.info('Registered as worker id=%s', worker.id)
 
 
-def get_next_event(pg_conn):
-    # Skip events that have reached `MAX_ATTEMPTS`.
-    # In other cases, `last_updated` should be within a
-    # specific time interval. We start by waiting 1 hour,
-    # and wait an additional hour per each attempt.
-    return pg_conn.execute(dedent('''
-        SELECT * FROM artwork_indexer.event_queue eq
-        WHERE eq.state = 'queued'
-        AND eq.attempts < %(max_attempts)s
-        AND eq.last_updated <=
-            (now() - (interval '1 hour' * eq.attempts))
-        AND (eq.depends_on IS NULL OR NOT EXISTS (
-            SELECT TRUE
-            FROM artwork_indexer.event_queue parent_eq
-            WHERE parent_eq.id = any(eq.depends_on)
-            AND parent_eq.state != 'completed'
-        ))
-        ORDER BY created, id
-        LIMIT 1
-        FOR UPDATE SKIP LOCKED
-    '''), {'max_attempts': MAX_ATTEMPTS}).fetchone()
+def send_heartbeat(pg_conn, worker):
+    # The worker row is committed first, on its own, so that failing to
+    # extend the leases can't undo it and get the worker presumed dead.
+    params = worker.get_heartbeat_params()
+    pg_conn.execute_and_commit(WORKER_HEARTBEAT_QUERY, params)
+    if params['event_ids']:
+        extend_event_leases(pg_conn, params)
+
+
+def extend_event_leases(pg_conn, params):
+    # An event completed after the query's snapshot was taken has been
+    # moved out of `event_queue_active` by the time it's locked, which
+    # fails with a serialization error ("tuple to be locked was already
+    # moved to another partition") rather than skipping it. A retry no
+    # longer sees that event.
+    for attempt in range(1, EXTEND_EVENT_LEASES_ATTEMPTS + 1):
+        try:
+            pg_conn.execute_and_commit(EXTEND_EVENT_LEASES_QUERY, params)
+            return
+        except psycopg.errors.SerializationFailure:
+            pg_conn.rollback()
+            if attempt == EXTEND_EVENT_LEASES_ATTEMPTS:
+                raise
+
+
+def deregister_worker(pg_conn, worker):
+    pg_conn.execute_and_commit(DEREGISTER_WORKER_QUERY, {
+        'worker_id': worker.id,
+    })
+
+
+def maintenance_db_section(config):
+    # Session-level advisory locks don't work through pgbouncer in
+    # transaction pooling mode, any more than LISTEN does, so take the
+    # maintenance lock over the direct connection if there is one.
+    if 'database_listener' in config:
+        return 'database_listener'
+    return 'database'
+
+
+def try_maintenance_lock(pg_conn):
+    # Returns whether this session holds the maintenance lock, which it
+    # keeps until the connection is closed. With several indexer
+    # processes (on one host or more), that makes exactly one of them
+    # responsible for maintenance, and another takes over on its next
+    # attempt once it's gone.
+    locked = pg_conn.execute(TRY_MAINTENANCE_LOCK_QUERY).fetchone()['locked']
+    pg_conn.commit()
+    return locked
+
+
+def claim_events(pg_conn, limit, worker_id=None, fault_hooks=None):
+    # Claims up to `limit` events that are ready to run, marking them as
+    # running in a single statement.
+    #
+    # Events are claimed once their `next_attempt_at` has passed and
+    # all of their parents (`event_dependency`) have completed, in that
+    # order, which `event_queue_idx_queued_next_attempt_at` serves
+    # directly. (See `handle_event_failure` for how retries are delayed,
+    # and create_schema.sql for how `pending_parents` is maintained.)
+    # Skip events that have reached `MAX_ATTEMPTS`. The conditions on
+    # `completed_at` limit the query to the `event_queue_active`
+    # partition, however many completed events are kept.
+    #
+    # At most one event per entity (gid, or bucket for `copy_image`)
+    # may run at a time, whichever thread, process or machine runs it:
+    # events for an entity that already has a running event are
+    # skipped, as are those for an entity that an earlier event in the
+    # same batch is claiming. Claims are serialized by an advisory
+    # lock, since two concurrent claims couldn't see each other's
+    # running events otherwise.
+    #
+    # The events are leased to `worker_id` (see `WorkerState`).
+    pg_conn.execute(LOCK_EVENT_CLAIMS_QUERY)
+    events = pg_conn.execute(CLAIM_EVENTS_QUERY, {
+        'max_attempts': MAX_ATTEMPTS,
+        'limit': limit,
+        'lease_duration': EVENT_LEASE_DURATION,
+        'worker_id': worker_id,
+    }).fetchall()
+    if fault_hooks:
+        inject_fault(fault_hooks, 'before_claim_commit', events)
+    pg_conn.commit()
+    # `RETURNING` doesn't preserve the order of the subquery.
+    events.sort(key=lambda event: (event['next_attempt_at'], event['id']))
+    return events
+
+
+def is_canonical_uuid(value):
+    try:
+        return str(uuid.UUID(value)) == value
+    except (AttributeError, TypeError, ValueError):
+        return False
+
+
+def group_gids_to_prefetch(event_handler_map, events):
+    # Groups the gids of claimed events that will build index.json from
+    # image rows by entity type, for `prefetch_image_rows`. An entity
+    # type with only one such event is left out, since fetching its rows
+    # up front wouldn't save a query; so are gids that aren't UUIDs in
+    # canonical form, which `index_images` looks up (or fails on) by
+    # itself, as before.
+    gids_by_entity_type = collections.defaultdict(list)
+    for event in events:
+        if event['action'] not in ('index', 'index_images'):
+            continue
+        handler = event_handler_map[event['entity_type']]
+        if handler.index_json_renderer != 'python':
+            continue
+        gid = event['message'].get('gid')
+        if is_canonical_uuid(gid):
+            gids_by_entity_type[event['entity_type']].append(gid)
+    return {
+        entity_type: gids
+        for entity_type, gids in gids_by_entity_type.items()
+        if len(gids) > 1
+    }
+
+
+def prefetch_image_rows(pg_conn, event_handler_map, events,
+                        max_rows=PREFETCH_MAX_IMAGE_ROWS):
+    # Fetches the image rows of the entities that a batch of claimed
+    # events is going to index, up to `max_rows` of them, in one query
+    # per entity type (plus one to count them) rather than one per
+    # event, for their `index_images` to take (see
+    # `handlers_base.prefetched_image_rows`). If the images change in
+    # the meantime, the triggers queue another event for the entity,
+    # which can't be claimed until this one is done.
+    gids_by_entity_type = group_gids_to_prefetch(event_handler_map, events)
+    if not gids_by_entity_type:
+        return
+    try:
+        for entity_type, gids in gids_by_entity_type.items():
+            handler = event_handler_map[entity_type]
+            image_rows_by_gid = handler.fetch_image_rows_batch(
+                pg_conn,
+                gids,
+                max_rows=max_rows,
+            )
+            handlers_base.store_prefetched_image_rows(
+                entity_type,
+                image_rows_by_gid,
+            )
+            max_rows -= sum(map(len, image_rows_by_gid.values()))
+        pg_conn.commit()
+    except Exception as exc:
+        # The events can still fetch their own.
+        pg_conn.rollback()
+        logging.error('Failed to prefetch image rows: %s', exc)
+
+
+def release_events(pg_conn, events):
+    # Returns claimed events that were never started (e.g. because we're
+    # shutting down) to the queue, undoing the attempt counted by
+    # `claim_events`. Their `next_attempt_at` is left as it was, so
+    # they're immediately available again, in their original place.
+    for event in events:
+        handlers_base.discard_prefetched_image_rows(event)
+
+        # An identical event may have been queued after this one was
+        # claimed. It supersedes ours, which then can't be re-queued
+        # anyway due to `event_queue_idx_queued_uniq`; any events that
+        # depended on ours are made to depend on the duplicate instead.
+        duplicate = pg_conn.execute(FIND_QUEUED_DUPLICATE_QUERY, {
+            'entity_type': event['entity_type'],
+            'action': event['action'],
+            'message': Jsonb(event['message']),
+        }).fetchone()
+
+        if duplicate:
+            pg_conn.execute(REPLACE_DEPENDENCY_QUERY, {
+                'event_id': event['id'],
+                'duplicate_id': duplicate['id'],
+            })
+            pg_conn.execute(DELETE_EVENT_QUERY, {'event_id': event['id']})
+            logging.info(
+                'Event id=%s was superseded by id=%s; deleted it',
+                event['id'],
+                duplicate['id'],
+            )
+        else:
+            pg_conn.execute(REQUEUE_EVENT_QUERY, {'event_id': event['id']})
+            logging.info('Event id=%s was released', event['id'])
+    pg_conn.commit()
 
 
 def run_event_handler(pg_conn, event, handler):
@@ -218,132 +799,483 @@ def run_event_handler(pg_conn, event, handler):
             'Event id=%s completed succesfully',
             event['id'],
         )
-        pg_conn.execute_with_retry(dedent('''
-            UPDATE artwork_indexer.event_queue
-            SET state = 'completed'
-            WHERE id = %(event_id)s
-        '''), {'event_id': event['id']})
-
+        updated = pg_conn.execute_with_retry(COMPLETE_EVENT_QUERY, {
+            'event_id': event['id'],
+            'worker_id': event['worker'],
+        }).rowcount
+        if not updated:
+            log_lost_lease(event, 'completed')
 
-def indexer(
-    config,
-    pg_conn,
-    maxwait,
-    max_idle_loops=inf,
-    http_client_cls=requests.Session
-):
-    sleep_amount = 1  # seconds
 
+def make_event_handler_map(config, http_client_cls):
     http_session = http_client_cls()
     http_session.headers.update({
         'user-agent': 'metabrainz/artwork-indexer ' +
                       f'({requests.utils.default_user_agent()})',
     })
 
-    event_handler_map = {
+    return {
         entity: cls(config, http_session)
         for entity, cls in EVENT_HANDLER_CLASSES.items()
     }
 
-    idle_loops = 0
-    last_cleanup_datetime = datetime.datetime.min
 
-    while not SHUTDOWN_SIGNAL:
-        time.sleep(sleep_amount)
+def process_event(pg_conn,
+                  event_handler_map,
+                  event,
+                  fault_hooks,
+                  event_counter=None,
+                  worker=None):
+    if fault_hooks:
+        inject_fault(fault_hooks, 'after_claim', event)
 
-        event = get_next_event(pg_conn)
+    logging.info('Processing event %s', event)
 
-        # Reset `sleep_amount` if we're seeing activity, otherwise
-        # increase it exponentially up to `maxwait` seconds.
-        if event:
-            sleep_amount = 1
-            idle_loops = 0
-        else:
-            # Close the transaction opened by `get_next_event`.
-            pg_conn.commit()
-
-            # Since there's nothing else to do, cleanup old events
-            # (but not too often).
-            current_datetime = datetime.datetime.now()
-            seconds_elapsed_since_last_cleanup = \
-                (current_datetime - last_cleanup_datetime).total_seconds()
-            if seconds_elapsed_since_last_cleanup >= 150:
-                cleanup_events(pg_conn)
-                last_cleanup_datetime = current_datetime
-
-            idle_loops += 1
-            if idle_loops >= max_idle_loops:
-                break
+    handler = event_handler_map[event['entity_type']]
 
-            if sleep_amount < maxwait:
-                sleep_amount = min(sleep_amount * 2, maxwait)
-                logging.info(
-                    'No event found; sleeping for %s second(s)',
-                    sleep_amount,
-                )
+    if fault_hooks:
+        inject_fault(fault_hooks, 'before_handler', event)
 
-            continue
+    run_event_handler(
+        pg_conn,
+        event,
+        handler,
+    )
+    handlers_base.discard_prefetched_image_rows(event)
+    pg_conn.commit()
 
-        if event['state'] != 'queued':
-            # Close the transaction opened by `get_next_event`.
-            pg_conn.commit()
+    if worker is not None:
+        worker.finish_event(event)
 
-            # This is mainly a development aid.  In at least one
-            # occasion I broke the SQL query above by having bad
-            # boolean operator precedence.  -- mwiencek
-            raise Exception('Event is not queued: %r', event)
+    # Shared with the supervisor when running with `--workers`.
+    if event_counter is not None:
+        with event_counter.get_lock():
+            event_counter.value += 1
 
-        # XXX: This is used by tests/test_concurrency.sh to check
-        # that concurrent indexer processes don't select the same
-        # queued events. A small delay is added before we mark them
-        # as `running`.
-        time.sleep(0.25)
+    if fault_hooks:
+        inject_fault(fault_hooks, 'after_handler', event)
 
-        logging.info('Processing event %s', event)
 
-        pg_conn.execute_and_commit(dedent('''
-            UPDATE artwork_indexer.event_queue
-            SET state = 'running',
-                attempts = attempts + 1
-            WHERE id = %(event_id)s
-        '''), {'event_id': event['id']})
+class EventWorkerPool:
+    """
+    Runs event handlers on `concurrency` threads. Each thread has its own
+    database connection and HTTP session (neither of which may be shared
+    between threads), created the first time it picks up an event. With a
+    connection pool, the threads' connections are instead borrowed from
+    it for each transaction (see `PgConnWrapper`).
+    """
 
-        handler = event_handler_map[event['entity_type']]
+    def __init__(self,
+                 config,
+                 http_client_cls,
+                 concurrency,
+                 fault_hooks,
+                 event_counter,
+                 worker):
+        self.config = config
+        self.http_client_cls = http_client_cls
+        self.concurrency = concurrency
+        self.fault_hooks = fault_hooks
+        self.event_counter = event_counter
+        self.worker = worker
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=concurrency,
+            thread_name_prefix='event-worker',
+        )
+        self.in_flight = set()
+        self.thread_state = threading.local()
+        self.pg_conns = []
+        self.pg_conns_lock = threading.Lock()
 
-        run_event_handler(
-            pg_conn,
+    def _run(self, event):
+        state = self.thread_state
+        if not hasattr(state, 'pg_conn'):
+            state.pg_conn = PgConnWrapper(self.config)
+            state.event_handler_map = make_event_handler_map(
+                self.config,
+                self.http_client_cls,
+            )
+            with self.pg_conns_lock:
+                self.pg_conns.append(state.pg_conn)
+        process_event(
+            state.pg_conn,
+            state.event_handler_map,
             event,
-            handler,
+            self.fault_hooks,
+            self.event_counter,
+            self.worker,
         )
-        pg_conn.commit()
 
-    pg_conn.close()
+    @property
+    def free_slots(self):
+        return self.concurrency - len(self.in_flight)
 
+    def submit(self, event):
+        self.in_flight.add(self.executor.submit(self._run, event))
 
-def setup_schema(pg_conn):
+    def wait(self, timeout=None):
+        # Blocks until at least one in-flight event is done (or until
+        # `timeout` expires), and returns whether any is. Exceptions that
+        # escaped `run_event_handler` are re-raised here, just as they'd
+        # propagate out of the loop in the single-threaded case.
+        done, self.in_flight = concurrent.futures.wait(
+            self.in_flight,
+            timeout=timeout,
+            return_when=concurrent.futures.FIRST_COMPLETED,
+        )
+        for future in done:
+            future.result()
+        return bool(done)
+
+    def shutdown(self):
+        # Lets in-flight events finish; nothing new is submitted by now.
+        # The first exception that escaped one is re-raised, but only
+        # once the threads' connections are closed.
+        self.executor.shutdown(wait=True)
+        try:
+            for future in self.in_flight:
+                future.result()
+        finally:
+            self.in_flight.clear()
+            for pg_conn in self.pg_conns:
+                pg_conn.close()
+
+
+def wait_for_in_flight_events(worker_pool, listener, timeout):
+    # Returns once an in-flight event is done, which may unblock others
+    # that depend on it, or the triggers notify us that an event was
+    # queued, or `timeout` seconds have passed, whichever comes first.
+    deadline = time.monotonic() + timeout
+    while worker_pool.in_flight:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        if worker_pool.wait(timeout=min(IN_FLIGHT_POLL_INTERVAL,
+                                        remaining)):
+            break
+        if listener.wait(0):
+            break
+
+
+class WorkerHeartbeatThread(threading.Thread):
+    """
+    Registers this indexer process as a worker when started, sends a
+    heartbeat every `HEARTBEAT_INTERVAL` seconds (see `send_heartbeat`),
+    and deregisters it when stopped. Uses its own database connection,
+    so that it's never held up by a handler.
+    """
+
+    def __init__(self, config, worker, interval=HEARTBEAT_INTERVAL):
+        super().__init__(name='worker-heartbeat', daemon=True)
+        self.pg_conn = PgConnWrapper(config)
+        self.worker = worker
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def start(self):
+        register_worker(self.pg_conn, self.worker)
+        super().start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                send_heartbeat(self.pg_conn, self.worker)
+            except Exception as exc:
+                # The leases are long enough to survive a missed
+                # heartbeat or two.
+                self.pg_conn.rollback()
+                logging.error('Failed to send heartbeat: %s', exc)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        try:
+            deregister_worker(self.pg_conn, self.worker)
+        except Exception as exc:
+            # It'll be presumed dead before long.
+            logging.error('Failed to deregister worker: %s', exc)
+        self.pg_conn.close()
+
+
+class EventCleanupThread(threading.Thread):
+    """
+    Runs `cleanup_events` every `CLEANUP_INTERVAL` seconds (starting
+    right away) on its own database connection, so that it keeps up even
+    while the indexer never runs out of events to handle.
+
+    Only one indexer process, the one holding the maintenance lock, does
+    so at a time; see `try_maintenance_lock`.
+    """
+
+    def __init__(self, config, interval=CLEANUP_INTERVAL):
+        super().__init__(name='event-cleanup', daemon=True)
+        # Not pooled, since the maintenance lock lasts as long as the
+        # session.
+        self.pg_conn = PgConnWrapper(config, maintenance_db_section(config),
+                                     pooled=False)
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        has_lock = False
+        while True:
+            try:
+                if self.pg_conn.closed:
+                    # The lock went with the old session, if any.
+                    has_lock = False
+                if not has_lock:
+                    has_lock = try_maintenance_lock(self.pg_conn)
+                    if has_lock:
+                        logging.info('Took over maintenance tasks')
+                if has_lock:
+                    cleanup_events(self.pg_conn)
+            except Exception as exc:
+                # Try again next time, rather than stopping cleanup for
+                # the rest of the indexer's lifetime.
+                self.pg_conn.rollback()
+                logging.error('Cleanup failed: %s', exc)
+                try:
+                    sentry_sdk.capture_exception(exc)
+                except BaseException as sentry_exc:
+                    logging.error(sentry_exc)
+            if self.stopped.wait(self.interval):
+                break
+
+    def stop(self):
+        # Waits for any cleanup in progress to finish.
+        self.stopped.set()
+        self.join()
+        self.pg_conn.close()
+
+
+def indexer(
+    config,
+    pg_conn,
+    maxwait,
+    max_idle_loops=inf,
+    http_client_cls=requests.Session,
+    claim_batch_size=1,
+    concurrency=1,
+    event_counter=None,
+):
+    sleep_amount = 1  # seconds
+
+    listener = PgNotifyListener(config)
+
+    # Used by tests to delay or crash the loop at specific points;
+    # empty in production.
+    fault_hooks = load_fault_hooks(config)
+
+    # Keeps the events we've claimed from being re-queued as abandoned.
+    worker = WorkerState(concurrency)
+    heartbeat_thread = WorkerHeartbeatThread(config, worker)
+    heartbeat_thread.start()
+
+    # With a concurrency of 1, events are handled inline on `pg_conn`.
+    # Otherwise this loop only claims events and hands them off to a pool
+    # of worker threads, which is worthwhile because the handlers spend
+    # most of their time waiting on the IA.
+    if concurrency > 1:
+        worker_pool = EventWorkerPool(
+            config,
+            http_client_cls,
+            concurrency,
+            fault_hooks,
+            event_counter,
+            worker,
+        )
+    else:
+        worker_pool = None
+        event_handler_map = make_event_handler_map(config, http_client_cls)
+
+    # Only used to prefetch image rows on `pg_conn`, so they need no
+    # HTTP session.
+    prefetch_handler_map = {
+        entity: cls(config, None)
+        for entity, cls in EVENT_HANDLER_CLASSES.items()
+    }
+
+    cleanup_thread = EventCleanupThread(config)
+    cleanup_thread.start()
+
+    idle_loops = 0
+
+    # Events that have been claimed (and marked as running) but not yet
+    # handled. At most `claim_batch_size` are claimed at a time, and we
+    # only claim more once these are exhausted.
+    claimed_events = collections.deque()
+
+    try:
+        while not SHUTDOWN_SIGNAL:
+            if worker_pool and not worker_pool.free_slots:
+                worker_pool.wait()
+                continue
+
+            if not claimed_events:
+                claim_start = time.monotonic()
+                new_events = claim_events(pg_conn, claim_batch_size,
+                                          worker.id, fault_hooks)
+                worker.add_events(new_events,
+                                  time.monotonic() - claim_start)
+                claimed_events.extend(new_events)
+                prefetch_image_rows(pg_conn, prefetch_handler_map,
+                                    new_events)
+
+            # While events keep coming, drain the queue without sleeping.
+            # Once it's empty, back off exponentially up to `maxwait`
+            # seconds, and reset the delay as soon as we see activity
+            # again.
+            if claimed_events:
+                sleep_amount = 1
+                idle_loops = 0
+            elif worker_pool and worker_pool.in_flight:
+                # Not idle yet: the running events may complete, and
+                # unblock others that depend on them, or new ones may be
+                # queued in the meantime.
+                wait_for_in_flight_events(worker_pool, listener, maxwait)
+                continue
+            else:
+                idle_loops += 1
+                if idle_loops >= max_idle_loops:
+                    break
+
+                if sleep_amount < maxwait:
+                    logging.info(
+                        'No event found; sleeping for %s second(s)',
+                        sleep_amount,
+                    )
+                # Wake up early if the triggers tell us an event was queued.
+                listener.wait(sleep_amount)
+                sleep_amount = min(sleep_amount * 2, maxwait)
+                continue
+
+            event = claimed_events.popleft()
+
+            if worker_pool:
+                worker_pool.submit(event)
+            else:
+                process_event(pg_conn, event_handler_map, event, fault_hooks,
+                              event_counter, worker)
+    finally:
+        # On shutdown, wait for the events that are already being handled,
+        # and put back the ones that were claimed but never started. Each
+        # step is taken even if one before it raises (e.g. an in-flight
+        # event's exception, re-raised by `shutdown`), so that claimed
+        # events aren't left running until their leases expire, nor this
+        # process registered as a worker.
+        try:
+            if worker_pool:
+                worker_pool.shutdown()
+        finally:
+            cleanup_thread.stop()
+            try:
+                if claimed_events:
+                    # Whatever failed may have left a transaction open.
+                    pg_conn.rollback()
+                    release_events(pg_conn, claimed_events)
+            finally:
+                heartbeat_thread.stop()
+                listener.close()
+                pg_conn.close()
+
+
+# Generated by generate_code.py. They replace any existing functions and
+# triggers, so `upgrade_schema` re-runs them to install the latest ones.
+TRIGGER_SQL_FILES = (
+    'caa_functions',
+    'eaa_functions',
+    'caa_triggers',
+    'eaa_triggers',
+)
+
+
+def run_sql_file(pg_conn, file_name):
+    curdir = os.path.dirname(__file__)
+    with open(os.path.join(curdir, 'sql', file_name + '.sql')) as fp:
+        pg_conn.execute(fp.read())
+
+
+def get_schema_update_names():
     curdir = os.path.dirname(__file__)
+    return sorted(
+        os.path.splitext(file_name)[0]
+        for file_name in os.listdir(os.path.join(curdir, 'sql', 'updates'))
+        if file_name.endswith('.sql')
+    )
 
-    schema_exists = pg_conn.execute(dedent('''
+
+def schema_exists(pg_conn):
+    return pg_conn.execute(dedent('''
         SELECT TRUE
           FROM information_schema.schemata
          WHERE schema_name = 'artwork_indexer';
-    ''')).fetchone()
-    if schema_exists:
+    ''')).fetchone() is not None
+
+
+def setup_schema(pg_conn):
+    if schema_exists(pg_conn):
         logging.error(
             'ERROR: The `artwork_indexer` schema already exists. ' +
             'If you would like to recreate it, drop it first.',
         )
         sys.exit(1)
 
-    for file_name in (
-        'create_schema',
-        'caa_functions',
-        'eaa_functions',
-        'caa_triggers',
-        'eaa_triggers',
-    ):
-        with open(os.path.join(curdir, 'sql', file_name + '.sql')) as fp:
-            pg_conn.execute(fp.read())
+    run_sql_file(pg_conn, 'create_schema')
+    for file_name in TRIGGER_SQL_FILES:
+        run_sql_file(pg_conn, file_name)
+    pg_conn.execute(CREATE_EVENT_PARTITIONS_QUERY)
+
+    # create_schema.sql is always up-to-date.
+    for update_name in get_schema_update_names():
+        pg_conn.execute(dedent('''
+            INSERT INTO artwork_indexer.schema_update (name)
+            VALUES (%(name)s)
+        '''), {'name': update_name})
+
+    pg_conn.commit()
+
+
+def upgrade_schema(pg_conn):
+    # Applies the scripts in sql/updates/ that haven't been yet, in order
+    # of their names, then reinstalls the functions and triggers. It's
+    # all done in one transaction, so a failed upgrade changes nothing.
+    # Stop the indexer first: it may depend on the changes.
+    if not schema_exists(pg_conn):
+        logging.error(
+            'ERROR: The `artwork_indexer` schema doesn\'t exist. ' +
+            'Install it with --setup-schema instead.',
+        )
+        sys.exit(1)
+
+    # Schemas installed before sql/updates/ existed lack this table.
+    pg_conn.execute(dedent('''
+        CREATE TABLE IF NOT EXISTS artwork_indexer.schema_update (
+            name                TEXT NOT NULL,
+            applied             TIMESTAMP WITH TIME ZONE NOT NULL
+                                DEFAULT NOW(),
+            CONSTRAINT schema_update_pkey PRIMARY KEY (name)
+        )
+    '''))
+
+    applied_update_names = {
+        row['name'] for row in pg_conn.execute(dedent('''
+            SELECT name FROM artwork_indexer.schema_update
+        ''')).fetchall()
+    }
+
+    for update_name in get_schema_update_names():
+        if update_name in applied_update_names:
+            continue
+        logging.info(f'Applying schema update {update_name}')
+        run_sql_file(pg_conn, os.path.join('updates', update_name))
+        pg_conn.execute(dedent('''
+            INSERT INTO artwork_indexer.schema_update (name)
+            VALUES (%(name)s)
+        '''), {'name': update_name})
+
+    for file_name in TRIGGER_SQL_FILES:
+        run_sql_file(pg_conn, file_name)
+    pg_conn.execute(CREATE_EVENT_PARTITIONS_QUERY)
 
     pg_conn.commit()
 
@@ -367,10 +1299,36 @@ def main():
                             dest='max_idle_loops',
                             type=int,
                             default=inf)
+    arg_parser.add_argument('--claim-batch-size',
+                            help='number of events to claim at a time',
+                            dest='claim_batch_size',
+                            type=int,
+                            default=1)
+    arg_parser.add_argument('--concurrency',
+                            help='number of events to handle in parallel',
+                            dest='concurrency',
+                            type=int,
+                            default=1)
+    arg_parser.add_argument('--engine',
+                            help='run event handlers on threads (sync) ' +
+                                 'or an asyncio event loop (async)',
+                            dest='engine',
+                            choices=('sync', 'async'),
+                            default='sync')
+    arg_parser.add_argument('--workers',
+                            help='fork this many worker processes, and ' +
+                                 'restart them if they crash',
+                            dest='workers',
+                            type=int,
+                            default=0)
     arg_parser.add_argument('--setup-schema',
                             help='install the schema and exit',
                             dest='setup_schema',
                             action='store_true')
+    arg_parser.add_argument('--upgrade-schema',
+                            help='apply pending schema updates and exit',
+                            dest='upgrade_schema',
+                            action='store_true')
     args = arg_parser.parse_args()
 
     logger = logging.getLogger()
@@ -379,33 +1337,57 @@ def main():
     config = configparser.ConfigParser()
     config.read(args.config)
 
-    pg_conn = PgConnWrapper(config)
-
     if args.setup_schema:
-        setup_schema(pg_conn)
+        setup_schema(PgConnWrapper(config, pooled=False))
+        sys.exit(0)
+
+    if args.upgrade_schema:
+        upgrade_schema(PgConnWrapper(config, pooled=False))
         sys.exit(0)
 
-    def reload_configuration(signum, frame):
-        logging.info('Got SIGHUP, reloading configuration')
-        config.read('config.ini')
+    def run_worker(event_counter=None):
+        def reload_configuration(signum, frame):
+            logging.info('Got SIGHUP, reloading configuration')
+            config.read('config.ini')
 
-    signal.signal(signal.SIGHUP, reload_configuration)
+        signal.signal(signal.SIGHUP, reload_configuration)
 
-    def shutdown(signum, frame):
-        logging.info(f'Got signal {signum}, shutting down')
-        global SHUTDOWN_SIGNAL
-        SHUTDOWN_SIGNAL = True
+        def shutdown(signum, frame):
+            logging.info(f'Got signal {signum}, shutting down')
+            global SHUTDOWN_SIGNAL
+            SHUTDOWN_SIGNAL = True
 
-    signal.signal(signal.SIGTERM, shutdown)
-    signal.signal(signal.SIGINT, shutdown)
+        signal.signal(signal.SIGTERM, shutdown)
+        signal.signal(signal.SIGINT, shutdown)
 
-    if 'sentry' in config:
-        sentry_dsn = config['sentry'].get('dsn')
-        if sentry_dsn:
-            sentry_sdk.init(dsn=sentry_dsn)
+        # Initialized per worker, since the SDK's background thread
+        # doesn't survive a fork.
+        if 'sentry' in config:
+            sentry_dsn = config['sentry'].get('dsn')
+            if sentry_dsn:
+                sentry_sdk.init(dsn=sentry_dsn)
 
-    indexer(config, pg_conn, args.maxwait,
-            max_idle_loops=args.max_idle_loops)
+        if args.engine == 'async':
+            # Imported here, since indexer_async imports this module.
+            import indexer_async
+            indexer_async.run(config, args.maxwait,
+                              max_idle_loops=args.max_idle_loops,
+                              claim_batch_size=args.claim_batch_size,
+                              concurrency=args.concurrency,
+                              event_counter=event_counter)
+            return
+
+        indexer(config, PgConnWrapper(config), args.maxwait,
+                max_idle_loops=args.max_idle_loops,
+                claim_batch_size=args.claim_batch_size,
+                concurrency=args.concurrency,
+                event_counter=event_counter)
+        close_pools()
+
+    if args.workers:
+        WorkerSupervisor(args.workers, run_worker).run()
+    else:
+        run_worker()
 
 
 if __name__ == '__main__':
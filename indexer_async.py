@@ -0,0 +1,648 @@
+# artwork-indexer - update artwork index files at the Internet Archive
+#
+# Copyright (C) 2026  MetaBrainz Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# An asyncio version of the `indexer` event loop, selected with
+# `--engine=async`. It runs the same queries as indexer.py, and the
+# `*_async` variants of the handler methods, so the two engines behave
+# identically apart from how events are run concurrently. Comments
+# explaining the queue semantics live with the sync functions.
+
+import asyncio
+import collections
+import logging
+import signal
+import time
+import traceback
+from math import inf
+
+import httpx
+import psycopg
+import requests
+import sentry_sdk
+from psycopg.types.json import Jsonb
+
+import handlers_base
+from fault_injection import inject_fault_async, load_fault_hooks
+from handlers import EVENT_HANDLER_CLASSES
+from indexer import (
+    CLAIM_EVENTS_QUERY,
+    CLEANUP_BATCH_SIZE,
+    CLEANUP_INTERVAL,
+    COMPLETE_EVENT_QUERY,
+    CREATE_EVENT_PARTITIONS_QUERY,
+    DELETE_DEAD_WORKERS_QUERY,
+    DELETE_EVENT_QUERY,
+    DEREGISTER_WORKER_QUERY,
+    DROP_OLD_EVENT_PARTITIONS_QUERY,
+    EVENT_LEASE_DURATION,
+    EXTEND_EVENT_LEASES_ATTEMPTS,
+    EXTEND_EVENT_LEASES_QUERY,
+    FAIL_DEPENDENT_EVENTS_QUERY,
+    FIND_EXPIRED_EVENTS_QUERY,
+    FIND_QUEUED_DUPLICATE_QUERY,
+    HEARTBEAT_INTERVAL,
+    IN_FLIGHT_POLL_INTERVAL,
+    INSERT_FAILURE_REASON_QUERY,
+    LOCK_EVENT_CLAIMS_QUERY,
+    MAX_ATTEMPTS,
+    PARTITION_LOCK_TIMEOUT_QUERY,
+    PREFETCH_MAX_IMAGE_ROWS,
+    REGISTER_WORKER_QUERY,
+    REPLACE_DEPENDENCY_QUERY,
+    REQUEUE_EVENT_QUERY,
+    RETRY_OR_FAIL_EVENT_QUERY,
+    TRY_MAINTENANCE_LOCK_QUERY,
+    WORKER_HEARTBEAT_QUERY,
+    WorkerState,
+    group_gids_to_prefetch,
+    log_lost_lease,
+    maintenance_db_section,
+)
+from pg_conn_wrapper import (
+    AsyncPgConnWrapper,
+    PgNotifyListener,
+    close_async_pools,
+)
+
+# When set to True, indicates to the `indexer` event loop that it should
+# stop once idle. (Separate from `indexer.SHUTDOWN_SIGNAL`, because this
+# engine installs its own signal handlers on the event loop.)
+SHUTDOWN_SIGNAL = False
+
+
+async def handle_event_failure(pg_conn, event, error):
+    logging.error(error)
+    logging.error(''.join(traceback.format_tb(error.__traceback__)))
+
+    # See `indexer.handle_event_failure`.
+    pg_cur = await pg_conn.execute_with_retry(RETRY_OR_FAIL_EVENT_QUERY, {
+        'max_attempts': MAX_ATTEMPTS,
+        'event_id': event['id'],
+        'worker_id': event['worker'],
+    })
+
+    if pg_cur.rowcount:
+        await pg_conn.execute_with_retry(INSERT_FAILURE_REASON_QUERY, {
+            'event_id': event['id'],
+            'error': str(error),
+        })
+
+        event_id = event['id']
+        await pg_conn.execute_with_retry(FAIL_DEPENDENT_EVENTS_QUERY, {
+            'event_id': event_id,
+            'failure_reason': 'This event was marked as failed because '
+                              f'an event it depended on ({event_id}) '
+                              'had failed.',
+        })
+    else:
+        log_lost_lease(event, 'failed')
+
+    try:
+        sentry_sdk.capture_exception(error)
+    except BaseException as sentry_exc:
+        logging.error(sentry_exc)
+
+
+async def maintain_event_partitions(pg_conn):
+    # See `indexer.maintain_event_partitions`.
+    try:
+        await pg_conn.execute(PARTITION_LOCK_TIMEOUT_QUERY)
+        await pg_conn.execute(CREATE_EVENT_PARTITIONS_QUERY)
+        pg_cur = await pg_conn.execute(DROP_OLD_EVENT_PARTITIONS_QUERY)
+        dropped_partitions = [row['name'] for row in await pg_cur.fetchall()]
+        await pg_conn.commit()
+    except psycopg.errors.LockNotAvailable as exc:
+        await pg_conn.rollback()
+        logging.warning('Skipped partition maintenance: %s', exc)
+        return None
+    return dropped_partitions
+
+
+async def cleanup_events(pg_conn):
+    # See `indexer.cleanup_events`.
+    for partition_name in await maintain_event_partitions(pg_conn) or ():
+        logging.info('Dropped %s (events completed over 90 days ago)',
+                     partition_name)
+
+    await delete_dead_workers(pg_conn)
+    await requeue_expired_events(pg_conn)
+
+
+async def requeue_expired_events(pg_conn, batch_size=CLEANUP_BATCH_SIZE):
+    # See `indexer.requeue_expired_events`.
+    while True:
+        pg_cur = await pg_conn.execute(FIND_EXPIRED_EVENTS_QUERY, {
+            'limit': batch_size,
+        })
+        expired_events = await pg_cur.fetchall()
+        for event in expired_events:
+            logging.warning('Lease expired for event id=%s', event['id'])
+        await release_events(pg_conn, expired_events)
+        if len(expired_events) < batch_size:
+            break
+
+
+async def delete_dead_workers(pg_conn):
+    # See `indexer.delete_dead_workers`.
+    pg_cur = await pg_conn.execute(DELETE_DEAD_WORKERS_QUERY, {
+        'lease_duration': EVENT_LEASE_DURATION,
+    })
+    dead_workers = await pg_cur.fetchall()
+    await pg_conn.commit()
+    for worker in dead_workers:
+        logging.warning('Worker id=%s (pid %s on %s) stopped responding',
+                        worker['id'], worker['pid'], worker['host'])
+
+
+async def register_worker(pg_conn, worker):
+    # See `indexer.register_worker`.
+    pg_cur = await pg_conn.execute(REGISTER_WORKER_QUERY, {
+        'host': worker.host,
+        'pid': worker.pid,
+        'concurrency': worker.concurrency,
+    })
+    row = await pg_cur.fetchone()
+    await pg_conn.commit()
+    worker.id = row['id']
+    worker.started = row['started']
+    logging.info('Registered as worker id=%s', worker.id)
+
+
+async def send_heartbeat(pg_conn, worker):
+    # See `indexer.send_heartbeat`.
+    params = worker.get_heartbeat_params()
+    await pg_conn.execute_and_commit(WORKER_HEARTBEAT_QUERY, params)
+    if params['event_ids']:
+        await extend_event_leases(pg_conn, params)
+
+
+async def extend_event_leases(pg_conn, params):
+    # See `indexer.extend_event_leases`.
+    for attempt in range(1, EXTEND_EVENT_LEASES_ATTEMPTS + 1):
+        try:
+            await pg_conn.execute_and_commit(EXTEND_EVENT_LEASES_QUERY,
+                                             params)
+            return
+        except psycopg.errors.SerializationFailure:
+            await pg_conn.rollback()
+            if attempt == EXTEND_EVENT_LEASES_ATTEMPTS:
+                raise
+
+
+async def deregister_worker(pg_conn, worker):
+    await pg_conn.execute_and_commit(DEREGISTER_WORKER_QUERY, {
+        'worker_id': worker.id,
+    })
+
+
+async def try_maintenance_lock(pg_conn):
+    # See `indexer.try_maintenance_lock`.
+    pg_cur = await pg_conn.execute(TRY_MAINTENANCE_LOCK_QUERY)
+    locked = (await pg_cur.fetchone())['locked']
+    await pg_conn.commit()
+    return locked
+
+
+async def run_event_cleanup(config, stopped, interval=CLEANUP_INTERVAL):
+    # See `indexer.EventCleanupThread`; runs as a task until `stopped`
+    # (an `asyncio.Event`) is set.
+    # Not pooled, for the same reason.
+    pg_conn = AsyncPgConnWrapper(config, maintenance_db_section(config),
+                                 pooled=False)
+    has_lock = False
+    try:
+        while True:
+            try:
+                if pg_conn.closed:
+                    has_lock = False
+                if not has_lock:
+                    has_lock = await try_maintenance_lock(pg_conn)
+                    if has_lock:
+                        logging.info('Took over maintenance tasks')
+                if has_lock:
+                    await cleanup_events(pg_conn)
+            except Exception as exc:
+                await pg_conn.rollback()
+                logging.error('Cleanup failed: %s', exc)
+                try:
+                    sentry_sdk.capture_exception(exc)
+                except BaseException as sentry_exc:
+                    logging.error(sentry_exc)
+            try:
+                await asyncio.wait_for(stopped.wait(), interval)
+                break
+            except TimeoutError:
+                pass
+    finally:
+        await pg_conn.close()
+
+
+async def claim_events(pg_conn, limit, worker_id=None, fault_hooks=None):
+    # See `indexer.claim_events`.
+    await pg_conn.execute(LOCK_EVENT_CLAIMS_QUERY)
+    pg_cur = await pg_conn.execute(CLAIM_EVENTS_QUERY, {
+        'max_attempts': MAX_ATTEMPTS,
+        'limit': limit,
+        'lease_duration': EVENT_LEASE_DURATION,
+        'worker_id': worker_id,
+    })
+    events = await pg_cur.fetchall()
+    if fault_hooks:
+        await inject_fault_async(fault_hooks, 'before_claim_commit', events)
+    await pg_conn.commit()
+    events.sort(key=lambda event: (event['next_attempt_at'], event['id']))
+    return events
+
+
+async def prefetch_image_rows(pg_conn, event_handler_map, events,
+                              max_rows=PREFETCH_MAX_IMAGE_ROWS):
+    # See `indexer.prefetch_image_rows`.
+    gids_by_entity_type = group_gids_to_prefetch(event_handler_map, events)
+    if not gids_by_entity_type:
+        return
+    try:
+        for entity_type, gids in gids_by_entity_type.items():
+            handler = event_handler_map[entity_type]
+            image_rows_by_gid = await handler.fetch_image_rows_batch_async(
+                pg_conn,
+                gids,
+                max_rows=max_rows,
+            )
+            handlers_base.store_prefetched_image_rows(
+                entity_type,
+                image_rows_by_gid,
+            )
+            max_rows -= sum(map(len, image_rows_by_gid.values()))
+        await pg_conn.commit()
+    except Exception as exc:
+        await pg_conn.rollback()
+        logging.error('Failed to prefetch image rows: %s', exc)
+
+
+async def release_events(pg_conn, events):
+    # See `indexer.release_events`.
+    for event in events:
+        handlers_base.discard_prefetched_image_rows(event)
+
+        pg_cur = await pg_conn.execute(FIND_QUEUED_DUPLICATE_QUERY, {
+            'entity_type': event['entity_type'],
+            'action': event['action'],
+            'message': Jsonb(event['message']),
+        })
+        duplicate = await pg_cur.fetchone()
+
+        if duplicate:
+            await pg_conn.execute(REPLACE_DEPENDENCY_QUERY, {
+                'event_id': event['id'],
+                'duplicate_id': duplicate['id'],
+            })
+            await pg_conn.execute(DELETE_EVENT_QUERY, {
+                'event_id': event['id'],
+            })
+            logging.info(
+                'Event id=%s was superseded by id=%s; deleted it',
+                event['id'],
+                duplicate['id'],
+            )
+        else:
+            await pg_conn.execute(REQUEUE_EVENT_QUERY, {
+                'event_id': event['id'],
+            })
+            logging.info('Event id=%s was released', event['id'])
+    await pg_conn.commit()
+
+
+async def run_event_handler(pg_conn, event, handler):
+    handler_method = getattr(handler, event['action'] + '_async')
+    try:
+        await handler_method(pg_conn, event)
+    except Exception as task_exc:
+        # Unlike the sync version, don't catch BaseException here:
+        # `asyncio.CancelledError` must be allowed to propagate.
+        await handle_event_failure(pg_conn, event, task_exc)
+    else:
+        logging.info(
+            'Event id=%s completed succesfully',
+            event['id'],
+        )
+        pg_cur = await pg_conn.execute_with_retry(COMPLETE_EVENT_QUERY, {
+            'event_id': event['id'],
+            'worker_id': event['worker'],
+        })
+        if not pg_cur.rowcount:
+            log_lost_lease(event, 'completed')
+
+
+def make_http_session(concurrency):
+    # Every in-flight event makes at most one request at a time, so this
+    # many connections are enough to never wait for a free one.
+    return httpx.AsyncClient(limits=httpx.Limits(
+        max_connections=concurrency,
+        max_keepalive_connections=concurrency,
+    ))
+
+
+def make_event_handler_map(config, http_session):
+    http_session.headers.update({
+        'user-agent': 'metabrainz/artwork-indexer ' +
+                      f'({requests.utils.default_user_agent()})',
+    })
+
+    return {
+        entity: cls(config, http_session)
+        for entity, cls in EVENT_HANDLER_CLASSES.items()
+    }
+
+
+async def process_event(pg_conn,
+                        event_handler_map,
+                        event,
+                        fault_hooks,
+                        event_counter=None,
+                        worker=None):
+    if fault_hooks:
+        await inject_fault_async(fault_hooks, 'after_claim', event)
+
+    logging.info('Processing event %s', event)
+
+    handler = event_handler_map[event['entity_type']]
+
+    if fault_hooks:
+        await inject_fault_async(fault_hooks, 'before_handler', event)
+
+    await run_event_handler(
+        pg_conn,
+        event,
+        handler,
+    )
+    handlers_base.discard_prefetched_image_rows(event)
+    await pg_conn.commit()
+
+    if worker is not None:
+        worker.finish_event(event)
+
+    if event_counter is not None:
+        with event_counter.get_lock():
+            event_counter.value += 1
+
+    if fault_hooks:
+        await inject_fault_async(fault_hooks, 'after_handler', event)
+
+
+class WorkerHeartbeatTask:
+    """
+    See `indexer.WorkerHeartbeatThread`; sends heartbeats from a task on
+    the event loop, between `start` and `stop`.
+    """
+
+    def __init__(self, config, worker, interval=HEARTBEAT_INTERVAL):
+        self.pg_conn = AsyncPgConnWrapper(config)
+        self.worker = worker
+        self.interval = interval
+        self.stopped = asyncio.Event()
+        self.task = None
+
+    async def start(self):
+        await register_worker(self.pg_conn, self.worker)
+        self.task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.stopped.wait(), self.interval)
+                break
+            except TimeoutError:
+                pass
+            try:
+                await send_heartbeat(self.pg_conn, self.worker)
+            except Exception as exc:
+                await self.pg_conn.rollback()
+                logging.error('Failed to send heartbeat: %s', exc)
+
+    async def stop(self):
+        self.stopped.set()
+        await self.task
+        try:
+            await deregister_worker(self.pg_conn, self.worker)
+        except Exception as exc:
+            logging.error('Failed to deregister worker: %s', exc)
+        await self.pg_conn.close()
+
+
+class EventTaskPool:
+    """
+    Runs up to `concurrency` events at once as tasks on the event loop.
+    Unlike the thread pool in indexer.py, all tasks share one HTTP client
+    (and its connection pool). Each task borrows a database connection
+    from the `AsyncConnectionPool` for each of its transactions, so none
+    is held while a handler waits on the IA.
+    """
+
+    def __init__(self,
+                 config,
+                 event_handler_map,
+                 concurrency,
+                 fault_hooks,
+                 event_counter,
+                 worker):
+        self.config = config
+        self.event_handler_map = event_handler_map
+        self.concurrency = concurrency
+        self.fault_hooks = fault_hooks
+        self.event_counter = event_counter
+        self.worker = worker
+        self.in_flight = set()
+
+    async def _run(self, event):
+        pg_conn = AsyncPgConnWrapper(self.config)
+        try:
+            await process_event(
+                pg_conn,
+                self.event_handler_map,
+                event,
+                self.fault_hooks,
+                self.event_counter,
+                self.worker,
+            )
+        finally:
+            # Gives back a connection left borrowed by a failure.
+            await pg_conn.close()
+
+    @property
+    def free_slots(self):
+        return self.concurrency - len(self.in_flight)
+
+    def submit(self, event):
+        self.in_flight.add(asyncio.create_task(self._run(event)))
+
+    async def wait(self, timeout=None):
+        # See `indexer.EventWorkerPool.wait`.
+        done, self.in_flight = await asyncio.wait(
+            self.in_flight,
+            timeout=timeout,
+            return_when=asyncio.FIRST_COMPLETED,
+        )
+        for task in done:
+            task.result()
+        return bool(done)
+
+    async def shutdown(self):
+        if self.in_flight:
+            done, _ = await asyncio.wait(self.in_flight)
+            self.in_flight.clear()
+            for task in done:
+                task.result()
+
+
+async def wait_for_in_flight_events(task_pool, listener, timeout):
+    # See `indexer.wait_for_in_flight_events`.
+    deadline = time.monotonic() + timeout
+    while task_pool.in_flight:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        if await task_pool.wait(timeout=min(IN_FLIGHT_POLL_INTERVAL,
+                                            remaining)):
+            break
+        if await asyncio.to_thread(listener.wait, 0):
+            break
+
+
+async def indexer(
+    config,
+    pg_conn,
+    maxwait,
+    max_idle_loops=inf,
+    http_client_cls=None,
+    claim_batch_size=1,
+    concurrency=1,
+    event_counter=None,
+):
+    # See `indexer.indexer`; `pg_conn` is an `AsyncPgConnWrapper` here,
+    # and `http_client_cls` must return an `httpx.AsyncClient` (or an
+    # equivalent).
+    sleep_amount = 1  # seconds
+
+    if http_client_cls is None:
+        http_session = make_http_session(concurrency)
+    else:
+        http_session = http_client_cls()
+
+    listener = PgNotifyListener(config)
+
+    fault_hooks = load_fault_hooks(config)
+
+    worker = WorkerState(concurrency)
+    heartbeat_task = WorkerHeartbeatTask(config, worker)
+    await heartbeat_task.start()
+
+    event_handler_map = make_event_handler_map(config, http_session)
+
+    task_pool = EventTaskPool(
+        config,
+        event_handler_map,
+        concurrency,
+        fault_hooks,
+        event_counter,
+        worker,
+    )
+
+    cleanup_stopped = asyncio.Event()
+    cleanup_task = asyncio.create_task(
+        run_event_cleanup(config, cleanup_stopped),
+    )
+
+    idle_loops = 0
+
+    claimed_events = collections.deque()
+
+    try:
+        while not SHUTDOWN_SIGNAL:
+            if not task_pool.free_slots:
+                await task_pool.wait()
+                continue
+
+            if not claimed_events:
+                claim_start = time.monotonic()
+                new_events = await claim_events(pg_conn, claim_batch_size,
+                                                worker.id, fault_hooks)
+                worker.add_events(new_events,
+                                  time.monotonic() - claim_start)
+                claimed_events.extend(new_events)
+                await prefetch_image_rows(pg_conn, event_handler_map,
+                                          new_events)
+
+            if claimed_events:
+                sleep_amount = 1
+                idle_loops = 0
+            elif task_pool.in_flight:
+                await wait_for_in_flight_events(task_pool, listener,
+                                                maxwait)
+                continue
+            else:
+                idle_loops += 1
+                if idle_loops >= max_idle_loops:
+                    break
+
+                if sleep_amount < maxwait:
+                    logging.info(
+                        'No event found; sleeping for %s second(s)',
+                        sleep_amount,
+                    )
+                # The listener is blocking, so wait for it in a thread.
+                await asyncio.to_thread(listener.wait, sleep_amount)
+                sleep_amount = min(sleep_amount * 2, maxwait)
+                continue
+
+            task_pool.submit(claimed_events.popleft())
+    finally:
+        # See `indexer.indexer`: each step is taken even if one before it
+        # raises.
+        try:
+            await task_pool.shutdown()
+        finally:
+            try:
+                await http_session.aclose()
+            finally:
+                cleanup_stopped.set()
+                await cleanup_task
+                try:
+                    if claimed_events:
+                        await pg_conn.rollback()
+                        await release_events(pg_conn, claimed_events)
+                finally:
+                    await heartbeat_task.stop()
+                    listener.close()
+                    await pg_conn.close()
+                    await close_async_pools()
+
+
+def request_shutdown(signum):
+    logging.info(f'Got signal {signum}, shutting down')
+    global SHUTDOWN_SIGNAL
+    SHUTDOWN_SIGNAL = True
+
+
+def run(config, maxwait, **kwargs):
+    async def main():
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, request_shutdown, signum)
+        await indexer(config, AsyncPgConnWrapper(config), maxwait, **kwargs)
+
+    asyncio.run(main())
@@ -0,0 +1,409 @@
+# artwork-indexer - update artwork index files at the Internet Archive
+#
+# Copyright (C) 2026  MetaBrainz Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+# Renders `_mb_metadata.xml` from the MusicBrainz database, for projects
+# configured with `{abbr}_metadata_source=database` (see
+# config.default.ini), instead of fetching it from the web service.
+#
+# The documents follow the web service's format (mmd-2.0), element for
+# element, for what it would return with each project's `ws_inc_params`,
+# and are checked against its recorded output (see
+# tests/record_golden.py). Two things are known to differ: relationships
+# are rendered without their attributes (`<attribute-list>`), and a
+# related place with only its name, not its address, coordinates or
+# area. So the events that have either get less detailed XML than from
+# the web service, which stays the default `{abbr}_metadata_source`.
+
+import xml.etree.ElementTree as ET
+from textwrap import dedent
+
+
+MMD_NAMESPACE = 'http://musicbrainz.org/ns/mmd-2.0#'
+
+XML_DECLARATION = '<?xml version="1.0" encoding="UTF-8"?>\n'
+
+RELEASE_QUALITY_NAMES = {
+    0: 'low',
+    1: 'normal',
+    2: 'high',
+}
+
+RELEASE_METADATA_QUERY = dedent('''
+    SELECT r.gid::text AS gid,
+           r.name,
+           r.comment,
+           r.quality,
+           r.barcode,
+           rs.name AS status,
+           rs.gid::text AS status_id,
+           rp.name AS packaging,
+           rp.gid::text AS packaging_id,
+           language.iso_code_3 AS language,
+           script.iso_code AS script,
+           rm.amazon_asin,
+           rm.cover_art_presence,
+           (
+               SELECT json_agg(json_build_object(
+                   'name', acn.name,
+                   'join_phrase', acn.join_phrase,
+                   'artist_gid', a.gid,
+                   'artist_name', a.name,
+                   'artist_sort_name', a.sort_name,
+                   'artist_comment', a.comment,
+                   'artist_type', at.name,
+                   'artist_type_id', at.gid
+               ) ORDER BY acn.position)
+               FROM musicbrainz.artist_credit_name acn
+               JOIN musicbrainz.artist a ON a.id = acn.artist
+               LEFT JOIN musicbrainz.artist_type at ON at.id = a.type
+               WHERE acn.artist_credit = r.artist_credit
+           ) AS artist_credit,
+           (
+               SELECT json_agg(json_build_object(
+                   'year', re.date_year,
+                   'month', re.date_month,
+                   'day', re.date_day,
+                   'area_gid', area.gid,
+                   'area_name', area.name,
+                   'iso_3166_1_codes', (
+                       SELECT json_agg(iso.code ORDER BY iso.code)
+                       FROM musicbrainz.iso_3166_1 iso
+                       WHERE iso.area = area.id
+                   )
+               ) ORDER BY re.date_year, re.date_month, re.date_day,
+                          area.name)
+               FROM (
+                   SELECT country, date_year, date_month, date_day
+                   FROM musicbrainz.release_country
+                   WHERE release = r.id
+                   UNION ALL
+                   SELECT NULL, date_year, date_month, date_day
+                   FROM musicbrainz.release_unknown_country
+                   WHERE release = r.id
+               ) re
+               LEFT JOIN musicbrainz.area ON area.id = re.country
+           ) AS release_events,
+           ca.count AS cover_art_count,
+           ca.front AS cover_art_front,
+           ca.back AS cover_art_back
+    FROM musicbrainz.release r
+    JOIN musicbrainz.release_meta rm ON rm.id = r.id
+    LEFT JOIN musicbrainz.release_status rs ON rs.id = r.status
+    LEFT JOIN musicbrainz.release_packaging rp ON rp.id = r.packaging
+    LEFT JOIN musicbrainz.language ON language.id = r.language
+    LEFT JOIN musicbrainz.script ON script.id = r.script
+    CROSS JOIN LATERAL (
+        SELECT count(DISTINCT ca.id) AS count,
+               coalesce(bool_or(art_type.name = 'Front'), FALSE) AS front,
+               coalesce(bool_or(art_type.name = 'Back'), FALSE) AS back
+        FROM cover_art_archive.cover_art ca
+        LEFT JOIN cover_art_archive.cover_art_type cat ON cat.id = ca.id
+        LEFT JOIN cover_art_archive.art_type ON art_type.id = cat.type_id
+        WHERE ca.release = r.id
+    ) ca
+    WHERE r.gid = %(gid)s
+''')
+
+EVENT_METADATA_QUERY = dedent('''
+    SELECT e.gid::text AS gid,
+           e.name,
+           e.comment,
+           e.cancelled,
+           e.begin_date_year,
+           e.begin_date_month,
+           e.begin_date_day,
+           e.end_date_year,
+           e.end_date_month,
+           e.end_date_day,
+           e.ended,
+           e.time,
+           et.name AS type,
+           et.gid::text AS type_id,
+           (
+               SELECT json_agg(json_build_object(
+                   'type', lt.name,
+                   'type_id', lt.gid,
+                   'direction', 'backward',
+                   'begin_date_year', l.begin_date_year,
+                   'begin_date_month', l.begin_date_month,
+                   'begin_date_day', l.begin_date_day,
+                   'end_date_year', l.end_date_year,
+                   'end_date_month', l.end_date_month,
+                   'end_date_day', l.end_date_day,
+                   'ended', l.ended,
+                   'target_gid', a.gid,
+                   'target_name', a.name,
+                   'target_sort_name', a.sort_name,
+                   'target_comment', a.comment,
+                   'target_type', at.name,
+                   'target_type_id', at.gid
+               ) ORDER BY lt.name, a.name, lae.id)
+               FROM musicbrainz.l_artist_event lae
+               JOIN musicbrainz.link l ON l.id = lae.link
+               JOIN musicbrainz.link_type lt ON lt.id = l.link_type
+               JOIN musicbrainz.artist a ON a.id = lae.entity0
+               LEFT JOIN musicbrainz.artist_type at ON at.id = a.type
+               WHERE lae.entity1 = e.id
+           ) AS artist_relations,
+           (
+               SELECT json_agg(json_build_object(
+                   'type', lt.name,
+                   'type_id', lt.gid,
+                   'direction', 'forward',
+                   'begin_date_year', l.begin_date_year,
+                   'begin_date_month', l.begin_date_month,
+                   'begin_date_day', l.begin_date_day,
+                   'end_date_year', l.end_date_year,
+                   'end_date_month', l.end_date_month,
+                   'end_date_day', l.end_date_day,
+                   'ended', l.ended,
+                   'target_gid', p.gid,
+                   'target_name', p.name
+               ) ORDER BY lt.name, p.name, lep.id)
+               FROM musicbrainz.l_event_place lep
+               JOIN musicbrainz.link l ON l.id = lep.link
+               JOIN musicbrainz.link_type lt ON lt.id = l.link_type
+               JOIN musicbrainz.place p ON p.id = lep.entity1
+               WHERE lep.entity0 = e.id
+           ) AS place_relations
+    FROM musicbrainz.event e
+    LEFT JOIN musicbrainz.event_type et ON et.id = e.type
+    WHERE e.gid = %(gid)s
+''')
+
+
+def format_partial_date(year, month, day):
+    # As the web service does: 1989, 1989-10, 1989-10-02, or ????-10-02
+    # if only the year is unknown.
+    if year is None and month is None and day is None:
+        return None
+    date = '????' if year is None else '%04d' % year
+    if month is not None or day is not None:
+        date += '-' + ('??' if month is None else '%02d' % month)
+    if day is not None:
+        date += '-%02d' % day
+    return date
+
+
+def xml_bool(value):
+    return 'true' if value else 'false'
+
+
+def add_element(parent, tag, text=None, attrib=None):
+    element = ET.SubElement(parent, tag, attrib or {})
+    element.text = text
+    return element
+
+
+def add_date_period(parent, row):
+    # Adds the <begin>, <end> and <ended> elements that are set in `row`
+    # (an event, or a relationship's link) to `parent`, returning
+    # whether there were any.
+    begin = format_partial_date(row['begin_date_year'],
+                                row['begin_date_month'],
+                                row['begin_date_day'])
+    end = format_partial_date(row['end_date_year'],
+                              row['end_date_month'],
+                              row['end_date_day'])
+    if begin is not None:
+        add_element(parent, 'begin', begin)
+    if end is not None:
+        add_element(parent, 'end', end)
+    if row['ended']:
+        add_element(parent, 'ended', 'true')
+    return begin is not None or end is not None or row['ended']
+
+
+def add_artist(parent, gid, name, sort_name, comment,
+               type=None, type_id=None):
+    attrib = {'id': gid}
+    if type is not None:
+        attrib['type'] = type
+        attrib['type-id'] = type_id
+    artist = add_element(parent, 'artist', attrib=attrib)
+    add_element(artist, 'name', name)
+    add_element(artist, 'sort-name', sort_name)
+    if comment:
+        add_element(artist, 'disambiguation', comment)
+    return artist
+
+
+def add_artist_credit(parent, names):
+    artist_credit = add_element(parent, 'artist-credit')
+    for name in names:
+        attrib = {}
+        if name['join_phrase']:
+            attrib['joinphrase'] = name['join_phrase']
+        name_credit = add_element(artist_credit, 'name-credit', attrib=attrib)
+        if name['name'] != name['artist_name']:
+            add_element(name_credit, 'name', name['name'])
+        add_artist(name_credit,
+                   name['artist_gid'],
+                   name['artist_name'],
+                   name['artist_sort_name'],
+                   name['artist_comment'],
+                   name['artist_type'],
+                   name['artist_type_id'])
+
+
+def add_area(parent, release_event):
+    area = add_element(parent, 'area', attrib={
+        'id': release_event['area_gid'],
+    })
+    add_element(area, 'name', release_event['area_name'])
+    add_element(area, 'sort-name', release_event['area_name'])
+    iso_3166_1_codes = release_event['iso_3166_1_codes']
+    if iso_3166_1_codes:
+        code_list = add_element(area, 'iso-3166-1-code-list')
+        for code in iso_3166_1_codes:
+            add_element(code_list, 'iso-3166-1-code', code)
+
+
+def add_relation_list(parent, target_type, relations):
+    if not relations:
+        return
+    relation_list = add_element(parent, 'relation-list', attrib={
+        'target-type': target_type,
+    })
+    for row in relations:
+        relation = add_element(relation_list, 'relation', attrib={
+            'type': row['type'],
+            'type-id': row['type_id'],
+        })
+        add_element(relation, 'target', row['target_gid'])
+        if row['direction'] == 'backward':
+            add_element(relation, 'direction', 'backward')
+        add_date_period(relation, row)
+        if target_type == 'artist':
+            add_artist(relation,
+                       row['target_gid'],
+                       row['target_name'],
+                       row['target_sort_name'],
+                       row['target_comment'],
+                       row['target_type'],
+                       row['target_type_id'])
+        else:
+            target = add_element(relation, target_type, attrib={
+                'id': row['target_gid'],
+            })
+            add_element(target, 'name', row['target_name'])
+
+
+def serialize_metadata(entity):
+    metadata = ET.Element('metadata', {'xmlns': MMD_NAMESPACE})
+    metadata.append(entity)
+    return XML_DECLARATION + ET.tostring(metadata, encoding='unicode') + '\n'
+
+
+def build_release_metadata_xml(row):
+    release = ET.Element('release', {'id': row['gid']})
+    add_element(release, 'title', row['name'])
+    if row['status'] is not None:
+        add_element(release, 'status', row['status'],
+                    attrib={'id': row['status_id']})
+    add_element(release, 'quality',
+                RELEASE_QUALITY_NAMES.get(row['quality'], 'normal'))
+    if row['comment']:
+        add_element(release, 'disambiguation', row['comment'])
+    if row['packaging'] is not None:
+        add_element(release, 'packaging', row['packaging'],
+                    attrib={'id': row['packaging_id']})
+    if row['language'] is not None or row['script'] is not None:
+        text_representation = add_element(release, 'text-representation')
+        if row['language'] is not None:
+            add_element(text_representation, 'language', row['language'])
+        if row['script'] is not None:
+            add_element(text_representation, 'script', row['script'])
+    add_artist_credit(release, row['artist_credit'] or ())
+
+    release_events = row['release_events'] or ()
+    if release_events:
+        first_event = release_events[0]
+        date = format_partial_date(first_event['year'],
+                                   first_event['month'],
+                                   first_event['day'])
+        if date is not None:
+            add_element(release, 'date', date)
+        if first_event['iso_3166_1_codes']:
+            add_element(release, 'country',
+                        first_event['iso_3166_1_codes'][0])
+        release_event_list = add_element(
+            release,
+            'release-event-list',
+            attrib={'count': str(len(release_events))},
+        )
+        for release_event in release_events:
+            release_event_element = add_element(release_event_list,
+                                                'release-event')
+            date = format_partial_date(release_event['year'],
+                                       release_event['month'],
+                                       release_event['day'])
+            if date is not None:
+                add_element(release_event_element, 'date', date)
+            if release_event['area_gid'] is not None:
+                add_area(release_event_element, release_event)
+
+    if row['barcode'] is not None:
+        add_element(release, 'barcode', row['barcode'])
+    if row['amazon_asin']:
+        add_element(release, 'asin', row['amazon_asin'])
+
+    # Darkened releases are reported as having no artwork at all.
+    darkened = row['cover_art_presence'] == 'darkened'
+    count = 0 if darkened else row['cover_art_count']
+    cover_art_archive = add_element(release, 'cover-art-archive')
+    add_element(cover_art_archive, 'artwork', xml_bool(count > 0))
+    add_element(cover_art_archive, 'count', str(count))
+    add_element(cover_art_archive, 'front',
+                xml_bool(not darkened and row['cover_art_front']))
+    add_element(cover_art_archive, 'back',
+                xml_bool(not darkened and row['cover_art_back']))
+
+    return serialize_metadata(release)
+
+
+def build_event_metadata_xml(row):
+    attrib = {'id': row['gid']}
+    if row['type'] is not None:
+        attrib['type'] = row['type']
+        attrib['type-id'] = row['type_id']
+    event = ET.Element('event', attrib)
+    add_element(event, 'name', row['name'])
+    if row['comment']:
+        add_element(event, 'disambiguation', row['comment'])
+    if row['cancelled']:
+        add_element(event, 'cancelled', 'true')
+    life_span = ET.Element('life-span')
+    if add_date_period(life_span, row):
+        event.append(life_span)
+    if row['time'] is not None:
+        add_element(event, 'time', row['time'].strftime('%H:%M'))
+    add_relation_list(event, 'artist', row['artist_relations'])
+    add_relation_list(event, 'place', row['place_relations'])
+    return serialize_metadata(event)
+
+
+METADATA_QUERIES = {
+    'release': RELEASE_METADATA_QUERY,
+    'event': EVENT_METADATA_QUERY,
+}
+
+METADATA_XML_BUILDERS = {
+    'release': build_release_metadata_xml,
+    'event': build_event_metadata_xml,
+}
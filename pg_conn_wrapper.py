@@ -16,32 +16,233 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
+import asyncio
+import datetime
 import json
 import logging
+import threading
 import time
 
 import psycopg
+import psycopg_pool
+from psycopg import sql
+from psycopg.types.datetime import TimestamptzLoader
+
+# Settings in a database section of the config that are used for its
+# connection pool (see `PgConnWrapper`), rather than passed on to libpq.
+# Setting `pool_max_size` enables the pool. (The async engine always uses
+# one; see `ASYNC_POOL_MAX_SIZE`.)
+POOL_SETTINGS = (
+    'pool_min_size',
+    'pool_max_size',
+    # Seconds after which a connection is replaced.
+    'pool_max_lifetime',
+    # Seconds to wait for a free connection before giving up.
+    'pool_timeout',
+    # Whether to check that a connection still works before lending it.
+    'pool_check',
+)
+
+# The connection pools, one per database section, shared by all of the
+# pooled `PgConnWrapper`s (and so threads) of a process. They're created
+# on first use, which is never before the supervisor forks its workers.
+pools = {}
+pools_lock = threading.Lock()
+
+# The same for the `AsyncPgConnWrapper`s (and so tasks) of the async
+# engine, whose pools only last as long as its event loop (see
+# `close_async_pools`).
+async_pools = {}
+
+# The size of the async engine's pool when `pool_max_size` isn't set. Its
+# tasks only hold a connection for the length of a transaction, so a few
+# are enough for a much higher `--concurrency`.
+ASYNC_POOL_MAX_SIZE = 8
+
+
+class InfinityTimestamptzLoader(TimestamptzLoader):
+    """
+    Loads 'infinity' (the `completed_at` of events that haven't
+    completed) as `datetime.max`, which psycopg can't do by default.
+    """
+
+    def load(self, data):
+        if data == b'infinity':
+            return datetime.datetime.max.replace(tzinfo=datetime.UTC)
+        return super().load(data)
+
+
+def make_conninfo(config, section):
+    return psycopg.conninfo.make_conninfo(**{
+        key: value
+        for key, value in config[section].items()
+        if key not in POOL_SETTINGS
+    })
+
+
+def configure_connection(conn):
+    conn.adapters.register_loader('timestamptz', InfinityTimestamptzLoader)
+
+
+def is_pool_enabled(config, section):
+    return 'pool_max_size' in config[section]
+
+
+async def configure_connection_async(conn):
+    configure_connection(conn)
+
+
+def get_pool_kwargs(config, section, default_max_size=None):
+    settings = config[section]
+    return {
+        'kwargs': {
+            'prepare_threshold': None,
+            'row_factory': psycopg.rows.dict_row,
+        },
+        'min_size': settings.getint('pool_min_size', 1),
+        'max_size': settings.getint('pool_max_size', default_max_size),
+        'max_lifetime': settings.getfloat('pool_max_lifetime', 3600),
+        'timeout': settings.getfloat('pool_timeout', 30),
+        'name': section,
+    }
+
+
+def get_pool(config, section):
+    with pools_lock:
+        pool = pools.get(section)
+        if pool is None:
+            check = None
+            if config[section].getboolean('pool_check', False):
+                check = psycopg_pool.ConnectionPool.check_connection
+            pool = psycopg_pool.ConnectionPool(
+                make_conninfo(config, section),
+                configure=configure_connection,
+                check=check,
+                open=True,
+                **get_pool_kwargs(config, section),
+            )
+            pools[section] = pool
+        return pool
+
+
+async def get_async_pool(config, section):
+    pool = async_pools.get(section)
+    if pool is None:
+        check = None
+        if config[section].getboolean('pool_check', False):
+            check = psycopg_pool.AsyncConnectionPool.check_connection
+        pool = psycopg_pool.AsyncConnectionPool(
+            make_conninfo(config, section),
+            configure=configure_connection_async,
+            check=check,
+            open=False,
+            **get_pool_kwargs(config, section, ASYNC_POOL_MAX_SIZE),
+        )
+        async_pools[section] = pool
+    # Does nothing once it's open, but another task may still be opening
+    # it.
+    await pool.open()
+    return pool
+
+
+POOL_STATS_KEYS = (
+    'requests',
+    'requests_queued',
+    'wait_time',
+    'request_errors',
+)
+
+
+def get_pool_stats(section='database'):
+    # How many connections have been requested from the section's pool,
+    # how many of those requests had to wait, for how long in total, and
+    # how many failed (because none was free within `pool_timeout`), or
+    # None without a pool.
+    with pools_lock:
+        pool = pools.get(section) or async_pools.get(section)
+    if pool is None:
+        return None
+    stats = pool.get_stats()
+    return {
+        'requests': stats.get('requests_num', 0),
+        'requests_queued': stats.get('requests_queued', 0),
+        'wait_time': datetime.timedelta(
+            milliseconds=stats.get('requests_wait_ms', 0),
+        ),
+        'request_errors': stats.get('requests_errors', 0),
+    }
+
+
+def close_pools():
+    with pools_lock:
+        for pool in pools.values():
+            pool.close()
+        pools.clear()
+
+
+async def close_async_pools():
+    for pool in async_pools.values():
+        await pool.close()
+    async_pools.clear()
 
 
 class PgConnWrapper(object):
+    """
+    Connects to the database described by `config[section]` on first
+    use, and again if the connection is lost.
 
-    def __init__(self, config):
+    If `pool_max_size` is set in the section (and `pooled` isn't False),
+    a connection is instead borrowed from the section's pool by the first
+    `execute` of each transaction, and given back by the `commit` or
+    `rollback` that ends it, so that it's only held for as long as the
+    transaction. Connections whose session state must outlive a
+    transaction, like the maintenance lock's, mustn't be pooled.
+    """
+
+    def __init__(self, config, section='database', pooled=True):
         self.config = config
+        self.section = section
+        self.pooled = pooled and is_pool_enabled(config, section)
         self.conn = None
 
+    @property
+    def closed(self):
+        return self.conn is None or self.conn.closed
+
     def connect(self):
-        conninfo = psycopg.conninfo.make_conninfo(**self.config['database'])
+        if self.pooled:
+            # A connection we still hold has been lost; the pool discards
+            # it rather than lending it again.
+            self.release()
+            self.conn = get_pool(self.config, self.section).getconn()
+            return
         self.conn = psycopg.connect(
-            conninfo,
+            make_conninfo(self.config, self.section),
             prepare_threshold=None,
             row_factory=psycopg.rows.dict_row
         )
+        configure_connection(self.conn)
+
+    def release(self):
+        # Gives a borrowed connection back to the pool, which rolls back
+        # any transaction left open on it.
+        if self.pooled and self.conn is not None:
+            get_pool(self.config, self.section).putconn(self.conn)
+            self.conn = None
 
     def execute(self, query, params=None):
         if self.conn is None or self.conn.closed:
             self.connect()
         return self.conn.execute(query, params)
 
+    def server_cursor(self, name):
+        # Fetches the rows of the query it executes from the server
+        # as they're iterated over, rather than all at once. It only
+        # lasts until the end of the transaction.
+        if self.conn is None or self.conn.closed:
+            self.connect()
+        return self.conn.cursor(name)
+
     def execute_and_commit(self, query, params=None):
         self.execute(query, params)
         self.commit()
@@ -62,11 +263,179 @@ class PgConnWrapper(object):
                 time.sleep(30)
 
     def commit(self):
+        if self.pooled and self.conn is None:
+            # Nothing was borrowed since the last transaction ended.
+            return
         if self.conn is None or self.conn.closed:
             raise Exception('Commit called with no open connection.')
-        return self.conn.commit()
+        self.conn.commit()
+        self.release()
 
-    def close(self):
+    def rollback(self):
         if self.conn and not self.conn.closed:
+            self.conn.rollback()
+        self.release()
+
+    def close(self):
+        if self.pooled:
+            self.release()
+        elif self.conn and not self.conn.closed:
             self.conn.close()
             self.conn = None
+
+
+class AsyncPgConnWrapper(object):
+    """
+    The same as `PgConnWrapper`, but wrapping a `psycopg.AsyncConnection`
+    for the async engine. All methods are coroutines. Unlike
+    `PgConnWrapper`, it borrows from an `AsyncConnectionPool` unless
+    `pooled=False`, even if `pool_max_size` isn't set.
+    """
+
+    def __init__(self, config, section='database', pooled=True):
+        self.config = config
+        self.section = section
+        self.pooled = pooled
+        self.conn = None
+
+    @property
+    def closed(self):
+        return self.conn is None or self.conn.closed
+
+    async def connect(self):
+        if self.pooled:
+            await self.release()
+            pool = await get_async_pool(self.config, self.section)
+            self.conn = await pool.getconn()
+            return
+        self.conn = await psycopg.AsyncConnection.connect(
+            make_conninfo(self.config, self.section),
+            prepare_threshold=None,
+            row_factory=psycopg.rows.dict_row
+        )
+        configure_connection(self.conn)
+
+    async def release(self):
+        if self.pooled and self.conn is not None:
+            pool = await get_async_pool(self.config, self.section)
+            await pool.putconn(self.conn)
+            self.conn = None
+
+    async def execute(self, query, params=None):
+        if self.conn is None or self.conn.closed:
+            await self.connect()
+        return await self.conn.execute(query, params)
+
+    async def server_cursor(self, name):
+        # See `PgConnWrapper.server_cursor`.
+        if self.conn is None or self.conn.closed:
+            await self.connect()
+        return self.conn.cursor(name)
+
+    async def execute_and_commit(self, query, params=None):
+        await self.execute(query, params)
+        await self.commit()
+
+    async def execute_with_retry(self, query, params=None):
+        while True:
+            try:
+                return await self.execute(query, params)
+            except psycopg.OperationalError as exc:
+                logging.error(exc)
+                execute_args = ', '.join((
+                    json.dumps(query),
+                    json.dumps(params)
+                ))
+                logging.error(
+                    'Command failed. Retrying in 30s: ' +
+                    f'execute({execute_args})')
+                await asyncio.sleep(30)
+
+    async def commit(self):
+        if self.pooled and self.conn is None:
+            return
+        if self.conn is None or self.conn.closed:
+            raise Exception('Commit called with no open connection.')
+        await self.conn.commit()
+        await self.release()
+
+    async def rollback(self):
+        if self.conn and not self.conn.closed:
+            await self.conn.rollback()
+        await self.release()
+
+    async def close(self):
+        if self.pooled:
+            await self.release()
+        elif self.conn and not self.conn.closed:
+            await self.conn.close()
+            self.conn = None
+
+
+class PgNotifyListener(object):
+    """
+    Waits for the notifications sent by the artwork_indexer triggers
+    whenever new events are queued.
+
+    LISTEN doesn't work through pgbouncer in transaction pooling mode,
+    so this uses its own connection, configured in the
+    `[database_listener]` section (normally a direct connection to the
+    primary). Without that section, or while the connection is down,
+    `wait` simply sleeps and the indexer falls back to polling.
+    """
+
+    channel = 'artwork_indexer'
+
+    def __init__(self, config):
+        self.config = config
+        self.conn = None
+
+    @property
+    def enabled(self):
+        return 'database_listener' in self.config
+
+    def listen(self):
+        self.conn = psycopg.connect(
+            make_conninfo(self.config, 'database_listener'),
+            autocommit=True,
+        )
+        self.conn.execute(
+            sql.SQL('LISTEN {}').format(sql.Identifier(self.channel)))
+
+    def wait(self, timeout):
+        """
+        Wait up to `timeout` seconds for a notification. Returns True if
+        one was received (or may have been missed, after reconnecting).
+        """
+        if not self.enabled:
+            time.sleep(timeout)
+            return False
+
+        try:
+            if self.conn is None or self.conn.closed:
+                # Anything queued while we weren't listening would go
+                # unnoticed, so have the caller check right away.
+                self.listen()
+                return True
+
+            notified = False
+            for _ in self.conn.notifies(timeout=timeout, stop_after=1):
+                notified = True
+            if notified:
+                # Drain any others that arrived at the same time.
+                for _ in self.conn.notifies(timeout=0):
+                    pass
+            return notified
+        except psycopg.OperationalError as exc:
+            logging.error(exc)
+            logging.error(
+                'Lost the listener connection; polling for %s second(s)',
+                timeout)
+            self.close()
+            time.sleep(timeout)
+            return False
+
+    def close(self):
+        if self.conn and not self.conn.closed:
+            self.conn.close()
+        self.conn = None
@@ -55,6 +55,14 @@ CAA_PROJECT = {
     'domain': 'coverartarchive.org',
     'ia_collection': 'coverartarchive',
     'ws_inc_params': 'artists',
+    # Whether the web service XML summarizes the entity's artwork (here,
+    # the <cover-art-archive> element, with its count and whether there's
+    # a front or back image), so that adding or removing images, or
+    # changing their types, requires reindexing the metadata too.
+    'ws_artwork_summary': True,
+    # Whether the index_listing view has an `is_back` column, in which
+    # case index.json says whether each image is the back one.
+    'back_images': True,
     'indexed_metadata': (
         {
             'schema': 'musicbrainz',
@@ -137,6 +145,8 @@ EAA_PROJECT = {
     'domain': 'eventartarchive.org',
     'ia_collection': 'eventartarchive',
     'ws_inc_params': 'artist-rels+place-rels',
+    'ws_artwork_summary': False,
+    'back_images': False,
     'indexed_metadata': (
         {
             'schema': 'musicbrainz',
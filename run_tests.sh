@@ -8,5 +8,6 @@ cd "$(dirname "${BASH_SOURCE[0]}")"
 
 ./tests/test_concurrency.sh
 ./tests/test_signals.sh
+./tests/test_workers.sh
 
 exec poetry run coverage run -m unittest discover . "test_*.py"
@@ -13,6 +13,8 @@ BEGIN
     VALUES ('release', 'index', jsonb_build_object('gid', release_gid))
     ON CONFLICT DO NOTHING;
 
+    PERFORM pg_notify('artwork_indexer', '');
+
     RETURN NEW;
 END;
 $$ LANGUAGE plpgsql;
@@ -51,10 +53,13 @@ BEGIN
         ))
         RETURNING id INTO STRICT copy_event_id;
 
-        INSERT INTO artwork_indexer.event_queue (entity_type, action, message, depends_on)
-        VALUES ('release', 'delete_image', jsonb_build_object('artwork_id', OLD.id, 'gid', old_release_gid, 'suffix', suffix), array[copy_event_id])
+        INSERT INTO artwork_indexer.event_queue (entity_type, action, message)
+        VALUES ('release', 'delete_image', jsonb_build_object('artwork_id', OLD.id, 'gid', old_release_gid, 'suffix', suffix))
         RETURNING id INTO STRICT delete_event_id;
 
+        INSERT INTO artwork_indexer.event_dependency (parent, child)
+        VALUES (copy_event_id, delete_event_id);
+
         -- Check if any images remain for the old release. If not, deindex it.
         PERFORM 1 FROM cover_art_archive.cover_art
         WHERE cover_art_archive.cover_art.release = OLD.release
@@ -64,32 +69,51 @@ BEGIN
         IF FOUND THEN
             -- If there's an existing, queued index event, reset its parent to our
             -- deletion event (i.e. delay it until after the deletion executes).
-            INSERT INTO artwork_indexer.event_queue (entity_type, action, message, depends_on)
-            VALUES ('release', 'index', jsonb_build_object('gid', old_release_gid), array[delete_event_id]), ('release', 'index', jsonb_build_object('gid', new_release_gid), array[delete_event_id])
-            ON CONFLICT (entity_type, action, message) WHERE state = 'queued'
-            DO UPDATE SET depends_on = (coalesce(artwork_indexer.event_queue.depends_on, '{}') || delete_event_id);
+            WITH child AS (
+                INSERT INTO artwork_indexer.event_queue (entity_type, action, message)
+                VALUES ('release', 'index', jsonb_build_object('gid', old_release_gid)), ('release', 'index', jsonb_build_object('gid', new_release_gid))
+                ON CONFLICT (entity_type, action, message, completed_at) WHERE state = 'queued'
+                DO UPDATE SET last_updated = now()
+                RETURNING id
+            )
+            INSERT INTO artwork_indexer.event_dependency (parent, child)
+            SELECT delete_event_id, child.id FROM child;
         ELSE
-            INSERT INTO artwork_indexer.event_queue (entity_type, action, message, depends_on)
-            VALUES ('release', 'index', jsonb_build_object('gid', new_release_gid), array[delete_event_id])
-            ON CONFLICT (entity_type, action, message) WHERE state = 'queued'
-            DO UPDATE SET depends_on = (coalesce(artwork_indexer.event_queue.depends_on, '{}') || delete_event_id);
-
-            INSERT INTO artwork_indexer.event_queue (entity_type, action, message, depends_on)
-            VALUES ('release', 'deindex', jsonb_build_object('gid', old_release_gid), array[delete_event_id])
-            ON CONFLICT DO NOTHING;
+            WITH child AS (
+                INSERT INTO artwork_indexer.event_queue (entity_type, action, message)
+                VALUES ('release', 'index', jsonb_build_object('gid', new_release_gid))
+                ON CONFLICT (entity_type, action, message, completed_at) WHERE state = 'queued'
+                DO UPDATE SET last_updated = now()
+                RETURNING id
+            )
+            INSERT INTO artwork_indexer.event_dependency (parent, child)
+            SELECT delete_event_id, child.id FROM child;
+
+            WITH child AS (
+                INSERT INTO artwork_indexer.event_queue (entity_type, action, message)
+                VALUES ('release', 'deindex', jsonb_build_object('gid', old_release_gid))
+                ON CONFLICT DO NOTHING
+                RETURNING id
+            )
+            INSERT INTO artwork_indexer.event_dependency (parent, child)
+            SELECT delete_event_id, child.id FROM child;
 
             DELETE FROM artwork_indexer.event_queue
             WHERE state = 'queued'
             AND entity_type = 'release'
-            AND action = 'index'
+            AND action IN ('index', 'index_images', 'index_metadata')
             AND message = jsonb_build_object('gid', old_release_gid);
         END IF;
     ELSE
+        -- Only the image's own details changed (such as its comment),
+        -- which don't appear in the web service XML.
         INSERT INTO artwork_indexer.event_queue (entity_type, action, message)
-        VALUES ('release', 'index', jsonb_build_object('gid', old_release_gid)), ('release', 'index', jsonb_build_object('gid', new_release_gid))
+        VALUES ('release', 'index_images', jsonb_build_object('gid', old_release_gid)), ('release', 'index_images', jsonb_build_object('gid', new_release_gid))
         ON CONFLICT DO NOTHING;
     END IF;
 
+    PERFORM pg_notify('artwork_indexer', '');
+
     RETURN NEW;
 END;
 $$ LANGUAGE plpgsql;
@@ -114,10 +138,17 @@ BEGIN
         VALUES ('release', 'delete_image', jsonb_build_object('artwork_id', OLD.id, 'gid', release_gid, 'suffix', suffix))
         RETURNING id INTO STRICT delete_event_id;
 
-        INSERT INTO artwork_indexer.event_queue (entity_type, action, message, depends_on)
-        VALUES ('release', 'index', jsonb_build_object('gid', release_gid), array[delete_event_id])
-        ON CONFLICT (entity_type, action, message) WHERE state = 'queued'
-        DO UPDATE SET depends_on = (coalesce(artwork_indexer.event_queue.depends_on, '{}') || delete_event_id);
+        WITH child AS (
+            INSERT INTO artwork_indexer.event_queue (entity_type, action, message)
+            VALUES ('release', 'index', jsonb_build_object('gid', release_gid))
+            ON CONFLICT (entity_type, action, message, completed_at) WHERE state = 'queued'
+            DO UPDATE SET last_updated = now()
+            RETURNING id
+        )
+        INSERT INTO artwork_indexer.event_dependency (parent, child)
+        SELECT delete_event_id, child.id FROM child;
+
+        PERFORM pg_notify('artwork_indexer', '');
     END IF;
 
     RETURN OLD;
@@ -138,6 +169,8 @@ BEGIN
     VALUES ('release', 'index', jsonb_build_object('gid', release_gid))
     ON CONFLICT DO NOTHING;
 
+    PERFORM pg_notify('artwork_indexer', '');
+
     RETURN NEW;
 END;
 $$ LANGUAGE plpgsql;
@@ -158,6 +191,8 @@ BEGIN
         INSERT INTO artwork_indexer.event_queue (entity_type, action, message)
         VALUES ('release', 'index', jsonb_build_object('gid', release_gid))
         ON CONFLICT DO NOTHING;
+
+        PERFORM pg_notify('artwork_indexer', '');
     END IF;
 
     RETURN OLD;
@@ -184,15 +219,17 @@ BEGIN
         )
         ON CONFLICT DO NOTHING;
 
-        INSERT INTO artwork_indexer.event_queue (entity_type, action, message, depends_on)
-        VALUES ('release', 'deindex', jsonb_build_object('gid', OLD.gid), NULL)
+        INSERT INTO artwork_indexer.event_queue (entity_type, action, message)
+        VALUES ('release', 'deindex', jsonb_build_object('gid', OLD.gid))
         ON CONFLICT DO NOTHING;
 
         DELETE FROM artwork_indexer.event_queue
         WHERE state = 'queued'
         AND entity_type = 'release'
-        AND action = 'index'
+        AND action IN ('index', 'index_images', 'index_metadata')
         AND message = jsonb_build_object('gid', OLD.gid);
+
+        PERFORM pg_notify('artwork_indexer', '');
     END IF;
 
     RETURN OLD;
@@ -203,7 +240,7 @@ CREATE OR REPLACE FUNCTION artwork_indexer.a_upd_artist() RETURNS trigger AS $$
 BEGIN
     IF (OLD.name != NEW.name OR OLD.sort_name != NEW.sort_name) THEN
         INSERT INTO artwork_indexer.event_queue (entity_type, action, message) (
-            SELECT 'release', 'index', jsonb_build_object('gid', musicbrainz.release.gid)
+            SELECT 'release', 'index_metadata', jsonb_build_object('gid', musicbrainz.release.gid)
             FROM musicbrainz.release
             JOIN musicbrainz.artist_credit_name ON musicbrainz.artist_credit_name.artist_credit = musicbrainz.release.artist_credit
             WHERE EXISTS (
@@ -211,8 +248,19 @@ BEGIN
                 WHERE cover_art_archive.cover_art.release = musicbrainz.release.id
             )
             AND musicbrainz.artist_credit_name.artist = NEW.id
+            AND NOT EXISTS (
+                SELECT 1 FROM artwork_indexer.event_queue
+                WHERE state = 'queued'
+                AND entity_type = 'release'
+                AND action = 'index'
+                AND message = jsonb_build_object('gid', musicbrainz.release.gid)
+            )
         )
         ON CONFLICT DO NOTHING;
+
+        IF FOUND THEN
+            PERFORM pg_notify('artwork_indexer', '');
+        END IF;
     END IF;
 
     RETURN NEW;
@@ -223,15 +271,26 @@ CREATE OR REPLACE FUNCTION artwork_indexer.a_upd_release() RETURNS trigger AS $$
 BEGIN
     IF (OLD.name != NEW.name OR OLD.artist_credit != NEW.artist_credit OR OLD.language IS DISTINCT FROM NEW.language OR OLD.barcode IS DISTINCT FROM NEW.barcode) THEN
         INSERT INTO artwork_indexer.event_queue (entity_type, action, message) (
-            SELECT 'release', 'index', jsonb_build_object('gid', musicbrainz.release.gid)
+            SELECT 'release', 'index_metadata', jsonb_build_object('gid', musicbrainz.release.gid)
             FROM musicbrainz.release
             WHERE EXISTS (
                 SELECT 1 FROM cover_art_archive.cover_art
                 WHERE cover_art_archive.cover_art.release = musicbrainz.release.id
             )
             AND musicbrainz.release.gid = NEW.gid
+            AND NOT EXISTS (
+                SELECT 1 FROM artwork_indexer.event_queue
+                WHERE state = 'queued'
+                AND entity_type = 'release'
+                AND action = 'index'
+                AND message = jsonb_build_object('gid', musicbrainz.release.gid)
+            )
         )
         ON CONFLICT DO NOTHING;
+
+        IF FOUND THEN
+            PERFORM pg_notify('artwork_indexer', '');
+        END IF;
     END IF;
 
     RETURN NEW;
@@ -242,15 +301,26 @@ CREATE OR REPLACE FUNCTION artwork_indexer.a_upd_release_meta() RETURNS trigger
 BEGIN
     IF (OLD.amazon_asin IS DISTINCT FROM NEW.amazon_asin) THEN
         INSERT INTO artwork_indexer.event_queue (entity_type, action, message) (
-            SELECT 'release', 'index', jsonb_build_object('gid', musicbrainz.release.gid)
+            SELECT 'release', 'index_metadata', jsonb_build_object('gid', musicbrainz.release.gid)
             FROM musicbrainz.release
             WHERE EXISTS (
                 SELECT 1 FROM cover_art_archive.cover_art
                 WHERE cover_art_archive.cover_art.release = musicbrainz.release.id
             )
             AND musicbrainz.release.id = NEW.id
+            AND NOT EXISTS (
+                SELECT 1 FROM artwork_indexer.event_queue
+                WHERE state = 'queued'
+                AND entity_type = 'release'
+                AND action = 'index'
+                AND message = jsonb_build_object('gid', musicbrainz.release.gid)
+            )
         )
         ON CONFLICT DO NOTHING;
+
+        IF FOUND THEN
+            PERFORM pg_notify('artwork_indexer', '');
+        END IF;
     END IF;
 
     RETURN NEW;
@@ -260,16 +330,27 @@ $$ LANGUAGE plpgsql;
 CREATE OR REPLACE FUNCTION artwork_indexer.a_ins_release_first_release_date() RETURNS trigger AS $$
 BEGIN
     INSERT INTO artwork_indexer.event_queue (entity_type, action, message) (
-        SELECT 'release', 'index', jsonb_build_object('gid', musicbrainz.release.gid)
+        SELECT 'release', 'index_metadata', jsonb_build_object('gid', musicbrainz.release.gid)
         FROM musicbrainz.release
         WHERE EXISTS (
             SELECT 1 FROM cover_art_archive.cover_art
             WHERE cover_art_archive.cover_art.release = musicbrainz.release.id
         )
         AND musicbrainz.release.id = NEW.release
+        AND NOT EXISTS (
+            SELECT 1 FROM artwork_indexer.event_queue
+            WHERE state = 'queued'
+            AND entity_type = 'release'
+            AND action = 'index'
+            AND message = jsonb_build_object('gid', musicbrainz.release.gid)
+        )
     )
     ON CONFLICT DO NOTHING;
 
+    IF FOUND THEN
+        PERFORM pg_notify('artwork_indexer', '');
+    END IF;
+
     RETURN NEW;
 END;
 $$ LANGUAGE plpgsql;
@@ -277,17 +358,65 @@ $$ LANGUAGE plpgsql;
 CREATE OR REPLACE FUNCTION artwork_indexer.a_del_release_first_release_date() RETURNS trigger AS $$
 BEGIN
     INSERT INTO artwork_indexer.event_queue (entity_type, action, message) (
-        SELECT 'release', 'index', jsonb_build_object('gid', musicbrainz.release.gid)
+        SELECT 'release', 'index_metadata', jsonb_build_object('gid', musicbrainz.release.gid)
         FROM musicbrainz.release
         WHERE EXISTS (
             SELECT 1 FROM cover_art_archive.cover_art
             WHERE cover_art_archive.cover_art.release = musicbrainz.release.id
         )
         AND musicbrainz.release.id = OLD.release
+        AND NOT EXISTS (
+            SELECT 1 FROM artwork_indexer.event_queue
+            WHERE state = 'queued'
+            AND entity_type = 'release'
+            AND action = 'index'
+            AND message = jsonb_build_object('gid', musicbrainz.release.gid)
+        )
     )
     ON CONFLICT DO NOTHING;
 
+    IF FOUND THEN
+        PERFORM pg_notify('artwork_indexer', '');
+    END IF;
+
     RETURN OLD;
 END;
 $$ LANGUAGE plpgsql;
 
+CREATE OR REPLACE FUNCTION artwork_indexer.build_release_index_json(release_gid UUID) RETURNS TEXT AS $$
+    SELECT '{' ||
+        '"images": [' || coalesce(string_agg(image_json, ', ' ORDER BY ordering), '') || ']' ||
+        ', "release": "https://musicbrainz.org/release/' || release_gid || '"' ||
+        '}'
+    FROM (
+        SELECT il.ordering,
+            '{"approved": ' || coalesce(il.approved, FALSE)::text ||
+            ', "back": ' || coalesce(il.is_back, FALSE)::text ||
+            ', "comment": ' || coalesce(artwork_indexer.json_ascii_text(il.comment), 'null') ||
+            ', "edit": ' || coalesce(il.edit::text, 'null') ||
+            ', "front": ' || coalesce(il.is_front, FALSE)::text ||
+            ', "id": ' || il.id ||
+            ', "image": "' || image_url || '.' || cover_art_archive.image_type.suffix || '"' ||
+            ', "thumbnails": {' ||
+                '"1200": "' || image_url || '-1200.jpg", ' ||
+                '"250": "' || image_url || '-250.jpg", ' ||
+                '"500": "' || image_url || '-500.jpg", ' ||
+                '"large": "' || image_url || '-500.jpg", ' ||
+                '"small": "' || image_url || '-250.jpg"' ||
+            '}' ||
+            ', "types": [' || coalesce((
+                SELECT string_agg(artwork_indexer.json_ascii_text(type), ', ' ORDER BY position)
+                FROM unnest(il.types) WITH ORDINALITY AS types (type, position)
+            ), '') || ']' ||
+            '}' AS image_json
+        FROM cover_art_archive.index_listing il
+        JOIN cover_art_archive.image_type USING (mime_type)
+        CROSS JOIN LATERAL (
+            SELECT 'https://coverartarchive.org/release/' || release_gid || '/' || il.id AS image_url
+        ) url
+        WHERE il.release = (
+            SELECT id FROM musicbrainz.release WHERE gid = release_gid
+        )
+    ) images
+$$ LANGUAGE sql STABLE;
+
@@ -6,7 +6,11 @@ CREATE TYPE artwork_indexer.indexable_entity_type AS ENUM (
 );
 
 CREATE TYPE artwork_indexer.event_queue_action AS ENUM (
+    -- Uploads both index.json and the MB metadata XML; 'index_images'
+    -- and 'index_metadata' upload just one of them.
     'index',
+    'index_images',
+    'index_metadata',
     'copy_image',
     'delete_image',
     'deindex',
@@ -16,9 +20,9 @@ CREATE TYPE artwork_indexer.event_queue_action AS ENUM (
 CREATE TYPE artwork_indexer.event_state AS ENUM (
     -- 'queued' events are waiting to run, and are generally not
     -- blocked from doing so when it's their turn (based on order of
-    -- creation), unless their parent (depends_on) has 'failed', in
-    -- which case they're stuck until the failed parent event is dealt
-    -- with.
+    -- creation), unless one of their parents (see `event_dependency`)
+    -- has 'failed', in which case they're stuck until the failed parent
+    -- event is dealt with.
     --
     -- There cannot be more than one queued event for the same
     -- (entity_type, action, message) tuple. See
@@ -43,61 +47,210 @@ CREATE TYPE artwork_indexer.event_state AS ENUM (
     -- is addressed, or deleted as appropriate.
     'failed',
     -- 'completed' events are as they're named, but kept around for
-    -- debugging purposes for 90 days.
+    -- debugging purposes for 90 days (see `completed_at` below).
     'completed'
 );
 
+-- Partitioned by `completed_at`: events that haven't completed are all
+-- in `event_queue_active`, which therefore stays small, and completed
+-- ones are moved to a partition for the month they completed in. Old
+-- partitions are dropped whole (see `drop_event_partitions` below)
+-- rather than deleted from.
 CREATE TABLE artwork_indexer.event_queue (
     id                  BIGSERIAL,
     state               artwork_indexer.event_state NOT NULL DEFAULT 'queued',
     entity_type         artwork_indexer.indexable_entity_type NOT NULL,
     action              artwork_indexer.event_queue_action NOT NULL,
     message             JSONB NOT NULL,
-    depends_on          BIGINT[],
     created             TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW(),
     -- Note `event_queue_idx_queued_uniq` below. Due to the requirement
     -- that queued events be unique, external triggers should have an
     -- `ON CONFLICT` action.
     attempts            SMALLINT NOT NULL DEFAULT 0,
-    last_updated        TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW()
+    last_updated        TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW(),
+    -- When a queued event may next be run. Events are run in this
+    -- order, which for events that haven't failed yet is the order
+    -- they were created in. After each failed attempt, it's pushed
+    -- back by an hour per attempt so far.
+    next_attempt_at     TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW(),
+    -- How many of the event's parents (see `event_dependency`) haven't
+    -- completed yet. Kept up-to-date by the triggers below, so it needn't
+    -- be set by hand. An event can only run once this reaches 0.
+    pending_parents     INTEGER NOT NULL DEFAULT 0,
+    -- When the event completed, or 'infinity' if it hasn't. Kept
+    -- up-to-date by `b_upd_event_queue` (below), which moves the event
+    -- between partitions as a result, so it only needs to be set when
+    -- inserting completed events.
+    completed_at        TIMESTAMP WITH TIME ZONE NOT NULL
+                        DEFAULT 'infinity',
+    -- While the event is running, when its claim lapses unless the
+    -- indexer running it extends it, which it does periodically until
+    -- the event is done. Events whose lease has expired (say, because
+    -- the indexer crashed) are re-queued. Cleared by `b_upd_event_queue`
+    -- once the event stops running.
+    lease_expires_at    TIMESTAMP WITH TIME ZONE,
+    -- The `worker` running the event, if any. Cleared along with
+    -- `lease_expires_at`.
+    worker              INTEGER,
+    CONSTRAINT event_queue_completed_at_check
+        CHECK ((state = 'completed') = (completed_at != 'infinity'))
+) PARTITION BY RANGE (completed_at);
+
+CREATE TABLE artwork_indexer.event_queue_active
+    PARTITION OF artwork_indexer.event_queue
+    FOR VALUES FROM ('infinity') TO (MAXVALUE);
+
+-- Names of the scripts in sql/updates/ that have been applied.
+-- `--setup-schema` marks all existing ones as applied, since this file
+-- already includes their changes; `--upgrade-schema` runs the rest.
+CREATE TABLE artwork_indexer.schema_update (
+    name                TEXT NOT NULL,
+    applied             TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW()
+);
+
+-- An event (`child`) that must not run until another (`parent`) has
+-- completed. Rows are removed along with either event, and once the
+-- child completes, by the triggers below. (`event_queue` has no unique
+-- key on `id` alone to reference.)
+CREATE TABLE artwork_indexer.event_dependency (
+    parent              BIGINT NOT NULL,
+    child               BIGINT NOT NULL
+);
+
+-- The indexer processes that are running, each of which registers
+-- itself on startup, updates its row (and its events' leases) every 20
+-- seconds or so while it runs, and removes it when it stops. Rows whose
+-- `last_heartbeat` is over a minute old belong to processes that died,
+-- and are removed during maintenance; any events they were running are
+-- re-queued.
+CREATE TABLE artwork_indexer.worker (
+    id                  SERIAL,
+    host                TEXT NOT NULL,
+    pid                 INTEGER NOT NULL,
+    concurrency         INTEGER NOT NULL,
+    started             TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW(),
+    last_heartbeat      TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW(),
+    -- Counted since `started`.
+    events_handled      BIGINT NOT NULL DEFAULT 0,
+    -- Claimed, but not yet handled.
+    events_in_flight    INTEGER NOT NULL DEFAULT 0,
+    -- How long the last claim of events took.
+    last_claim_duration INTERVAL,
+    -- Uploads skipped because the file was unchanged (see
+    -- `uploaded_file`), counted since `started`.
+    uploads_skipped     BIGINT NOT NULL DEFAULT 0,
+    -- Connections requested from the worker's pool, the requests that
+    -- had to wait for one, how long they waited in total, and those
+    -- that timed out, counted since `started`. NULL without a pool (see
+    -- `pool_max_size`).
+    pool_requests       BIGINT,
+    pool_requests_queued BIGINT,
+    pool_wait_time      INTERVAL,
+    pool_request_errors BIGINT
+);
+
+-- The SHA-256 hash of the content last uploaded to each file (index.json
+-- or *_mb_metadata.xml) of an entity's bucket. An index event whose file
+-- would have the same content skips uploading it, unless its message has
+-- `"force": true`.
+CREATE TABLE artwork_indexer.uploaded_file (
+    entity_type         artwork_indexer.indexable_entity_type NOT NULL,
+    gid                 UUID NOT NULL,
+    file_name           TEXT NOT NULL,
+    content_sha256      BYTEA NOT NULL,
+    uploaded            TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW()
 );
 
+-- Partitioned like `event_queue`. `event_completed_at` follows the
+-- event's `completed_at` (through `ON UPDATE CASCADE`), which moves the
+-- failure reasons along with their event.
 CREATE TABLE artwork_indexer.event_failure_reason (
     event               BIGINT NOT NULL,
+    event_completed_at  TIMESTAMP WITH TIME ZONE NOT NULL
+                        DEFAULT 'infinity',
     failure_reason      TEXT NOT NULL,
     created             TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW()
-);
+) PARTITION BY RANGE (event_completed_at);
+
+CREATE TABLE artwork_indexer.event_failure_reason_active
+    PARTITION OF artwork_indexer.event_failure_reason
+    FOR VALUES FROM ('infinity') TO (MAXVALUE);
 
 ALTER TABLE artwork_indexer.event_queue
     ADD CONSTRAINT event_queue_pkey
+    PRIMARY KEY (id, completed_at);
+
+ALTER TABLE artwork_indexer.schema_update
+    ADD CONSTRAINT schema_update_pkey
+    PRIMARY KEY (name);
+
+ALTER TABLE artwork_indexer.worker
+    ADD CONSTRAINT worker_pkey
     PRIMARY KEY (id);
 
+ALTER TABLE artwork_indexer.uploaded_file
+    ADD CONSTRAINT uploaded_file_pkey
+    PRIMARY KEY (entity_type, gid, file_name);
+
+ALTER TABLE artwork_indexer.event_dependency
+    ADD CONSTRAINT event_dependency_pkey
+    PRIMARY KEY (parent, child);
+
 ALTER TABLE artwork_indexer.event_failure_reason
     ADD CONSTRAINT event_failure_reason_fk_event
-    FOREIGN KEY (event)
-    REFERENCES artwork_indexer.event_queue(id)
+    FOREIGN KEY (event, event_completed_at)
+    REFERENCES artwork_indexer.event_queue(id, completed_at)
+    ON UPDATE CASCADE
     ON DELETE CASCADE;
 
 --- MusicBrainz Server will sometimes publish the same message multiple
 --- times due to its SQL triggers firing for the same release (or event)
 --- across multiple statements. It's therefore useful to enforce that
---- queued index events be unique.
+--- queued index events be unique. (`completed_at` is only included
+--- because a partitioned table's unique indexes must include its
+--- partition key; it's always 'infinity' for queued events.)
 CREATE UNIQUE INDEX event_queue_idx_queued_uniq
-    ON artwork_indexer.event_queue (entity_type, action, message)
+    ON artwork_indexer.event_queue
+       (entity_type, action, message, completed_at)
     WHERE state = 'queued';
 
 CREATE INDEX event_queue_idx_state_created
     ON artwork_indexer.event_queue (state, created);
 
+-- Serves `claim_events` as a range scan over the queued events that
+-- are due, in the order they're run.
+CREATE INDEX event_queue_idx_queued_next_attempt_at
+    ON artwork_indexer.event_queue (next_attempt_at, id)
+    WHERE state = 'queued' AND pending_parents = 0;
+
+-- `event_dependency_pkey` finds an event's children; this finds its
+-- parents, so that they're removed along with it.
+CREATE INDEX event_dependency_idx_child
+    ON artwork_indexer.event_dependency (child);
+
 CREATE INDEX event_failure_reason_idx_event
     ON artwork_indexer.event_failure_reason (event, created);
 
+CREATE INDEX worker_idx_last_heartbeat
+    ON artwork_indexer.worker (last_heartbeat);
+
 CREATE OR REPLACE FUNCTION artwork_indexer.b_upd_event_queue()
 RETURNS TRIGGER AS $$
 BEGIN
     IF OLD.last_updated = NEW.last_updated THEN
         NEW.last_updated = NOW();
     END IF;
+    IF (OLD.state = 'completed') != (NEW.state = 'completed') THEN
+        NEW.completed_at = (
+            CASE WHEN NEW.state = 'completed'
+                 THEN NOW()
+                 ELSE 'infinity' END
+        );
+    END IF;
+    IF NEW.state != 'running' THEN
+        NEW.lease_expires_at = NULL;
+        NEW.worker = NULL;
+    END IF;
     RETURN NEW;
 END;
 $$ LANGUAGE 'plpgsql';
@@ -105,3 +258,253 @@ $$ LANGUAGE 'plpgsql';
 CREATE TRIGGER b_upd_event_queue
     BEFORE UPDATE ON artwork_indexer.event_queue
     FOR EACH ROW EXECUTE FUNCTION artwork_indexer.b_upd_event_queue();
+
+
+-- Counts the parents that haven't completed yet as dependencies are
+-- added. They're locked, so that one can't complete between being
+-- counted here and the new rows becoming visible to
+-- `a_del_event_queue`. (The generated triggers only ever add parents
+-- they've just inserted themselves, so this doesn't wait on the
+-- indexer.)
+CREATE OR REPLACE FUNCTION artwork_indexer.a_ins_event_dependency()
+RETURNS TRIGGER AS $$
+BEGIN
+    WITH pending_parent AS (
+        SELECT parent_eq.id
+          FROM artwork_indexer.event_queue parent_eq
+         WHERE parent_eq.id IN (SELECT parent FROM new_dependency)
+           AND parent_eq.completed_at = 'infinity'
+           FOR SHARE
+    )
+    UPDATE artwork_indexer.event_queue eq
+       SET pending_parents = eq.pending_parents + added.count
+      FROM (
+        SELECT dep.child, count(*) AS count
+          FROM new_dependency dep
+          JOIN pending_parent ON pending_parent.id = dep.parent
+         GROUP BY dep.child
+      ) added
+     WHERE eq.id = added.child;
+    RETURN NULL;
+END;
+$$ LANGUAGE 'plpgsql';
+
+CREATE TRIGGER a_ins_event_dependency
+    AFTER INSERT ON artwork_indexer.event_dependency
+    REFERENCING NEW TABLE AS new_dependency
+    FOR EACH STATEMENT
+    EXECUTE FUNCTION artwork_indexer.a_ins_event_dependency();
+
+-- Uncounts the parents that haven't completed yet as dependencies are
+-- removed. (Those removed along with their parent are uncounted by
+-- `a_del_event_queue` instead.)
+CREATE OR REPLACE FUNCTION artwork_indexer.a_del_event_dependency()
+RETURNS TRIGGER AS $$
+BEGIN
+    UPDATE artwork_indexer.event_queue eq
+       SET pending_parents = eq.pending_parents - removed.count
+      FROM (
+        SELECT dep.child, count(*) AS count
+          FROM old_dependency dep
+          JOIN artwork_indexer.event_queue parent_eq
+            ON parent_eq.id = dep.parent
+         WHERE parent_eq.completed_at = 'infinity'
+         GROUP BY dep.child
+      ) removed
+     WHERE eq.id = removed.child;
+    RETURN NULL;
+END;
+$$ LANGUAGE 'plpgsql';
+
+CREATE TRIGGER a_del_event_dependency
+    AFTER DELETE ON artwork_indexer.event_dependency
+    REFERENCING OLD TABLE AS old_dependency
+    FOR EACH STATEMENT
+    EXECUTE FUNCTION artwork_indexer.a_del_event_dependency();
+
+-- A change of state to or from 'completed' moves an event to another
+-- partition, which runs the DELETE and INSERT triggers below (but not
+-- UPDATE ones).
+
+-- Blocks an event's children again when it's re-queued by hand after
+-- completing. (New events don't have any children yet.)
+CREATE OR REPLACE FUNCTION artwork_indexer.a_ins_event_queue()
+RETURNS TRIGGER AS $$
+BEGIN
+    UPDATE artwork_indexer.event_queue
+       SET pending_parents = pending_parents + 1
+     WHERE id IN (
+        SELECT child
+          FROM artwork_indexer.event_dependency
+         WHERE parent = NEW.id
+     );
+    RETURN NULL;
+END;
+$$ LANGUAGE 'plpgsql';
+
+CREATE TRIGGER a_ins_event_queue
+    AFTER INSERT ON artwork_indexer.event_queue
+    FOR EACH ROW
+    WHEN (NEW.completed_at = 'infinity')
+    EXECUTE FUNCTION artwork_indexer.a_ins_event_queue();
+
+-- Unblocks an event's children once it completes. Events that no
+-- longer exist don't block anything either, as if they had completed;
+-- their dependencies are removed here, along with those of completed
+-- events, which aren't needed anymore.
+CREATE OR REPLACE FUNCTION artwork_indexer.a_del_event_queue()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF OLD.completed_at = 'infinity' THEN
+        UPDATE artwork_indexer.event_queue
+           SET pending_parents = pending_parents - 1
+         WHERE id IN (
+            SELECT child
+              FROM artwork_indexer.event_dependency
+             WHERE parent = OLD.id
+         );
+    END IF;
+    IF NOT EXISTS (
+        SELECT 1 FROM artwork_indexer.event_queue WHERE id = OLD.id
+    ) THEN
+        DELETE FROM artwork_indexer.event_dependency WHERE parent = OLD.id;
+        DELETE FROM artwork_indexer.event_dependency WHERE child = OLD.id;
+    ELSIF OLD.completed_at = 'infinity' THEN
+        DELETE FROM artwork_indexer.event_dependency WHERE child = OLD.id;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE 'plpgsql';
+
+CREATE TRIGGER a_del_event_queue
+    AFTER DELETE ON artwork_indexer.event_queue
+    FOR EACH ROW EXECUTE FUNCTION artwork_indexer.a_del_event_queue();
+
+-- Without foreign keys to the queue, `event_dependency` isn't reached
+-- by `TRUNCATE ... CASCADE`.
+CREATE OR REPLACE FUNCTION artwork_indexer.a_trunc_event_queue()
+RETURNS TRIGGER AS $$
+BEGIN
+    TRUNCATE artwork_indexer.event_dependency;
+    RETURN NULL;
+END;
+$$ LANGUAGE 'plpgsql';
+
+CREATE TRIGGER a_trunc_event_queue
+    AFTER TRUNCATE ON artwork_indexer.event_queue
+    FOR EACH STATEMENT
+    EXECUTE FUNCTION artwork_indexer.a_trunc_event_queue();
+
+-- Creates the partitions of `event_queue` and `event_failure_reason`
+-- for events completed in the (UTC) month of `month`, unless they
+-- exist already. The indexer creates them for the current and next
+-- months as part of its cleanup, so that events always have one to
+-- complete into.
+CREATE OR REPLACE FUNCTION artwork_indexer.create_event_partitions(
+    month TIMESTAMP WITH TIME ZONE
+)
+RETURNS VOID AS $$
+DECLARE
+    month_start TIMESTAMP WITH TIME ZONE := date_trunc('month', month, 'UTC');
+    month_end TIMESTAMP WITH TIME ZONE := month_start + interval '1 month';
+    suffix TEXT := to_char(month_start AT TIME ZONE 'UTC', 'YYYY_MM');
+BEGIN
+    IF to_regclass('artwork_indexer.event_queue_' || suffix) IS NULL THEN
+        EXECUTE format(
+            'CREATE TABLE artwork_indexer.%I '
+            'PARTITION OF artwork_indexer.event_queue '
+            'FOR VALUES FROM (%L) TO (%L)',
+            'event_queue_' || suffix, month_start, month_end
+        );
+        EXECUTE format(
+            'CREATE TABLE artwork_indexer.%I '
+            'PARTITION OF artwork_indexer.event_failure_reason '
+            'FOR VALUES FROM (%L) TO (%L)',
+            'event_failure_reason_' || suffix, month_start, month_end
+        );
+    END IF;
+END;
+$$ LANGUAGE 'plpgsql';
+
+-- Detaches and drops the partitions of events completed in months that
+-- ended before `older_than`, returning their names. Dependencies on the
+-- events dropped are removed first.
+--
+-- Detaching needs an exclusive lock on both parent tables. These are
+-- taken up front, in the order the indexer's own queries use, since
+-- upgrading to them midway (after the `DELETE`) can deadlock with an
+-- indexer claiming or failing events.
+CREATE OR REPLACE FUNCTION artwork_indexer.drop_event_partitions(
+    older_than TIMESTAMP WITH TIME ZONE
+)
+RETURNS SETOF TEXT AS $$
+DECLARE
+    suffix TEXT;
+    locked BOOLEAN := FALSE;
+BEGIN
+    FOR suffix IN
+        SELECT substring(child.relname FROM '^event_queue_(\d{4}_\d{2})$')
+          FROM pg_inherits
+          JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+         WHERE pg_inherits.inhparent = 'artwork_indexer.event_queue'::regclass
+           AND child.relname ~ '^event_queue_\d{4}_\d{2}$'
+         ORDER BY child.relname
+    LOOP
+        CONTINUE WHEN (
+            to_date(suffix, 'YYYY_MM')::timestamp AT TIME ZONE 'UTC'
+        ) + interval '1 month' > older_than;
+        IF NOT locked THEN
+            LOCK TABLE artwork_indexer.event_queue,
+                       artwork_indexer.event_failure_reason
+                IN ACCESS EXCLUSIVE MODE;
+            locked := TRUE;
+        END IF;
+        EXECUTE format(
+            'DELETE FROM artwork_indexer.event_dependency dep '
+            'USING artwork_indexer.%I eq WHERE eq.id = dep.parent',
+            'event_queue_' || suffix
+        );
+        EXECUTE format(
+            'ALTER TABLE artwork_indexer.event_failure_reason '
+            'DETACH PARTITION artwork_indexer.%1$I; '
+            'DROP TABLE artwork_indexer.%1$I',
+            'event_failure_reason_' || suffix
+        );
+        EXECUTE format(
+            'ALTER TABLE artwork_indexer.event_queue '
+            'DETACH PARTITION artwork_indexer.%1$I; '
+            'DROP TABLE artwork_indexer.%1$I',
+            'event_queue_' || suffix
+        );
+        RETURN NEXT 'event_queue_' || suffix;
+    END LOOP;
+END;
+$$ LANGUAGE 'plpgsql';
+
+-- Quotes `value` as a JSON string the way Python's `json.dumps` does by
+-- default (`ensure_ascii=True`): like `to_json`, but with everything
+-- outside printable ASCII escaped, and characters beyond the BMP as
+-- surrogate pairs. Used by the generated `build_*_index_json` functions,
+-- which must match `EventHandler.build_index_json` byte for byte.
+CREATE OR REPLACE FUNCTION artwork_indexer.json_ascii_text(value TEXT)
+RETURNS TEXT AS $$
+    SELECT CASE
+        WHEN json_text ~ '[^\x01-\x7e]' THEN (
+            SELECT string_agg(
+                CASE
+                    WHEN ascii(c) > 65535 THEN
+                        '\u' || to_hex(55296 + ((ascii(c) - 65536) >> 10)) ||
+                        '\u' || to_hex(56320 + ((ascii(c) - 65536) & 1023))
+                    WHEN ascii(c) > 126 THEN
+                        '\u' || lpad(to_hex(ascii(c)), 4, '0')
+                    ELSE c
+                END,
+                '' ORDER BY i
+            )
+            FROM regexp_split_to_table(json_text, '')
+                 WITH ORDINALITY AS chars (c, i)
+        )
+        ELSE json_text
+    END
+    FROM (SELECT to_json(value)::text AS json_text) json_value
+$$ LANGUAGE 'sql' IMMUTABLE STRICT PARALLEL SAFE;
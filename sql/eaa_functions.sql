@@ -10,9 +10,11 @@ BEGIN
     WHERE musicbrainz.event.id = NEW.event;
 
     INSERT INTO artwork_indexer.event_queue (entity_type, action, message)
-    VALUES ('event', 'index', jsonb_build_object('gid', event_gid))
+    VALUES ('event', 'index_images', jsonb_build_object('gid', event_gid))
     ON CONFLICT DO NOTHING;
 
+    PERFORM pg_notify('artwork_indexer', '');
+
     RETURN NEW;
 END;
 $$ LANGUAGE plpgsql;
@@ -51,10 +53,13 @@ BEGIN
         ))
         RETURNING id INTO STRICT copy_event_id;
 
-        INSERT INTO artwork_indexer.event_queue (entity_type, action, message, depends_on)
-        VALUES ('event', 'delete_image', jsonb_build_object('artwork_id', OLD.id, 'gid', old_event_gid, 'suffix', suffix), array[copy_event_id])
+        INSERT INTO artwork_indexer.event_queue (entity_type, action, message)
+        VALUES ('event', 'delete_image', jsonb_build_object('artwork_id', OLD.id, 'gid', old_event_gid, 'suffix', suffix))
         RETURNING id INTO STRICT delete_event_id;
 
+        INSERT INTO artwork_indexer.event_dependency (parent, child)
+        VALUES (copy_event_id, delete_event_id);
+
         -- Check if any images remain for the old event. If not, deindex it.
         PERFORM 1 FROM event_art_archive.event_art
         WHERE event_art_archive.event_art.event = OLD.event
@@ -64,32 +69,51 @@ BEGIN
         IF FOUND THEN
             -- If there's an existing, queued index event, reset its parent to our
             -- deletion event (i.e. delay it until after the deletion executes).
-            INSERT INTO artwork_indexer.event_queue (entity_type, action, message, depends_on)
-            VALUES ('event', 'index', jsonb_build_object('gid', old_event_gid), array[delete_event_id]), ('event', 'index', jsonb_build_object('gid', new_event_gid), array[delete_event_id])
-            ON CONFLICT (entity_type, action, message) WHERE state = 'queued'
-            DO UPDATE SET depends_on = (coalesce(artwork_indexer.event_queue.depends_on, '{}') || delete_event_id);
+            WITH child AS (
+                INSERT INTO artwork_indexer.event_queue (entity_type, action, message)
+                VALUES ('event', 'index_images', jsonb_build_object('gid', old_event_gid)), ('event', 'index_images', jsonb_build_object('gid', new_event_gid))
+                ON CONFLICT (entity_type, action, message, completed_at) WHERE state = 'queued'
+                DO UPDATE SET last_updated = now()
+                RETURNING id
+            )
+            INSERT INTO artwork_indexer.event_dependency (parent, child)
+            SELECT delete_event_id, child.id FROM child;
         ELSE
-            INSERT INTO artwork_indexer.event_queue (entity_type, action, message, depends_on)
-            VALUES ('event', 'index', jsonb_build_object('gid', new_event_gid), array[delete_event_id])
-            ON CONFLICT (entity_type, action, message) WHERE state = 'queued'
-            DO UPDATE SET depends_on = (coalesce(artwork_indexer.event_queue.depends_on, '{}') || delete_event_id);
+            WITH child AS (
+                INSERT INTO artwork_indexer.event_queue (entity_type, action, message)
+                VALUES ('event', 'index_images', jsonb_build_object('gid', new_event_gid))
+                ON CONFLICT (entity_type, action, message, completed_at) WHERE state = 'queued'
+                DO UPDATE SET last_updated = now()
+                RETURNING id
+            )
+            INSERT INTO artwork_indexer.event_dependency (parent, child)
+            SELECT delete_event_id, child.id FROM child;
 
-            INSERT INTO artwork_indexer.event_queue (entity_type, action, message, depends_on)
-            VALUES ('event', 'deindex', jsonb_build_object('gid', old_event_gid), array[delete_event_id])
-            ON CONFLICT DO NOTHING;
+            WITH child AS (
+                INSERT INTO artwork_indexer.event_queue (entity_type, action, message)
+                VALUES ('event', 'deindex', jsonb_build_object('gid', old_event_gid))
+                ON CONFLICT DO NOTHING
+                RETURNING id
+            )
+            INSERT INTO artwork_indexer.event_dependency (parent, child)
+            SELECT delete_event_id, child.id FROM child;
 
             DELETE FROM artwork_indexer.event_queue
             WHERE state = 'queued'
             AND entity_type = 'event'
-            AND action = 'index'
+            AND action IN ('index', 'index_images', 'index_metadata')
             AND message = jsonb_build_object('gid', old_event_gid);
         END IF;
     ELSE
+        -- Only the image's own details changed (such as its comment),
+        -- which don't appear in the web service XML.
         INSERT INTO artwork_indexer.event_queue (entity_type, action, message)
-        VALUES ('event', 'index', jsonb_build_object('gid', old_event_gid)), ('event', 'index', jsonb_build_object('gid', new_event_gid))
+        VALUES ('event', 'index_images', jsonb_build_object('gid', old_event_gid)), ('event', 'index_images', jsonb_build_object('gid', new_event_gid))
         ON CONFLICT DO NOTHING;
     END IF;
 
+    PERFORM pg_notify('artwork_indexer', '');
+
     RETURN NEW;
 END;
 $$ LANGUAGE plpgsql;
@@ -114,10 +138,17 @@ BEGIN
         VALUES ('event', 'delete_image', jsonb_build_object('artwork_id', OLD.id, 'gid', event_gid, 'suffix', suffix))
         RETURNING id INTO STRICT delete_event_id;
 
-        INSERT INTO artwork_indexer.event_queue (entity_type, action, message, depends_on)
-        VALUES ('event', 'index', jsonb_build_object('gid', event_gid), array[delete_event_id])
-        ON CONFLICT (entity_type, action, message) WHERE state = 'queued'
-        DO UPDATE SET depends_on = (coalesce(artwork_indexer.event_queue.depends_on, '{}') || delete_event_id);
+        WITH child AS (
+            INSERT INTO artwork_indexer.event_queue (entity_type, action, message)
+            VALUES ('event', 'index_images', jsonb_build_object('gid', event_gid))
+            ON CONFLICT (entity_type, action, message, completed_at) WHERE state = 'queued'
+            DO UPDATE SET last_updated = now()
+            RETURNING id
+        )
+        INSERT INTO artwork_indexer.event_dependency (parent, child)
+        SELECT delete_event_id, child.id FROM child;
+
+        PERFORM pg_notify('artwork_indexer', '');
     END IF;
 
     RETURN OLD;
@@ -135,9 +166,11 @@ BEGIN
     WHERE event_art_archive.event_art.id = NEW.id;
 
     INSERT INTO artwork_indexer.event_queue (entity_type, action, message)
-    VALUES ('event', 'index', jsonb_build_object('gid', event_gid))
+    VALUES ('event', 'index_images', jsonb_build_object('gid', event_gid))
     ON CONFLICT DO NOTHING;
 
+    PERFORM pg_notify('artwork_indexer', '');
+
     RETURN NEW;
 END;
 $$ LANGUAGE plpgsql;
@@ -156,8 +189,10 @@ BEGIN
     -- deleted, which cascades to this table.
     IF FOUND THEN
         INSERT INTO artwork_indexer.event_queue (entity_type, action, message)
-        VALUES ('event', 'index', jsonb_build_object('gid', event_gid))
+        VALUES ('event', 'index_images', jsonb_build_object('gid', event_gid))
         ON CONFLICT DO NOTHING;
+
+        PERFORM pg_notify('artwork_indexer', '');
     END IF;
 
     RETURN OLD;
@@ -184,15 +219,17 @@ BEGIN
         )
         ON CONFLICT DO NOTHING;
 
-        INSERT INTO artwork_indexer.event_queue (entity_type, action, message, depends_on)
-        VALUES ('event', 'deindex', jsonb_build_object('gid', OLD.gid), NULL)
+        INSERT INTO artwork_indexer.event_queue (entity_type, action, message)
+        VALUES ('event', 'deindex', jsonb_build_object('gid', OLD.gid))
         ON CONFLICT DO NOTHING;
 
         DELETE FROM artwork_indexer.event_queue
         WHERE state = 'queued'
         AND entity_type = 'event'
-        AND action = 'index'
+        AND action IN ('index', 'index_images', 'index_metadata')
         AND message = jsonb_build_object('gid', OLD.gid);
+
+        PERFORM pg_notify('artwork_indexer', '');
     END IF;
 
     RETURN OLD;
@@ -203,18 +240,65 @@ CREATE OR REPLACE FUNCTION artwork_indexer.a_upd_event() RETURNS trigger AS $$
 BEGIN
     IF (OLD.name != NEW.name) THEN
         INSERT INTO artwork_indexer.event_queue (entity_type, action, message) (
-            SELECT 'event', 'index', jsonb_build_object('gid', musicbrainz.event.gid)
+            SELECT 'event', 'index_metadata', jsonb_build_object('gid', musicbrainz.event.gid)
             FROM musicbrainz.event
             WHERE EXISTS (
                 SELECT 1 FROM event_art_archive.event_art
                 WHERE event_art_archive.event_art.event = musicbrainz.event.id
             )
             AND musicbrainz.event.gid = NEW.gid
+            AND NOT EXISTS (
+                SELECT 1 FROM artwork_indexer.event_queue
+                WHERE state = 'queued'
+                AND entity_type = 'event'
+                AND action = 'index'
+                AND message = jsonb_build_object('gid', musicbrainz.event.gid)
+            )
         )
         ON CONFLICT DO NOTHING;
+
+        IF FOUND THEN
+            PERFORM pg_notify('artwork_indexer', '');
+        END IF;
     END IF;
 
     RETURN NEW;
 END;
 $$ LANGUAGE plpgsql;
 
+CREATE OR REPLACE FUNCTION artwork_indexer.build_event_index_json(event_gid UUID) RETURNS TEXT AS $$
+    SELECT '{' ||
+        '"event": "https://musicbrainz.org/event/' || event_gid || '"' ||
+        ', "images": [' || coalesce(string_agg(image_json, ', ' ORDER BY ordering), '') || ']' ||
+        '}'
+    FROM (
+        SELECT il.ordering,
+            '{"approved": ' || coalesce(il.approved, FALSE)::text ||
+            ', "comment": ' || coalesce(artwork_indexer.json_ascii_text(il.comment), 'null') ||
+            ', "edit": ' || coalesce(il.edit::text, 'null') ||
+            ', "front": ' || coalesce(il.is_front, FALSE)::text ||
+            ', "id": ' || il.id ||
+            ', "image": "' || image_url || '.' || cover_art_archive.image_type.suffix || '"' ||
+            ', "thumbnails": {' ||
+                '"1200": "' || image_url || '-1200.jpg", ' ||
+                '"250": "' || image_url || '-250.jpg", ' ||
+                '"500": "' || image_url || '-500.jpg", ' ||
+                '"large": "' || image_url || '-500.jpg", ' ||
+                '"small": "' || image_url || '-250.jpg"' ||
+            '}' ||
+            ', "types": [' || coalesce((
+                SELECT string_agg(artwork_indexer.json_ascii_text(type), ', ' ORDER BY position)
+                FROM unnest(il.types) WITH ORDINALITY AS types (type, position)
+            ), '') || ']' ||
+            '}' AS image_json
+        FROM event_art_archive.index_listing il
+        JOIN cover_art_archive.image_type USING (mime_type)
+        CROSS JOIN LATERAL (
+            SELECT 'https://eventartarchive.org/event/' || event_gid || '/' || il.id AS image_url
+        ) url
+        WHERE il.event = (
+            SELECT id FROM musicbrainz.event WHERE gid = event_gid
+        )
+    ) images
+$$ LANGUAGE sql STABLE;
+
@@ -0,0 +1,17 @@
+-- Materializes the retry delay, which `claim_events` used to compute
+-- for every queued row from `last_updated` and `attempts`, so that it
+-- can be served by an index instead.
+--
+-- Adding a column with a constant default doesn't rewrite the table;
+-- only queued events (the ones the schedule matters for) are updated.
+
+ALTER TABLE artwork_indexer.event_queue
+    ADD COLUMN next_attempt_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW();
+
+UPDATE artwork_indexer.event_queue
+   SET next_attempt_at = last_updated + (interval '1 hour' * attempts)
+ WHERE state = 'queued';
+
+CREATE INDEX event_queue_idx_queued_next_attempt_at
+    ON artwork_indexer.event_queue (next_attempt_at, id)
+    WHERE state = 'queued';
@@ -0,0 +1,112 @@
+-- Replaces the per-row check that an event's parents (`depends_on`) have
+-- all completed, which `claim_events` used to run for every candidate,
+-- with a `pending_parents` counter kept up-to-date by triggers.
+
+ALTER TABLE artwork_indexer.event_queue
+    ADD COLUMN pending_parents INTEGER NOT NULL DEFAULT 0;
+
+UPDATE artwork_indexer.event_queue eq
+   SET pending_parents = (
+        SELECT count(*)
+          FROM artwork_indexer.event_queue parent_eq
+         WHERE parent_eq.id = any(eq.depends_on)
+           AND parent_eq.state != 'completed'
+       )
+ WHERE eq.depends_on IS NOT NULL
+   AND eq.state != 'completed';
+
+DROP INDEX artwork_indexer.event_queue_idx_queued_next_attempt_at;
+
+CREATE INDEX event_queue_idx_queued_next_attempt_at
+    ON artwork_indexer.event_queue (next_attempt_at, id)
+    WHERE state = 'queued' AND pending_parents = 0;
+
+CREATE INDEX event_queue_idx_depends_on
+    ON artwork_indexer.event_queue USING gin (depends_on);
+
+-- Counts the parents that haven't completed yet as they're added to
+-- `depends_on`, and uncounts those removed from it. Added parents are
+-- locked, so that one can't complete between being counted here and
+-- this row becoming visible to `a_upd_event_queue_state`. (The generated
+-- triggers only ever add parents they've just inserted themselves, so
+-- this doesn't wait on the indexer.)
+CREATE OR REPLACE FUNCTION artwork_indexer.b_ins_upd_event_queue_depends_on()
+RETURNS TRIGGER AS $$
+DECLARE
+    old_depends_on BIGINT[] := '{}';
+    added_count INTEGER;
+    removed_count INTEGER;
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        NEW.pending_parents = 0;
+    ELSIF OLD.depends_on IS NOT NULL THEN
+        old_depends_on = OLD.depends_on;
+    END IF;
+
+    IF NEW.depends_on IS NULL AND cardinality(old_depends_on) = 0 THEN
+        RETURN NEW;
+    END IF;
+
+    SELECT count(*)
+      INTO added_count
+      FROM (
+        SELECT 1
+          FROM artwork_indexer.event_queue parent_eq
+         WHERE parent_eq.id = any(NEW.depends_on)
+           AND NOT (parent_eq.id = any(old_depends_on))
+           AND parent_eq.state != 'completed'
+           FOR SHARE
+      ) added_parent;
+
+    SELECT count(*)
+      INTO removed_count
+      FROM artwork_indexer.event_queue parent_eq
+     WHERE parent_eq.id = any(old_depends_on)
+       AND NOT (parent_eq.id = any(coalesce(NEW.depends_on, '{}')))
+       AND parent_eq.state != 'completed';
+
+    NEW.pending_parents = NEW.pending_parents + added_count - removed_count;
+    RETURN NEW;
+END;
+$$ LANGUAGE 'plpgsql';
+
+CREATE TRIGGER b_ins_upd_event_queue_depends_on
+    BEFORE INSERT OR UPDATE OF depends_on ON artwork_indexer.event_queue
+    FOR EACH ROW EXECUTE FUNCTION artwork_indexer.b_ins_upd_event_queue_depends_on();
+
+-- Pushes an event's completion (or, if it's re-queued by hand, the
+-- reverse) to the events depending on it.
+CREATE OR REPLACE FUNCTION artwork_indexer.a_upd_event_queue_state()
+RETURNS TRIGGER AS $$
+BEGIN
+    UPDATE artwork_indexer.event_queue
+       SET pending_parents = pending_parents +
+           (CASE WHEN NEW.state = 'completed' THEN -1 ELSE 1 END)
+     WHERE depends_on @> ARRAY[NEW.id];
+    RETURN NULL;
+END;
+$$ LANGUAGE 'plpgsql';
+
+CREATE TRIGGER a_upd_event_queue_state
+    AFTER UPDATE OF state ON artwork_indexer.event_queue
+    FOR EACH ROW
+    WHEN ((OLD.state = 'completed') != (NEW.state = 'completed'))
+    EXECUTE FUNCTION artwork_indexer.a_upd_event_queue_state();
+
+-- Events that no longer exist don't block anything, as if they had
+-- completed.
+CREATE OR REPLACE FUNCTION artwork_indexer.a_del_event_queue()
+RETURNS TRIGGER AS $$
+BEGIN
+    UPDATE artwork_indexer.event_queue
+       SET pending_parents = pending_parents - 1
+     WHERE depends_on @> ARRAY[OLD.id];
+    RETURN NULL;
+END;
+$$ LANGUAGE 'plpgsql';
+
+CREATE TRIGGER a_del_event_queue
+    AFTER DELETE ON artwork_indexer.event_queue
+    FOR EACH ROW
+    WHEN (OLD.state != 'completed')
+    EXECUTE FUNCTION artwork_indexer.a_del_event_queue();
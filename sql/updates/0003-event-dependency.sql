@@ -0,0 +1,154 @@
+-- Moves event dependencies from the `depends_on` array into the
+-- `event_dependency` table, whose indexes find an event's children
+-- (e.g. to fail them along with it) without scanning the queue.
+
+CREATE TABLE artwork_indexer.event_dependency (
+    parent              BIGINT NOT NULL,
+    child               BIGINT NOT NULL
+);
+
+-- Parents that no longer exist didn't count towards `pending_parents`,
+-- and are dropped.
+INSERT INTO artwork_indexer.event_dependency (parent, child)
+     SELECT DISTINCT parent_eq.id, eq.id
+       FROM artwork_indexer.event_queue eq
+       JOIN artwork_indexer.event_queue parent_eq
+         ON parent_eq.id = any(eq.depends_on);
+
+ALTER TABLE artwork_indexer.event_dependency
+    ADD CONSTRAINT event_dependency_pkey
+    PRIMARY KEY (parent, child);
+
+ALTER TABLE artwork_indexer.event_dependency
+    ADD CONSTRAINT event_dependency_fk_parent
+    FOREIGN KEY (parent)
+    REFERENCES artwork_indexer.event_queue(id)
+    DEFERRABLE INITIALLY DEFERRED;
+
+ALTER TABLE artwork_indexer.event_dependency
+    ADD CONSTRAINT event_dependency_fk_child
+    FOREIGN KEY (child)
+    REFERENCES artwork_indexer.event_queue(id)
+    ON DELETE CASCADE;
+
+CREATE INDEX event_dependency_idx_child
+    ON artwork_indexer.event_dependency (child);
+
+DROP TRIGGER b_ins_upd_event_queue_depends_on
+    ON artwork_indexer.event_queue;
+DROP FUNCTION artwork_indexer.b_ins_upd_event_queue_depends_on();
+DROP TRIGGER a_upd_event_queue_state ON artwork_indexer.event_queue;
+DROP TRIGGER a_del_event_queue ON artwork_indexer.event_queue;
+
+-- Also drops `event_queue_idx_depends_on`.
+ALTER TABLE artwork_indexer.event_queue DROP COLUMN depends_on;
+
+-- Counts the parents that haven't completed yet as dependencies are
+-- added. They're locked, so that one can't complete between being
+-- counted here and the new rows becoming visible to
+-- `a_upd_event_queue_state`. (The generated triggers only ever add
+-- parents they've just inserted themselves, so this doesn't wait on
+-- the indexer.)
+CREATE OR REPLACE FUNCTION artwork_indexer.a_ins_event_dependency()
+RETURNS TRIGGER AS $$
+BEGIN
+    WITH pending_parent AS (
+        SELECT parent_eq.id
+          FROM artwork_indexer.event_queue parent_eq
+         WHERE parent_eq.id IN (SELECT parent FROM new_dependency)
+           AND parent_eq.state != 'completed'
+           FOR SHARE
+    )
+    UPDATE artwork_indexer.event_queue eq
+       SET pending_parents = eq.pending_parents + added.count
+      FROM (
+        SELECT dep.child, count(*) AS count
+          FROM new_dependency dep
+          JOIN pending_parent ON pending_parent.id = dep.parent
+         GROUP BY dep.child
+      ) added
+     WHERE eq.id = added.child;
+    RETURN NULL;
+END;
+$$ LANGUAGE 'plpgsql';
+
+CREATE TRIGGER a_ins_event_dependency
+    AFTER INSERT ON artwork_indexer.event_dependency
+    REFERENCING NEW TABLE AS new_dependency
+    FOR EACH STATEMENT
+    EXECUTE FUNCTION artwork_indexer.a_ins_event_dependency();
+
+-- Uncounts the parents that haven't completed yet as dependencies are
+-- removed. (Those removed along with their parent are uncounted by
+-- `a_del_event_queue` instead.)
+CREATE OR REPLACE FUNCTION artwork_indexer.a_del_event_dependency()
+RETURNS TRIGGER AS $$
+BEGIN
+    UPDATE artwork_indexer.event_queue eq
+       SET pending_parents = eq.pending_parents - removed.count
+      FROM (
+        SELECT dep.child, count(*) AS count
+          FROM old_dependency dep
+          JOIN artwork_indexer.event_queue parent_eq
+            ON parent_eq.id = dep.parent
+         WHERE parent_eq.state != 'completed'
+         GROUP BY dep.child
+      ) removed
+     WHERE eq.id = removed.child;
+    RETURN NULL;
+END;
+$$ LANGUAGE 'plpgsql';
+
+CREATE TRIGGER a_del_event_dependency
+    AFTER DELETE ON artwork_indexer.event_dependency
+    REFERENCING OLD TABLE AS old_dependency
+    FOR EACH STATEMENT
+    EXECUTE FUNCTION artwork_indexer.a_del_event_dependency();
+
+-- Pushes an event's completion (or, if it's re-queued by hand, the
+-- reverse) to the events depending on it.
+CREATE OR REPLACE FUNCTION artwork_indexer.a_upd_event_queue_state()
+RETURNS TRIGGER AS $$
+BEGIN
+    UPDATE artwork_indexer.event_queue
+       SET pending_parents = pending_parents +
+           (CASE WHEN NEW.state = 'completed' THEN -1 ELSE 1 END)
+     WHERE id IN (
+        SELECT child
+          FROM artwork_indexer.event_dependency
+         WHERE parent = NEW.id
+     );
+    RETURN NULL;
+END;
+$$ LANGUAGE 'plpgsql';
+
+CREATE TRIGGER a_upd_event_queue_state
+    AFTER UPDATE OF state ON artwork_indexer.event_queue
+    FOR EACH ROW
+    WHEN ((OLD.state = 'completed') != (NEW.state = 'completed'))
+    EXECUTE FUNCTION artwork_indexer.a_upd_event_queue_state();
+
+-- Events that no longer exist don't block anything, as if they had
+-- completed. Their dependencies are removed here rather than by
+-- `ON DELETE CASCADE`, which would run before this trigger could find
+-- the children.
+CREATE OR REPLACE FUNCTION artwork_indexer.a_del_event_queue()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF OLD.state != 'completed' THEN
+        UPDATE artwork_indexer.event_queue
+           SET pending_parents = pending_parents - 1
+         WHERE id IN (
+            SELECT child
+              FROM artwork_indexer.event_dependency
+             WHERE parent = OLD.id
+         );
+    END IF;
+    DELETE FROM artwork_indexer.event_dependency WHERE parent = OLD.id;
+    RETURN NULL;
+END;
+$$ LANGUAGE 'plpgsql';
+
+CREATE TRIGGER a_del_event_queue
+    AFTER DELETE ON artwork_indexer.event_queue
+    FOR EACH ROW EXECUTE FUNCTION artwork_indexer.a_del_event_queue();
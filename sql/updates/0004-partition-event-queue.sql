@@ -0,0 +1,402 @@
+-- Partitions `event_queue` and `event_failure_reason` by when events
+-- completed (see create_schema.sql), so that completed events no longer
+-- share a heap and indexes with the queue, and can be dropped a month at
+-- a time. This requires PostgreSQL 15 or later.
+--
+-- The tables are recreated and their rows copied over, except for the
+-- completed events that `cleanup_events` would have deleted anyway.
+-- Events that completed before this have their `last_updated` as their
+-- `completed_at`.
+
+DROP TRIGGER b_upd_event_queue ON artwork_indexer.event_queue;
+DROP TRIGGER a_upd_event_queue_state ON artwork_indexer.event_queue;
+DROP TRIGGER a_del_event_queue ON artwork_indexer.event_queue;
+DROP TRIGGER a_ins_event_dependency ON artwork_indexer.event_dependency;
+DROP TRIGGER a_del_event_dependency ON artwork_indexer.event_dependency;
+DROP FUNCTION artwork_indexer.a_upd_event_queue_state();
+
+ALTER TABLE artwork_indexer.event_dependency
+    DROP CONSTRAINT event_dependency_fk_parent,
+    DROP CONSTRAINT event_dependency_fk_child;
+
+ALTER TABLE artwork_indexer.event_failure_reason
+    DROP CONSTRAINT event_failure_reason_fk_event;
+ALTER TABLE artwork_indexer.event_queue
+    DROP CONSTRAINT event_queue_pkey;
+DROP INDEX artwork_indexer.event_queue_idx_queued_uniq;
+DROP INDEX artwork_indexer.event_queue_idx_state_created;
+DROP INDEX artwork_indexer.event_queue_idx_queued_next_attempt_at;
+DROP INDEX artwork_indexer.event_failure_reason_idx_event;
+
+ALTER TABLE artwork_indexer.event_queue RENAME TO event_queue_old;
+ALTER TABLE artwork_indexer.event_failure_reason
+    RENAME TO event_failure_reason_old;
+ALTER SEQUENCE artwork_indexer.event_queue_id_seq
+    RENAME TO event_queue_old_id_seq;
+
+-- Partitioned by `completed_at`: events that haven't completed are all
+-- in `event_queue_active`, which therefore stays small, and completed
+-- ones are moved to a partition for the month they completed in. Old
+-- partitions are dropped whole (see `drop_event_partitions` below)
+-- rather than deleted from.
+CREATE TABLE artwork_indexer.event_queue (
+    id                  BIGSERIAL,
+    state               artwork_indexer.event_state NOT NULL DEFAULT 'queued',
+    entity_type         artwork_indexer.indexable_entity_type NOT NULL,
+    action              artwork_indexer.event_queue_action NOT NULL,
+    message             JSONB NOT NULL,
+    created             TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW(),
+    -- Note `event_queue_idx_queued_uniq` below. Due to the requirement
+    -- that queued events be unique, external triggers should have an
+    -- `ON CONFLICT` action.
+    attempts            SMALLINT NOT NULL DEFAULT 0,
+    last_updated        TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW(),
+    -- When a queued event may next be run. Events are run in this
+    -- order, which for events that haven't failed yet is the order
+    -- they were created in. After each failed attempt, it's pushed
+    -- back by an hour per attempt so far.
+    next_attempt_at     TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW(),
+    -- How many of the event's parents (see `event_dependency`) haven't
+    -- completed yet. Kept up-to-date by the triggers below, so it needn't
+    -- be set by hand. An event can only run once this reaches 0.
+    pending_parents     INTEGER NOT NULL DEFAULT 0,
+    -- When the event completed, or 'infinity' if it hasn't. Kept
+    -- up-to-date by `b_upd_event_queue` (below), which moves the event
+    -- between partitions as a result, so it only needs to be set when
+    -- inserting completed events.
+    completed_at        TIMESTAMP WITH TIME ZONE NOT NULL
+                        DEFAULT 'infinity',
+    CONSTRAINT event_queue_completed_at_check
+        CHECK ((state = 'completed') = (completed_at != 'infinity'))
+) PARTITION BY RANGE (completed_at);
+
+CREATE TABLE artwork_indexer.event_queue_active
+    PARTITION OF artwork_indexer.event_queue
+    FOR VALUES FROM ('infinity') TO (MAXVALUE);
+
+-- Partitioned like `event_queue`. `event_completed_at` follows the
+-- event's `completed_at` (through `ON UPDATE CASCADE`), which moves the
+-- failure reasons along with their event.
+CREATE TABLE artwork_indexer.event_failure_reason (
+    event               BIGINT NOT NULL,
+    event_completed_at  TIMESTAMP WITH TIME ZONE NOT NULL
+                        DEFAULT 'infinity',
+    failure_reason      TEXT NOT NULL,
+    created             TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW()
+) PARTITION BY RANGE (event_completed_at);
+
+CREATE TABLE artwork_indexer.event_failure_reason_active
+    PARTITION OF artwork_indexer.event_failure_reason
+    FOR VALUES FROM ('infinity') TO (MAXVALUE);
+
+ALTER TABLE artwork_indexer.event_queue
+    ADD CONSTRAINT event_queue_pkey
+    PRIMARY KEY (id, completed_at);
+
+ALTER TABLE artwork_indexer.event_failure_reason
+    ADD CONSTRAINT event_failure_reason_fk_event
+    FOREIGN KEY (event, event_completed_at)
+    REFERENCES artwork_indexer.event_queue(id, completed_at)
+    ON UPDATE CASCADE
+    ON DELETE CASCADE;
+
+--- MusicBrainz Server will sometimes publish the same message multiple
+--- times due to its SQL triggers firing for the same release (or event)
+--- across multiple statements. It's therefore useful to enforce that
+--- queued index events be unique. (`completed_at` is only included
+--- because a partitioned table's unique indexes must include its
+--- partition key; it's always 'infinity' for queued events.)
+CREATE UNIQUE INDEX event_queue_idx_queued_uniq
+    ON artwork_indexer.event_queue
+       (entity_type, action, message, completed_at)
+    WHERE state = 'queued';
+
+CREATE INDEX event_queue_idx_state_created
+    ON artwork_indexer.event_queue (state, created);
+
+-- Serves `claim_events` as a range scan over the queued events that
+-- are due, in the order they're run.
+CREATE INDEX event_queue_idx_queued_next_attempt_at
+    ON artwork_indexer.event_queue (next_attempt_at, id)
+    WHERE state = 'queued' AND pending_parents = 0;
+
+CREATE INDEX event_failure_reason_idx_event
+    ON artwork_indexer.event_failure_reason (event, created);
+
+-- Creates the partitions of `event_queue` and `event_failure_reason`
+-- for events completed in the (UTC) month of `month`, unless they
+-- exist already. The indexer creates them for the current and next
+-- months as part of its cleanup, so that events always have one to
+-- complete into.
+CREATE OR REPLACE FUNCTION artwork_indexer.create_event_partitions(
+    month TIMESTAMP WITH TIME ZONE
+)
+RETURNS VOID AS $$
+DECLARE
+    month_start TIMESTAMP WITH TIME ZONE := date_trunc('month', month, 'UTC');
+    month_end TIMESTAMP WITH TIME ZONE := month_start + interval '1 month';
+    suffix TEXT := to_char(month_start AT TIME ZONE 'UTC', 'YYYY_MM');
+BEGIN
+    IF to_regclass('artwork_indexer.event_queue_' || suffix) IS NULL THEN
+        EXECUTE format(
+            'CREATE TABLE artwork_indexer.%I '
+            'PARTITION OF artwork_indexer.event_queue '
+            'FOR VALUES FROM (%L) TO (%L)',
+            'event_queue_' || suffix, month_start, month_end
+        );
+        EXECUTE format(
+            'CREATE TABLE artwork_indexer.%I '
+            'PARTITION OF artwork_indexer.event_failure_reason '
+            'FOR VALUES FROM (%L) TO (%L)',
+            'event_failure_reason_' || suffix, month_start, month_end
+        );
+    END IF;
+END;
+$$ LANGUAGE 'plpgsql';
+
+-- Detaches and drops the partitions of events completed in months that
+-- ended before `older_than`, returning their names. Dependencies on the
+-- events dropped are removed first.
+CREATE OR REPLACE FUNCTION artwork_indexer.drop_event_partitions(
+    older_than TIMESTAMP WITH TIME ZONE
+)
+RETURNS SETOF TEXT AS $$
+DECLARE
+    suffix TEXT;
+BEGIN
+    FOR suffix IN
+        SELECT substring(child.relname FROM '^event_queue_(\d{4}_\d{2})$')
+          FROM pg_inherits
+          JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+         WHERE pg_inherits.inhparent = 'artwork_indexer.event_queue'::regclass
+           AND child.relname ~ '^event_queue_\d{4}_\d{2}$'
+         ORDER BY child.relname
+    LOOP
+        CONTINUE WHEN (
+            to_date(suffix, 'YYYY_MM')::timestamp AT TIME ZONE 'UTC'
+        ) + interval '1 month' > older_than;
+        EXECUTE format(
+            'DELETE FROM artwork_indexer.event_dependency dep '
+            'USING artwork_indexer.%I eq WHERE eq.id = dep.parent',
+            'event_queue_' || suffix
+        );
+        EXECUTE format(
+            'ALTER TABLE artwork_indexer.event_failure_reason '
+            'DETACH PARTITION artwork_indexer.%1$I; '
+            'DROP TABLE artwork_indexer.%1$I',
+            'event_failure_reason_' || suffix
+        );
+        EXECUTE format(
+            'ALTER TABLE artwork_indexer.event_queue '
+            'DETACH PARTITION artwork_indexer.%1$I; '
+            'DROP TABLE artwork_indexer.%1$I',
+            'event_queue_' || suffix
+        );
+        RETURN NEXT 'event_queue_' || suffix;
+    END LOOP;
+END;
+$$ LANGUAGE 'plpgsql';
+
+SELECT artwork_indexer.create_event_partitions(month)
+  FROM (
+    SELECT DISTINCT date_trunc('month', last_updated, 'UTC') AS month
+      FROM artwork_indexer.event_queue_old
+     WHERE state = 'completed'
+       AND (now() - created) <= interval '90 days'
+  ) completed_month;
+
+INSERT INTO artwork_indexer.event_queue
+        (id, state, entity_type, action, message, created, attempts,
+         last_updated, next_attempt_at, pending_parents, completed_at)
+     SELECT id, state, entity_type, action, message, created, attempts,
+            last_updated, next_attempt_at, pending_parents,
+            CASE WHEN state = 'completed'
+                 THEN last_updated
+                 ELSE 'infinity' END
+       FROM artwork_indexer.event_queue_old
+      WHERE state != 'completed'
+         OR (now() - created) <= interval '90 days';
+
+INSERT INTO artwork_indexer.event_failure_reason
+        (event, event_completed_at, failure_reason, created)
+     SELECT fr.event, eq.completed_at, fr.failure_reason, fr.created
+       FROM artwork_indexer.event_failure_reason_old fr
+       JOIN artwork_indexer.event_queue eq ON eq.id = fr.event;
+
+SELECT setval('artwork_indexer.event_queue_id_seq', last_value, is_called)
+  FROM artwork_indexer.event_queue_old_id_seq;
+
+DROP TABLE artwork_indexer.event_failure_reason_old;
+DROP TABLE artwork_indexer.event_queue_old;
+
+-- Completed events no longer keep their dependencies, and those on
+-- events that weren't copied are dropped. Neither counted towards
+-- `pending_parents`.
+DELETE FROM artwork_indexer.event_dependency dep
+ WHERE NOT EXISTS (
+        SELECT 1
+          FROM artwork_indexer.event_queue eq
+         WHERE eq.id = dep.child
+           AND eq.completed_at = 'infinity'
+       )
+    OR NOT EXISTS (
+        SELECT 1
+          FROM artwork_indexer.event_queue eq
+         WHERE eq.id = dep.parent
+       );
+
+CREATE OR REPLACE FUNCTION artwork_indexer.b_upd_event_queue()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF OLD.last_updated = NEW.last_updated THEN
+        NEW.last_updated = NOW();
+    END IF;
+    IF (OLD.state = 'completed') != (NEW.state = 'completed') THEN
+        NEW.completed_at = (
+            CASE WHEN NEW.state = 'completed'
+                 THEN NOW()
+                 ELSE 'infinity' END
+        );
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE 'plpgsql';
+
+CREATE TRIGGER b_upd_event_queue
+    BEFORE UPDATE ON artwork_indexer.event_queue
+    FOR EACH ROW EXECUTE FUNCTION artwork_indexer.b_upd_event_queue();
+
+-- Counts the parents that haven't completed yet as dependencies are
+-- added. They're locked, so that one can't complete between being
+-- counted here and the new rows becoming visible to
+-- `a_del_event_queue`. (The generated triggers only ever add parents
+-- they've just inserted themselves, so this doesn't wait on the
+-- indexer.)
+CREATE OR REPLACE FUNCTION artwork_indexer.a_ins_event_dependency()
+RETURNS TRIGGER AS $$
+BEGIN
+    WITH pending_parent AS (
+        SELECT parent_eq.id
+          FROM artwork_indexer.event_queue parent_eq
+         WHERE parent_eq.id IN (SELECT parent FROM new_dependency)
+           AND parent_eq.completed_at = 'infinity'
+           FOR SHARE
+    )
+    UPDATE artwork_indexer.event_queue eq
+       SET pending_parents = eq.pending_parents + added.count
+      FROM (
+        SELECT dep.child, count(*) AS count
+          FROM new_dependency dep
+          JOIN pending_parent ON pending_parent.id = dep.parent
+         GROUP BY dep.child
+      ) added
+     WHERE eq.id = added.child;
+    RETURN NULL;
+END;
+$$ LANGUAGE 'plpgsql';
+
+CREATE TRIGGER a_ins_event_dependency
+    AFTER INSERT ON artwork_indexer.event_dependency
+    REFERENCING NEW TABLE AS new_dependency
+    FOR EACH STATEMENT
+    EXECUTE FUNCTION artwork_indexer.a_ins_event_dependency();
+
+-- Uncounts the parents that haven't completed yet as dependencies are
+-- removed. (Those removed along with their parent are uncounted by
+-- `a_del_event_queue` instead.)
+CREATE OR REPLACE FUNCTION artwork_indexer.a_del_event_dependency()
+RETURNS TRIGGER AS $$
+BEGIN
+    UPDATE artwork_indexer.event_queue eq
+       SET pending_parents = eq.pending_parents - removed.count
+      FROM (
+        SELECT dep.child, count(*) AS count
+          FROM old_dependency dep
+          JOIN artwork_indexer.event_queue parent_eq
+            ON parent_eq.id = dep.parent
+         WHERE parent_eq.completed_at = 'infinity'
+         GROUP BY dep.child
+      ) removed
+     WHERE eq.id = removed.child;
+    RETURN NULL;
+END;
+$$ LANGUAGE 'plpgsql';
+
+CREATE TRIGGER a_del_event_dependency
+    AFTER DELETE ON artwork_indexer.event_dependency
+    REFERENCING OLD TABLE AS old_dependency
+    FOR EACH STATEMENT
+    EXECUTE FUNCTION artwork_indexer.a_del_event_dependency();
+
+-- A change of state to or from 'completed' moves an event to another
+-- partition, which runs the DELETE and INSERT triggers below (but not
+-- UPDATE ones).
+
+-- Blocks an event's children again when it's re-queued by hand after
+-- completing. (New events don't have any children yet.)
+CREATE OR REPLACE FUNCTION artwork_indexer.a_ins_event_queue()
+RETURNS TRIGGER AS $$
+BEGIN
+    UPDATE artwork_indexer.event_queue
+       SET pending_parents = pending_parents + 1
+     WHERE id IN (
+        SELECT child
+          FROM artwork_indexer.event_dependency
+         WHERE parent = NEW.id
+     );
+    RETURN NULL;
+END;
+$$ LANGUAGE 'plpgsql';
+
+CREATE TRIGGER a_ins_event_queue
+    AFTER INSERT ON artwork_indexer.event_queue
+    FOR EACH ROW
+    WHEN (NEW.completed_at = 'infinity')
+    EXECUTE FUNCTION artwork_indexer.a_ins_event_queue();
+
+-- Unblocks an event's children once it completes. Events that no
+-- longer exist don't block anything either, as if they had completed;
+-- their dependencies are removed here, along with those of completed
+-- events, which aren't needed anymore.
+CREATE OR REPLACE FUNCTION artwork_indexer.a_del_event_queue()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF OLD.completed_at = 'infinity' THEN
+        UPDATE artwork_indexer.event_queue
+           SET pending_parents = pending_parents - 1
+         WHERE id IN (
+            SELECT child
+              FROM artwork_indexer.event_dependency
+             WHERE parent = OLD.id
+         );
+    END IF;
+    IF NOT EXISTS (
+        SELECT 1 FROM artwork_indexer.event_queue WHERE id = OLD.id
+    ) THEN
+        DELETE FROM artwork_indexer.event_dependency WHERE parent = OLD.id;
+        DELETE FROM artwork_indexer.event_dependency WHERE child = OLD.id;
+    ELSIF OLD.completed_at = 'infinity' THEN
+        DELETE FROM artwork_indexer.event_dependency WHERE child = OLD.id;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE 'plpgsql';
+
+CREATE TRIGGER a_del_event_queue
+    AFTER DELETE ON artwork_indexer.event_queue
+    FOR EACH ROW EXECUTE FUNCTION artwork_indexer.a_del_event_queue();
+
+-- Without foreign keys to the queue, `event_dependency` isn't reached
+-- by `TRUNCATE ... CASCADE`.
+CREATE OR REPLACE FUNCTION artwork_indexer.a_trunc_event_queue()
+RETURNS TRIGGER AS $$
+BEGIN
+    TRUNCATE artwork_indexer.event_dependency;
+    RETURN NULL;
+END;
+$$ LANGUAGE 'plpgsql';
+
+CREATE TRIGGER a_trunc_event_queue
+    AFTER TRUNCATE ON artwork_indexer.event_queue
+    FOR EACH STATEMENT
+    EXECUTE FUNCTION artwork_indexer.a_trunc_event_queue();
@@ -0,0 +1,30 @@
+-- Replaces the rule failing events that had been running for over 2.5
+-- minutes (counted from when they were created) with leases, which the
+-- indexer extends while it's running an event. Events whose lease has
+-- expired are re-queued.
+--
+-- Running events left over from before the upgrade have no lease, and
+-- are re-queued as though it had expired.
+
+ALTER TABLE artwork_indexer.event_queue
+    ADD COLUMN lease_expires_at TIMESTAMP WITH TIME ZONE;
+
+CREATE OR REPLACE FUNCTION artwork_indexer.b_upd_event_queue()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF OLD.last_updated = NEW.last_updated THEN
+        NEW.last_updated = NOW();
+    END IF;
+    IF (OLD.state = 'completed') != (NEW.state = 'completed') THEN
+        NEW.completed_at = (
+            CASE WHEN NEW.state = 'completed'
+                 THEN NOW()
+                 ELSE 'infinity' END
+        );
+    END IF;
+    IF NEW.state != 'running' THEN
+        NEW.lease_expires_at = NULL;
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE 'plpgsql';
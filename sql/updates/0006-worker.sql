@@ -0,0 +1,46 @@
+-- Adds the `worker` table, where each indexer process registers itself
+-- and reports its progress, and records which worker is running each
+-- event.
+
+CREATE TABLE artwork_indexer.worker (
+    id                  SERIAL,
+    host                TEXT NOT NULL,
+    pid                 INTEGER NOT NULL,
+    concurrency         INTEGER NOT NULL,
+    started             TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW(),
+    last_heartbeat      TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW(),
+    events_handled      BIGINT NOT NULL DEFAULT 0,
+    events_in_flight    INTEGER NOT NULL DEFAULT 0,
+    last_claim_duration INTERVAL
+);
+
+ALTER TABLE artwork_indexer.worker
+    ADD CONSTRAINT worker_pkey
+    PRIMARY KEY (id);
+
+CREATE INDEX worker_idx_last_heartbeat
+    ON artwork_indexer.worker (last_heartbeat);
+
+ALTER TABLE artwork_indexer.event_queue
+    ADD COLUMN worker INTEGER;
+
+CREATE OR REPLACE FUNCTION artwork_indexer.b_upd_event_queue()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF OLD.last_updated = NEW.last_updated THEN
+        NEW.last_updated = NOW();
+    END IF;
+    IF (OLD.state = 'completed') != (NEW.state = 'completed') THEN
+        NEW.completed_at = (
+            CASE WHEN NEW.state = 'completed'
+                 THEN NOW()
+                 ELSE 'infinity' END
+        );
+    END IF;
+    IF NEW.state != 'running' THEN
+        NEW.lease_expires_at = NULL;
+        NEW.worker = NULL;
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE 'plpgsql';
@@ -0,0 +1,18 @@
+-- Adds the `uploaded_file` table, where the hash of the content last
+-- uploaded to each file is kept so that unchanged files aren't uploaded
+-- again, and counts the uploads each worker skips.
+
+CREATE TABLE artwork_indexer.uploaded_file (
+    entity_type         artwork_indexer.indexable_entity_type NOT NULL,
+    gid                 UUID NOT NULL,
+    file_name           TEXT NOT NULL,
+    content_sha256      BYTEA NOT NULL,
+    uploaded            TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW()
+);
+
+ALTER TABLE artwork_indexer.uploaded_file
+    ADD CONSTRAINT uploaded_file_pkey
+    PRIMARY KEY (entity_type, gid, file_name);
+
+ALTER TABLE artwork_indexer.worker
+    ADD COLUMN uploads_skipped BIGINT NOT NULL DEFAULT 0;
@@ -0,0 +1,9 @@
+-- Adds the `index_images` and `index_metadata` actions, which upload
+-- just index.json or the MB metadata XML (respectively), so that the
+-- triggers don't request more than an edit changed.
+
+ALTER TYPE artwork_indexer.event_queue_action
+    ADD VALUE 'index_images' AFTER 'index';
+
+ALTER TYPE artwork_indexer.event_queue_action
+    ADD VALUE 'index_metadata' AFTER 'index_images';
@@ -0,0 +1,54 @@
+-- Detaches and drops the partitions of events completed in months that
+-- ended before `older_than`, returning their names. Dependencies on the
+-- events dropped are removed first.
+--
+-- Detaching needs an exclusive lock on both parent tables. These are
+-- taken up front, in the order the indexer's own queries use, since
+-- upgrading to them midway (after the `DELETE`) can deadlock with an
+-- indexer claiming or failing events.
+CREATE OR REPLACE FUNCTION artwork_indexer.drop_event_partitions(
+    older_than TIMESTAMP WITH TIME ZONE
+)
+RETURNS SETOF TEXT AS $$
+DECLARE
+    suffix TEXT;
+    locked BOOLEAN := FALSE;
+BEGIN
+    FOR suffix IN
+        SELECT substring(child.relname FROM '^event_queue_(\d{4}_\d{2})$')
+          FROM pg_inherits
+          JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+         WHERE pg_inherits.inhparent = 'artwork_indexer.event_queue'::regclass
+           AND child.relname ~ '^event_queue_\d{4}_\d{2}$'
+         ORDER BY child.relname
+    LOOP
+        CONTINUE WHEN (
+            to_date(suffix, 'YYYY_MM')::timestamp AT TIME ZONE 'UTC'
+        ) + interval '1 month' > older_than;
+        IF NOT locked THEN
+            LOCK TABLE artwork_indexer.event_queue,
+                       artwork_indexer.event_failure_reason
+                IN ACCESS EXCLUSIVE MODE;
+            locked := TRUE;
+        END IF;
+        EXECUTE format(
+            'DELETE FROM artwork_indexer.event_dependency dep '
+            'USING artwork_indexer.%I eq WHERE eq.id = dep.parent',
+            'event_queue_' || suffix
+        );
+        EXECUTE format(
+            'ALTER TABLE artwork_indexer.event_failure_reason '
+            'DETACH PARTITION artwork_indexer.%1$I; '
+            'DROP TABLE artwork_indexer.%1$I',
+            'event_failure_reason_' || suffix
+        );
+        EXECUTE format(
+            'ALTER TABLE artwork_indexer.event_queue '
+            'DETACH PARTITION artwork_indexer.%1$I; '
+            'DROP TABLE artwork_indexer.%1$I',
+            'event_queue_' || suffix
+        );
+        RETURN NEXT 'event_queue_' || suffix;
+    END LOOP;
+END;
+$$ LANGUAGE 'plpgsql';
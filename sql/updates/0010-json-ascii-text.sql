@@ -0,0 +1,29 @@
+-- Adds `json_ascii_text`, used to render index.json in the database.
+
+-- Quotes `value` as a JSON string the way Python's `json.dumps` does by
+-- default (`ensure_ascii=True`): like `to_json`, but with everything
+-- outside printable ASCII escaped, and characters beyond the BMP as
+-- surrogate pairs. Used by the generated `build_*_index_json` functions,
+-- which must match `EventHandler.build_index_json` byte for byte.
+CREATE OR REPLACE FUNCTION artwork_indexer.json_ascii_text(value TEXT)
+RETURNS TEXT AS $$
+    SELECT CASE
+        WHEN json_text ~ '[^\x01-\x7e]' THEN (
+            SELECT string_agg(
+                CASE
+                    WHEN ascii(c) > 65535 THEN
+                        '\u' || to_hex(55296 + ((ascii(c) - 65536) >> 10)) ||
+                        '\u' || to_hex(56320 + ((ascii(c) - 65536) & 1023))
+                    WHEN ascii(c) > 126 THEN
+                        '\u' || lpad(to_hex(ascii(c)), 4, '0')
+                    ELSE c
+                END,
+                '' ORDER BY i
+            )
+            FROM regexp_split_to_table(json_text, '')
+                 WITH ORDINALITY AS chars (c, i)
+        )
+        ELSE json_text
+    END
+    FROM (SELECT to_json(value)::text AS json_text) json_value
+$$ LANGUAGE 'sql' IMMUTABLE STRICT PARALLEL SAFE;
@@ -0,0 +1,7 @@
+-- Adds the connection pool stats sent with each worker's heartbeat.
+
+ALTER TABLE artwork_indexer.worker
+    ADD COLUMN pool_requests BIGINT,
+    ADD COLUMN pool_requests_queued BIGINT,
+    ADD COLUMN pool_wait_time INTERVAL,
+    ADD COLUMN pool_request_errors BIGINT;
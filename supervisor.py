@@ -0,0 +1,212 @@
+# artwork-indexer - update artwork index files at the Internet Archive
+#
+# Copyright (C) 2026  MetaBrainz Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import logging
+import multiprocessing
+import os
+import signal
+import time
+
+
+class WorkerSupervisor:
+    """
+    Forks `worker_count` worker processes, each calling
+    `run_worker(event_counter)`, and keeps them running:
+
+      * SIGTERM and SIGINT are forwarded to the workers as SIGTERM; the
+        supervisor exits once all of them have.
+
+      * SIGHUP is forwarded as-is, so that the workers reload their
+        configuration.
+
+      * Workers that crash (exit with a non-zero status, or are killed by
+        a signal) are restarted, waiting `restart_backoff_min` seconds
+        before the first restart and twice as long after each further
+        crash, up to `restart_backoff_max`. A worker that stayed up for at
+        least `restart_backoff_max` seconds is considered healthy again.
+        Workers that exit cleanly are not restarted.
+
+      * `event_counter` is a shared `multiprocessing.Value` which the
+        worker increments for each event it handles. Every
+        `stats_interval` seconds, the supervisor logs the throughput of
+        each worker and of all of them combined.
+
+    Nothing may connect to the database before the workers are forked:
+    connections can't be shared between processes.
+    """
+
+    def __init__(self,
+                 worker_count,
+                 run_worker,
+                 stats_interval=60,
+                 restart_backoff_min=1,
+                 restart_backoff_max=60):
+        self.worker_count = worker_count
+        self.run_worker = run_worker
+        self.stats_interval = stats_interval
+        self.restart_backoff_min = restart_backoff_min
+        self.restart_backoff_max = restart_backoff_max
+
+        self.event_counters = [
+            multiprocessing.Value('Q', 0) for _ in range(worker_count)
+        ]
+        self.last_event_counts = [0] * worker_count
+        self.restart_backoffs = [restart_backoff_min] * worker_count
+        self.restart_counts = [0] * worker_count
+
+        # pid -> (worker index, start time)
+        self.workers = {}
+        # worker index -> time at which to restart it
+        self.pending_restarts = {}
+
+        self.shutdown_requested = False
+        self.reload_requested = False
+
+    def _start_worker(self, index):
+        pid = os.fork()
+        if pid == 0:
+            # Let the worker install its own signal handlers.
+            for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+                signal.signal(signum, signal.SIG_DFL)
+            status = 0
+            try:
+                self.run_worker(self.event_counters[index])
+            except SystemExit as exc:
+                status = exc.code if isinstance(exc.code, int) \
+                    else int(exc.code is not None)
+            except BaseException:
+                logging.exception('Worker %s crashed', index + 1)
+                status = 1
+            finally:
+                # Never return into the supervisor's code.
+                logging.shutdown()
+                os._exit(status)
+
+        logging.info('Started worker %s (pid %s)', index + 1, pid)
+        self.workers[pid] = (index, time.monotonic())
+
+    def _reap_workers(self):
+        while self.workers:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                break
+            index, start_time = self.workers.pop(pid)
+            exit_code = os.waitstatus_to_exitcode(status)
+
+            if exit_code == 0 or self.shutdown_requested:
+                logging.info('Worker %s (pid %s) exited with status %s',
+                             index + 1, pid, exit_code)
+                continue
+
+            if time.monotonic() - start_time >= self.restart_backoff_max:
+                self.restart_backoffs[index] = self.restart_backoff_min
+            backoff = self.restart_backoffs[index]
+            self.restart_backoffs[index] = min(
+                backoff * 2,
+                self.restart_backoff_max,
+            )
+            logging.error(
+                'Worker %s (pid %s) crashed with status %s; '
+                'restarting it in %s second(s)',
+                index + 1, pid, exit_code, backoff,
+            )
+            self.pending_restarts[index] = time.monotonic() + backoff
+
+    def _restart_workers(self):
+        current_time = time.monotonic()
+        for index, restart_time in list(self.pending_restarts.items()):
+            if restart_time <= current_time:
+                del self.pending_restarts[index]
+                self.restart_counts[index] += 1
+                self._start_worker(index)
+
+    def _signal_workers(self, signum):
+        for pid in self.workers:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def _log_throughput(self, seconds_elapsed):
+        event_counts = [counter.value for counter in self.event_counters]
+        deltas = [
+            count - last_count
+            for count, last_count in zip(event_counts, self.last_event_counts)
+        ]
+        self.last_event_counts = event_counts
+        logging.info(
+            'Handled %s event(s) in the last %.0f second(s) '
+            '(%.1f events/s); per worker: %s',
+            sum(deltas),
+            seconds_elapsed,
+            sum(deltas) / seconds_elapsed if seconds_elapsed else 0,
+            ', '.join(
+                '%s=%s' % (index + 1, delta)
+                for index, delta in enumerate(deltas)
+            ),
+        )
+
+    def run(self):
+        def request_shutdown(signum, frame):
+            logging.info(f'Got signal {signum}, stopping workers')
+            self.shutdown_requested = True
+
+        def request_reload(signum, frame):
+            self.reload_requested = True
+
+        previous_handlers = {
+            signal.SIGTERM: signal.signal(signal.SIGTERM, request_shutdown),
+            signal.SIGINT: signal.signal(signal.SIGINT, request_shutdown),
+            signal.SIGHUP: signal.signal(signal.SIGHUP, request_reload),
+        }
+
+        try:
+            for index in range(self.worker_count):
+                self._start_worker(index)
+
+            last_stats_time = time.monotonic()
+            shutdown_forwarded = False
+
+            while self.workers or (
+                self.pending_restarts and not self.shutdown_requested
+            ):
+                if self.shutdown_requested and not shutdown_forwarded:
+                    self.pending_restarts.clear()
+                    self._signal_workers(signal.SIGTERM)
+                    shutdown_forwarded = True
+
+                if self.reload_requested:
+                    self.reload_requested = False
+                    logging.info('Got SIGHUP, forwarding it to workers')
+                    self._signal_workers(signal.SIGHUP)
+
+                self._reap_workers()
+                if not self.shutdown_requested:
+                    self._restart_workers()
+
+                current_time = time.monotonic()
+                if current_time - last_stats_time >= self.stats_interval:
+                    self._log_throughput(current_time - last_stats_time)
+                    last_stats_time = current_time
+
+                time.sleep(0.1)
+
+            self._log_throughput(time.monotonic() - last_stats_time)
+        finally:
+            for signum, handler in previous_handlers.items():
+                signal.signal(signum, handler)
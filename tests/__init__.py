@@ -1,9 +1,13 @@
 import configparser
+import contextlib
 import json
 import logging
+import threading
+import time
 import unittest
 from textwrap import dedent
 
+import psycopg
 from pg_conn_wrapper import PgConnWrapper
 
 
@@ -117,12 +121,44 @@ def mb_metadata_xml_put(project, mbid, xml):
 
 
 def record_items(rec):
-    # ignore datetime columns
+    # ignore datetime columns, and `pending_parents`, which is kept by the
+    # `event_dependency` triggers (see
+    # test_general.TestGeneral.test_pending_parents)
     for (key, value) in rec.items():
-        if key not in ('created', 'last_updated'):
+        if key not in ('created', 'last_updated', 'next_attempt_at',
+                       'pending_parents', 'completed_at',
+                       'lease_expires_at', 'worker'):
             yield (key, value)
 
 
+def queue_event_while_running(running_event_id, event_id, delay):
+    # Queues a no-op event from another connection, `delay` seconds after
+    # the event `running_event_id` starts running, and notifies the
+    # indexer as the triggers would. Returns the thread that does so,
+    # which is started.
+    def run():
+        pg_conn = PgConnWrapper(tests_config)
+        while pg_conn.execute(dedent('''
+            SELECT state FROM artwork_indexer.event_queue WHERE id = %s
+        '''), (running_event_id,)).fetchone()['state'] != 'running':
+            pg_conn.commit()
+            time.sleep(0.05)
+        pg_conn.commit()
+        time.sleep(delay)
+        pg_conn.execute_and_commit(dedent('''
+            INSERT INTO artwork_indexer.event_queue
+                    (id, entity_type, action, message)
+                 VALUES (%(id)s, 'release', 'noop',
+                         jsonb_build_object('id', %(id)s));
+        '''), {'id': event_id})
+        pg_conn.execute_and_commit("SELECT pg_notify('artwork_indexer', '')")
+        pg_conn.close()
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread
+
+
 class MockResponse():
 
     def __init__(self, status=200, content=''):
@@ -131,10 +167,24 @@ class MockResponse():
             content = content.encode('utf-8')
         self.content = content
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
     def raise_for_status(self):
         if self.status < 200 or self.status >= 300:
             raise Exception('Error: HTTP ' + str(self.status))
 
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+    async def aiter_bytes(self, chunk_size):
+        for chunk in self.iter_content(chunk_size):
+            yield chunk
+
 
 class MockClientSession():
 
@@ -142,6 +192,20 @@ class MockClientSession():
         self.last_requests = []
         self.next_responses = []
         self.headers = {}
+        # If set, the requests made while it had a transaction open are
+        # collected in `requests_in_transaction`.
+        self.pg_conn = None
+        self.requests_in_transaction = []
+
+    def _record_request(self, request):
+        self.last_requests.append(request)
+        if (
+            self.pg_conn is not None and
+            not self.pg_conn.closed and
+            self.pg_conn.conn.info.transaction_status !=
+                psycopg.pq.TransactionStatus.IDLE
+        ):
+            self.requests_in_transaction.append(request)
 
     def _get_next_response(self):
         resp = self.next_responses.pop(0)
@@ -150,7 +214,7 @@ class MockClientSession():
         return resp
 
     def get(self, url, **kwargs):
-        self.last_requests.append({
+        self._record_request({
             'method': 'GET',
             'url': url,
             'headers': kwargs.get('headers'),
@@ -159,16 +223,19 @@ class MockClientSession():
         return self._get_next_response()
 
     def put(self, url, **kwargs):
-        self.last_requests.append({
+        data = kwargs.get('data')
+        if hasattr(data, 'read'):
+            data = data.read()
+        self._record_request({
             'method': 'PUT',
             'url': url,
             'headers': kwargs.get('headers'),
-            'data': kwargs.get('data'),
+            'data': data,
         })
         return self._get_next_response()
 
     def delete(self, url, **kwargs):
-        self.last_requests.append({
+        self._record_request({
             'method': 'DELETE',
             'url': url,
             'headers': kwargs.get('headers'),
@@ -180,20 +247,58 @@ class MockClientSession():
         pass
 
 
+class AsyncMockClientSession(MockClientSession):
+    """
+    Stands in for `httpx.AsyncClient` in the async engine, recording
+    requests in the same format as `MockClientSession`.
+    """
+
+    async def request(self, method, url, **kwargs):
+        content = kwargs.get('content')
+        if hasattr(content, '__aiter__'):
+            content = b''.join([chunk async for chunk in content])
+        self._record_request({
+            'method': method,
+            'url': url,
+            'headers': kwargs.get('headers'),
+            'data': content,
+        })
+        return self._get_next_response()
+
+    @contextlib.asynccontextmanager
+    async def stream(self, method, url, **kwargs):
+        yield await self.request(method, url, **kwargs)
+
+    async def aclose(self):
+        pass
+
+
 class TestArtArchive(unittest.TestCase):
 
     def setUp(self):
         self.pg_conn = PgConnWrapper(tests_config)
         self.session = MockClientSession()
+        # Events handled on `pg_conn` (by the sync engine, with a
+        # concurrency of 1) mustn't keep a transaction open while
+        # waiting on the IA or MusicBrainz.
+        self.session.pg_conn = self.pg_conn
         self.http_client_cls = lambda: self.session
 
     def tearDown(self):
+        self.assertEqual(self.session.requests_in_transaction, [])
         self.pg_conn.close()
         self.session.close()
 
     def get_event_queue(self):
+        # Each event's parents (from `event_dependency`) are included as
+        # `depends_on`, or None if it has none.
         pg_cur = self.pg_conn.execute(dedent('''
-            SELECT * FROM artwork_indexer.event_queue
+            SELECT eq.*, (
+                SELECT array_agg(dep.parent ORDER BY dep.parent)
+                FROM artwork_indexer.event_dependency dep
+                WHERE dep.child = eq.id
+            ) AS depends_on
+            FROM artwork_indexer.event_queue eq
             WHERE state != 'completed'
             ORDER BY id
         '''))
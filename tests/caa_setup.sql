@@ -68,3 +68,6 @@ INSERT INTO cover_art_archive.cover_art_type (id, type_id)
 TRUNCATE artwork_indexer.event_queue CASCADE;
 
 SELECT setval('artwork_indexer.event_queue_id_seq', 1, FALSE);
+
+TRUNCATE artwork_indexer.worker RESTART IDENTITY;
+TRUNCATE artwork_indexer.uploaded_file;
@@ -33,3 +33,6 @@ INSERT INTO event_art_archive.event_art_type (id, type_id)
 TRUNCATE artwork_indexer.event_queue CASCADE;
 
 SELECT setval('artwork_indexer.event_queue_id_seq', 1, FALSE);
+
+TRUNCATE artwork_indexer.worker RESTART IDENTITY;
+TRUNCATE artwork_indexer.uploaded_file;
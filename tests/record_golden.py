@@ -0,0 +1,65 @@
+# Records the web service's XML for the entities in caa_setup.sql and
+# eaa_setup.sql into tests/golden/, which test_mb_metadata compares the
+# database renderer (mb_metadata.py) against. It fetches
+# `/ws/2/{entity}/{mbid}?inc=...`, with each project's `ws_inc_params`,
+# from the MusicBrainz server at `[musicbrainz] url` in
+# config.tests.ini, which must serve the test database (see
+# `database=TEST_ARTWORK_INDEXER` in config.tests.example.ini):
+#
+#   poetry run python -m tests.record_golden
+#
+# Re-run it whenever the fixtures or `ws_inc_params` change, and commit
+# the responses as they are.
+
+import os.path
+
+import requests
+
+from handlers import EVENT_HANDLER_CLASSES
+from pg_conn_wrapper import PgConnWrapper
+from . import tests_config
+from .test_mb_metadata import EVENT_MBIDS, GOLDEN_DIR, RELEASE_MBIDS
+
+FIXTURES = (
+    ('release', 'caa', RELEASE_MBIDS),
+    ('event', 'eaa', EVENT_MBIDS),
+)
+
+
+def run_sql_file(pg_conn, file_name):
+    with open(
+        os.path.join(os.path.dirname(__file__), file_name),
+        'r'
+    ) as fp:
+        pg_conn.execute_and_commit(fp.read())
+
+
+def record(entity_type, mbids):
+    handler = EVENT_HANDLER_CLASSES[entity_type](tests_config, None)
+    for mbid in mbids:
+        response = requests.get(
+            handler.build_metadata_url(mbid),
+            headers=handler.build_metadata_headers(),
+            timeout=30,
+        )
+        response.raise_for_status()
+        path = os.path.join(GOLDEN_DIR, f'{entity_type}-{mbid}.xml')
+        with open(path, 'wb') as fp:
+            fp.write(response.content)
+        print(f'Recorded {path}')
+
+
+def main():
+    os.makedirs(GOLDEN_DIR, exist_ok=True)
+    pg_conn = PgConnWrapper(tests_config)
+    for entity_type, project_abbr, mbids in FIXTURES:
+        run_sql_file(pg_conn, f'{project_abbr}_setup.sql')
+        try:
+            record(entity_type, mbids)
+        finally:
+            run_sql_file(pg_conn, f'{project_abbr}_teardown.sql')
+    pg_conn.close()
+
+
+if __name__ == '__main__':
+    main()
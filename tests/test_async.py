@@ -0,0 +1,391 @@
+import asyncio
+import configparser
+import os.path
+import time
+import unittest
+from textwrap import dedent
+from unittest import mock
+import psycopg
+from psycopg.types.json import Jsonb
+import indexer_async
+import pg_conn_wrapper
+from pg_conn_wrapper import AsyncPgConnWrapper
+from projects import CAA_PROJECT
+from . import (
+    AsyncMockClientSession,
+    MockResponse,
+    TestArtArchive,
+    index_json_put,
+    mb_metadata_xml_get,
+    mb_metadata_xml_put,
+    queue_event_while_running,
+    tests_config,
+)
+from .test_mb_metadata import (
+    RELEASE1_XML,
+    database_metadata_config,
+)
+
+
+RELEASE1_MBID = '16ebbc86-670c-4ad3-980b-bfbd1eee4ff4'
+
+
+def with_content_length(request):
+    # httpx is given the length of streamed content explicitly.
+    request['headers']['content-length'] = str(len(request['data']))
+    return request
+
+
+def streamed_index_json_put(mbid, images):
+    return with_content_length(index_json_put(CAA_PROJECT, mbid, images))
+
+
+def streamed_mb_metadata_xml_put(mbid, xml):
+    return with_content_length(mb_metadata_xml_put(CAA_PROJECT, mbid, xml))
+
+
+class TestAsyncEngine(TestArtArchive):
+
+    def setUp(self):
+        super().setUp()
+        self.session = AsyncMockClientSession()
+
+        with open(
+            os.path.join(os.path.dirname(__file__), 'caa_setup.sql'),
+            'r'
+        ) as fp:
+            self.pg_conn.execute_and_commit(fp.read())
+
+    def tearDown(self):
+        with open(
+            os.path.join(os.path.dirname(__file__), 'caa_teardown.sql'),
+            'r'
+        ) as fp:
+            self.pg_conn.execute_and_commit(fp.read())
+        super().tearDown()
+
+    def run_indexer(self, config=tests_config, maxwait=1, **kwargs):
+        asyncio.run(indexer_async.indexer(
+            config,
+            AsyncPgConnWrapper(config),
+            maxwait,
+            max_idle_loops=1,
+            http_client_cls=self.http_client_cls,
+            **kwargs
+        ))
+
+    def get_event_states(self):
+        return self.pg_conn.execute(dedent('''
+            SELECT id, state, attempts
+              FROM artwork_indexer.event_queue
+             ORDER BY id
+        ''')).fetchall()
+
+    def queue_index_event(self, action):
+        self.pg_conn.execute_and_commit(dedent('''
+            INSERT INTO artwork_indexer.event_queue
+                    (entity_type, action, message)
+                VALUES ('release', %(action)s, %(message)s)
+        '''), {'action': action, 'message': Jsonb({'gid': RELEASE1_MBID})})
+
+    def test_index(self):
+        self.queue_index_event('index')
+
+        xml = '<metadata/>'
+        self.session.next_responses = [
+            MockResponse(),
+            MockResponse(status=200, content=xml),
+            MockResponse(),
+        ]
+
+        self.run_indexer()
+
+        # The same requests as the sync engine makes (but for the
+        # Content-Length header, which requests adds itself).
+        self.assertEqual(self.session.last_requests, [
+            streamed_index_json_put(RELEASE1_MBID, [{
+                'approved': False,
+                'back': False,
+                'comment': '❇',
+                'edit': 1,
+                'front': True,
+                'id': 1,
+                'types': ['Front'],
+            }]),
+            mb_metadata_xml_get(CAA_PROJECT, RELEASE1_MBID),
+            streamed_mb_metadata_xml_put(RELEASE1_MBID, xml),
+        ])
+        self.assertEqual(self.get_event_states(), [
+            {'id': 1, 'state': 'completed', 'attempts': 1},
+        ])
+
+        # Reindexing skips the uploads, since nothing changed.
+        self.queue_index_event('index')
+        self.session.last_requests = []
+        self.session.next_responses = [
+            MockResponse(status=200, content=xml),
+        ]
+
+        self.run_indexer()
+
+        self.assertEqual(self.session.last_requests, [
+            mb_metadata_xml_get(CAA_PROJECT, RELEASE1_MBID),
+        ])
+
+        # `index_metadata` doesn't touch index.json.
+        self.queue_index_event('index_metadata')
+        xml = '<metadata><release/></metadata>'
+        self.session.last_requests = []
+        self.session.next_responses = [
+            MockResponse(status=200, content=xml),
+            MockResponse(),
+        ]
+
+        self.run_indexer()
+
+        self.assertEqual(self.session.last_requests, [
+            mb_metadata_xml_get(CAA_PROJECT, RELEASE1_MBID),
+            streamed_mb_metadata_xml_put(RELEASE1_MBID, xml),
+        ])
+
+    def test_rendering_metadata(self):
+        self.queue_index_event('index_metadata')
+
+        self.session.next_responses = [MockResponse()]
+
+        self.run_indexer(config=database_metadata_config())
+
+        self.assertEqual(self.session.last_requests, [
+            mb_metadata_xml_put(
+                CAA_PROJECT,
+                RELEASE1_MBID,
+                RELEASE1_XML,
+            ),
+        ])
+        self.assertEqual(self.get_event_states(), [
+            {'id': 1, 'state': 'completed', 'attempts': 1},
+        ])
+
+    def test_deleting_release(self):
+        self.pg_conn.execute_and_commit(dedent('''
+            DELETE FROM release_country WHERE release = 1;
+            DELETE FROM release WHERE id = 1;
+        '''))
+
+        self.session.next_responses = [
+            MockResponse(status=204),
+            MockResponse(status=500),
+        ]
+
+        self.run_indexer()
+
+        delete_headers = {
+            'authorization': 'LOW caa_user:caa_pass',
+            'x-archive-keep-old-version': '1',
+            'x-archive-cascade-delete': '1',
+        }
+        self.assertEqual(self.session.last_requests, [
+            {
+                'method': 'DELETE',
+                'url': f'http://mbid-{RELEASE1_MBID}.s3.example.com/' +
+                       f'mbid-{RELEASE1_MBID}-1.jpg',
+                'headers': delete_headers,
+                'data': None,
+            },
+            {
+                'method': 'DELETE',
+                'url': f'http://mbid-{RELEASE1_MBID}.s3.example.com/' +
+                       'index.json',
+                'headers': delete_headers,
+                'data': None,
+            },
+        ])
+        # The failed deindex is retried later, as with the sync engine.
+        self.assertEqual(self.get_event_states(), [
+            {'id': 2, 'state': 'completed', 'attempts': 1},
+            {'id': 3, 'state': 'queued', 'attempts': 1},
+        ])
+        failure_reason = self.pg_conn.execute(dedent('''
+            SELECT failure_reason
+              FROM artwork_indexer.event_failure_reason
+             WHERE event = 3
+        ''')).fetchone()['failure_reason']
+        self.assertEqual(failure_reason, 'HTTP 500')
+
+    def test_concurrency(self):
+        self.pg_conn.execute_and_commit(dedent('''
+            INSERT INTO artwork_indexer.event_queue
+                    (id, entity_type, action, message)
+                 VALUES (1, 'release', 'noop', '{"sleep": 1}'),
+                        (2, 'release', 'noop', '{"sleep": 1.1}'),
+                        (3, 'release', 'noop', '{"sleep": 1.2}'),
+                        (4, 'release', 'noop', '{"fail": true}'),
+                        (5, 'release', 'noop', '{"id": 5}');
+            INSERT INTO artwork_indexer.event_dependency (parent, child)
+                 VALUES (4, 5);
+        '''))
+
+        start = time.monotonic()
+        self.run_indexer(concurrency=4)
+        elapsed = time.monotonic() - start
+
+        self.assertLess(elapsed, 3)
+        self.assertEqual(self.get_event_states(), [
+            {'id': 1, 'state': 'completed', 'attempts': 1},
+            {'id': 2, 'state': 'completed', 'attempts': 1},
+            {'id': 3, 'state': 'completed', 'attempts': 1},
+            {'id': 4, 'state': 'queued', 'attempts': 1},
+            {'id': 5, 'state': 'queued', 'attempts': 0},
+        ])
+
+    def test_notify_while_busy(self):
+        self.pg_conn.execute_and_commit(dedent('''
+            INSERT INTO artwork_indexer.event_queue
+                    (id, entity_type, action, message)
+                 VALUES (1, 'release', 'noop', '{"sleep": 4}');
+        '''))
+
+        thread = queue_event_while_running(1, 2, delay=1)
+        self.run_indexer(maxwait=32, concurrency=2)
+        thread.join()
+
+        # See `test_general.TestGeneral.test_notify_while_busy`.
+        events = self.pg_conn.execute(dedent('''
+            SELECT id, state
+              FROM artwork_indexer.event_queue
+             ORDER BY completed_at
+        ''')).fetchall()
+        self.assertEqual(events, [
+            {'id': 2, 'state': 'completed'},
+            {'id': 1, 'state': 'completed'},
+        ])
+
+    def test_connection_pool(self):
+        config = configparser.ConfigParser()
+        config.read_dict(tests_config)
+        config['database']['pool_max_size'] = '1'
+
+        async def borrow():
+            pooled_pg_conn = AsyncPgConnWrapper(config)
+            try:
+                await pooled_pg_conn.execute('SELECT pg_sleep(0.2)')
+                self.assertIsNotNone(pooled_pg_conn.conn)
+                await pooled_pg_conn.commit()
+                # Given back at the end of the transaction.
+                self.assertIsNone(pooled_pg_conn.conn)
+            finally:
+                await pooled_pg_conn.close()
+
+        async def run():
+            try:
+                # The one connection is shared, so at least the second
+                # borrower waits for it.
+                await asyncio.gather(borrow(), borrow())
+                return pg_conn_wrapper.get_pool_stats()
+            finally:
+                await pg_conn_wrapper.close_async_pools()
+
+        stats = asyncio.run(run())
+        self.assertEqual(stats['requests'], 2)
+        self.assertGreaterEqual(stats['requests_queued'], 1)
+        self.assertEqual(stats['request_errors'], 0)
+
+        # More events at once than there are connections.
+        self.pg_conn.execute_and_commit(dedent('''
+            INSERT INTO artwork_indexer.event_queue
+                    (id, entity_type, action, message)
+                 SELECT i, 'release', 'noop',
+                        jsonb_build_object('sleep', 0.1 * i)
+                   FROM generate_series(1, 6) AS i;
+        '''))
+        self.run_indexer(config=config, concurrency=3)
+        self.assertEqual(self.get_event_states(), [
+            {'id': i, 'state': 'completed', 'attempts': 1}
+            for i in range(1, 7)
+        ])
+        self.assertEqual(pg_conn_wrapper.async_pools, {})
+
+    def test_default_connection_pool(self):
+        async def run():
+            pooled_pg_conn = AsyncPgConnWrapper(tests_config)
+            try:
+                await pooled_pg_conn.execute('SELECT 1')
+                await pooled_pg_conn.commit()
+                self.assertIsNone(pooled_pg_conn.conn)
+                return pg_conn_wrapper.async_pools['database'].get_stats()
+            finally:
+                await pg_conn_wrapper.close_async_pools()
+
+        # The async engine pools even without `pool_max_size`.
+        self.assertNotIn('pool_max_size', tests_config['database'])
+        stats = asyncio.run(run())
+        self.assertEqual(stats['pool_max'],
+                         pg_conn_wrapper.ASYNC_POOL_MAX_SIZE)
+        self.assertEqual(stats['requests_num'], 1)
+
+        # Twice as many events at once as there are connections.
+        concurrency = 2 * pg_conn_wrapper.ASYNC_POOL_MAX_SIZE
+        self.pg_conn.execute_and_commit(dedent('''
+            INSERT INTO artwork_indexer.event_queue
+                    (id, entity_type, action, message)
+                 SELECT i, 'release', 'noop',
+                        jsonb_build_object('sleep', 0.5 + 0.01 * i)
+                   FROM generate_series(1, %(concurrency)s) AS i;
+        '''), {'concurrency': concurrency})
+        self.run_indexer(concurrency=concurrency)
+        self.assertEqual(self.get_event_states(), [
+            {'id': i, 'state': 'completed', 'attempts': 1}
+            for i in range(1, concurrency + 1)
+        ])
+
+    def test_teardown_after_error(self):
+        # See `test_general.TestGeneral.test_teardown_after_error`.
+        self.pg_conn.execute_and_commit(dedent('''
+            INSERT INTO artwork_indexer.event_queue
+                    (id, entity_type, action, message)
+                 SELECT i, 'release', 'noop', jsonb_build_object('id', i)
+                   FROM generate_series(1, 4) AS i;
+        '''))
+
+        async def process_event(pg_conn, event_handler_map, event, *args):
+            if event['id'] == 2:
+                await asyncio.sleep(0.5)
+            raise psycopg.OperationalError('server closed the connection')
+
+        with mock.patch.object(indexer_async, 'process_event',
+                               process_event):
+            with self.assertRaises(psycopg.OperationalError):
+                self.run_indexer(claim_batch_size=4, concurrency=2)
+
+        self.assertEqual(self.get_event_states(), [
+            {'id': 1, 'state': 'running', 'attempts': 1},
+            {'id': 2, 'state': 'running', 'attempts': 1},
+            {'id': 3, 'state': 'queued', 'attempts': 0},
+            {'id': 4, 'state': 'queued', 'attempts': 0},
+        ])
+        self.assertEqual(self.pg_conn.execute(dedent('''
+            SELECT count(*) FROM artwork_indexer.worker
+        ''')).fetchone()['count'], 0)
+        self.assertEqual(pg_conn_wrapper.async_pools, {})
+
+    def test_expired_lease_while_busy(self):
+        self.pg_conn.execute_and_commit(dedent('''
+            INSERT INTO artwork_indexer.event_queue
+                    (id, state, entity_type, action, message, attempts,
+                     lease_expires_at)
+                 VALUES (1, 'running', 'release', 'noop', '{"id": 1}', 1,
+                         now() - interval '1 minute'),
+                        (2, 'queued', 'release', 'noop', '{"sleep": 1}', 0,
+                         NULL);
+        '''))
+
+        self.run_indexer()
+
+        self.assertEqual(self.get_event_states(), [
+            {'id': 1, 'state': 'completed', 'attempts': 1},
+            {'id': 2, 'state': 'completed', 'attempts': 1},
+        ])
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
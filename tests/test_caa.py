@@ -1,6 +1,8 @@
 import os.path
 import unittest
 from textwrap import dedent
+from psycopg.types.json import Jsonb
+import handlers_base
 import indexer
 from projects import CAA_PROJECT
 from . import (
@@ -158,9 +160,10 @@ class TestCoverArtArchive(TestArtArchive):
                               event_id=None,
                               images_json=None,
                               xml_fmt_args_base=None,
-                              xml_fmt_args=None):
+                              xml_fmt_args=None,
+                              action='index'):
         self.assertEqual(self.get_event_queue(), [
-            release_index_event(release_mbid, id=event_id),
+            release_index_event(release_mbid, id=event_id, action=action),
         ])
 
         xml = RELEASE_XML_TEMPLATE.format(
@@ -168,44 +171,55 @@ class TestCoverArtArchive(TestArtArchive):
         )
 
         self.session.last_requests = []
-        self.session.next_responses = [
-            MockResponse(),
-            MockResponse(status=200, content=xml),
-            MockResponse(status=200, content=xml),
-        ]
+        self.session.next_responses = []
+        expected_requests = []
+        if action in ('index', 'index_images'):
+            self.session.next_responses.append(MockResponse())
+            expected_requests.append(
+                release_index_json_put(release_mbid, images_json),
+            )
+        if action in ('index', 'index_metadata'):
+            self.session.next_responses += [
+                MockResponse(status=200, content=xml),
+                MockResponse(status=200, content=xml),
+            ]
+            expected_requests += [
+                release_mb_metadata_xml_get(release_mbid),
+                release_mb_metadata_xml_put(release_mbid, xml),
+            ]
 
         indexer.indexer(tests_config, self.pg_conn, 1,
                         max_idle_loops=1,
                         http_client_cls=self.http_client_cls)
 
-        self.assertEqual(self.session.last_requests, [
-            release_index_json_put(release_mbid, images_json),
-            release_mb_metadata_xml_get(release_mbid),
-            release_mb_metadata_xml_put(release_mbid, xml),
-        ])
+        self.assertEqual(self.session.last_requests, expected_requests)
 
     def _release1_reindex_test(self,
                                event_id=None,
                                images_json=None,
-                               xml_fmt_args=None):
+                               xml_fmt_args=None,
+                               action='index'):
         self._release_reindex_test(
             release_mbid=RELEASE1_MBID,
             event_id=event_id,
             images_json=images_json,
             xml_fmt_args_base=RELEASE1_XML_FMT_ARGS,
-            xml_fmt_args=xml_fmt_args
+            xml_fmt_args=xml_fmt_args,
+            action=action,
         )
 
     def _release2_reindex_test(self,
                                event_id=None,
                                images_json=None,
-                               xml_fmt_args=None):
+                               xml_fmt_args=None,
+                               action='index'):
         self._release_reindex_test(
             release_mbid=RELEASE2_MBID,
             event_id=event_id,
             images_json=images_json,
             xml_fmt_args_base=RELEASE2_XML_FMT_ARGS,
-            xml_fmt_args=xml_fmt_args
+            xml_fmt_args=xml_fmt_args,
+            action=action,
         )
 
     def test_inserting_cover_art(self):
@@ -250,9 +264,12 @@ class TestCoverArtArchive(TestArtArchive):
 
         new_image1_json = self._orig_image1_json | {'comment': ''}
 
+        # The metadata XML doesn't include the image's comment, so it
+        # needn't be reindexed.
         self._release1_reindex_test(
             event_id=1,
             images_json=[new_image1_json],
+            action='index_images',
         )
 
     def test_deleting_cover_art(self):
@@ -337,7 +354,7 @@ class TestCoverArtArchive(TestArtArchive):
         new_image1_json = self._orig_image1_json | {'comment': ''}
 
         self.assertEqual(self.get_event_queue(), [
-            release_index_event(RELEASE1_MBID, id=1),
+            release_index_event(RELEASE1_MBID, id=1, action='index_images'),
         ])
 
         # This simulates a merge, where the cover art is first copied to
@@ -423,7 +440,7 @@ class TestCoverArtArchive(TestArtArchive):
 
         self.pg_conn.execute_and_commit(dedent('''
             UPDATE artwork_indexer.event_queue
-            SET attempts = 4, last_updated = (now() - interval '1 day')
+            SET attempts = 4
             WHERE action = 'copy_image'
         '''))
 
@@ -659,7 +676,7 @@ class TestCoverArtArchive(TestArtArchive):
 
         self._release1_reindex_test(
             event_id=1,
-            images_json=[self._orig_image1_json],
+            action='index_metadata',
             xml_fmt_args={
                 'artist_name': 'foo',
                 'artist_sort_name': 'bar',
@@ -679,7 +696,7 @@ class TestCoverArtArchive(TestArtArchive):
 
         self._release1_reindex_test(
             event_id=1,
-            images_json=[self._orig_image1_json],
+            action='index_metadata',
             xml_fmt_args={
                 'title': 'updated name1',
             },
@@ -698,7 +715,7 @@ class TestCoverArtArchive(TestArtArchive):
 
         self._release1_reindex_test(
             event_id=1,
-            images_json=[self._orig_image1_json],
+            action='index_metadata',
             xml_fmt_args={
                 'asin_xml': '<asin>FOOBAR123</asin>',
             },
@@ -717,7 +734,7 @@ class TestCoverArtArchive(TestArtArchive):
 
         self._release1_reindex_test(
             event_id=1,
-            images_json=[self._orig_image1_json],
+            action='index_metadata',
             xml_fmt_args={
                 'release_event_xml': (
                     '<date>1980-01-01</date>'
@@ -747,12 +764,85 @@ class TestCoverArtArchive(TestArtArchive):
 
         self._release1_reindex_test(
             event_id=1,
-            images_json=[self._orig_image1_json],
+            action='index_metadata',
             xml_fmt_args={
                 'release_event_xml': ''
             },
         )
 
+    def test_skipping_unchanged_uploads(self):
+        # An index event shouldn't upload files whose content hasn't
+        # changed since they were last uploaded, unless it's forced to.
+
+        def queue_event(action, message):
+            self.pg_conn.execute_and_commit(dedent('''
+                INSERT INTO artwork_indexer.event_queue
+                        (entity_type, action, message)
+                    VALUES ('release', %(action)s, %(message)s)
+            '''), {'action': action, 'message': Jsonb(message)})
+
+        def get_uploaded_files():
+            return self.pg_conn.execute(dedent('''
+                SELECT file_name FROM artwork_indexer.uploaded_file
+                WHERE entity_type = 'release' AND gid = %(gid)s
+                ORDER BY file_name
+            '''), {'gid': RELEASE1_MBID}).fetchall()
+
+        queue_event('index', {'gid': RELEASE1_MBID})
+        self._release1_reindex_test(
+            event_id=1,
+            images_json=[self._orig_image1_json],
+        )
+        self.assertEqual(get_uploaded_files(), [
+            {'file_name': 'index.json'},
+            {'file_name': f'mbid-{RELEASE1_MBID}_mb_metadata.xml'},
+        ])
+
+        xml = RELEASE_XML_TEMPLATE.format(**RELEASE1_XML_FMT_ARGS)
+        skipped_upload_count = handlers_base.skipped_upload_count
+
+        queue_event('index', {'gid': RELEASE1_MBID})
+        self.session.last_requests = []
+        self.session.next_responses = [
+            MockResponse(status=200, content=xml),
+        ]
+        indexer.indexer(tests_config, self.pg_conn, 1,
+                        max_idle_loops=1,
+                        http_client_cls=self.http_client_cls)
+        self.assertEqual(self.session.last_requests, [
+            release_mb_metadata_xml_get(RELEASE1_MBID),
+        ])
+        self.assertEqual(handlers_base.skipped_upload_count,
+                         skipped_upload_count + 2)
+
+        queue_event('index', {'gid': RELEASE1_MBID, 'force': True})
+        self.session.last_requests = []
+        self.session.next_responses = [
+            MockResponse(),
+            MockResponse(status=200, content=xml),
+            MockResponse(status=200, content=xml),
+        ]
+        indexer.indexer(tests_config, self.pg_conn, 1,
+                        max_idle_loops=1,
+                        http_client_cls=self.http_client_cls)
+        self.assertEqual(self.session.last_requests, [
+            release_index_json_put(RELEASE1_MBID, [self._orig_image1_json]),
+            release_mb_metadata_xml_get(RELEASE1_MBID),
+            release_mb_metadata_xml_put(RELEASE1_MBID, xml),
+        ])
+
+        # Deindexing forgets index.json, so that it's uploaded again
+        # if the release is ever reindexed.
+        queue_event('deindex', {'gid': RELEASE1_MBID})
+        self.session.last_requests = []
+        self.session.next_responses = [MockResponse(status=204)]
+        indexer.indexer(tests_config, self.pg_conn, 1,
+                        max_idle_loops=1,
+                        http_client_cls=self.http_client_cls)
+        self.assertEqual(get_uploaded_files(), [
+            {'file_name': f'mbid-{RELEASE1_MBID}_mb_metadata.xml'},
+        ])
+
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)
@@ -12,23 +12,44 @@ EOF
 psql -U musicbrainz -d musicbrainz_test_artwork_indexer -c "$SQL" -q > /dev/null
 
 run_indexer() {
+    ARTWORK_INDEXER_FAULTS="$1" \
     poetry run python indexer.py \
         --max-wait=1 \
         --max-idle-loops=1 \
+        --claim-batch-size=1 \
         --config=config.tests.ini 2>&1
 }
 
-run_indexer > /tmp/a26a73c_run1_output &
+# Run #1 claims event 1 (the oldest), then pauses for 3 seconds before
+# committing the claim, with the claimed row still locked.
+run_indexer 'before_claim_commit=sleep:3' > /tmp/a26a73c_run1_output &
 run1_pid=$!
 
-# This is paired with `time.sleep(0.25)` in indexer.py. That sleep duration
-# is divided by two here in order to
-#  1. give run #1 enough time to select an event (which should lock it), and
-#  2. give run #2 enough time to select an event while run #1 still holds a
-#     lock on the first event (or at least that's what we're verifying).
-sleep 0.125
+# Wait until run #1 is inside its claim transaction, so that run #2 claims
+# while the claim is still uncommitted. It must not claim event 1 as well
+# (that's what we're verifying), but take event 2 instead.
+read -r -d '' SQL <<'EOF'
+SELECT count(*)
+  FROM pg_stat_activity
+ WHERE state = 'idle in transaction'
+   AND query LIKE '%running_gids%'
+EOF
+
+for _ in $(seq 100); do
+    claiming="$(psql -U musicbrainz -d musicbrainz_test_artwork_indexer -tAc "$SQL")"
+    if [[ $claiming -gt 0 ]]; then
+        break
+    fi
+    sleep 0.1
+done
+
+if [[ $claiming -eq 0 ]]; then
+    echo 'ERROR: Run #1 never claimed an event'
+    kill "$run1_pid"
+    exit 1
+fi
 
-run_indexer > /tmp/a26a73c_run2_output &
+run_indexer '' > /tmp/a26a73c_run2_output &
 run2_pid=$!
 
 wait "$run1_pid" "$run2_pid"
@@ -39,18 +60,15 @@ run2_id1_completion_count="$(cat /tmp/a26a73c_run2_output | grep -Fo 'Event id=1
 run1_id2_completion_count="$(cat /tmp/a26a73c_run1_output | grep -Fo 'Event id=2 completed succesfully' | wc -l)"
 run2_id2_completion_count="$(cat /tmp/a26a73c_run2_output | grep -Fo 'Event id=2 completed succesfully' | wc -l)"
 
-id1_completion_count="$(( run1_id1_completion_count +  run2_id1_completion_count ))"
-id2_completion_count="$(( run1_id2_completion_count +  run2_id2_completion_count ))"
-
 rm /tmp/a26a73c*
 
-if [[ $id1_completion_count -gt 1 ]]; then
-    echo 'ERROR: Event id=1 was processed more than once'
+if [[ $run1_id1_completion_count -ne 1 || $run2_id1_completion_count -ne 0 ]]; then
+    echo 'ERROR: Event id=1 was not processed by run #1 alone'
     exit 1
 fi
 
-if [[ $id2_completion_count -gt 1 ]]; then
-    echo 'ERROR: Event id=2 was processed more than once'
+if [[ $run2_id2_completion_count -ne 1 || $run1_id2_completion_count -ne 0 ]]; then
+    echo 'ERROR: Event id=2 was not processed by run #2 alone'
     exit 1
 fi
 
@@ -73,9 +73,6 @@ EVENT2_XML_FMT_ARGS = {
     'time': '21:00',
 }
 
-EVENT1_XML = EVENT_XML_TEMPLATE.format(**EVENT1_XML_FMT_ARGS)
-EVENT2_XML = EVENT_XML_TEMPLATE.format(**EVENT2_XML_FMT_ARGS)
-
 
 class TestEventArtArchive(TestArtArchive):
 
@@ -118,9 +115,12 @@ class TestEventArtArchive(TestArtArchive):
                             event_id=None,
                             images_json=None,
                             xml_fmt_args_base=None,
-                            xml_fmt_args=None):
+                            xml_fmt_args=None,
+                            action='index_images'):
+        # The event XML doesn't summarize the event's artwork, so changes
+        # to the artwork only reindex images by default.
         self.assertEqual(self.get_event_queue(), [
-            event_index_event(event_mbid, id=event_id),
+            event_index_event(event_mbid, id=event_id, action=action),
         ])
 
         xml = EVENT_XML_TEMPLATE.format(
@@ -128,32 +128,41 @@ class TestEventArtArchive(TestArtArchive):
         )
 
         self.session.last_requests = []
-        self.session.next_responses = [
-            MockResponse(),
-            MockResponse(status=200, content=xml),
-            MockResponse(status=200, content=xml),
-        ]
+        self.session.next_responses = []
+        expected_requests = []
+        if action in ('index', 'index_images'):
+            self.session.next_responses.append(MockResponse())
+            expected_requests.append(
+                event_index_json_put(event_mbid, images_json),
+            )
+        if action in ('index', 'index_metadata'):
+            self.session.next_responses += [
+                MockResponse(status=200, content=xml),
+                MockResponse(status=200, content=xml),
+            ]
+            expected_requests += [
+                event_mb_metadata_xml_get(event_mbid),
+                event_mb_metadata_xml_put(event_mbid, xml),
+            ]
 
         indexer.indexer(tests_config, self.pg_conn, 1,
                         max_idle_loops=1,
                         http_client_cls=self.http_client_cls)
 
-        self.assertEqual(self.session.last_requests, [
-            event_index_json_put(event_mbid, images_json),
-            event_mb_metadata_xml_get(event_mbid),
-            event_mb_metadata_xml_put(event_mbid, xml),
-        ])
+        self.assertEqual(self.session.last_requests, expected_requests)
 
     def _event1_reindex_test(self,
                              event_id=None,
                              images_json=None,
-                             xml_fmt_args=None):
+                             xml_fmt_args=None,
+                             action='index_images'):
         self._event_reindex_test(
             event_mbid=EVENT1_MBID,
             event_id=event_id,
             images_json=images_json,
             xml_fmt_args_base=EVENT1_XML_FMT_ARGS,
-            xml_fmt_args=xml_fmt_args
+            xml_fmt_args=xml_fmt_args,
+            action=action,
         )
 
     def test_inserting_event_art(self):
@@ -227,15 +236,14 @@ class TestEventArtArchive(TestArtArchive):
                 'depends_on': None,
                 'attempts': 0,
             },
-            event_index_event(EVENT1_MBID, id=2, depends_on=[1]),
+            event_index_event(EVENT1_MBID, id=2, depends_on=[1],
+                              action='index_images'),
         ])
 
         self.session.last_requests = []
         self.session.next_responses = [
             MockResponse(status=204),
             MockResponse(),
-            MockResponse(status=200, content=EVENT1_XML),
-            MockResponse(status=200, content=EVENT1_XML),
         ]
 
         indexer.indexer(tests_config, self.pg_conn, 1,
@@ -255,8 +263,6 @@ class TestEventArtArchive(TestArtArchive):
                 },
             },
             event_index_json_put(EVENT1_MBID, []),
-            event_mb_metadata_xml_get(EVENT1_MBID),
-            event_mb_metadata_xml_put(EVENT1_MBID, EVENT1_XML),
         ])
 
     def test_merging_events(self):
@@ -275,7 +281,7 @@ class TestEventArtArchive(TestArtArchive):
         new_image1_json = self._orig_image1_json | {'comment': ''}
 
         self.assertEqual(self.get_event_queue(), [
-            event_index_event(EVENT1_MBID, id=1),
+            event_index_event(EVENT1_MBID, id=1, action='index_images'),
         ])
 
         # This simulates a merge, where the cover art is first copied to
@@ -314,7 +320,8 @@ class TestEventArtArchive(TestArtArchive):
                 'depends_on': [5],
                 'attempts': 0,
             },
-            event_index_event(EVENT2_MBID, id=7, depends_on=[6]),
+            event_index_event(EVENT2_MBID, id=7, depends_on=[6],
+                              action='index_images'),
             {
                 'id': 8,
                 'state': 'queued',
@@ -336,7 +343,7 @@ class TestEventArtArchive(TestArtArchive):
 
         self.pg_conn.execute_and_commit(dedent('''
             UPDATE artwork_indexer.event_queue
-            SET attempts = 4, last_updated = (now() - interval '1 day')
+            SET attempts = 4
             WHERE action = 'copy_image'
         '''))
 
@@ -373,7 +380,7 @@ class TestEventArtArchive(TestArtArchive):
                 'attempts': 0,
             },
             event_index_event(EVENT2_MBID, id=7, depends_on=[6],
-                              state='failed'),
+                              action='index_images', state='failed'),
             {
                 'id': 8,
                 'state': 'failed',
@@ -422,8 +429,6 @@ class TestEventArtArchive(TestArtArchive):
             MockResponse(),
             MockResponse(status=204),
             MockResponse(),
-            MockResponse(status=200, content=EVENT2_XML),
-            MockResponse(status=200, content=EVENT2_XML),
             MockResponse(),
         ]
 
@@ -448,8 +453,6 @@ class TestEventArtArchive(TestArtArchive):
                 self._orig_image2_json,
                 new_image1_json,
             ]),
-            event_mb_metadata_xml_get(EVENT2_MBID),
-            event_mb_metadata_xml_put(EVENT2_MBID, EVENT2_XML),
             {
                 'method': 'DELETE',
                 'url': f'http://mbid-{EVENT1_MBID}.s3.example.com/index.json',
@@ -544,6 +547,23 @@ class TestEventArtArchive(TestArtArchive):
             images_json=[new_image1_json],
         )
 
+    def test_updating_event(self):
+        # artwork_indexer_a_upd_event
+
+        self.pg_conn.execute_and_commit(dedent('''
+            UPDATE event SET name = 'updated name1' WHERE id = 1;
+
+            -- Should not produce any update, as there is no event art
+            -- associated with this event.
+            UPDATE event SET name = 'updated name3' WHERE id = 3;
+        '''))
+
+        self._event1_reindex_test(
+            event_id=1,
+            xml_fmt_args={'name': 'updated name1'},
+            action='index_metadata',
+        )
+
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)
@@ -1,11 +1,24 @@
+import configparser
+import datetime
+import hashlib
 import os.path
+import re
+import time
 import unittest
 from textwrap import dedent
+from unittest import mock
+import psycopg
+import fault_injection
+import handlers_base
 import indexer
+import pg_conn_wrapper
+from handlers import EVENT_HANDLER_CLASSES
+from pg_conn_wrapper import PgConnWrapper, PgNotifyListener
 from . import (
     MockResponse,
     TestArtArchive,
     index_event,
+    queue_event_while_running,
     tests_config,
 )
 
@@ -39,9 +52,14 @@ class TestGeneral(TestArtArchive):
             UPDATE cover_art_archive.cover_art SET comment = 'b' WHERE id = 1;
         '''))
 
-        # Test that duplicate index events are not inserted.
+        # Test that duplicate index events are not inserted. The release
+        # update only affects its metadata, and the cover art updates only
+        # its images, so they each queue one of the narrower actions.
         self.assertEqual(self.get_event_queue(), [
-            index_event(RELEASE1_MBID, entity_type='release', id=1)
+            index_event(RELEASE1_MBID, entity_type='release', id=1,
+                        action='index_metadata'),
+            index_event(RELEASE1_MBID, entity_type='release', id=2,
+                        action='index_images'),
         ])
 
     def test_cleanup(self):
@@ -64,11 +82,43 @@ class TestGeneral(TestArtArchive):
         ''')).fetchone()['count']
         self.assertEqual(event_count, 1)
 
+        # Completed events are dropped with their month's partition, so
+        # move this one into an older month's.
         self.pg_conn.execute_and_commit(dedent('''
+            SELECT artwork_indexer.create_event_partitions(
+                now() - interval '6 months'
+            );
             UPDATE artwork_indexer.event_queue
-            SET created = (created - interval '100 days');
+            SET completed_at = (completed_at - interval '6 months');
+            INSERT INTO artwork_indexer.event_failure_reason
+                    (event, event_completed_at, failure_reason)
+                 SELECT id, completed_at, 'old failure'
+                   FROM artwork_indexer.event_queue;
         '''))
 
+        def get_partition_names(table_name):
+            return [
+                row['relname'] for row in self.pg_conn.execute(dedent('''
+                    SELECT child.relname
+                      FROM pg_inherits
+                      JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+                     WHERE pg_inherits.inhparent = %(table_name)s::regclass
+                  ORDER BY child.relname
+                '''), {'table_name': table_name}).fetchall()
+            ]
+
+        def get_month_suffix(interval):
+            return self.pg_conn.execute(dedent('''
+                SELECT to_char((now() + %(interval)s::interval)
+                                   AT TIME ZONE 'UTC',
+                               'YYYY_MM') AS suffix
+            '''), {'interval': interval}).fetchone()['suffix']
+
+        self.assertIn(
+            'event_queue_' + get_month_suffix('-6 months'),
+            get_partition_names('artwork_indexer.event_queue'),
+        )
+
         indexer.indexer(tests_config, self.pg_conn, 2,
                         max_idle_loops=2,
                         http_client_cls=self.http_client_cls)
@@ -78,40 +128,336 @@ class TestGeneral(TestArtArchive):
         ''')).fetchone()['count']
         self.assertEqual(event_count, 0)
 
+        # Only the old partitions were dropped; those for this month
+        # and next remain.
+        for table_name in ('event_queue', 'event_failure_reason'):
+            self.assertEqual(
+                get_partition_names('artwork_indexer.' + table_name),
+                [
+                    table_name + '_' + get_month_suffix('0 months'),
+                    table_name + '_' + get_month_suffix('1 month'),
+                    table_name + '_active',
+                ],
+            )
+
     def test_depends_on(self):
         self.pg_conn.execute_and_commit(dedent('''
             INSERT INTO artwork_indexer.event_queue
-                    (id, state, entity_type, action, depends_on, message,
-                     created)
-                 VALUES (1, 'queued', 'release', 'index', NULL,
-                         '{"gid": "A"}', NOW() - interval '1 day'),
-                        (2, 'completed', 'release', 'index', NULL,
-                         '{"gid": "B"}', NOW() - interval '2 days'),
-                        (3, 'queued', 'release', 'index', '{1,2}',
-                         '{"gid": "C"}', NOW() - interval '3 day');
+                    (id, state, entity_type, action, message, created,
+                     completed_at)
+                 VALUES (1, 'queued', 'release', 'index',
+                         '{"gid": "A"}', NOW() - interval '1 day',
+                         'infinity'),
+                        (2, 'completed', 'release', 'index',
+                         '{"gid": "B"}', NOW() - interval '2 days', NOW()),
+                        (3, 'queued', 'release', 'index',
+                         '{"gid": "C"}', NOW() - interval '3 day',
+                         'infinity');
+            INSERT INTO artwork_indexer.event_dependency (parent, child)
+                 VALUES (1, 3), (2, 3);
         '''))
-        next_event = indexer.get_next_event(self.pg_conn)
+        next_events = indexer.claim_events(self.pg_conn, 3)
         # Event #3, even though it was created the earliest, still depends
         # on event #1, which is not yet completed.
-        self.assertEqual(next_event['id'], 1)
+        self.assertEqual([event['id'] for event in next_events], [1])
+
+    def test_pending_parents(self):
+        def get_pending_parents():
+            return {
+                row['id']: row['pending_parents']
+                for row in self.pg_conn.execute(dedent('''
+                    SELECT id, pending_parents
+                      FROM artwork_indexer.event_queue
+                     ORDER BY id
+                ''')).fetchall()
+            }
+
+        self.pg_conn.execute_and_commit(dedent('''
+            INSERT INTO artwork_indexer.event_queue
+                    (id, state, entity_type, action, message)
+                 VALUES (1, 'queued', 'release', 'noop', '{"id": 1}'),
+                        (3, 'queued', 'release', 'noop', '{"id": 3}'),
+                        (4, 'queued', 'release', 'index', '{"gid": "A"}'),
+                        (5, 'queued', 'release', 'noop', '{"id": 5}');
+            INSERT INTO artwork_indexer.event_queue
+                    (id, state, entity_type, action, message, completed_at)
+                 VALUES (2, 'completed', 'release', 'noop', '{"id": 2}',
+                         NOW());
+            INSERT INTO artwork_indexer.event_dependency (parent, child)
+                 VALUES (1, 4), (2, 4);
+        '''))
+        # Completed parents don't count.
+        self.assertEqual(get_pending_parents(),
+                         {1: 0, 2: 0, 3: 0, 4: 1, 5: 0})
+
+        # As the generated triggers do, when an identical event is queued
+        # with another parent.
+        self.pg_conn.execute_and_commit(dedent('''
+            WITH child AS (
+                INSERT INTO artwork_indexer.event_queue
+                        (entity_type, action, message)
+                     VALUES ('release', 'index', '{"gid": "A"}')
+                ON CONFLICT (entity_type, action, message, completed_at)
+                    WHERE state = 'queued'
+                DO UPDATE SET last_updated = now()
+                RETURNING id
+            )
+            INSERT INTO artwork_indexer.event_dependency (parent, child)
+            SELECT 3, child.id FROM child;
+        '''))
+        self.assertEqual(get_pending_parents(),
+                         {1: 0, 2: 0, 3: 0, 4: 2, 5: 0})
+
+        events = indexer.claim_events(self.pg_conn, 5)
+        self.assertEqual([event['id'] for event in events], [1, 3, 5])
+        self.pg_conn.execute_and_commit(dedent('''
+            UPDATE artwork_indexer.event_queue
+               SET state = 'completed'
+             WHERE id = 1;
+        '''))
+        self.assertEqual(get_pending_parents(),
+                         {1: 0, 2: 0, 3: 0, 4: 1, 5: 0})
+
+        # Moving a dependency between unfinished parents (as
+        # `release_events` does) doesn't change the count.
+        self.pg_conn.execute_and_commit(
+            indexer.REPLACE_DEPENDENCY_QUERY,
+            {'event_id': 3, 'duplicate_id': 5},
+        )
+        self.assertEqual(get_pending_parents(),
+                         {1: 0, 2: 0, 3: 0, 4: 1, 5: 0})
+
+        # Deleting a parent unblocks its children.
+        self.pg_conn.execute_and_commit(dedent('''
+            DELETE FROM artwork_indexer.event_queue WHERE id = 5;
+        '''))
+        self.assertEqual(get_pending_parents(), {1: 0, 2: 0, 3: 0, 4: 0})
+        events = indexer.claim_events(self.pg_conn, 5)
+        self.assertEqual([event['id'] for event in events], [4])
+
+        # Re-running a completed parent blocks its children again.
+        self.pg_conn.execute_and_commit(dedent('''
+            UPDATE artwork_indexer.event_queue
+               SET state = 'queued'
+             WHERE id = 2;
+        '''))
+        self.assertEqual(get_pending_parents(), {1: 0, 2: 0, 3: 0, 4: 1})
+
+        # So does removing the dependency.
+        self.pg_conn.execute_and_commit(dedent('''
+            DELETE FROM artwork_indexer.event_dependency
+             WHERE parent = 2 AND child = 4;
+        '''))
+        self.assertEqual(get_pending_parents(), {1: 0, 2: 0, 3: 0, 4: 0})
+
+        # Deleting a parent along with its child is fine, too.
+        self.pg_conn.execute_and_commit(dedent('''
+            INSERT INTO artwork_indexer.event_dependency (parent, child)
+                 VALUES (2, 4);
+            DELETE FROM artwork_indexer.event_queue WHERE id IN (2, 4);
+        '''))
+        self.assertEqual(get_pending_parents(), {1: 0, 3: 0})
+        edge_count = self.pg_conn.execute(dedent('''
+            SELECT count(*) AS count FROM artwork_indexer.event_dependency
+        ''')).fetchone()['count']
+        self.assertEqual(edge_count, 0)
+
+    def test_partitions(self):
+        def get_partitions():
+            return self.pg_conn.execute(dedent('''
+                SELECT eq.tableoid::regclass::text AS event,
+                       efr.tableoid::regclass::text AS failure_reason
+                  FROM artwork_indexer.event_queue eq
+                  JOIN artwork_indexer.event_failure_reason efr
+                    ON efr.event = eq.id
+                 WHERE eq.id = 1
+            ''')).fetchone()
+
+        month_suffix = self.pg_conn.execute(dedent('''
+            SELECT to_char(now() AT TIME ZONE 'UTC', 'YYYY_MM') AS suffix
+        ''')).fetchone()['suffix']
+
+        self.pg_conn.execute(dedent('''
+            INSERT INTO artwork_indexer.event_queue
+                    (id, state, entity_type, action, message)
+                 VALUES (1, 'running', 'release', 'noop', '{}');
+        '''))
+        self.pg_conn.execute(indexer.INSERT_FAILURE_REASON_QUERY, {
+            'event_id': 1,
+            'error': 'HTTP 500',
+        })
+        self.pg_conn.commit()
+        self.assertEqual(get_partitions(), {
+            'event': 'artwork_indexer.event_queue_active',
+            'failure_reason': 'artwork_indexer.event_failure_reason_active',
+        })
+
+        # Completing the event moves it, and its failure reasons, to this
+        # month's partitions.
+        self.pg_conn.execute_and_commit(indexer.COMPLETE_EVENT_QUERY, {
+            'event_id': 1,
+            'worker_id': None,
+        })
+        self.assertEqual(get_partitions(), {
+            'event': 'artwork_indexer.event_queue_' + month_suffix,
+            'failure_reason':
+                'artwork_indexer.event_failure_reason_' + month_suffix,
+        })
+
+        # And re-queueing it moves them back.
+        self.pg_conn.execute_and_commit(dedent('''
+            UPDATE artwork_indexer.event_queue
+               SET state = 'queued'
+             WHERE id = 1;
+        '''))
+        self.assertEqual(get_partitions(), {
+            'event': 'artwork_indexer.event_queue_active',
+            'failure_reason': 'artwork_indexer.event_failure_reason_active',
+        })
+
+        # Completed events can't be inserted without a `completed_at`,
+        # which decides their partition.
+        with self.assertRaises(psycopg.errors.CheckViolation):
+            self.pg_conn.execute(dedent('''
+                INSERT INTO artwork_indexer.event_queue
+                        (id, state, entity_type, action, message)
+                     VALUES (2, 'completed', 'release', 'noop', '{}');
+            '''))
+        self.pg_conn.rollback()
+
+    def test_partition_pruning(self):
+        # The queries that look up events that haven't completed by id
+        # only scan `event_queue_active`, not this month's (or next
+        # month's) partition of completed events.
+        params = {
+            'event_id': 1,
+            'worker_id': 1,
+            'max_attempts': indexer.MAX_ATTEMPTS,
+            'failure_reason': 'HTTP 500',
+        }
+        for name in (
+            'RETRY_OR_FAIL_EVENT_QUERY',
+            'FAIL_DEPENDENT_EVENTS_QUERY',
+            'DELETE_EVENT_QUERY',
+            'REQUEUE_EVENT_QUERY',
+            'COMPLETE_EVENT_QUERY',
+        ):
+            with self.subTest(query=name):
+                plan = '\n'.join(
+                    row['QUERY PLAN']
+                    for row in self.pg_conn.execute(
+                        'EXPLAIN ' + getattr(indexer, name),
+                        params,
+                    ).fetchall()
+                )
+                self.pg_conn.rollback()
+                self.assertIn('event_queue_active', plan)
+                self.assertIsNone(
+                    re.search(r'event_queue_\d{4}_\d{2}', plan),
+                )
+
+    def test_claim_and_release(self):
+        self.pg_conn.execute_and_commit(dedent('''
+            INSERT INTO artwork_indexer.event_queue
+                    (id, entity_type, action, message, created)
+                 VALUES (1, 'release', 'index', '{"gid": "A"}',
+                         NOW() - interval '3 minutes'),
+                        (2, 'release', 'index', '{"gid": "B"}',
+                         NOW() - interval '2 minutes'),
+                        (3, 'release', 'noop', '{}',
+                         NOW() - interval '1 minute');
+            INSERT INTO artwork_indexer.event_dependency (parent, child)
+                 VALUES (2, 3);
+        '''))
+
+        events = indexer.claim_events(self.pg_conn, 5)
+        # Event #3 isn't ready until event #2 completes.
+        self.assertEqual([event['id'] for event in events], [1, 2])
+        for event in events:
+            self.assertEqual(event['state'], 'running')
+            self.assertEqual(event['attempts'], 1)
+        self.assertEqual(indexer.claim_events(self.pg_conn, 5), [])
+
+        # An identical event is queued while #2 is still unstarted.
+        self.pg_conn.execute_and_commit(dedent('''
+            INSERT INTO artwork_indexer.event_queue
+                    (id, entity_type, action, message)
+                 VALUES (4, 'release', 'index', '{"gid": "B"}');
+        '''))
+
+        indexer.release_events(self.pg_conn, events)
+
+        self.assertEqual(self.get_event_queue(), [
+            index_event('A', entity_type='release', id=1),
+            {
+                'id': 3,
+                'state': 'queued',
+                'entity_type': 'release',
+                'action': 'noop',
+                'message': {},
+                'depends_on': [4],
+                'attempts': 0,
+            },
+            index_event('B', entity_type='release', id=4),
+        ])
+
+        events = indexer.claim_events(self.pg_conn, 5)
+        self.assertEqual([event['id'] for event in events], [1, 4])
+
+    def test_entity_serialization(self):
+        self.pg_conn.execute_and_commit(dedent('''
+            INSERT INTO artwork_indexer.event_queue
+                    (id, entity_type, action, message, created)
+                 VALUES (1, 'release', 'index', '{"gid": "A"}',
+                         NOW() - interval '5 minutes'),
+                        (2, 'release', 'delete_image', '{"gid": "A"}',
+                         NOW() - interval '4 minutes'),
+                        (3, 'release', 'copy_image',
+                         '{"old_gid": "B", "new_gid": "C"}',
+                         NOW() - interval '3 minutes'),
+                        (4, 'release', 'index', '{"gid": "C"}',
+                         NOW() - interval '2 minutes'),
+                        (5, 'event', 'index', '{"gid": "A"}',
+                         NOW() - interval '1 minute'),
+                        (6, 'release', 'noop', '{}', NOW()),
+                        (7, 'release', 'noop', '{"sleep": 0}', NOW());
+        '''))
+
+        # #2 and #4 touch the same buckets as #1 and #3, which are
+        # claimed first. #5 is for a different entity type, and #6 and
+        # #7 have no gid at all.
+        events = indexer.claim_events(self.pg_conn, 10)
+        self.assertEqual([event['id'] for event in events], [1, 3, 5, 6, 7])
+
+        # They stay blocked while #1 and #3 run.
+        self.assertEqual(indexer.claim_events(self.pg_conn, 10), [])
+
+        self.pg_conn.execute_and_commit(dedent('''
+            UPDATE artwork_indexer.event_queue
+               SET state = 'completed'
+             WHERE id = 3
+        '''))
+        events = indexer.claim_events(self.pg_conn, 10)
+        self.assertEqual([event['id'] for event in events], [4])
 
     def test_failure(self):
         self.pg_conn.execute_and_commit(dedent('''
             INSERT INTO artwork_indexer.event_queue
-                    (id, entity_type, action, message, depends_on, created)
-                 VALUES (1, 'release', 'noop', '{"fail": true}', NULL,
+                    (id, entity_type, action, message, created)
+                 VALUES (1, 'release', 'noop', '{"fail": true}',
                          NOW() - interval '1 day'),
-                        (2, 'release', 'noop', '{"id": 2}', '{1}',
+                        (2, 'release', 'noop', '{"id": 2}',
                          NOW() - interval '1 day'),
-                        (3, 'release', 'noop', '{"id": 3}', '{2}',
+                        (3, 'release', 'noop', '{"id": 3}',
                          NOW() - interval '1 day');
+            INSERT INTO artwork_indexer.event_dependency (parent, child)
+                 VALUES (1, 2), (2, 3);
         '''))
 
         for index in range(0, indexer.MAX_ATTEMPTS):
             self.pg_conn.execute_and_commit(dedent('''
                 UPDATE artwork_indexer.event_queue
-                   SET last_updated =
-                        (NOW() - (interval '1 hour' * attempts))
+                   SET next_attempt_at = NOW()
                  WHERE id = 1;
             '''))
 
@@ -141,6 +487,12 @@ class TestGeneral(TestArtArchive):
                 self.assertEqual(event1['state'], 'queued')
                 self.assertEqual(event2['state'], 'queued')
                 self.assertEqual(event3['state'], 'queued')
+                # The retry is delayed by an hour per attempt so far.
+                self.assertEqual(
+                    event1['next_attempt_at'] - event1['last_updated'],
+                    datetime.timedelta(hours=attempts),
+                )
+                self.assertEqual(indexer.claim_events(self.pg_conn, 1), [])
             else:
                 self.assertEqual(event1['state'], 'failed')
                 self.assertEqual(event2['state'], 'failed')
@@ -164,36 +516,660 @@ class TestGeneral(TestArtArchive):
                 )
 
         # Should not return the failed event.
-        self.assertEqual(indexer.get_next_event(self.pg_conn), None)
+        self.assertEqual(indexer.claim_events(self.pg_conn, 1), [])
 
-    def test_timeout(self):
+        # Once re-queued by hand, it runs right away.
         self.pg_conn.execute_and_commit(dedent('''
-            INSERT INTO artwork_indexer.event_queue
-                    (id, state, entity_type, action, message, created)
-                 VALUES (1, 'running', 'release', 'index',
-                         '{"gid": "A"}', NOW() - interval '5 minutes');
+            UPDATE artwork_indexer.event_queue
+               SET state = 'queued', attempts = 0
+             WHERE id = 1;
         '''))
+        events = indexer.claim_events(self.pg_conn, 1)
+        self.assertEqual([event['id'] for event in events], [1])
+
+    def test_streaming_metadata(self):
+        self.pg_conn.execute_and_commit(dedent('''
+            INSERT INTO artwork_indexer.event_queue
+                    (id, entity_type, action, message)
+                 VALUES (1, 'release', 'index_metadata',
+                         jsonb_build_object('gid', %(gid)s::text));
+        '''), {'gid': RELEASE1_MBID})
+
+        class BrokenResponse(MockResponse):
+
+            def iter_content(self, chunk_size):
+                yield self.content[:chunk_size]
+                raise ConnectionError('Connection reset')
+
+        # A response that fails partway through fails the event, and
+        # nothing is uploaded.
+        xml = '<metadata>' + (' ' * handlers_base.SPOOL_MAX_MEMORY_SIZE) + \
+            '</metadata>'
+        self.session.next_responses = [
+            BrokenResponse(status=200, content=xml),
+        ]
 
         indexer.indexer(tests_config, self.pg_conn, 1,
                         max_idle_loops=1,
                         http_client_cls=self.http_client_cls)
 
+        self.assertEqual([
+            request['method'] for request in self.session.last_requests
+        ], ['GET'])
         event = self.pg_conn.execute(dedent('''
-            SELECT eq.*,
-                   string_agg(efr.failure_reason, ', ') AS failure_reason
+            SELECT eq.state, fr.failure_reason
               FROM artwork_indexer.event_queue eq
-              JOIN artwork_indexer.event_failure_reason efr
-                ON efr.event = eq.id
-             WHERE eq.id = 1
-          GROUP BY eq.id;
+              JOIN artwork_indexer.event_failure_reason fr ON fr.event = eq.id
         ''')).fetchone()
+        self.assertEqual(event, {
+            'state': 'queued',
+            'failure_reason': 'Connection reset',
+        })
+
+        # On retrying, the whole response is uploaded. It's larger than
+        # what's kept in memory, so it's spooled to disk on the way.
+        self.pg_conn.execute_and_commit(dedent('''
+            UPDATE artwork_indexer.event_queue SET next_attempt_at = now();
+        '''))
+        self.session.last_requests = []
+        self.session.next_responses = [
+            MockResponse(status=200, content=xml),
+            MockResponse(),
+        ]
+
+        indexer.indexer(tests_config, self.pg_conn, 1,
+                        max_idle_loops=1,
+                        http_client_cls=self.http_client_cls)
 
-        self.assertEqual(event['state'], 'failed')
-        self.assertRegex(
-            event['failure_reason'],
-            r'been running for more than 2\.5 minutes'
+        self.assertEqual([
+            (request['method'], request['data'])
+            for request in self.session.last_requests
+        ], [
+            ('GET', None),
+            ('PUT', xml.encode('utf-8')),
+        ])
+        uploaded_file = self.pg_conn.execute(dedent('''
+            SELECT content_sha256 FROM artwork_indexer.uploaded_file
+        ''')).fetchone()
+        self.assertEqual(
+            uploaded_file['content_sha256'],
+            hashlib.sha256(xml.encode('utf-8')).digest(),
+        )
+
+    def test_upgrade_schema(self):
+        # Revert the next_attempt_at update, as if the schema predated it.
+        self.pg_conn.execute_and_commit(dedent('''
+            ALTER TABLE artwork_indexer.event_queue
+                DROP COLUMN next_attempt_at;
+            DELETE FROM artwork_indexer.schema_update
+             WHERE name = '0001-next-attempt-at';
+            INSERT INTO artwork_indexer.event_queue
+                    (id, entity_type, action, message, attempts,
+                     last_updated)
+                 VALUES (1, 'release', 'noop', '{}', 2,
+                         NOW() - interval '30 minutes'),
+                        (2, 'release', 'noop', '{"id": 2}', 1,
+                         NOW() - interval '90 minutes');
+        '''))
+
+        indexer.upgrade_schema(self.pg_conn)
+        # Already up-to-date.
+        indexer.upgrade_schema(self.pg_conn)
+
+        # The retry schedule carried over: #1 is due in 90 minutes, and
+        # #2 was due 30 minutes ago.
+        events = indexer.claim_events(self.pg_conn, 5)
+        self.assertEqual([event['id'] for event in events], [2])
+        update_names = self.pg_conn.execute(dedent('''
+            SELECT name FROM artwork_indexer.schema_update ORDER BY name
+        ''')).fetchall()
+        self.assertEqual(
+            [row['name'] for row in update_names],
+            indexer.get_schema_update_names(),
+        )
+
+    def test_concurrency(self):
+        self.pg_conn.execute_and_commit(dedent('''
+            INSERT INTO artwork_indexer.event_queue
+                    (id, entity_type, action, message)
+                 VALUES (1, 'release', 'noop', '{"sleep": 1}'),
+                        (2, 'release', 'noop', '{"sleep": 1.1}'),
+                        (3, 'release', 'noop', '{"sleep": 1.2}'),
+                        (4, 'release', 'noop', '{"fail": true}'),
+                        (5, 'release', 'noop', '{"id": 5}');
+            INSERT INTO artwork_indexer.event_dependency (parent, child)
+                 VALUES (1, 5);
+        '''))
+
+        start = time.monotonic()
+        indexer.indexer(tests_config, self.pg_conn, 1,
+                        max_idle_loops=1,
+                        http_client_cls=self.http_client_cls,
+                        concurrency=4)
+        elapsed = time.monotonic() - start
+
+        # The sleeps overlapped, and the loop waited for all of them
+        # (plus the dependent event 5) before exiting.
+        self.assertLess(elapsed, 3)
+
+        events = self.pg_conn.execute(dedent('''
+            SELECT id, state, attempts
+              FROM artwork_indexer.event_queue
+             ORDER BY id
+        ''')).fetchall()
+        self.assertEqual(events, [
+            {'id': 1, 'state': 'completed', 'attempts': 1},
+            {'id': 2, 'state': 'completed', 'attempts': 1},
+            {'id': 3, 'state': 'completed', 'attempts': 1},
+            {'id': 4, 'state': 'queued', 'attempts': 1},
+            {'id': 5, 'state': 'completed', 'attempts': 1},
+        ])
+
+    def test_notify_while_busy(self):
+        self.pg_conn.execute_and_commit(dedent('''
+            INSERT INTO artwork_indexer.event_queue
+                    (id, entity_type, action, message)
+                 VALUES (1, 'release', 'noop', '{"sleep": 4}');
+        '''))
+
+        # Queued while event 1 is the only one running, and nothing could
+        # be claimed.
+        thread = queue_event_while_running(1, 2, delay=1)
+        indexer.indexer(tests_config, self.pg_conn, 32,
+                        max_idle_loops=1,
+                        http_client_cls=self.http_client_cls,
+                        concurrency=2)
+        thread.join()
+
+        # The notification woke the loop, which ran event 2 without
+        # waiting for event 1 to finish.
+        events = self.pg_conn.execute(dedent('''
+            SELECT id, state, completed_at
+              FROM artwork_indexer.event_queue
+             ORDER BY completed_at
+        ''')).fetchall()
+        self.assertEqual(
+            [(event['id'], event['state']) for event in events],
+            [(2, 'completed'), (1, 'completed')],
         )
 
+    def test_fault_injection(self):
+        self.pg_conn.execute_and_commit(dedent('''
+            INSERT INTO artwork_indexer.event_queue
+                    (id, entity_type, action, message)
+                 VALUES (1, 'release', 'noop', '{}');
+        '''))
+
+        config = configparser.ConfigParser()
+        config.read_dict(tests_config)
+        config['fault_injection'] = {'before_handler': 'fail'}
+
+        with self.assertRaises(fault_injection.InjectedFault):
+            indexer.indexer(config, self.pg_conn, 1,
+                            max_idle_loops=1,
+                            http_client_cls=self.http_client_cls)
+
+        # The fault struck after the event was marked as running, but
+        # before its handler ran.
+        event = self.pg_conn.execute(dedent('''
+            SELECT * FROM artwork_indexer.event_queue WHERE id = 1
+        ''')).fetchone()
+        self.assertEqual(event['state'], 'running')
+
+        config['fault_injection'] = {'before_lunch': 'sleep:1'}
+        with self.assertRaises(ValueError):
+            fault_injection.load_fault_hooks(config)
+
+    def test_teardown_after_error(self):
+        self.pg_conn.execute_and_commit(dedent('''
+            INSERT INTO artwork_indexer.event_queue
+                    (id, entity_type, action, message)
+                 SELECT i, 'release', 'noop', jsonb_build_object('id', i)
+                   FROM generate_series(1, 4) AS i;
+        '''))
+
+        # Events 1 and 2 run (and fail outside their handlers) while 3
+        # and 4 are claimed but not started. Event 1's error stops the
+        # loop, and event 2's is then re-raised by the pool's `shutdown`.
+        def process_event(pg_conn, event_handler_map, event, *args):
+            if event['id'] == 2:
+                time.sleep(0.5)
+            raise psycopg.OperationalError('server closed the connection')
+
+        with mock.patch.object(indexer, 'process_event', process_event):
+            with self.assertRaises(psycopg.OperationalError):
+                indexer.indexer(tests_config, self.pg_conn, 1,
+                                max_idle_loops=1,
+                                http_client_cls=self.http_client_cls,
+                                claim_batch_size=4,
+                                concurrency=2)
+
+        # The unstarted events were still put back, and the worker
+        # deregistered.
+        self.assertEqual(self.pg_conn.execute(dedent('''
+            SELECT id, state, attempts
+              FROM artwork_indexer.event_queue
+             ORDER BY id
+        ''')).fetchall(), [
+            {'id': 1, 'state': 'running', 'attempts': 1},
+            {'id': 2, 'state': 'running', 'attempts': 1},
+            {'id': 3, 'state': 'queued', 'attempts': 0},
+            {'id': 4, 'state': 'queued', 'attempts': 0},
+        ])
+        self.assertEqual(self.pg_conn.execute(dedent('''
+            SELECT count(*) FROM artwork_indexer.worker
+        ''')).fetchone()['count'], 0)
+
+    def test_notify(self):
+        listener = PgNotifyListener(tests_config)
+        listener.listen()
+
+        # Release #2 has no artwork, so nothing is queued.
+        self.pg_conn.execute_and_commit(dedent('''
+            UPDATE musicbrainz.release SET name = 'quiet' WHERE id = 2;
+        '''))
+        self.assertFalse(listener.wait(0.1))
+
+        self.pg_conn.execute_and_commit(dedent('''
+            UPDATE musicbrainz.release SET name = 'loud' WHERE id = 1;
+            UPDATE cover_art_archive.cover_art SET comment = 'a' WHERE id = 1;
+        '''))
+        self.assertTrue(listener.wait(5))
+        # Both updates were committed together, and only notify once.
+        self.assertFalse(listener.wait(0.1))
+
+        listener.close()
+
+    def test_worker_heartbeats(self):
+        self.pg_conn.execute_and_commit(dedent('''
+            INSERT INTO artwork_indexer.event_queue
+                    (id, entity_type, action, message)
+                 VALUES (1, 'release', 'noop', '{"id": 1}'),
+                        (2, 'release', 'noop', '{"id": 2}');
+        '''))
+
+        def get_workers():
+            return self.pg_conn.execute(dedent('''
+                SELECT id, host, pid, concurrency, events_handled,
+                       events_in_flight, last_claim_duration, pool_requests
+                  FROM artwork_indexer.worker
+            ''')).fetchall()
+
+        def get_leases():
+            return {
+                row['id']: (row['worker'], row['leased'])
+                for row in self.pg_conn.execute(dedent('''
+                    SELECT id, worker, lease_expires_at > now() AS leased
+                      FROM artwork_indexer.event_queue
+                     ORDER BY id
+                ''')).fetchall()
+            }
+
+        worker = indexer.WorkerState(4)
+        heartbeat_thread = indexer.WorkerHeartbeatThread(
+            tests_config, worker, interval=0.1)
+        heartbeat_thread.start()
+
+        events = indexer.claim_events(self.pg_conn, 2, worker.id)
+        self.assertEqual(get_leases(), {
+            1: (worker.id, True),
+            2: (worker.id, True),
+        })
+
+        worker.add_events(events, 0.25)
+        worker.finish_event(events[1])
+        self.pg_conn.execute_and_commit(dedent('''
+            UPDATE artwork_indexer.event_queue
+               SET lease_expires_at = now() - interval '1 minute';
+        '''))
+        time.sleep(0.5)
+
+        # Only the lease of the event still being run was extended.
+        self.assertEqual(get_leases(), {
+            1: (worker.id, True),
+            2: (worker.id, False),
+        })
+        self.assertEqual(get_workers(), [{
+            'id': worker.id,
+            'host': worker.host,
+            'pid': os.getpid(),
+            'concurrency': 4,
+            'events_handled': 1,
+            'events_in_flight': 1,
+            'last_claim_duration': datetime.timedelta(seconds=0.25),
+            # There's no connection pool.
+            'pool_requests': None,
+        }])
+
+        heartbeat_thread.stop()
+        self.assertEqual(get_workers(), [])
+
+        # Leases only last while the event is running.
+        self.pg_conn.execute_and_commit(indexer.COMPLETE_EVENT_QUERY, {
+            'event_id': 1,
+            'worker_id': worker.id,
+        })
+        self.assertEqual(get_leases(), {
+            1: (None, None),
+            2: (worker.id, False),
+        })
+
+    def test_heartbeat_serialization_failure(self):
+        self.pg_conn.execute_and_commit(dedent('''
+            INSERT INTO artwork_indexer.event_queue
+                    (id, entity_type, action, message)
+                 VALUES (1, 'release', 'noop', '{}');
+        '''))
+
+        worker = indexer.WorkerState(1)
+        indexer.register_worker(self.pg_conn, worker)
+        worker.add_events(indexer.claim_events(self.pg_conn, 1, worker.id),
+                          0.25)
+        self.pg_conn.execute_and_commit(dedent('''
+            UPDATE artwork_indexer.event_queue
+               SET lease_expires_at = now() - interval '1 minute';
+            UPDATE artwork_indexer.worker
+               SET last_heartbeat = now() - interval '1 hour';
+        '''))
+
+        def get_state():
+            return self.pg_conn.execute(dedent('''
+                SELECT w.last_heartbeat > now() - interval '1 minute'
+                           AS alive,
+                       eq.lease_expires_at > now() AS leased
+                  FROM artwork_indexer.worker w,
+                       artwork_indexer.event_queue eq
+            ''')).fetchone()
+
+        # Fails to lock an event that was completed (and moved to another
+        # partition) concurrently, the first `failures` times.
+        execute = self.pg_conn.execute
+
+        def execute_with_failures(query, params=None):
+            if query == indexer.EXTEND_EVENT_LEASES_QUERY and failures:
+                failures.pop()
+                raise psycopg.errors.SerializationFailure(
+                    'tuple to be locked was already moved to another '
+                    'partition due to concurrent update'
+                )
+            return execute(query, params)
+
+        with mock.patch.object(self.pg_conn, 'execute',
+                               execute_with_failures):
+            # The leases are extended on a retry.
+            failures = [True]
+            indexer.send_heartbeat(self.pg_conn, worker)
+            self.assertEqual(get_state(), {'alive': True, 'leased': True})
+
+            # If they never are, the heartbeat itself still counts.
+            self.pg_conn.execute_and_commit(dedent('''
+                UPDATE artwork_indexer.event_queue
+                   SET lease_expires_at = now() - interval '1 minute';
+                UPDATE artwork_indexer.worker
+                   SET last_heartbeat = now() - interval '1 hour';
+            '''))
+            failures = [True] * indexer.EXTEND_EVENT_LEASES_ATTEMPTS
+            with self.assertRaises(psycopg.errors.SerializationFailure):
+                indexer.send_heartbeat(self.pg_conn, worker)
+            self.assertEqual(get_state(), {'alive': True, 'leased': False})
+
+        indexer.deregister_worker(self.pg_conn, worker)
+
+    def test_connection_pool(self):
+        self.pg_conn.execute_and_commit(dedent('''
+            INSERT INTO artwork_indexer.event_queue
+                    (id, entity_type, action, message)
+                 SELECT i, 'release', 'noop', jsonb_build_object('id', i)
+                   FROM generate_series(1, 6) AS i;
+        '''))
+
+        # Fewer connections than there are threads to share them.
+        config = configparser.ConfigParser()
+        config.read_dict(tests_config)
+        config['database']['pool_max_size'] = '2'
+        self.addCleanup(pg_conn_wrapper.close_pools)
+
+        pooled_pg_conn = PgConnWrapper(config)
+        indexer.indexer(config, pooled_pg_conn, 1,
+                        max_idle_loops=1,
+                        http_client_cls=self.http_client_cls,
+                        claim_batch_size=3,
+                        concurrency=3)
+
+        events = self.pg_conn.execute(dedent('''
+            SELECT state FROM artwork_indexer.event_queue
+        ''')).fetchall()
+        self.assertEqual(events, [{'state': 'completed'}] * 6)
+
+        # Each connection was given back once its transaction ended.
+        self.assertIsNone(pooled_pg_conn.conn)
+        pool_stats = pg_conn_wrapper.pools['database'].get_stats()
+        self.assertLessEqual(pool_stats['pool_size'], 2)
+        self.assertEqual(pool_stats['pool_available'],
+                         pool_stats['pool_size'])
+
+        # The cleanup thread took the maintenance lock on a connection of
+        # its own, which it's since closed.
+        self.assertTrue(indexer.try_maintenance_lock(self.pg_conn))
+        self.pg_conn.close()
+
+        # Heartbeats report the pool's stats.
+        worker = indexer.WorkerState(1)
+        indexer.register_worker(pooled_pg_conn, worker)
+        stats = pg_conn_wrapper.get_pool_stats()
+        self.assertGreater(stats['requests'], 6)
+        self.assertEqual(stats['request_errors'], 0)
+        indexer.send_heartbeat(pooled_pg_conn, worker)
+        self.assertEqual(self.pg_conn.execute(dedent('''
+            SELECT pool_requests AS requests,
+                   pool_requests_queued AS requests_queued,
+                   pool_wait_time AS wait_time,
+                   pool_request_errors AS request_errors
+              FROM artwork_indexer.worker
+        ''')).fetchall(), [stats])
+        indexer.deregister_worker(pooled_pg_conn, worker)
+        self.assertIsNone(pooled_pg_conn.conn)
+
+    def test_dead_workers(self):
+        # Worker 1 has stopped sending heartbeats, and worker 3 is gone.
+        self.pg_conn.execute_and_commit(dedent('''
+            INSERT INTO artwork_indexer.worker
+                    (id, host, pid, concurrency, last_heartbeat)
+                 VALUES (1, 'a', 1, 1, now() - interval '5 minutes'),
+                        (2, 'b', 2, 1, now());
+            INSERT INTO artwork_indexer.event_queue
+                    (id, state, entity_type, action, message, attempts,
+                     lease_expires_at, worker)
+                 SELECT i, 'running', 'release', 'noop',
+                        jsonb_build_object('id', i), 1,
+                        now() + interval '1 minute', i
+                   FROM generate_series(1, 3) AS i;
+        '''))
+
+        indexer.delete_dead_workers(self.pg_conn)
+        indexer.requeue_expired_events(self.pg_conn)
+
+        workers = self.pg_conn.execute(dedent('''
+            SELECT id FROM artwork_indexer.worker
+        ''')).fetchall()
+        self.assertEqual(workers, [{'id': 2}])
+        events = self.pg_conn.execute(dedent('''
+            SELECT id, state, worker
+              FROM artwork_indexer.event_queue
+             ORDER BY id
+        ''')).fetchall()
+        self.assertEqual(events, [
+            {'id': 1, 'state': 'queued', 'worker': None},
+            {'id': 2, 'state': 'running', 'worker': 2},
+            {'id': 3, 'state': 'queued', 'worker': None},
+        ])
+
+    def test_expired_leases(self):
+        # Event 3 has no lease, as if claimed before leases existed.
+        self.pg_conn.execute_and_commit(dedent('''
+            INSERT INTO artwork_indexer.event_queue
+                    (id, state, entity_type, action, message, attempts,
+                     lease_expires_at)
+                 SELECT i, 'running', 'release', 'noop',
+                        jsonb_build_object('id', i), 1,
+                        CASE WHEN i = 2 THEN now() + interval '1 minute'
+                             WHEN i != 3 THEN now() - interval '1 minute'
+                         END
+                   FROM generate_series(1, 5) AS i;
+        '''))
+
+        indexer.requeue_expired_events(self.pg_conn, batch_size=2)
+
+        # The attempts they were claimed for aren't counted.
+        events = self.pg_conn.execute(dedent('''
+            SELECT id, state, attempts, lease_expires_at IS NULL AS no_lease
+              FROM artwork_indexer.event_queue
+             ORDER BY id
+        ''')).fetchall()
+        self.assertEqual(events, [
+            {'id': 1, 'state': 'queued', 'attempts': 0, 'no_lease': True},
+            {'id': 2, 'state': 'running', 'attempts': 1, 'no_lease': False},
+            {'id': 3, 'state': 'queued', 'attempts': 0, 'no_lease': True},
+            {'id': 4, 'state': 'queued', 'attempts': 0, 'no_lease': True},
+            {'id': 5, 'state': 'queued', 'attempts': 0, 'no_lease': True},
+        ])
+
+    def test_expired_lease_while_busy(self):
+        self.pg_conn.execute_and_commit(dedent('''
+            INSERT INTO artwork_indexer.event_queue
+                    (id, state, entity_type, action, message, attempts,
+                     lease_expires_at)
+                 VALUES (1, 'running', 'release', 'noop', '{"id": 1}', 1,
+                         now() - interval '1 minute'),
+                        (2, 'queued', 'release', 'noop', '{"sleep": 1}', 0,
+                         NULL);
+        '''))
+
+        indexer.indexer(tests_config, self.pg_conn, 1,
+                        max_idle_loops=1,
+                        http_client_cls=self.http_client_cls)
+
+        # Event 1 was re-queued while event 2 was running, rather than
+        # once the indexer had nothing left to do, so it was run again.
+        events = self.pg_conn.execute(dedent('''
+            SELECT id, state, attempts
+              FROM artwork_indexer.event_queue
+             ORDER BY id
+        ''')).fetchall()
+        self.assertEqual(events, [
+            {'id': 1, 'state': 'completed', 'attempts': 1},
+            {'id': 2, 'state': 'completed', 'attempts': 1},
+        ])
+
+    def test_lease_taken_over(self):
+        # Event 3 depends on event 2, which fails.
+        self.pg_conn.execute_and_commit(dedent('''
+            INSERT INTO artwork_indexer.event_queue
+                    (id, entity_type, action, message)
+                 VALUES (1, 'release', 'noop', '{"id": 1}'),
+                        (2, 'release', 'noop', '{"fail": true}'),
+                        (3, 'release', 'noop', '{"id": 3}');
+            INSERT INTO artwork_indexer.event_dependency (parent, child)
+                 VALUES (2, 3);
+        '''))
+
+        def get_events():
+            return self.pg_conn.execute(dedent('''
+                SELECT id, state, worker, attempts
+                  FROM artwork_indexer.event_queue
+                 ORDER BY id
+            ''')).fetchall()
+
+        def get_failure_reasons():
+            return self.pg_conn.execute(dedent('''
+                SELECT event, failure_reason
+                  FROM artwork_indexer.event_failure_reason
+                 ORDER BY event
+            ''')).fetchall()
+
+        handler = EVENT_HANDLER_CLASSES['release'](tests_config, None)
+
+        # Worker 1's leases expire, and worker 2 claims the events.
+        stale_events = indexer.claim_events(self.pg_conn, 2, 1)
+        self.pg_conn.execute_and_commit(dedent('''
+            UPDATE artwork_indexer.event_queue
+               SET lease_expires_at = now() - interval '1 minute';
+        '''))
+        indexer.requeue_expired_events(self.pg_conn)
+        events = indexer.claim_events(self.pg_conn, 2, 2)
+        self.assertEqual([event['id'] for event in events], [1, 2])
+
+        # Worker 1 finishing them after all changes nothing.
+        with self.assertLogs(level='WARNING') as logs:
+            for event in stale_events:
+                indexer.run_event_handler(self.pg_conn, event, handler)
+            self.pg_conn.commit()
+        self.assertEqual(
+            [line for line in logs.output if line.startswith('WARNING')],
+            [
+                'WARNING:root:Event id=1 is no longer running on this '
+                'worker (its lease expired); not marking it completed',
+                'WARNING:root:Event id=2 is no longer running on this '
+                'worker (its lease expired); not marking it failed',
+            ],
+        )
+        self.assertEqual(get_events(), [
+            {'id': 1, 'state': 'running', 'worker': 2, 'attempts': 1},
+            {'id': 2, 'state': 'running', 'worker': 2, 'attempts': 1},
+            {'id': 3, 'state': 'queued', 'worker': None, 'attempts': 0},
+        ])
+        self.assertEqual(get_failure_reasons(), [])
+
+        # Worker 2 still can.
+        for event in events:
+            indexer.run_event_handler(self.pg_conn, event, handler)
+        self.pg_conn.commit()
+        self.assertEqual(get_events(), [
+            {'id': 1, 'state': 'completed', 'worker': None, 'attempts': 1},
+            {'id': 2, 'state': 'queued', 'worker': None, 'attempts': 1},
+            {'id': 3, 'state': 'queued', 'worker': None, 'attempts': 0},
+        ])
+        self.assertEqual(get_failure_reasons(), [
+            {'event': 2, 'failure_reason': 'Failure (no-op)'},
+        ])
+
+    def test_maintenance_lock(self):
+        # The event isn't due again once it's re-queued, so that it
+        # isn't run as well.
+        self.pg_conn.execute_and_commit(dedent('''
+            INSERT INTO artwork_indexer.event_queue
+                    (id, state, entity_type, action, message,
+                     next_attempt_at)
+                 VALUES (1, 'running', 'release', 'noop', '{"id": 1}',
+                         now() + interval '1 hour');
+        '''))
+
+        # Another indexer process is doing maintenance.
+        other_pg_conn = PgConnWrapper(tests_config)
+        self.assertTrue(indexer.try_maintenance_lock(other_pg_conn))
+        self.assertFalse(indexer.try_maintenance_lock(self.pg_conn))
+
+        indexer.indexer(tests_config, self.pg_conn, 1,
+                        max_idle_loops=1,
+                        http_client_cls=self.http_client_cls)
+
+        event = self.pg_conn.execute(dedent('''
+            SELECT state FROM artwork_indexer.event_queue WHERE id = 1
+        ''')).fetchone()
+        self.assertEqual(event['state'], 'running')
+
+        # Until it goes away.
+        other_pg_conn.close()
+
+        indexer.indexer(tests_config, self.pg_conn, 1,
+                        max_idle_loops=1,
+                        http_client_cls=self.http_client_cls)
+
+        event = self.pg_conn.execute(dedent('''
+            SELECT state FROM artwork_indexer.event_queue WHERE id = 1
+        ''')).fetchone()
+        self.assertEqual(event['state'], 'queued')
+
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)
@@ -0,0 +1,243 @@
+import configparser
+import os.path
+from textwrap import dedent
+import handlers_base
+import indexer
+from handlers import EVENT_HANDLER_CLASSES
+from projects import CAA_PROJECT
+from . import (
+    MockResponse,
+    TestArtArchive,
+    index_json_put,
+    tests_config,
+)
+
+
+RELEASE_MBIDS = (
+    '16ebbc86-670c-4ad3-980b-bfbd1eee4ff4',
+    '2198f7b1-658c-4217-8cae-f63abe0b2391',
+    '41f27dcf-f012-4c91-afc0-0531e196bbda',
+    # Doesn't exist.
+    '6b6d3a86-3a40-4a3d-8b1c-dbbd1e0ac8b1',
+)
+
+EVENT_MBIDS = (
+    'e2aad65a-12e0-44ec-b693-94d225154e90',
+    'a0f19ff3-e140-417f-81c6-2a7466eeea0a',
+    'f5c9461c-e5b4-4152-9458-d9a74baa7161',
+)
+
+# Comments covering each way `json.dumps` escapes a string.
+ESCAPED_COMMENTS = (
+    '',
+    '"quoted" \\ back/slash',
+    'line\nbreak\ttab\x01\x7f',
+    'é ❇ \u2028 🀽 𝄞',
+)
+
+
+def database_renderer_config():
+    config = configparser.ConfigParser()
+    config.read_dict(tests_config)
+    config['indexer'] = {'index_json_renderer': 'database'}
+    return config
+
+
+class IndexJsonTestCase(TestArtArchive):
+
+    def setUp(self):
+        super().setUp()
+
+        with open(
+            os.path.join(os.path.dirname(__file__), self.setup_file),
+            'r'
+        ) as fp:
+            self.pg_conn.execute_and_commit(fp.read())
+
+        self.handler = EVENT_HANDLER_CLASSES[self.entity_type](
+            database_renderer_config(),
+            self.session,
+        )
+
+    def tearDown(self):
+        with open(
+            os.path.join(os.path.dirname(__file__), self.teardown_file),
+            'r'
+        ) as fp:
+            self.pg_conn.execute_and_commit(fp.read())
+
+        super().tearDown()
+
+    def render_streamed_index_json(self, mbid):
+        with handlers_base.SpooledContent() as content:
+            self.handler.write_index_json(
+                mbid,
+                self.handler.iter_image_rows(self.pg_conn, mbid),
+                content,
+            )
+            content.rewind()
+            return content.read().decode('utf-8')
+
+    def assertRenderersMatch(self, mbids):
+        for mbid in mbids:
+            with self.subTest(mbid=mbid):
+                index_json = self.handler.build_index_json(
+                    mbid,
+                    self.handler.fetch_image_rows_batch(
+                        self.pg_conn,
+                        [mbid],
+                    )[mbid],
+                )
+                self.assertEqual(
+                    self.handler.render_index_json(self.pg_conn, mbid),
+                    index_json,
+                )
+                self.assertEqual(
+                    self.render_streamed_index_json(mbid),
+                    index_json,
+                )
+
+
+class TestReleaseIndexJson(IndexJsonTestCase):
+
+    entity_type = 'release'
+    setup_file = 'caa_setup.sql'
+    teardown_file = 'caa_teardown.sql'
+
+    def test_renderers_match(self):
+        self.assertRenderersMatch(RELEASE_MBIDS)
+
+        # Add images with each kind of comment, several types (or the
+        # back one), an approved edit, and other file types.
+        self.pg_conn.execute_and_commit(dedent('''
+            INSERT INTO musicbrainz.edit
+                    (id, editor, type, status, expire_time, close_time)
+                 VALUES (3, 10, 314, 2, now(), now());
+        '''))
+        self.pg_conn.execute_and_commit(dedent('''
+            INSERT INTO cover_art_archive.cover_art
+                    (id, release, mime_type, edit, ordering, comment)
+                 SELECT 10 + i, 1,
+                        (ARRAY['image/png', 'application/pdf'])[1 + i %% 2],
+                        3, 2 + i, comment
+                   FROM unnest(%(comments)s::text[])
+                        WITH ORDINALITY AS comments (comment, i)
+        '''), {'comments': list(ESCAPED_COMMENTS)})
+        self.pg_conn.execute_and_commit(dedent('''
+            INSERT INTO cover_art_archive.cover_art_type (id, type_id)
+                 VALUES (11, 2), (12, 3), (12, 4);
+        '''))
+
+        self.assertRenderersMatch(RELEASE_MBIDS)
+
+    def test_indexing(self):
+        self.pg_conn.execute_and_commit(dedent('''
+            INSERT INTO artwork_indexer.event_queue
+                    (entity_type, action, message)
+                 VALUES ('release', 'index_images',
+                         jsonb_build_object('gid', %(gid)s::text));
+        '''), {'gid': RELEASE_MBIDS[0]})
+
+        self.session.next_responses = [MockResponse()]
+
+        indexer.indexer(database_renderer_config(), self.pg_conn, 1,
+                        max_idle_loops=1,
+                        http_client_cls=self.http_client_cls)
+
+        self.assertEqual(self.session.last_requests, [
+            index_json_put(CAA_PROJECT, RELEASE_MBIDS[0], [{
+                'approved': False,
+                'back': False,
+                'comment': '❇',
+                'edit': 1,
+                'front': True,
+                'id': 1,
+                'types': ['Front'],
+            }]),
+        ])
+
+    def test_prefetching_image_rows(self):
+        self.pg_conn.execute_and_commit(dedent('''
+            INSERT INTO artwork_indexer.event_queue
+                    (entity_type, action, message)
+                 SELECT 'release', 'index_images',
+                        jsonb_build_object('gid', gid)
+                   FROM unnest(%(gids)s::text[]) AS gid
+        '''), {'gids': list(RELEASE_MBIDS)})
+
+        # With the Python renderer, which uses the rows.
+        handler = EVENT_HANDLER_CLASSES['release'](tests_config, None)
+        image_rows = {
+            mbid: list(handler.iter_image_rows(self.pg_conn, mbid))
+            for mbid in RELEASE_MBIDS
+        }
+
+        events = indexer.claim_events(self.pg_conn, 10)
+        indexer.prefetch_image_rows(
+            self.pg_conn,
+            {'release': handler},
+            events,
+        )
+        self.assertEqual(handlers_base.prefetched_image_rows, {
+            ('release', mbid): rows for mbid, rows in image_rows.items()
+        })
+
+        indexer.release_events(self.pg_conn, events)
+        self.assertEqual(handlers_base.prefetched_image_rows, {})
+
+        # With room for only one row, the third release's image doesn't
+        # fit after the first's, so it's left to stream its own; those
+        # without images still fit.
+        events = indexer.claim_events(self.pg_conn, 10)
+        indexer.prefetch_image_rows(
+            self.pg_conn,
+            {'release': handler},
+            events,
+            max_rows=1,
+        )
+        self.assertEqual(handlers_base.prefetched_image_rows, {
+            ('release', mbid): image_rows[mbid]
+            for mbid in (RELEASE_MBIDS[0], RELEASE_MBIDS[1], RELEASE_MBIDS[3])
+        })
+
+        indexer.release_events(self.pg_conn, events)
+        self.assertEqual(handlers_base.prefetched_image_rows, {})
+
+        self.session.next_responses = [MockResponse() for _ in RELEASE_MBIDS]
+
+        indexer.indexer(tests_config, self.pg_conn, 1,
+                        max_idle_loops=1,
+                        http_client_cls=self.http_client_cls,
+                        claim_batch_size=10)
+
+        self.assertEqual(
+            [request['data'] for request in self.session.last_requests],
+            [
+                handler.build_index_json(mbid, rows).encode('utf-8')
+                for mbid, rows in image_rows.items()
+            ],
+        )
+        self.assertEqual(handlers_base.prefetched_image_rows, {})
+        self.assertEqual(self.get_event_queue(), [])
+
+
+class TestEventIndexJson(IndexJsonTestCase):
+
+    entity_type = 'event'
+    setup_file = 'eaa_setup.sql'
+    teardown_file = 'eaa_teardown.sql'
+
+    def test_renderers_match(self):
+        self.pg_conn.execute_and_commit(dedent('''
+            INSERT INTO event_art_archive.event_art
+                    (id, event, mime_type, edit, ordering, comment)
+                 SELECT 10 + i, 3, 'image/png', 2, i, comment
+                   FROM unnest(%(comments)s::text[])
+                        WITH ORDINALITY AS comments (comment, i)
+        '''), {'comments': list(ESCAPED_COMMENTS)})
+        self.pg_conn.execute_and_commit(dedent('''
+            INSERT INTO event_art_archive.event_art_type (id, type_id)
+                 VALUES (11, 2), (11, 3);
+        '''))
+
+        self.assertRenderersMatch(EVENT_MBIDS)
@@ -0,0 +1,532 @@
+import configparser
+import datetime
+import os.path
+import xml.etree.ElementTree as ET
+from textwrap import dedent
+import indexer
+import mb_metadata
+from handlers import EVENT_HANDLER_CLASSES
+from projects import CAA_PROJECT
+from . import (
+    MockResponse,
+    TestArtArchive,
+    index_event,
+    mb_metadata_xml_put,
+    tests_config,
+)
+
+
+# The web service's output for the entities in caa_setup.sql and
+# eaa_setup.sql, recorded by tests/record_golden.py from a MusicBrainz
+# server that serves the test database. The XML rendered from the
+# database must match it. Without a recording for an entity, its check
+# is skipped.
+GOLDEN_DIR = os.path.join(os.path.dirname(__file__), 'golden')
+
+RELEASE_MBIDS = (
+    '16ebbc86-670c-4ad3-980b-bfbd1eee4ff4',
+    '2198f7b1-658c-4217-8cae-f63abe0b2391',
+    '41f27dcf-f012-4c91-afc0-0531e196bbda',
+)
+
+EVENT_MBIDS = (
+    'e2aad65a-12e0-44ec-b693-94d225154e90',
+    'a0f19ff3-e140-417f-81c6-2a7466eeea0a',
+    'f5c9461c-e5b4-4152-9458-d9a74baa7161',
+)
+
+
+# What the renderer itself is expected to produce, as opposed to the
+# recordings above.
+RELEASE1_XML = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<metadata xmlns="http://musicbrainz.org/ns/mmd-2.0#">'
+        f'<release id="{RELEASE_MBIDS[0]}">'
+            '<title>ⶵ⮮</title>'
+            '<quality>normal</quality>'
+            '<artist-credit>'
+                '<name-credit>'
+                    '<name>✺⧳</name>'
+                    '<artist id="ae859a2d-5754-4e88-9af0-6df263345535">'
+                        '<name>🀽</name>'
+                        '<sort-name>🀽</sort-name>'
+                    '</artist>'
+                '</name-credit>'
+            '</artist-credit>'
+            '<date>1989-10</date>'
+            '<country>US</country>'
+            '<release-event-list count="1">'
+                '<release-event>'
+                    '<date>1989-10</date>'
+                    '<area id="489ce91b-6658-3307-9877-795b68554c98">'
+                        '<name>United States</name>'
+                        '<sort-name>United States</sort-name>'
+                        '<iso-3166-1-code-list>'
+                            '<iso-3166-1-code>US</iso-3166-1-code>'
+                        '</iso-3166-1-code-list>'
+                    '</area>'
+                '</release-event>'
+            '</release-event-list>'
+            '<cover-art-archive>'
+                '<artwork>true</artwork>'
+                '<count>1</count>'
+                '<front>true</front>'
+                '<back>false</back>'
+            '</cover-art-archive>'
+        '</release>'
+    '</metadata>\n'
+)
+
+# With the optional elements that the fixtures don't have set (see
+# `test_optional_elements`).
+RELEASE3_XML = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<metadata xmlns="http://musicbrainz.org/ns/mmd-2.0#">'
+        f'<release id="{RELEASE_MBIDS[2]}">'
+            '<title>artful</title>'
+            '<status id="4e304316-386d-3409-af2e-78857eec5cfe">'
+                'Official'
+            '</status>'
+            '<quality>high</quality>'
+            '<disambiguation>deluxe</disambiguation>'
+            '<packaging id="ec27701a-4a22-37f4-bfac-6616e0f9750a">'
+                'Jewel Case'
+            '</packaging>'
+            '<text-representation>'
+                '<language>eng</language>'
+                '<script>Latn</script>'
+            '</text-representation>'
+            '<artist-credit>'
+                '<name-credit joinphrase=" &amp; ">'
+                    '<artist id="4698a32d-b014-4da6-bdb7-de59fa5179bc" '
+                    'type="Group" '
+                    'type-id="e431f5f6-b5d2-343d-8b36-72607fffb74b">'
+                        '<name>O</name>'
+                        '<sort-name>O</sort-name>'
+                    '</artist>'
+                '</name-credit>'
+                '<name-credit>'
+                    '<name>✺⧳</name>'
+                    '<artist id="ae859a2d-5754-4e88-9af0-6df263345535">'
+                        '<name>🀽</name>'
+                        '<sort-name>🀽</sort-name>'
+                    '</artist>'
+                '</name-credit>'
+            '</artist-credit>'
+            '<date>????-07-02</date>'
+            '<release-event-list count="1">'
+                '<release-event>'
+                    '<date>????-07-02</date>'
+                '</release-event>'
+            '</release-event-list>'
+            '<barcode />'
+            '<asin>B000002UAL</asin>'
+            '<cover-art-archive>'
+                '<artwork>true</artwork>'
+                '<count>1</count>'
+                '<front>false</front>'
+                '<back>true</back>'
+            '</cover-art-archive>'
+        '</release>'
+    '</metadata>\n'
+)
+
+EVENT1_XML = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<metadata xmlns="http://musicbrainz.org/ns/mmd-2.0#">'
+        f'<event id="{EVENT_MBIDS[0]}">'
+            '<name>live at the place 1</name>'
+            '<cancelled>true</cancelled>'
+            '<life-span>'
+                '<begin>1990-05</begin>'
+                '<ended>true</ended>'
+            '</life-span>'
+            '<time>20:00</time>'
+            '<relation-list target-type="artist">'
+                '<relation type="main performer" '
+                'type-id="936c7c95-3156-3889-a062-8a0cd57f8946">'
+                    '<target>ae859a2d-5754-4e88-9af0-6df263345535'
+                    '</target>'
+                    '<direction>backward</direction>'
+                    '<artist id="ae859a2d-5754-4e88-9af0-6df263345535" '
+                    'type="Person" '
+                    'type-id="b6e035f4-3ce9-331c-97df-83397230b0df">'
+                        '<name>🀽</name>'
+                        '<sort-name>🀽</sort-name>'
+                        '<disambiguation>not that one'
+                        '</disambiguation>'
+                    '</artist>'
+                '</relation>'
+            '</relation-list>'
+            '<relation-list target-type="place">'
+                '<relation type="held at" '
+                'type-id="e2c6f697-07dc-38b1-be0b-83d740165532">'
+                    '<target>4352063b-a833-421b-a420-e7fb295dece0'
+                    '</target>'
+                    '<begin>1990</begin>'
+                    '<ended>true</ended>'
+                    '<place id="4352063b-a833-421b-a420-e7fb295dece0">'
+                        '<name>the place</name>'
+                    '</place>'
+                '</relation>'
+            '</relation-list>'
+        '</event>'
+    '</metadata>\n'
+)
+
+
+EVENT2_XML = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<metadata xmlns="http://musicbrainz.org/ns/mmd-2.0#">'
+        f'<event id="{EVENT_MBIDS[1]}" type="Concert" '
+        'type-id="ef55e8d7-3d00-394a-8012-f5506a29ff0b">'
+            '<name>live at the place 2</name>'
+            '<life-span>'
+                '<begin>1991</begin>'
+                '<end>1991</end>'
+            '</life-span>'
+            '<time>21:00</time>'
+        '</event>'
+    '</metadata>\n'
+)
+
+
+def read_golden_xml(entity_type, mbid):
+    # Returns None if there's no recording.
+    path = os.path.join(GOLDEN_DIR, f'{entity_type}-{mbid}.xml')
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as fp:
+        return fp.read()
+
+
+def database_metadata_config():
+    config = configparser.ConfigParser()
+    config.read_dict(tests_config)
+    config['musicbrainz']['caa_metadata_source'] = 'database'
+    config['musicbrainz']['eaa_metadata_source'] = 'database'
+    return config
+
+
+class TestReleaseMetadata(TestArtArchive):
+
+    def setUp(self):
+        super().setUp()
+
+        with open(
+            os.path.join(os.path.dirname(__file__), 'caa_setup.sql'),
+            'r'
+        ) as fp:
+            self.pg_conn.execute_and_commit(fp.read())
+
+        self.handler = EVENT_HANDLER_CLASSES['release'](
+            database_metadata_config(),
+            self.session,
+        )
+
+    def tearDown(self):
+        with open(
+            os.path.join(os.path.dirname(__file__), 'caa_teardown.sql'),
+            'r'
+        ) as fp:
+            self.pg_conn.execute_and_commit(fp.read())
+
+        super().tearDown()
+
+    def test_golden_files(self):
+        for mbid in RELEASE_MBIDS:
+            with self.subTest(mbid=mbid):
+                golden_xml = read_golden_xml('release', mbid)
+                if golden_xml is None:
+                    self.skipTest('not recorded; see tests/record_golden.py')
+                self.assertEqual(
+                    self.handler.render_metadata_xml(
+                        self.pg_conn,
+                        mbid,
+                    ).decode('utf-8'),
+                    golden_xml,
+                )
+
+    def test_rendering(self):
+        self.assertEqual(
+            self.handler.render_metadata_xml(
+                self.pg_conn,
+                RELEASE_MBIDS[0],
+            ).decode('utf-8'),
+            RELEASE1_XML,
+        )
+
+    def test_optional_elements(self):
+        self.pg_conn.execute_and_commit(dedent('''
+            INSERT INTO musicbrainz.language (id, name, iso_code_3)
+                 VALUES (120, 'English', 'eng')
+            ON CONFLICT DO NOTHING;
+
+            INSERT INTO musicbrainz.script
+                    (id, iso_code, iso_number, name, frequency)
+                 VALUES (28, 'Latn', '215', 'Latin', 4)
+            ON CONFLICT DO NOTHING;
+
+            INSERT INTO musicbrainz.release_status (id, name, gid)
+                 VALUES (1, 'Official',
+                         '4e304316-386d-3409-af2e-78857eec5cfe')
+            ON CONFLICT DO NOTHING;
+
+            INSERT INTO musicbrainz.release_packaging (id, name, gid)
+                 VALUES (1, 'Jewel Case',
+                         'ec27701a-4a22-37f4-bfac-6616e0f9750a')
+            ON CONFLICT DO NOTHING;
+
+            INSERT INTO musicbrainz.artist_type (id, name, gid)
+                 VALUES (2, 'Group',
+                         'e431f5f6-b5d2-343d-8b36-72607fffb74b')
+            ON CONFLICT DO NOTHING;
+
+            UPDATE musicbrainz.release
+               SET comment = 'deluxe',
+                   status = (
+                       SELECT id FROM musicbrainz.release_status
+                        WHERE name = 'Official'
+                   ),
+                   packaging = (
+                       SELECT id FROM musicbrainz.release_packaging
+                        WHERE name = 'Jewel Case'
+                   ),
+                   language = (
+                       SELECT id FROM musicbrainz.language
+                        WHERE iso_code_3 = 'eng'
+                   ),
+                   script = (
+                       SELECT id FROM musicbrainz.script
+                        WHERE iso_code = 'Latn'
+                   ),
+                   barcode = '',
+                   quality = 2
+             WHERE id = 3;
+
+            UPDATE musicbrainz.artist
+               SET type = (
+                       SELECT id FROM musicbrainz.artist_type
+                        WHERE name = 'Group'
+                   )
+             WHERE id = 2;
+
+            UPDATE musicbrainz.release_meta
+               SET amazon_asin = 'B000002UAL'
+             WHERE id = 3;
+
+            UPDATE musicbrainz.artist_credit_name
+               SET join_phrase = ' & '
+             WHERE artist_credit = 2;
+
+            INSERT INTO musicbrainz.artist_credit_name
+                    (artist_credit, name, artist, position, join_phrase)
+                 VALUES (2, '✺⧳', 1, 2, '');
+
+            INSERT INTO musicbrainz.release_unknown_country
+                    (release, date_year, date_month, date_day)
+                 VALUES (3, NULL, 7, 2);
+
+            INSERT INTO cover_art_archive.cover_art_type (id, type_id)
+                 VALUES (2, 2);
+        '''))
+
+        self.assertEqual(
+            self.handler.render_metadata_xml(
+                self.pg_conn,
+                RELEASE_MBIDS[2],
+            ).decode('utf-8'),
+            RELEASE3_XML,
+        )
+
+    def test_indexing(self):
+        self.pg_conn.execute_and_commit(dedent('''
+            INSERT INTO artwork_indexer.event_queue
+                    (entity_type, action, message)
+                 VALUES ('release', 'index_metadata',
+                         jsonb_build_object('gid', %(gid)s::text)),
+                        ('release', 'index_metadata',
+                         jsonb_build_object(
+                             'gid', '6b6d3a86-3a40-4a3d-8b1c-dbbd1e0ac8b1'
+                         ));
+        '''), {'gid': RELEASE_MBIDS[0]})
+
+        self.session.next_responses = [MockResponse()]
+
+        indexer.indexer(database_metadata_config(), self.pg_conn, 1,
+                        max_idle_loops=1,
+                        http_client_cls=self.http_client_cls)
+
+        # The XML is uploaded without asking the web service for it, and
+        # a release that doesn't exist fails instead of 404ing.
+        self.assertEqual(self.session.last_requests, [
+            mb_metadata_xml_put(
+                CAA_PROJECT,
+                RELEASE_MBIDS[0],
+                RELEASE1_XML,
+            ),
+        ])
+        self.assertEqual(self.get_event_queue(), [
+            index_event(
+                '6b6d3a86-3a40-4a3d-8b1c-dbbd1e0ac8b1',
+                id=2,
+                entity_type='release',
+                action='index_metadata',
+                attempts=1,
+            ),
+        ])
+        failure_reason = self.pg_conn.execute(dedent('''
+            SELECT failure_reason
+              FROM artwork_indexer.event_failure_reason
+             WHERE event = 2
+        ''')).fetchone()['failure_reason']
+        self.assertEqual(
+            failure_reason,
+            'The release 6b6d3a86-3a40-4a3d-8b1c-dbbd1e0ac8b1 '
+            'does not exist.',
+        )
+
+
+class TestEventMetadata(TestArtArchive):
+
+    def setUp(self):
+        super().setUp()
+
+        with open(
+            os.path.join(os.path.dirname(__file__), 'eaa_setup.sql'),
+            'r'
+        ) as fp:
+            self.pg_conn.execute_and_commit(fp.read())
+
+        self.handler = EVENT_HANDLER_CLASSES['event'](
+            database_metadata_config(),
+            self.session,
+        )
+
+    def tearDown(self):
+        with open(
+            os.path.join(os.path.dirname(__file__), 'eaa_teardown.sql'),
+            'r'
+        ) as fp:
+            self.pg_conn.execute_and_commit(fp.read())
+
+        super().tearDown()
+
+    def test_golden_files(self):
+        for mbid in EVENT_MBIDS:
+            with self.subTest(mbid=mbid):
+                golden_xml = read_golden_xml('event', mbid)
+                if golden_xml is None:
+                    self.skipTest('not recorded; see tests/record_golden.py')
+                self.assertEqual(
+                    self.handler.render_metadata_xml(
+                        self.pg_conn,
+                        mbid,
+                    ).decode('utf-8'),
+                    golden_xml,
+                )
+
+    def test_rendering(self):
+        self.assertEqual(
+            self.handler.render_metadata_xml(
+                self.pg_conn,
+                EVENT_MBIDS[1],
+            ).decode('utf-8'),
+            EVENT2_XML,
+        )
+
+    def test_relationships(self):
+        # The test database has no link types, so this builds the XML
+        # from a row directly.
+        relationship = {
+            'type': 'main performer',
+            'type_id': '936c7c95-3156-3889-a062-8a0cd57f8946',
+            'direction': 'backward',
+            'begin_date_year': None,
+            'begin_date_month': None,
+            'begin_date_day': None,
+            'end_date_year': None,
+            'end_date_month': None,
+            'end_date_day': None,
+            'ended': False,
+            'target_gid': 'ae859a2d-5754-4e88-9af0-6df263345535',
+            'target_name': '🀽',
+            'target_sort_name': '🀽',
+            'target_comment': 'not that one',
+            'target_type': 'Person',
+            'target_type_id': 'b6e035f4-3ce9-331c-97df-83397230b0df',
+        }
+        self.assertEqual(
+            mb_metadata.build_event_metadata_xml({
+                'gid': EVENT_MBIDS[0],
+                'name': 'live at the place 1',
+                'comment': '',
+                'cancelled': True,
+                'begin_date_year': 1990,
+                'begin_date_month': 5,
+                'begin_date_day': None,
+                'end_date_year': None,
+                'end_date_month': None,
+                'end_date_day': None,
+                'ended': True,
+                'time': datetime.time(20, 0),
+                'type': None,
+                'type_id': None,
+                'artist_relations': [relationship],
+                'place_relations': [{
+                    **relationship,
+                    'type': 'held at',
+                    'type_id': 'e2c6f697-07dc-38b1-be0b-83d740165532',
+                    'direction': 'forward',
+                    'begin_date_year': 1990,
+                    'ended': True,
+                    'target_gid': '4352063b-a833-421b-a420-e7fb295dece0',
+                    'target_name': 'the place',
+                }],
+            }),
+            EVENT1_XML,
+        )
+
+    def test_known_differences(self):
+        # Unlike the web service, the renderer leaves out a relationship's
+        # attributes (`<attribute-list>`), and all of a place's details
+        # but its name (like its address and coordinates); see
+        # mb_metadata.py. Its output differs for events with either.
+        xml = mb_metadata.build_event_metadata_xml({
+            'gid': EVENT_MBIDS[0],
+            'name': 'live at the place 1',
+            'comment': '',
+            'cancelled': False,
+            'begin_date_year': None,
+            'begin_date_month': None,
+            'begin_date_day': None,
+            'end_date_year': None,
+            'end_date_month': None,
+            'end_date_day': None,
+            'ended': False,
+            'time': None,
+            'type': None,
+            'type_id': None,
+            'artist_relations': None,
+            'place_relations': [{
+                'type': 'held at',
+                'type_id': 'e2c6f697-07dc-38b1-be0b-83d740165532',
+                'direction': 'forward',
+                'begin_date_year': None,
+                'begin_date_month': None,
+                'begin_date_day': None,
+                'end_date_year': None,
+                'end_date_month': None,
+                'end_date_day': None,
+                'ended': False,
+                'target_gid': '4352063b-a833-421b-a420-e7fb295dece0',
+                'target_name': 'the place',
+            }],
+        })
+        namespaces = {'mmd': mb_metadata.MMD_NAMESPACE}
+        relation = ET.fromstring(xml).find('.//mmd:relation', namespaces)
+        self.assertIsNone(relation.find('mmd:attribute-list', namespaces))
+        self.assertEqual(
+            [child.tag for child in relation.find('mmd:place', namespaces)],
+            ['{%s}name' % mb_metadata.MMD_NAMESPACE],
+        )
@@ -0,0 +1,173 @@
+import json
+import unittest
+from textwrap import dedent
+import indexer
+from pg_conn_wrapper import PgConnWrapper
+from supervisor import WorkerSupervisor
+from . import (
+    MockClientSession,
+    TestArtArchive,
+    tests_config,
+)
+
+
+WORKERS = 3
+CONCURRENCY = 8
+GIDS = ['A', 'B', 'C', 'D', 'E', 'F']
+EVENT_COUNT = 120
+
+
+class TestEntitySerialization(TestArtArchive):
+    """
+    Stress test for per-entity serialization: many processes, each with
+    many threads, drain a queue of events that keep touching the same
+    few buckets. A trigger logs every state change of every event, from
+    which we check that no two events for the same bucket ever ran at
+    the same time.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.pg_conn.execute_and_commit(dedent('''
+            TRUNCATE artwork_indexer.event_queue CASCADE;
+            SELECT setval('artwork_indexer.event_queue_id_seq', 1, FALSE);
+
+            CREATE TABLE artwork_indexer.test_event_state_log (
+                event       BIGINT NOT NULL,
+                state       artwork_indexer.event_state NOT NULL,
+                logged      TIMESTAMP WITH TIME ZONE NOT NULL
+                            DEFAULT clock_timestamp()
+            );
+
+            CREATE FUNCTION artwork_indexer.a_upd_event_queue_log()
+            RETURNS TRIGGER AS $$
+            BEGIN
+                INSERT INTO artwork_indexer.test_event_state_log
+                            (event, state)
+                     VALUES (NEW.id, NEW.state);
+                RETURN NULL;
+            END;
+            $$ LANGUAGE 'plpgsql';
+
+            CREATE TRIGGER a_upd_event_queue_log
+                AFTER UPDATE OF state ON artwork_indexer.event_queue
+                FOR EACH ROW
+                WHEN (OLD.state IS DISTINCT FROM NEW.state)
+                EXECUTE FUNCTION artwork_indexer.a_upd_event_queue_log();
+
+            -- Completing an event moves it to another partition, which
+            -- runs INSERT triggers rather than UPDATE ones.
+            CREATE TRIGGER a_ins_event_queue_log
+                AFTER INSERT ON artwork_indexer.event_queue
+                FOR EACH ROW
+                WHEN (NEW.state = 'completed')
+                EXECUTE FUNCTION artwork_indexer.a_upd_event_queue_log();
+        '''))
+
+    def tearDown(self):
+        self.pg_conn.execute_and_commit(dedent('''
+            DROP TRIGGER a_upd_event_queue_log
+                ON artwork_indexer.event_queue;
+            DROP TRIGGER a_ins_event_queue_log
+                ON artwork_indexer.event_queue;
+            DROP FUNCTION artwork_indexer.a_upd_event_queue_log();
+            DROP TABLE artwork_indexer.test_event_state_log;
+        '''))
+        super().tearDown()
+
+    def test_no_overlap(self):
+        events = []
+        for index in range(EVENT_COUNT):
+            gid = GIDS[index % len(GIDS)]
+            if index % 5 == 0:
+                # Like `copy_image`, touching two buckets at once.
+                message = {
+                    'old_gid': gid,
+                    'new_gid': GIDS[(index + 1) % len(GIDS)],
+                }
+            else:
+                message = {'gid': gid}
+            message['sleep'] = 0.02
+            message['n'] = index
+            events.append(json.dumps(message))
+
+        self.pg_conn.execute_and_commit(
+            dedent('''
+                INSERT INTO artwork_indexer.event_queue
+                            (entity_type, action, message)
+                     SELECT 'release', 'noop', message::jsonb
+                       FROM unnest(%(messages)s::text[]) AS message
+            '''),
+            {'messages': events},
+        )
+        # Nothing may be connected while forking.
+        self.pg_conn.close()
+
+        def run_worker(event_counter):
+            indexer.indexer(tests_config, PgConnWrapper(tests_config), 1,
+                            max_idle_loops=1,
+                            http_client_cls=MockClientSession,
+                            claim_batch_size=4,
+                            concurrency=CONCURRENCY,
+                            event_counter=event_counter)
+
+        supervisor = WorkerSupervisor(WORKERS, run_worker)
+        supervisor.run()
+
+        self.assertEqual(supervisor.restart_counts, [0] * WORKERS)
+        states = self.pg_conn.execute(dedent('''
+            SELECT state, count(*) AS count
+              FROM artwork_indexer.event_queue
+             GROUP BY state
+        ''')).fetchall()
+        self.assertEqual(states, [{'state': 'completed',
+                                   'count': EVENT_COUNT}])
+
+        spans_query = dedent('''
+            WITH spans AS (
+                SELECT event,
+                       min(logged) FILTER (WHERE state = 'running')
+                           AS started,
+                       max(logged) FILTER (WHERE state != 'running')
+                           AS finished
+                  FROM artwork_indexer.test_event_state_log
+                 GROUP BY event
+            ), bucket_spans AS (
+                SELECT spans.*, bucket
+                  FROM spans
+                  JOIN artwork_indexer.event_queue eq ON eq.id = spans.event
+                 CROSS JOIN LATERAL unnest(ARRAY[
+                       eq.message->>'gid',
+                       eq.message->>'old_gid',
+                       eq.message->>'new_gid'
+                   ]) AS bucket
+                 WHERE bucket IS NOT NULL
+            )
+        ''')
+
+        overlaps = self.pg_conn.execute(spans_query + dedent('''
+            SELECT a.event, b.event AS other_event, a.bucket
+              FROM bucket_spans a
+              JOIN bucket_spans b
+                ON b.bucket = a.bucket
+               AND b.event > a.event
+               AND b.started < a.finished
+               AND a.started < b.finished
+        ''')).fetchall()
+        self.assertEqual(overlaps, [])
+
+        # Events for different buckets did run in parallel.
+        max_parallel = self.pg_conn.execute(spans_query + dedent('''
+            SELECT max((
+                SELECT count(DISTINCT b.event)
+                  FROM bucket_spans b
+                 WHERE b.started <= a.started
+                   AND a.started < b.finished
+            )) AS count
+              FROM bucket_spans a
+        ''')).fetchone()['count']
+        self.assertGreater(max_parallel, 1)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -5,15 +5,18 @@ cd "$(dirname "${BASH_SOURCE[0]}")/../"
 read -r -d '' SQL <<'EOF'
 SET client_min_messages TO WARNING;
 INSERT INTO artwork_indexer.event_queue (id, entity_type, action, message, created)
-     VALUES (1, 'release', 'noop', '{"sleep": 3}', NOW() - interval '1 minute');
+     VALUES (1, 'release', 'noop', '{}', NOW() - interval '1 minute');
 EOF
 
 psql -U musicbrainz -d musicbrainz_test_artwork_indexer -c "$SQL" -q > /dev/null
 
+# Keep the event in progress while the signals below are delivered.
 run_indexer() {
+    ARTWORK_INDEXER_FAULTS='before_handler=sleep:3' \
     exec poetry run python indexer.py \
         --max-wait=1 \
-        --config=config.tests.ini
+        --config=config.tests.ini \
+        "$@"
 }
 
 run_indexer &
@@ -57,3 +60,43 @@ if [[ "$event_state" != 'completed' ]]; then
     echo 'ERROR: Event was not completed after SIGINT'
     exit 1
 fi
+
+# With worker threads, every in-flight event should be finished as well.
+read -r -d '' SQL <<'EOF'
+UPDATE artwork_indexer.event_queue
+   SET state = 'queued', attempts = 0
+ WHERE id = 1;
+INSERT INTO artwork_indexer.event_queue (id, entity_type, action, message, created)
+     VALUES (2, 'release', 'noop', '{"id": 2}', NOW() - interval '1 minute');
+EOF
+
+psql -U musicbrainz -d musicbrainz_test_artwork_indexer -c "$SQL"
+
+run_indexer --concurrency=2 &
+run3_pid=$!
+
+sleep 1.5
+
+kill -TERM "$run3_pid"
+wait "$run3_pid"
+
+read -r -d '' STATE_SQL <<'EOF'
+SELECT count(*)
+  FROM artwork_indexer.event_queue
+ WHERE id IN (1, 2)
+   AND state = 'completed';
+EOF
+
+completed_count="$(psql -U musicbrainz -d musicbrainz_test_artwork_indexer -c "$STATE_SQL" -tAq)"
+if [[ "$completed_count" != '2' ]]; then
+    echo 'ERROR: In-flight events were not completed after SIGTERM with --concurrency=2'
+    exit 1
+fi
+
+read -r -d '' SQL <<'EOF'
+SET client_min_messages TO WARNING;
+TRUNCATE artwork_indexer.event_queue CASCADE;
+SELECT setval('artwork_indexer.event_queue_id_seq', 1, FALSE);
+EOF
+
+psql -U musicbrainz -d musicbrainz_test_artwork_indexer -c "$SQL" -q > /dev/null
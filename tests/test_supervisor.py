@@ -0,0 +1,83 @@
+import multiprocessing
+import os
+import signal
+import threading
+import time
+import unittest
+from supervisor import WorkerSupervisor
+
+
+class TestWorkerSupervisor(unittest.TestCase):
+
+    def test_restart(self):
+        runs = multiprocessing.Value('i', 0)
+
+        def run_worker(event_counter):
+            with runs.get_lock():
+                runs.value += 1
+                first_run = runs.value <= 2
+            if first_run:
+                # Crash, as if killed by the OOM killer.
+                os.kill(os.getpid(), signal.SIGKILL)
+            event_counter.value += 5
+
+        supervisor = WorkerSupervisor(2, run_worker,
+                                      restart_backoff_min=0.1)
+        supervisor.run()
+
+        # Each worker crashed once, and then exited cleanly, which
+        # doesn't cause another restart.
+        self.assertEqual(runs.value, 4)
+        self.assertEqual(supervisor.restart_counts, [1, 1])
+        self.assertEqual(supervisor.restart_backoffs, [0.2, 0.2])
+        self.assertEqual(supervisor.workers, {})
+        self.assertEqual(
+            [counter.value for counter in supervisor.event_counters],
+            [5, 5],
+        )
+
+    def test_signal_forwarding(self):
+        hups = multiprocessing.Array('i', 2)
+        terms = multiprocessing.Array('i', 2)
+
+        def run_worker(event_counter):
+            index = supervisor.event_counters.index(event_counter)
+            shutdown = False
+
+            def on_hup(signum, frame):
+                hups[index] += 1
+
+            def on_term(signum, frame):
+                nonlocal shutdown
+                terms[index] += 1
+                shutdown = True
+
+            signal.signal(signal.SIGHUP, on_hup)
+            signal.signal(signal.SIGTERM, on_term)
+            while not shutdown:
+                time.sleep(0.05)
+
+        def send_signals():
+            time.sleep(0.5)
+            os.kill(os.getpid(), signal.SIGHUP)
+            time.sleep(0.5)
+            os.kill(os.getpid(), signal.SIGTERM)
+
+        original_sigterm_handler = signal.getsignal(signal.SIGTERM)
+
+        supervisor = WorkerSupervisor(2, run_worker)
+        signal_thread = threading.Thread(target=send_signals)
+        signal_thread.start()
+        supervisor.run()
+        signal_thread.join()
+
+        self.assertEqual(list(hups), [1, 1])
+        self.assertEqual(list(terms), [1, 1])
+        self.assertEqual(supervisor.restart_counts, [0, 0])
+        # The supervisor's own handlers are uninstalled afterwards.
+        self.assertEqual(signal.getsignal(signal.SIGTERM),
+                         original_sigterm_handler)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,56 @@
+#!/usr/bin/env bash
+
+cd "$(dirname "${BASH_SOURCE[0]}")/../"
+
+read -r -d '' SQL <<'EOF'
+SET client_min_messages TO WARNING;
+INSERT INTO artwork_indexer.event_queue (entity_type, action, message)
+     SELECT 'release', 'noop', jsonb_build_object('sleep', 0.5, 'run', i)
+       FROM generate_series(1, 6) AS i;
+EOF
+
+psql -U musicbrainz -d musicbrainz_test_artwork_indexer -c "$SQL" -q > /dev/null
+
+# Each worker exits once idle, after which the supervisor does too.
+poetry run python indexer.py \
+    --workers=3 \
+    --max-wait=1 \
+    --max-idle-loops=1 \
+    --config=config.tests.ini > /tmp/a26a73c_workers_output 2>&1
+status=$?
+
+# Each worker deregistered itself on the way out.
+worker_count="$(psql -U musicbrainz -d musicbrainz_test_artwork_indexer -c 'SELECT count(*) FROM artwork_indexer.worker' -tAq)"
+
+completion_count="$(grep -Fo 'completed succesfully' /tmp/a26a73c_workers_output | wc -l)"
+throughput_line="$(grep -F 'Handled 6 event(s)' /tmp/a26a73c_workers_output)"
+
+rm /tmp/a26a73c*
+
+read -r -d '' SQL <<'EOF'
+SET client_min_messages TO WARNING;
+TRUNCATE artwork_indexer.event_queue CASCADE;
+SELECT setval('artwork_indexer.event_queue_id_seq', 1, FALSE);
+EOF
+
+psql -U musicbrainz -d musicbrainz_test_artwork_indexer -c "$SQL" -q > /dev/null
+
+if [[ $status -ne 0 ]]; then
+    echo "ERROR: Supervisor exited with status $status"
+    exit 1
+fi
+
+if [[ $completion_count -ne 6 ]]; then
+    echo "ERROR: Expected 6 completed events, got $completion_count"
+    exit 1
+fi
+
+if [[ $worker_count -ne 0 ]]; then
+    echo "ERROR: Expected no registered workers, got $worker_count"
+    exit 1
+fi
+
+if [[ -z $throughput_line ]]; then
+    echo 'ERROR: Supervisor did not log the combined throughput'
+    exit 1
+fi